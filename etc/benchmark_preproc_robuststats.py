@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the batched robust statistics used in desispec.preproc
+(desispec.robuststats) against the previous per-row and per-patch python loops,
+on a 4k x 4k image.
+
+Usage: python benchmark_preproc_robuststats.py [--size 4096] [--nover 64]
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from desispec.preproc import _overscan, _overscan_per_row, _global_background
+from desispec.robuststats import patch_medians
+
+
+def loop_overscan(pix, nsigma=5, niter=3):
+    """previous implementation of desispec.preproc._overscan"""
+    overscan = np.median(pix)
+    absdiff = np.abs(pix - overscan)
+    readnoise = 1.4826*np.median(absdiff)
+    for i in range(niter):
+        absdiff = np.abs(pix - overscan)
+        good = absdiff < nsigma*readnoise
+        if np.sum(good)<5 :
+            overscan = np.median(pix)
+            absdiff = np.abs(pix - overscan)
+            readnoise = 1.4826*np.median(absdiff)
+            return overscan,readnoise
+        overscan = np.mean(pix[good])
+        readnoise = np.std(pix[good])
+    from desispec.preproc import _clipped_std_bias
+    readnoise /= _clipped_std_bias(nsigma)
+    return overscan, readnoise
+
+def loop_patch_medians(image, bins0, bins1):
+    """previous loop over patches of desispec.preproc._global_background"""
+    bkg_grid=np.zeros((bins0.size-1,bins1.size-1))
+    for j in range(bins1.size-1) :
+        for i in range(bins0.size-1) :
+            bkg_grid[i,j]=np.median(image[bins0[i]:bins0[i+1],bins1[j]:bins1[j+1]])
+    return bkg_grid
+
+def timeit(func, *args):
+    t0 = time.time()
+    result = func(*args)
+    return time.time()-t0, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=4096, help='image size in pixels')
+    parser.add_argument('--nover', type=int, default=64, help='number of overscan columns')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    overscan = (1000 + rng.normal(0, 3, (args.size, args.nover))).astype(np.int32)
+    overscan[rng.uniform(size=overscan.shape)<0.001] += 5000  # hot pixels
+    image = rng.normal(0, 3, (args.size, args.size)) \
+        + 10*np.sin(np.arange(args.size)/500.)[:,None]
+
+    print('Overscan per row, {} x {} pixels'.format(*overscan.shape))
+    t_loop, (o_loop, r_loop) = timeit(lambda pix : np.array([loop_overscan(row) for row in pix]).T, overscan)
+    t_batch, (o_batch, r_batch) = timeit(_overscan_per_row, overscan)
+    print('  loop    {:8.3f} sec'.format(t_loop))
+    print('  batched {:8.3f} sec'.format(t_batch))
+    print('  max |delta overscan| = {:.2g}, max |delta readnoise| = {:.2g}'.format(
+        np.max(np.abs(o_loop-o_batch)), np.max(np.abs(r_loop-r_batch))))
+
+    print('Overscan of whole region')
+    t_loop, (o_loop, r_loop) = timeit(loop_overscan, overscan)
+    t_batch, (o_batch, r_batch) = timeit(_overscan, overscan)
+    print('  previous {:8.3f} sec'.format(t_loop))
+    print('  batched  {:8.3f} sec'.format(t_batch))
+    print('  |delta overscan| = {:.2g}, |delta readnoise| = {:.2g}'.format(
+        np.abs(o_loop-o_batch), np.abs(r_loop-r_batch)))
+
+    patch_width = 200
+    bins0 = np.linspace(0, image.shape[0], int(image.shape[0]/patch_width)).astype(int)
+    bins1 = np.linspace(0, image.shape[1], int(image.shape[1]/patch_width)).astype(int)
+    print('Median of {} x {} patches of {} x {} image'.format(
+        bins0.size-1, bins1.size-1, *image.shape))
+    t_loop, m_loop = timeit(loop_patch_medians, image, bins0, bins1)
+    t_batch, m_batch = timeit(patch_medians, image, bins0, bins1)
+    print('  loop    {:8.3f} sec'.format(t_loop))
+    print('  batched {:8.3f} sec'.format(t_batch))
+    print('  max |delta median| = {:.2g}'.format(np.max(np.abs(m_loop-m_batch))))
+
+    t_bkg, bkg = timeit(_global_background, image, patch_width)
+    print('Global background with spline fit {:8.3f} sec'.format(t_bkg))
+
+if __name__ == '__main__':
+    main()
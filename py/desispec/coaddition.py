@@ -20,23 +20,132 @@ import multiprocessing
 
 from desiutil.log import get_logger
 
-from desispec.interpolation import resample_flux
+from desispec.interpolation import resample_flux_batch, get_resampling_matrix
 from desispec.spectra import Spectra
 from desispec.resolution import Resolution
 
+def _targetid_segments(targetid) :
+    """
+    Sort entries by TARGETID once, for group-by reductions over all targets
+
+    Args:
+       targetid: 1D array of TARGETID, one per spectrum
+
+    Returns (targets, order, starts, group) where targets are the sorted unique
+    TARGETID, order is the (stable) permutation that sorts the input by TARGETID,
+    starts are the indices in the sorted entries of the first entry of each target
+    (to be used with np.ufunc.reduceat), and group is the target index of each
+    sorted entry.
+    """
+    targetid = np.asarray(targetid)
+    order = np.argsort(targetid, kind='stable')
+    sorted_targetid = targetid[order]
+    first = np.ones(sorted_targetid.size, dtype=bool)
+    first[1:] = (sorted_targetid[1:] != sorted_targetid[:-1])
+    starts = np.where(first)[0]
+    group = np.cumsum(first) - 1
+    return sorted_targetid[starts], order, starts, group
+
+def _interpolate_bad_pixels(wave, values, good) :
+    """
+    Linear interpolation of each row of values over the pixels where good is False,
+    using the good pixels of the same row, like np.interp (with constant extrapolation
+    on the edges). Rows without any good pixel are returned unchanged.
+
+    Args:
+       wave: 1D array of wavelength, size nwave
+       values: 2D array (nspec,nwave)
+       good: 2D boolean array (nspec,nwave)
+
+    Returns a new 2D array (nspec,nwave)
+    """
+    nwave = values.shape[1]
+    index = np.arange(nwave)
+    # index of previous and next good pixel for each pixel
+    previous = np.maximum.accumulate(np.where(good, index, -1), axis=1)
+    following = np.minimum.accumulate(np.where(good, index, nwave)[:,::-1], axis=1)[:,::-1]
+
+    result = values.astype(float)
+    rows, cols = np.where((~good) & np.any(good, axis=1)[:,None])
+    previous = previous[rows,cols]
+    following = following[rows,cols]
+    # constant extrapolation on the edges
+    no_previous = (previous < 0)
+    previous[no_previous] = following[no_previous]
+    no_following = (following >= nwave)
+    following[no_following] = previous[no_following]
+
+    x0 = wave[previous]
+    dx = wave[following] - x0
+    y0 = values[rows,previous]
+    dy = values[rows,following] - y0
+    frac = np.zeros(rows.size)
+    ok = (dx != 0)
+    frac[ok] = (wave[cols[ok]] - x0[ok]) / dx[ok]
+    result[rows,cols] = y0 + frac*dy
+    return result
+
+def _cosmics_rejection(wave, flux, ivar, good, starts, group, nsig) :
+    """
+    Find outliers in the flux gradient among the spectra of each target
+
+    Args:
+       wave: 1D array of wavelength, size nwave
+       flux: 2D array (nspec,nwave), sorted by target
+       ivar: 2D array (nspec,nwave), sorted by target
+       good: 2D boolean array (nspec,nwave), True for valid (unmasked, ivar>0) pixels
+       starts: indices of the first entry of each target, see _targetid_segments
+       group: target index of each entry, see _targetid_segments
+       nsig: nsigma clipping threshold
+
+    Returns a 2D boolean array (nspec,nwave), True for the pixels to mask
+    """
+    log = get_logger()
+
+    # interpolate over bad measurements
+    # to be able to compute gradient next
+    # to a bad pixel and identify oulier
+    # many cosmics residuals are on edge
+    # of cosmic ray trace, and so can be
+    # next to a masked flux bin
+    gflux = _interpolate_bad_pixels(wave, flux, good)
+    givar = _interpolate_bad_pixels(wave, ivar, good)
+
+    with np.errstate(divide='ignore', invalid='ignore') :
+        gradvar = 1./givar
+        gradvar[:,1:] = gradvar[:,1:]+gradvar[:,:-1]
+        grad = np.zeros(gflux.shape)
+        grad[:,1:] = gflux[:,1:]-gflux[:,:-1]
+        gradivar = 1./gradvar
+
+        nspec = np.diff(np.append(starts, group.size))
+        meangrad = np.add.reduceat(gradivar*grad, starts, axis=0) / np.add.reduceat(np.sum(gradivar, axis=1), starts)[:,None]
+        deltagrad = grad-meangrad[group]
+        chi2terms = gradivar*deltagrad**2
+        chi2 = np.add.reduceat(chi2terms, starts, axis=0)/(nspec-1)[:,None]
+
+    # mask the largest outlier of each target at each wavelength,
+    # the first one in case of equality (as np.argmax)
+    outlier = (chi2terms == np.maximum.reduceat(chi2terms, starts, axis=0)[group])
+    outlier &= (chi2 > nsig**2)[group]
+    rank = np.cumsum(outlier, axis=0)
+    offset = np.zeros(chi2.shape, dtype=rank.dtype)
+    offset[1:] = rank[starts[1:]-1]
+    reject = outlier & (rank - offset[group] == 1)
+
+    log.debug("masking {} pixels".format(np.count_nonzero(reject)))
+    return reject
+
 def coadd_fibermap(fibermap) :
 
     log = get_logger()
     log.debug("'coadding' fibermap")
-    
-    targets = np.unique(fibermap["TARGETID"])
+
+    targets, order, starts, group = _targetid_segments(fibermap["TARGETID"])
     ntarget = targets.size
-    
+    nspec = np.diff(np.append(starts, order.size))
 
-    jj=np.zeros(ntarget,dtype=int)
-    for i,tid in enumerate(targets) :
-        jj[i]=np.where(fibermap["TARGETID"]==tid)[0][0]
-    tfmap=fibermap[jj]
+    tfmap=fibermap[order[starts]]
     # smarter values for some columns
     for k in ['DELTA_X','DELTA_Y'] :
         if k in fibermap.colnames :
@@ -52,25 +161,27 @@ def coadd_fibermap(fibermap) :
             xx = Column(np.arange(ntarget))
             tfmap.add_column(xx,name='NUM_'+k)
 
-    for i,tid in enumerate(targets) :
-        jj = fibermap["TARGETID"]==tid
-        for k in ['DELTA_X','DELTA_Y'] :
-            if k in fibermap.colnames :
-                vals=fibermap[k][jj]
-                tfmap['MEAN_'+k][i] = np.mean(vals)
-                tfmap['RMS_'+k][i] = np.sqrt(np.mean(vals**2)) # inc. mean offset, not same as std
-        for k in ['NIGHT','EXPID','TILEID','SPECTROID','FIBER'] :
-            if k in fibermap.colnames :
-                vals=fibermap[k][jj]
-                tfmap['FIRST_'+k][i] = np.min(vals)
-                tfmap['LAST_'+k][i] = np.max(vals)
-                tfmap['NUM_'+k][i] = np.unique(vals).size
-        for k in ['FIBERASSIGN_X', 'FIBERASSIGN_Y','FIBER_RA', 'FIBER_DEC'] :
-            if k in fibermap.colnames :
-                tfmap[k][i]=np.mean(fibermap[k][jj])
-        for k in ['FIBER_RA_IVAR', 'FIBER_DEC_IVAR','DELTA_X_IVAR', 'DELTA_Y_IVAR'] :
-            if k in fibermap.colnames :
-                tfmap[k][i]=np.sum(fibermap[k][jj])
+    for k in ['DELTA_X','DELTA_Y'] :
+        if k in fibermap.colnames :
+            vals=np.asarray(fibermap[k])[order]
+            tfmap['MEAN_'+k][:] = np.add.reduceat(vals, starts)/nspec
+            tfmap['RMS_'+k][:] = np.sqrt(np.add.reduceat(vals**2, starts)/nspec) # inc. mean offset, not same as std
+    for k in ['NIGHT','EXPID','TILEID','SPECTROID','FIBER'] :
+        if k in fibermap.colnames :
+            vals=np.asarray(fibermap[k])[order]
+            tfmap['FIRST_'+k][:] = np.minimum.reduceat(vals, starts)
+            tfmap['LAST_'+k][:] = np.maximum.reduceat(vals, starts)
+            # count distinct values within each target
+            ii = np.lexsort((vals, group))
+            new = np.ones(vals.size, dtype=int)
+            new[1:] = (vals[ii][1:] != vals[ii][:-1]) | (group[ii][1:] != group[ii][:-1])
+            tfmap['NUM_'+k][:] = np.add.reduceat(new, starts)
+    for k in ['FIBERASSIGN_X', 'FIBERASSIGN_Y','FIBER_RA', 'FIBER_DEC'] :
+        if k in fibermap.colnames :
+            tfmap[k][:]=np.add.reduceat(np.asarray(fibermap[k])[order], starts)/nspec
+    for k in ['FIBER_RA_IVAR', 'FIBER_DEC_IVAR','DELTA_X_IVAR', 'DELTA_Y_IVAR'] :
+        if k in fibermap.colnames :
+            tfmap[k][:]=np.add.reduceat(np.asarray(fibermap[k])[order], starts)
 
     return tfmap
 
@@ -85,90 +196,48 @@ def coadd(spectra, cosmics_nsig=0.) :
        cosmics_nsig: float, nsigma clipping threshold for cosmics rays
     """
     log = get_logger()
-    targets = np.unique(spectra.fibermap["TARGETID"])
+    targets, order, starts, group = _targetid_segments(spectra.fibermap["TARGETID"])
     ntarget=targets.size
     log.debug("number of targets= {}".format(ntarget))
     for b in spectra._bands :
         log.debug("coadding band '{}'".format(b))
-        nwave=spectra.wave[b].size
-        tflux=np.zeros((ntarget,nwave),dtype=spectra.flux[b].dtype)
-        tivar=np.zeros((ntarget,nwave),dtype=spectra.ivar[b].dtype)
+
+        # all reductions below are done on the spectra sorted by target
+        flux = spectra.flux[b][order]
+        ivar_unmasked = spectra.ivar[b][order]
         if spectra.mask is not None :
-            tmask=np.zeros((ntarget,nwave),dtype=spectra.mask[b].dtype)
+            mask = spectra.mask[b][order]
+            ivar = ivar_unmasked*(mask==0)
         else :
-            tmask=None
-        trdata=np.zeros((ntarget,spectra.resolution_data[b].shape[1],nwave),dtype=spectra.resolution_data[b].dtype)
-        
-        for i,tid in enumerate(targets) :
-            jj=np.where(spectra.fibermap["TARGETID"]==tid)[0]
-
-
-            if cosmics_nsig is not None and cosmics_nsig > 0 :
-                # interpolate over bad measurements
-                # to be able to compute gradient next
-                # to a bad pixel and identify oulier
-                # many cosmics residuals are on edge
-                # of cosmic ray trace, and so can be
-                # next to a masked flux bin
-                grad=[]
-                gradvar=[]
-                for j in jj :
-                    if spectra.mask is not None :
-                        ttivar = spectra.ivar[b][j]*(spectra.mask[b][j]==0)
-                    else :
-                        ttivar = spectra.ivar[b][j]
-                    good = (ttivar>0)
-                    bad  = (ttivar<=0)
-                    ttflux = spectra.flux[b][j]
-                    ttflux[bad] = np.interp(spectra.wave[b][bad],spectra.wave[b][good],ttflux[good])
-                    ttivar = spectra.ivar[b][j]
-                    ttivar[bad] = np.interp(spectra.wave[b][bad],spectra.wave[b][good],ttivar[good])
-                    ttvar = 1./ttivar
-                    ttflux[1:] = ttflux[1:]-ttflux[:-1]
-                    ttvar[1:]  = ttvar[1:]+ttvar[:-1]
-                    ttflux[0]  = 0
-                    grad.append(ttflux)
-                    gradvar.append(ttvar)
+            mask = None
+            ivar = ivar_unmasked.copy()
+
+        if cosmics_nsig is not None and cosmics_nsig > 0 :
+            reject = _cosmics_rejection(spectra.wave[b], flux, ivar_unmasked, (ivar>0), starts, group, cosmics_nsig)
+            ivar[reject] = 0.
+
+        tivar = np.add.reduceat(ivar, starts, axis=0).astype(spectra.ivar[b].dtype, copy=False)
+        tflux = np.add.reduceat(ivar*flux, starts, axis=0).astype(spectra.flux[b].dtype, copy=False)
+        tivar_unmasked = np.add.reduceat(ivar_unmasked, starts, axis=0)
+        bad=(tivar==0)
+        if np.any(bad) :
+            # if all masked, keep original ivar
+            tivar[bad] = tivar_unmasked[bad]
+            tflux[bad] = np.add.reduceat(ivar_unmasked*flux, starts, axis=0)[bad]
+        ok=(tivar>0)
+        tflux[ok] /= tivar[ok]
+
+        rdata = spectra.resolution_data[b][order]
+        rdata *= ivar_unmasked[:,None,:] # not sure applying mask is wise here
+        trdata = np.add.reduceat(rdata, starts, axis=0).astype(spectra.resolution_data[b].dtype, copy=False)
+        del rdata
+        ok=(tivar_unmasked>0)
+        trdata /= np.where(ok, tivar_unmasked, 1.)[:,None,:]
 
-            tivar_unmasked= np.sum(spectra.ivar[b][jj],axis=0)
-            if spectra.mask is not None :
-                ivarjj=spectra.ivar[b][jj]*(spectra.mask[b][jj]==0)
-            else :
-                ivarjj=spectra.ivar[b][jj]
-            if cosmics_nsig is not None and cosmics_nsig > 0 and len(grad)>0  :
-                grad=np.array(grad)
-                gradivar=1/np.array(gradvar)
-                nspec=grad.shape[0]
-                meangrad=np.sum(gradivar*grad,axis=0)/np.sum(gradivar)
-                deltagrad=grad-meangrad
-                chi2=np.sum(gradivar*deltagrad**2,axis=0)/(nspec-1)
-                
-                for l in np.where(chi2>cosmics_nsig**2)[0]  :
-                    k=np.argmax(gradivar[:,l]*deltagrad[:,l]**2)
-                    #k=np.argmax(flux[:,j])
-                    log.debug("masking spec {} wave={}".format(k,spectra.wave[b][l]))
-                    ivarjj[k][l]=0.
-            
-            tivar[i]=np.sum(ivarjj,axis=0)
-            tflux[i]=np.sum(ivarjj*spectra.flux[b][jj],axis=0)
-            for r in range(spectra.resolution_data[b].shape[1]) :
-                trdata[i,r]=np.sum((spectra.ivar[b][jj]*spectra.resolution_data[b][jj,r]),axis=0) # not sure applying mask is wise here
-            bad=(tivar[i]==0)
-            if np.sum(bad)>0 :
-                tivar[i][bad] = np.sum(spectra.ivar[b][jj][:,bad],axis=0) # if all masked, keep original ivar
-                tflux[i][bad] = np.sum(spectra.ivar[b][jj][:,bad]*spectra.flux[b][jj][:,bad],axis=0)
-            ok=(tivar[i]>0)
-            if np.sum(ok)>0 :
-                tflux[i][ok] /= tivar[i][ok]
-            ok=(tivar_unmasked>0)
-            if np.sum(ok)>0 :
-                trdata[i][:,ok] /= tivar_unmasked[ok]
-            if spectra.mask is not None :
-                tmask[i]      = np.bitwise_and.reduce(spectra.mask[b][jj],axis=0)
         spectra.flux[b] = tflux
         spectra.ivar[b] = tivar
-        if spectra.mask is not None :
-            spectra.mask[b] = tmask
+        if mask is not None :
+            spectra.mask[b] = np.bitwise_and.reduceat(mask, starts, axis=0)
         spectra.resolution_data[b] = trdata
 
     spectra.fibermap=coadd_fibermap(spectra.fibermap)
@@ -331,43 +400,6 @@ def coadd_cameras(spectra,cosmics_nsig=0.) :
     
     return res
 
-def get_resampling_matrix(global_grid,local_grid,sparse=False):
-    """Build the rectangular matrix that linearly resamples from the global grid to a local grid.
-
-    The local grid range must be contained within the global grid range.
-
-    Args:
-        global_grid(numpy.ndarray): Sorted array of n global grid wavelengths.
-        local_grid(numpy.ndarray): Sorted array of m local grid wavelengths.
-
-    Returns:
-        numpy.ndarray: Array of (m,n) matrix elements that perform the linear resampling.
-    """
-    assert np.all(np.diff(global_grid) > 0),'Global grid is not strictly increasing.'
-    assert np.all(np.diff(local_grid) > 0),'Local grid is not strictly increasing.'
-    # Locate each local wavelength in the global grid.
-    global_index = np.searchsorted(global_grid,local_grid)
-
-    assert local_grid[0] >= global_grid[0],'Local grid extends below global grid.'
-    assert local_grid[-1] <= global_grid[-1],'Local grid extends above global grid.'
-    
-    # Lookup the global-grid bracketing interval (xlo,xhi) for each local grid point.
-    # Note that this gives xlo = global_grid[-1] if local_grid[0] == global_grid[0]
-    # but this is fine since the coefficient of xlo will be zero.
-    global_xhi = global_grid[global_index]
-    global_xlo = global_grid[global_index-1]
-    # Create the rectangular interpolation matrix to return.
-    alpha = (local_grid - global_xlo)/(global_xhi - global_xlo)
-    local_index = np.arange(len(local_grid),dtype=int)
-    matrix = np.zeros((len(local_grid),len(global_grid)))
-    matrix[local_index,global_index] = alpha
-    matrix[local_index,global_index-1] = 1-alpha
-
-    # turn into a sparse matrix
-    return scipy.sparse.csc_matrix(matrix)
-
-
-    
 def decorrelate_divide_and_conquer(Cinv,Cinvf,wavebin,flux,ivar,rdata) :
     """Decorrelate an inverse covariance using the matrix square root.
 
@@ -649,13 +681,11 @@ def fast_resample_spectra(spectra, wave) :
             tivar=spectra.ivar[b]*(spectra.mask[b]==0)
         else :
             tivar=spectra.ivar[b]
-        for i in range(ntarget) :
-            ivar[i]  += resample_flux(wave,spectra.wave[b],tivar[i])
-            flux[i]  += resample_flux(wave,spectra.wave[b],tivar[i]*spectra.flux[b][i])
+        ivar += resample_flux_batch(wave,spectra.wave[b],tivar)
+        flux += resample_flux_batch(wave,spectra.wave[b],tivar*spectra.flux[b])
         bands += b
-    for i in range(ntarget) :
-        ok=(ivar[i]>0)
-        flux[i,ok]/=ivar[i,ok]    
+    ok=(ivar>0)
+    flux[ok]/=ivar[ok]
     if spectra.mask is not None :
         dmask={bands:mask,}
     else :
@@ -12,6 +12,7 @@ import math
 import copy
 import scipy.ndimage
 import time
+import os
 
 import numba
 
@@ -100,28 +101,101 @@ def reject_cosmic_rays_1d(frame,nsig=3,psferr=0.05) :
                         log.info("fiber {} wave={} S/N={} add cosmic mask of {} pix".format(fiber,int(frame.wave[i]),int(snr),nmasked))
     log.info("done")
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True,parallel=True)
 def dilate_numba(input_boolean_array,include_input=False) :
+    """Dilation of a boolean image by one pixel (3x3 box), ignoring the input
+    pixels on the image edges. Output rows are filled in parallel threads,
+    each from the 3 input rows around it."""
+    n0 = input_boolean_array.shape[0]
+    n1 = input_boolean_array.shape[1]
     output_boolean_array = np.zeros(input_boolean_array.shape, input_boolean_array.dtype)
-    if include_input :
-        output_boolean_array |= input_boolean_array
-    for i0 in range(1,input_boolean_array.shape[0]-1) :
-        for i1 in range(1,input_boolean_array.shape[1]-1) :
-            if input_boolean_array[i0,i1] :
-                output_boolean_array[i0-1,i1]=True
-                output_boolean_array[i0+1,i1]=True
-                output_boolean_array[i0,i1-1]=True
-                output_boolean_array[i0,i1+1]=True
-                output_boolean_array[i0-1,i1-1]=True
-                output_boolean_array[i0+1,i1+1]=True
-                output_boolean_array[i0-1,i1+1]=True
-                output_boolean_array[i0+1,i1-1]=True
+    for i0 in numba.prange(n0) :
+        # only the input pixels in [1,n-2] are dilated
+        for j0 in range(max(i0-1,1),min(i0+1,n0-2)+1) :
+            for j1 in range(1,n1-1) :
+                if input_boolean_array[j0,j1] :
+                    output_boolean_array[i0,j1-1]=True
+                    output_boolean_array[i0,j1+1]=True
+                    if j0 != i0 :
+                        output_boolean_array[i0,j1]=True
+        if include_input :
+            for i1 in range(n1) :
+                if input_boolean_array[i0,i1] :
+                    output_boolean_array[i0,i1]=True
     return output_boolean_array
 
-
+@numba.jit(nopython=True)
+def _psf_axes(naxis) :
+    """offsets of the neighboring pixels for the horizontal, vertical and 2 diagonal axes"""
+    dd = np.zeros((naxis,2),dtype=np.int64)
+    for a in range(naxis) :
+        if a==0 :
+            dd[a,0]=0
+            dd[a,1]=1
+        elif a==1 :
+            dd[a,0]=1
+            dd[a,1]=0
+        elif a==2 :
+            dd[a,0]=1
+            dd[a,1]=1
+        else :
+            dd[a,0]=1
+            dd[a,1]=-1
+    return dd
 
 @numba.jit(nopython=True)
-def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge) :
+def _reject_cosmic_ray_pixel_numba(pix,ivar,i0,i1,dd,psf_gradients,nsig,cfudge,c2fudge) :
+    """Test of a single pixel (i0,i1) for _reject_cosmic_rays_ala_sdss_single_numba,
+    the pixel must not be on the image edge. Returns True if rejected."""
+
+    central_pix_ivar=ivar[i0,i1]
+    if central_pix_ivar<=0 : return False
+
+    # first criterion, signal in pix must be significantly higher than neighbors
+    # in all directions
+    # JG comment : this does not look great for muon tracks that are perfectly aligned
+    # with one the axis. I change the algorithm to accept 2 out of 4 valid tests
+    first_criterion=0
+
+    # second criterion, rejected if at least for one axis
+    # the neighbors average value are not consistent with PSF given the central pixel value
+    # here the number of sigmas is the parameter cfudge
+    # c2fudge alters the PSF
+    second_criterion=False
+
+    central_pix_val=pix[i0,i1]
+    central_pix_err=1/np.sqrt(central_pix_ivar)
+
+    # loop on axis
+    for a in range(psf_gradients.size) :
+
+        # the offsets
+        d0=dd[a,0]
+        d1=dd[a,1]
+
+        neighboring_pix_val=0.
+        neighboring_pix_err=0.
+
+        # compute average value on both sides of central pix
+        for signe in [-1,1] :
+            tmp_ivar = ivar[i0+signe*d0,i1+signe*d1]
+            if tmp_ivar > 0 :
+                neighboring_pix_val  += pix[i0+signe*d0,i1+signe*d1]
+                neighboring_pix_err  += 1/tmp_ivar
+            else : # replace it by the central pixel value
+                neighboring_pix_val  += central_pix_val
+                neighboring_pix_err  += central_pix_err**2
+
+        neighboring_pix_val  *= 0.5 # average value
+        neighboring_pix_err   = np.sqrt(neighboring_pix_err)*0.5 # uncertainty on average value
+
+        first_criterion += (central_pix_val>(neighboring_pix_val+nsig*central_pix_err))
+        second_criterion |= (((central_pix_val-cfudge*central_pix_err)*c2fudge*psf_gradients[a]) > ( neighboring_pix_val+cfudge*neighboring_pix_err ))
+
+    return ( (first_criterion>=2) & second_criterion )
+
+@numba.jit(nopython=True,parallel=True)
+def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge,tile_size=256) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
 
@@ -130,10 +204,12 @@ def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,n
 
     Input is a pre-processed image : desispec.Image
     Ouput is a rejection mask of the same size as the image
-    
+
     This routine is much faster than _reject_cosmic_rays_ala_sdss_single
     (if you have numba installed, otherwise it is catastrophically slower)
-    
+    The image is divided in square tiles of tile_size pixels processed in
+    parallel threads, each tile reading a one pixel halo of its neighbors.
+
     Args:
        pix: input desispec.Image.pix (counts in pixels, 2D image)
        ivar: inverse variance of pix
@@ -142,82 +218,66 @@ def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,n
        nsig: number of sigma above background required
        cfudge: number of sigma inconsistent with PSF required
        c2fudge:  fudge factor applied to PSF
+       tile_size: size in pixels of the tiles
     """
-    
-    
+
     n0    = pix.shape[0]
     n1    = pix.shape[1]
-    
-    # definition of axis
-    naxis = psf_gradients.size
-    dd = np.zeros((naxis,2),dtype=type(n0))
-    for a in range(naxis) :
-        if a==0 : 
-            dd[a,0]=0
-            dd[a,1]=1
-        elif a==1 :
-            dd[a,0]=1
-            dd[a,1]=0
-        elif a==2 :
-            dd[a,0]=1
-            dd[a,1]=1
-        else :
-            dd[a,0]=1
-            dd[a,1]=-1
-        
-    rejection=np.zeros(pix.shape,dtype=type(True))
-    
-    for i0 in range(1,n0-1) :
-        for i1 in range(1,n1-1) :
-            
-            central_pix_ivar=ivar[i0,i1]
-            if (not selection[i0,i1]) or central_pix_ivar<=0 : continue
-            
-            # first criterion, signal in pix must be significantly higher than neighbors
-            # in all directions
-            # JG comment : this does not look great for muon tracks that are perfectly aligned
-            # with one the axis. I change the algorithm to accept 2 out of 4 valid tests
-            first_criterion=0 
-            
-            # second criterion, rejected if at least for one axis
-            # the neighbors average value are not consistent with PSF given the central pixel value
-            # here the number of sigmas is the parameter cfudge
-            # c2fudge alters the PSF
-            second_criterion=False
-            
-            central_pix_val=pix[i0,i1]
-            central_pix_err=1/np.sqrt(central_pix_ivar)
-                        
-            # loop on axis
-            for a in range(naxis) : 
-
-                # the offsets
-                d0=dd[a,0]
-                d1=dd[a,1]
-                
-                neighboring_pix_val=0.
-                neighboring_pix_err=0.
-                
-                # compute average value on both sides of central pix 
-                for signe in [-1,1] :
-                    tmp_ivar = ivar[i0+signe*d0,i1+signe*d1]
-                    if tmp_ivar > 0 :
-                        neighboring_pix_val  += pix[i0+signe*d0,i1+signe*d1]
-                        neighboring_pix_err  += 1/tmp_ivar
-                    else : # replace it by the central pixel value
-                        neighboring_pix_val  += central_pix_val
-                        neighboring_pix_err  += central_pix_err**2
-                
-                neighboring_pix_val  *= 0.5 # average value
-                neighboring_pix_err   = np.sqrt(neighboring_pix_err)*0.5 # uncertainty on average value
-                
-                first_criterion += (central_pix_val>(neighboring_pix_val+nsig*central_pix_err))
-                second_criterion |= (((central_pix_val-cfudge*central_pix_err)*c2fudge*psf_gradients[a]) > ( neighboring_pix_val+cfudge*neighboring_pix_err ))
-            
-            rejection[i0,i1] = ( (first_criterion>=2) & second_criterion )
-            
+    dd    = _psf_axes(psf_gradients.size)
+
+    rejection=np.zeros(pix.shape,dtype=np.bool_)
+
+    # tiles of the image without the edges
+    ntiles0 = (n0-2+tile_size-1)//tile_size
+    ntiles1 = (n1-2+tile_size-1)//tile_size
+    for tile in numba.prange(ntiles0*ntiles1) :
+        b0 = 1+(tile//ntiles1)*tile_size
+        b1 = 1+(tile%ntiles1)*tile_size
+        for i0 in range(b0,min(b0+tile_size,n0-1)) :
+            for i1 in range(b1,min(b1+tile_size,n1-1)) :
+                if selection[i0,i1] :
+                    rejection[i0,i1] = _reject_cosmic_ray_pixel_numba(pix,ivar,i0,i1,dd,psf_gradients,nsig,cfudge,c2fudge)
+
     return rejection
-    
+
+@numba.jit(nopython=True)
+def _new_neighbors_numba(rejected,new0,new1) :
+    """Returns the coordinates (ii0,ii1) of the pixels that are neighbors of the newly
+    rejected pixels (new0,new1) and not already rejected, excluding the image edges.
+    rejected must already include the new pixels."""
+    n0 = rejected.shape[0]
+    n1 = rejected.shape[1]
+    marked = np.zeros(rejected.shape,dtype=np.bool_)
+    ii0 = np.zeros(8*new0.size,dtype=np.int64)
+    ii1 = np.zeros(8*new0.size,dtype=np.int64)
+    nn = 0
+    for k in range(new0.size) :
+        i0 = new0[k]
+        i1 = new1[k]
+        # as in dilate_numba, pixels on the edges are not dilated
+        if i0<1 or i0>n0-2 or i1<1 or i1>n1-2 : continue
+        for j0 in range(i0-1,i0+2) :
+            if j0<1 or j0>n0-2 : continue
+            for j1 in range(i1-1,i1+2) :
+                if j1<1 or j1>n1-2 : continue
+                if rejected[j0,j1] or marked[j0,j1] : continue
+                marked[j0,j1] = True
+                ii0[nn] = j0
+                ii1[nn] = j1
+                nn += 1
+    return ii0[:nn],ii1[:nn]
+
+@numba.jit(nopython=True,parallel=True)
+def _reject_cosmic_rays_pixels_numba(pix,ivar,ii0,ii1,psf_gradients,nsig,cfudge,c2fudge) :
+    """Same as _reject_cosmic_rays_ala_sdss_single_numba for a list of pixels
+    with coordinates (ii0,ii1) not on the image edges, processed in parallel threads.
+    Returns an array of booleans, True for the rejected pixels of the list."""
+    dd = _psf_axes(psf_gradients.size)
+    rejection = np.zeros(ii0.size,dtype=np.bool_)
+    for k in numba.prange(ii0.size) :
+        rejection[k] = _reject_cosmic_ray_pixel_numba(pix,ivar,ii0[k],ii1[k],dd,psf_gradients,nsig,cfudge,c2fudge)
+    return rejection
+
 def _reject_cosmic_rays_ala_sdss_single(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
@@ -334,7 +394,20 @@ def _reject_cosmic_rays_ala_sdss_single(pix,ivar,selection,psf_gradients,nsig,cf
     rejection[1:-1,1:-1][tselection] = (first_criterion&second_criterion).reshape(pix[1:-1,1:-1][tselection].shape)
     return rejection
 
-def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate=True) :
+def _prefer_fork_safe_threading_layer() :
+    """Make numba prefer its fork-safe workqueue threading layer, unless a
+    layer is chosen with $NUMBA_THREADING_LAYER or
+    $NUMBA_THREADING_LAYER_PRIORITY
+
+    With the TBB threading layer, processes forked after multi-threaded numba
+    kernels have run (e.g. multiprocessing pools) can hang, and GNU OpenMP
+    aborts them. This only has an effect before numba starts its threads.
+    """
+    if 'NUMBA_THREADING_LAYER' not in os.environ and \
+       'NUMBA_THREADING_LAYER_PRIORITY' not in os.environ :
+        numba.config.THREADING_LAYER_PRIORITY = ['workqueue', 'omp', 'tbb']
+
+def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate=True,nthreads=None) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
 
@@ -352,6 +425,14 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
        c2fudge:  fudge factor applied to PSF
        niter: number of iterations on neighboring pixels of rejected pixels
        dilate: force +1 pixel dilation of rejection mask
+       nthreads: number of numba threads, default is numba's (all cores
+          or NUMBA_NUM_THREADS)
+
+    If run with more than one thread before numba has started its threads,
+    numba's threading layer priority is set to prefer the fork-safe workqueue
+    layer (unless $NUMBA_THREADING_LAYER or $NUMBA_THREADING_LAYER_PRIORITY
+    are set), so that processes can still be forked afterwards, e.g. by
+    multiprocessing pools. This setting is global to the process.
     """
     log=get_logger()
     log.info("starting with nsig=%2.1f cfudge=%2.1f c2fudge=%2.1f"%(nsig,cfudge,c2fudge))
@@ -384,23 +465,48 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
     selection = ((img.pix*np.sqrt(tivar))>nsig)
     
     use_numba = True
-    
-    if use_numba :
-        rejected   = _reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
-    else :
-        rejected  = _reject_cosmic_rays_ala_sdss_single(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
-    
-    
-    log.info("first pass: %d pixels rejected"%(np.sum(rejected)))
-    
-    if niter > 0 :        
-        
-        for iteration in range(niter) :
 
-            # if np.sum(rejected)==0 : break
-            if use_numba :
-                neighbors = dilate_numba(rejected,False)
-            else :
+    if use_numba and (nthreads is None or nthreads > 1) :
+        _prefer_fork_safe_threading_layer()
+
+    if use_numba and nthreads is not None :
+        previous_nthreads = numba.get_num_threads()
+        numba.set_num_threads(max(1,min(nthreads,numba.config.NUMBA_NUM_THREADS)))
+
+    try :
+        if use_numba :
+            rejected   = _reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
+        else :
+            rejected  = _reject_cosmic_rays_ala_sdss_single(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
+
+
+        log.info("first pass: %d pixels rejected"%(np.sum(rejected)))
+
+        if niter > 0 and use_numba :
+
+            # only the neighbors of the pixels newly rejected at the previous iteration
+            # need to be tested, because the other ones were already tested with
+            # the same tivar for their neighbors
+            new0,new1 = np.where(rejected)
+            for iteration in range(niter) :
+                tivar[new0,new1] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
+                ii0,ii1 = _new_neighbors_numba(rejected,new0,new1)
+
+                # rerun with much more strict cuts
+                newrejected = _reject_cosmic_rays_pixels_numba(img.pix,tivar,ii0,ii1,psf_gradients,nsig=3.,cfudge=0.,c2fudge=c2fudge)
+                new0 = ii0[newrejected]
+                new1 = ii1[newrejected]
+
+                log.info("at iter %d: %d new pixels rejected"%(iteration,new0.size))
+                if new0.size<1 :
+                    break
+                rejected[new0,new1] = True
+
+        elif niter > 0 :
+
+            for iteration in range(niter) :
+
+                # if np.sum(rejected)==0 : break
                 neighbors = np.zeros(rejected.shape,dtype=bool)
                 # left and right neighbors
                 neighbors[1:,:]  |= rejected[:-1,:]
@@ -412,50 +518,51 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
                 neighbors[:-1,:-1]  |= rejected[1:,1:]
                 neighbors[1:,:-1]  |= rejected[:-1,1:]
                 neighbors[:-1,1:]  |= rejected[1:,:-1]
-            neighbors &= (rejected==False) # excluded already rejected pixel
-            tivar[rejected] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
+                neighbors &= (rejected==False) # excluded already rejected pixel
+                tivar[rejected] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
+
+                # rerun with much more strict cuts
+                newrejected=_reject_cosmic_rays_ala_sdss_single(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=c2fudge)
 
-            # rerun with much more strict cuts
+                log.info("at iter %d: %d new pixels rejected"%(iteration,np.sum(newrejected)))
+                if np.sum(newrejected)<1 :
+                    break
+                rejected |= newrejected
+
+        if dilate :
+            log.debug("dilating cosmic ray mask")
+            # now apply the dilatation included in sdssproc.pro
+            # in IDL it is crmask = dilate(crmask, replicate(1,3,3))
             if use_numba :
-                newrejected=_reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=c2fudge)
+                rejected = dilate_numba(rejected,True)
             else :
-                newrejected=_reject_cosmic_rays_ala_sdss_single(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=c2fudge)
-                
-            log.info("at iter %d: %d new pixels rejected"%(iteration,np.sum(newrejected)))
-            if np.sum(newrejected)<1 :            
-                break
-            rejected |= newrejected
-        
+                tmp=rejected.copy()
+                rejected[1:,:]  |= tmp[:-1,:]
+                rejected[:-1,:] |= tmp[1:,:]
+                rejected[:,1:]  |= tmp[:,:-1]
+                rejected[:,:-1] |= tmp[:,1:]
+                rejected[1:,1:]  |= tmp[:-1,:-1]
+                rejected[:-1,:-1]  |= tmp[1:,1:]
+                rejected[1:,:-1]  |= tmp[:-1,1:]
+                rejected[:-1,1:]  |= tmp[1:,:-1]
+    finally :
+        #- restore the process-wide number of numba threads, also on errors
+        if use_numba and nthreads is not None :
+            numba.set_num_threads(previous_nthreads)
 
-    if dilate :
-        log.debug("dilating cosmic ray mask")
-        # now apply the dilatation included in sdssproc.pro
-        # in IDL it is crmask = dilate(crmask, replicate(1,3,3))
-        if use_numba :
-            rejected = dilate_numba(rejected,True)
-        else :
-            tmp=rejected.copy()
-            rejected[1:,:]  |= tmp[:-1,:]
-            rejected[:-1,:] |= tmp[1:,:]
-            rejected[:,1:]  |= tmp[:,:-1]
-            rejected[:,:-1] |= tmp[:,1:]
-            rejected[1:,1:]  |= tmp[:-1,:-1]
-            rejected[:-1,:-1]  |= tmp[1:,1:]
-            rejected[1:,:-1]  |= tmp[:-1,1:]
-            rejected[:-1,1:]  |= tmp[1:,:-1]
-        
     t1=time.time()
     log.info("end : {} pixels rejected in {:3.1f} sec".format(np.sum(rejected),t1-t0))
     return rejected
 
-def reject_cosmic_rays(img,nsig=5.,cfudge=3.,c2fudge=0.9,niter=30,dilate=True) :
+def reject_cosmic_rays(img,nsig=5.,cfudge=3.,c2fudge=0.9,niter=30,dilate=True,nthreads=None) :
     """Cosmic ray rejection
     Input is a pre-processed image : desispec.Image
     The image mask is modified
 
     Args:
        img: input desispec.Image
+       nthreads: number of threads, see reject_cosmic_rays_ala_sdss
 
     """
-    rejected=reject_cosmic_rays_ala_sdss(img,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge,niter=niter,dilate=dilate)
+    rejected=reject_cosmic_rays_ala_sdss(img,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge,niter=niter,dilate=dilate,nthreads=nthreads)
     img.mask[rejected] |= ccdmask.COSMIC
@@ -11,19 +11,23 @@ from __future__ import absolute_import, division, print_function
 import os
 import re
 import glob
+from io import StringIO
+from multiprocessing import Pool
 
 import numpy as np
+import fitsio
 from astropy.io import fits
 from astropy.table import Table
 from pytz import utc
 
 from sqlalchemy import (create_engine, event, ForeignKey, Column, DDL,
                         BigInteger, Boolean, Integer, String, Float, DateTime,
-                        bindparam)
+                        MetaData, bindparam)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
-from sqlalchemy.schema import CreateSchema
+from sqlalchemy.schema import CreateSchema, Table as SQLTable
 
 from desiutil.log import log, DEBUG, INFO
 
@@ -320,11 +324,134 @@ class FiberAssign(SchemaMixin, Base):
         return "<FiberAssign(tileid={0.tileid:d}, fiber={0.fiber:d})>".format(self)
 
 
+def _read_chunks(filepath, hdu=1, chunksize=50000, maxrows=0):
+    """Read a data file as a sequence of row ranges.
+
+    Parameters
+    ----------
+    filepath : :class:`str`
+        Full path to the data file.
+    hdu : :class:`int` or :class:`str`, optional
+        Read a data table from this HDU (default 1).
+    chunksize : :class:`int`, optional
+        Read `chunksize` rows at a time (default 50000).
+    maxrows : :class:`int`, optional
+        If set, stop reading after `maxrows` rows.
+
+    Returns
+    -------
+    generator
+        Yields pairs of the index of the first row of a chunk and the rows
+        themselves, as a :class:`numpy.ndarray` with a structured dtype.
+    """
+    if filepath.endswith('.fits'):
+        with fitsio.FITS(filepath, trim_strings=True) as fx:
+            nrows = fx[hdu].get_nrows()
+            if maxrows > 0:
+                nrows = min(nrows, maxrows)
+            for k in range(0, nrows, chunksize):
+                yield k, fx[hdu][k:min(k+chunksize, nrows)]
+    else:
+        #
+        # ECSV files can't be read in pieces, but are small anyway.
+        #
+        data = Table.read(filepath, format='ascii.ecsv').as_array()
+        nrows = len(data)
+        if maxrows > 0:
+            nrows = min(nrows, maxrows)
+        for k in range(0, nrows, chunksize):
+            yield k, data[k:min(k+chunksize, nrows)]
+
+
+def _csv_column(column):
+    """Format an array as a column of a CSV file suitable for ``COPY``.
+
+    Parameters
+    ----------
+    column : :class:`numpy.ndarray`
+        A one-dimensional array.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        An array of strings.
+    """
+    if column.dtype.kind in 'biuf':
+        return column.astype(str)
+    if column.dtype.kind == 'S':
+        text = np.char.decode(column, 'ascii')
+    else:
+        text = column.astype(str)
+    text = np.char.add(np.char.add('"', np.char.replace(text, '"', '""')), '"')
+    if column.dtype.kind == 'O':
+        #
+        # Unquoted empty values are NULL.
+        #
+        text[np.equal(column, None)] = ''
+    return text
+
+
+def _insert_columns(t, names, columns):
+    """Insert rows, given as a set of columns, into a table.
+
+    On PostgreSQL, the rows are sent with ``COPY FROM STDIN``. On SQLite,
+    they are inserted with the ``executemany()`` method of a raw cursor.
+    Other databases go through the usual :meth:`~sqlalchemy.sql.expression.Insert`.
+
+    Parameters
+    ----------
+    t : :class:`sqlalchemy.schema.Table`
+        The table to load.
+    names : :class:`list`
+        Database column names.
+    columns : :class:`list`
+        A one-dimensional :class:`numpy.ndarray` for each column in `names`.
+    """
+    if engine.dialect.name == 'postgresql':
+        text = _csv_column(columns[0])
+        for c in columns[1:]:
+            text = np.char.add(np.char.add(text, ','), _csv_column(c))
+        buf = StringIO('\n'.join(text.tolist()) + '\n')
+        q = "COPY {0} ({1}) FROM STDIN WITH CSV".format(t.fullname,
+                                                         ', '.join(names))
+        conn = engine.raw_connection()
+        try:
+            conn.cursor().copy_expert(q, buf)
+            conn.commit()
+        finally:
+            conn.close()
+        return
+    data_list = []
+    for n, c in zip(names, columns):
+        process = t.c[n].type.bind_processor(engine.dialect)
+        if process is None:
+            data_list.append(c.tolist())
+        else:
+            data_list.append([process(x) for x in c.tolist()])
+    data_rows = list(zip(*data_list))
+    if engine.dialect.name == 'sqlite':
+        q = "INSERT INTO {0} ({1}) VALUES ({2})".format(t.fullname,
+                                                       ', '.join(names),
+                                                       ', '.join(['?']*len(names)))
+        conn = engine.raw_connection()
+        try:
+            conn.cursor().executemany(q, data_rows)
+            conn.commit()
+        finally:
+            conn.close()
+    else:
+        engine.execute(t.insert(), [dict(zip(names, row))
+                                    for row in data_rows])
+
+
 def load_file(filepath, tcls, hdu=1, expand=None, convert=None, index=None,
               rowfilter=None, q3c=False, chunksize=50000, maxrows=0):
     """Load a data file into the database, assuming that column names map
     to database column names with no surprises.
 
+    The file is read and loaded `chunksize` rows at a time, so the whole
+    table is never held in memory.
+
     Parameters
     ----------
     filepath : :class:`str`
@@ -337,12 +464,13 @@ def load_file(filepath, tcls, hdu=1, expand=None, convert=None, index=None,
         If set, map FITS column names to one or more alternative column names.
     convert : :class:`dict`, optional
         If set, convert the data for a named (database) column using the
-        supplied function.
+        supplied function, which is applied to each element of the column.
     index : :class:`str`, optional
         If set, add a column that just counts the number of rows.
     rowfilter : callable, optional
         If set, apply this filter to the rows to be loaded.  The function
-        should return :class:`bool`, with ``True`` meaning a good row.
+        should return an array of :class:`bool`, with ``True`` meaning a
+        good row.
     q3c : :class:`bool`, optional
         If set, create q3c index on the table.
     chunksize : :class:`int`, optional
@@ -352,94 +480,63 @@ def load_file(filepath, tcls, hdu=1, expand=None, convert=None, index=None,
         set `maxrows` to zero (0) to load all rows.
     """
     tn = tcls.__tablename__
-    if filepath.endswith('.fits'):
-        with fits.open(filepath) as hdulist:
-            data = hdulist[hdu].data
-    elif filepath.endswith('.ecsv'):
-        data = Table.read(filepath, format='ascii.ecsv')
-    else:
+    if not (filepath.endswith('.fits') or filepath.endswith('.ecsv')):
         log.error("Unrecognized data file, %s!", filepath)
         return
-    if maxrows == 0:
-        maxrows = len(data)
-    log.info("Read data from %s HDU %s", filepath, hdu)
-    try:
-        colnames = data.names
-    except AttributeError:
-        colnames = data.colnames
-    for col in colnames:
-        if data[col].dtype.kind == 'f':
-            bad = np.isnan(data[col][0:maxrows])
-            if np.any(bad):
-                nbad = bad.sum()
-                log.warning("%d rows of bad data detected in column " +
-                            "%s of %s.", nbad, col, filepath)
-                #
-                # Temporary workaround for bad flux values, see
-                # https://github.com/desihub/desitarget/issues/397
-                #
-                if col in ('FLUX_R', 'FIBERFLUX_R', 'FIBERTOTFLUX_R'):
-                    data[col][0:maxrows][bad] = -9999.0
-    log.info("Integrity check complete on %s.", tn)
-    if rowfilter is None:
-        good_rows = np.ones((maxrows,), dtype=np.bool)
-    else:
-        good_rows = rowfilter(data[0:maxrows])
-    data_list = [data[col][0:maxrows][good_rows].tolist() for col in colnames]
-    data_names = [col.lower() for col in colnames]
-    finalrows = len(data_list[0])
-    log.info("Initial column conversion complete on %s.", tn)
-    if expand is not None:
-        for col in expand:
-            i = data_names.index(col.lower())
-            if isinstance(expand[col], str):
-                #
-                # Just rename a column.
-                #
-                log.debug("Renaming column %s (at index %d) to %s.", data_names[i], i, expand[col])
-                data_names[i] = expand[col]
-            else:
-                #
-                # Assume this is an expansion of an array-valued column
-                # into individual columns.
-                #
-                del data_names[i]
-                del data_list[i]
-                for j, n in enumerate(expand[col]):
-                    log.debug("Expanding column %d of %s (at index %d) to %s.", j, col, i, n)
-                    data_names.insert(i + j, n)
-                    data_list.insert(i + j, data[col][:, j].tolist())
-                log.debug(data_names)
-    log.info("Column expansion complete on %s.", tn)
-    del data
-    if convert is not None:
-        for col in convert:
-            i = data_names.index(col)
-            data_list[i] = [convert[col](x) for x in data_list[i]]
-    log.info("Column conversion complete on %s.", tn)
-    if index is not None:
-        data_list.insert(0, list(range(1, finalrows+1)))
-        data_names.insert(0, index)
-        log.info("Added index column '%s'.", index)
-    data_rows = list(zip(*data_list))
-    del data_list
-    log.info("Converted columns into rows on %s.", tn)
-    for k in range(finalrows//chunksize + 1):
-        data_chunk = [dict(zip(data_names, row))
-                      for row in data_rows[k*chunksize:(k+1)*chunksize]]
-        if len(data_chunk) > 0:
-            engine.execute(tcls.__table__.insert(), data_chunk)
-            log.info("Inserted %d rows in %s.",
-                     min((k+1)*chunksize, finalrows), tn)
-    # for k in range(finalrows//chunksize + 1):
-    #     data_insert = [dict([(col, data_list[i].pop(0))
-    #                          for i, col in enumerate(data_names)])
-    #                    for j in range(chunksize)]
-    #     session.bulk_insert_mappings(tcls, data_insert)
-    #     log.info("Inserted %d rows in %s..",
-    #              min((k+1)*chunksize, finalrows), tn)
-    # session.commit()
-    # dbSession.commit()
+    log.info("Reading data from %s HDU %s", filepath, hdu)
+    nbad = dict()
+    finalrows = 0
+    for k, data in _read_chunks(filepath, hdu, chunksize, maxrows):
+        colnames = list(data.dtype.names)
+        for col in colnames:
+            if data[col].dtype.kind == 'f':
+                bad = np.isnan(data[col])
+                if np.any(bad):
+                    nbad[col] = nbad.get(col, 0) + bad.sum()
+                    #
+                    # Temporary workaround for bad flux values, see
+                    # https://github.com/desihub/desitarget/issues/397
+                    #
+                    if col in ('FLUX_R', 'FIBERFLUX_R', 'FIBERTOTFLUX_R'):
+                        data[col][bad] = -9999.0
+        if rowfilter is not None:
+            data = data[rowfilter(data)]
+        if len(data) == 0:
+            continue
+        data_names = [col.lower() for col in colnames]
+        data_list = [data[col] for col in colnames]
+        if expand is not None:
+            for col in expand:
+                i = data_names.index(col.lower())
+                if isinstance(expand[col], str):
+                    #
+                    # Just rename a column.
+                    #
+                    data_names[i] = expand[col]
+                else:
+                    #
+                    # Assume this is an expansion of an array-valued column
+                    # into individual columns.
+                    #
+                    del data_names[i]
+                    del data_list[i]
+                    for j, n in enumerate(expand[col]):
+                        data_names.insert(i + j, n)
+                        data_list.insert(i + j, data[col][:, j])
+        if convert is not None:
+            for col in convert:
+                i = data_names.index(col)
+                data_list[i] = np.frompyfunc(convert[col], 1, 1)(data_list[i])
+        if index is not None:
+            data_list.insert(0, np.arange(finalrows + 1,
+                                          finalrows + len(data) + 1))
+            data_names.insert(0, index)
+        _insert_columns(tcls.__table__, data_names, data_list)
+        finalrows += len(data)
+        log.info("Inserted %d rows in %s.", finalrows, tn)
+    for col in nbad:
+        log.warning("%d rows of bad data detected in column " +
+                    "%s of %s.", nbad[col], col, filepath)
     if q3c:
         q3c_index(tn)
     return
@@ -507,7 +604,149 @@ def update_truth(filepath, hdu=2, chunksize=50000, skip=('SLOPES', 'EMLINES')):
                      min((k+1)*chunksize, finalrows), tn)
 
 
-def load_zbest(datapath=None, hdu='ZBEST', q3c=False):
+def _read_zbest(args):
+    """Read one zbest file and convert it to columns of the zcat table.
+
+    Parameters
+    ----------
+    args : :class:`tuple`
+        The name of the zbest file and the HDU containing the data.
+
+    Returns
+    -------
+    :class:`tuple`
+        The brickname, the database column names and the columns
+        themselves.
+    """
+    f, hdu = args
+    brickname = os.path.basename(os.path.dirname(f))
+    with fitsio.FITS(f, trim_strings=True) as fx:
+        data = fx[hdu].read()
+    data = data[(data['TARGETID'] != 0) & (data['TARGETID'] != -1)]
+    data_names = list()
+    data_list = list()
+    for col in data.dtype.names:
+        if col == 'COEFF':
+            for j in range(data[col].shape[1]):
+                data_names.append('coeff_{0:d}'.format(j))
+                data_list.append(data[col][:, j])
+        else:
+            data_names.append(col.lower())
+            data_list.append(data[col])
+    #
+    # zbest files don't contain the same columns as zcatalog.
+    #
+    for col in ZCat.__table__.columns:
+        if col.name not in data_names:
+            data_names.append(col.name)
+            data_list.append(np.zeros(len(data), dtype=np.int64))
+    return (brickname, data_names, data_list)
+
+
+def _read_fiberassign(args):
+    """Read one tile file and convert it to columns of the fiberassign table.
+
+    Parameters
+    ----------
+    args : :class:`tuple`
+        The tileid, the name of the tile file, the HDU containing the data
+        and the last column to load.
+
+    Returns
+    -------
+    :class:`tuple`
+        The tileid, the database column names and the columns themselves.
+    """
+    tileid, f, hdu, last_column = args
+    with fitsio.FITS(f, trim_strings=True) as fx:
+        data = fx[hdu].read()
+    colnames = list(data.dtype.names)
+    colnames = colnames[:colnames.index(last_column) + 1]
+    for col in colnames:
+        if data[col].dtype.kind == 'f':
+            bad = np.isnan(data[col])
+            if np.any(bad):
+                log.warning("%d rows of bad data detected in column " +
+                            "%s of %s.", bad.sum(), col, f)
+                #
+                # This replacement may be deprecated in the future.
+                #
+                if col in ('TARGET_RA', 'TARGET_DEC', 'FIBERASSIGN_X', 'FIBERASSIGN_Y'):
+                    data[col][bad] = -9999.0
+            assert not np.any(np.isnan(data[col]))
+            assert np.all(np.isfinite(data[col]))
+    data_names = ['tileid'] + [col.lower() for col in colnames]
+    data_list = ([np.full(len(data), tileid, dtype=np.int64)] +
+                 [data[col] for col in colnames])
+    return (tileid, data_names, data_list)
+
+
+def _load_staged(tcls, reader, tasks, ncpu=1):
+    """Load many files into a table through a staging table.
+
+    A pool of `ncpu` processes reads and converts the files, while this
+    process streams the rows into a staging table with no indexes.  The
+    staging table is then merged into the table with a single
+    ``INSERT ... SELECT``, skipping rows that duplicate a primary key.
+    The indexes on the table are dropped during the merge and created
+    again afterwards.
+
+    Parameters
+    ----------
+    tcls : :class:`sqlalchemy.ext.declarative.api.DeclarativeMeta`
+        The table to load, represented by its class.
+    reader : callable
+        Function that reads one file.  It is called with an element of
+        `tasks` and returns a label for the file, database column names
+        and the columns themselves.
+    tasks : :class:`list`
+        Arguments of `reader`, one for each file.
+    ncpu : :class:`int`, optional
+        Number of processes reading files (default 1).
+    """
+    t = tcls.__table__
+    prefixes = list()
+    if engine.dialect.name == 'postgresql':
+        prefixes.append('UNLOGGED')
+    staging = SQLTable(t.name + '_staging', MetaData(),
+                       *[Column(c.name, c.type) for c in t.columns],
+                       schema=t.schema, prefixes=prefixes)
+    staging.drop(engine, checkfirst=True)
+    staging.create(engine)
+    nstaged = 0
+    try:
+        with Pool(ncpu) as pool:
+            for label, data_names, data_list in pool.imap_unordered(reader, tasks):
+                keep = [i for i, n in enumerate(data_names) if n in staging.c]
+                n_rows = len(data_list[0])
+                if n_rows > 0:
+                    _insert_columns(staging, [data_names[i] for i in keep],
+                                    [data_list[i] for i in keep])
+                nstaged += n_rows
+                log.info("Staged %d rows in %s for %s.", n_rows,
+                         staging.name, label)
+        for ix in t.indexes:
+            ix.drop(engine)
+        if engine.dialect.name == 'postgresql':
+            q = pg_insert(t).on_conflict_do_nothing()
+        else:
+            q = t.insert().prefix_with('OR IGNORE', dialect='sqlite')
+        q = q.from_select([c.name for c in t.columns], staging.select())
+        with engine.begin() as conn:
+            n_rows = conn.execute(q).rowcount
+        if n_rows < nstaged:
+            log.warning("Skipped %d rows with duplicate keys in %s.",
+                        nstaged - n_rows, t.name)
+        log.info("Inserted %d rows in %s.", n_rows, t.name)
+        for ix in t.indexes:
+            ix.create(engine)
+        log.info("Created indexes on %s.", t.name)
+    finally:
+        staging.drop(engine)
+    return
+
+
+def load_zbest(datapath=None, hdu='ZBEST', q3c=False, ncpu=1):
     """Load zbest files into the zcat table.
 
     This function is deprecated since there should now be a single
@@ -521,6 +760,9 @@ def load_zbest(datapath=None, hdu='ZBEST', q3c=False):
         Read a data table from this HDU (default 'ZBEST').
     q3c : :class:`bool`, optional
         If set, create q3c index on the table.
+    ncpu : :class:`int`, optional
+        If greater than one, read the files with `ncpu` processes and load
+        them through a staging table.
     """
     if datapath is None:
         datapath = specprod_root()
@@ -531,6 +773,12 @@ def load_zbest(datapath=None, hdu='ZBEST', q3c=False):
         log.error("No zbest files found!")
         return
     log.info("Found %d zbest files.", len(zbest_files))
+    if ncpu > 1:
+        _load_staged(ZCat, _read_zbest, [(f, hdu) for f in zbest_files],
+                     ncpu=ncpu)
+        if q3c:
+            q3c_index('zcat')
+        return
     #
     # Read the identified zbest files.
     #
@@ -594,7 +842,7 @@ def load_zbest(datapath=None, hdu='ZBEST', q3c=False):
 
 
 def load_fiberassign(datapath, maxpass=4, hdu='FIBERASSIGN', q3c=False,
-                     latest_epoch=False, last_column='SUBPRIORITY'):
+                     latest_epoch=False, last_column='SUBPRIORITY', ncpu=1):
     """Load fiber assignment files into the fiberassign table.
 
     Tile files can appear in multiple epochs, so for a given tileid, load
@@ -617,6 +865,9 @@ def load_fiberassign(datapath, maxpass=4, hdu='FIBERASSIGN', q3c=False,
         If set, search for the latest tile file among several epochs.
     last_column : :class:`str`, optional
         Do not load columns past this name (default 'BRICKNAME').
+    ncpu : :class:`int`, optional
+        If greater than one, read the files with `ncpu` processes and load
+        them through a staging table.
     """
     fiberpath = os.path.join(datapath, 'tile*.fits')
     log.info("Using tile file search path: %s.", fiberpath)
@@ -649,6 +900,13 @@ def load_fiberassign(datapath, maxpass=4, hdu='FIBERASSIGN', q3c=False,
                          os.path.basename(f))[1])
             latest_tiles[tileid] = (0, f)
     log.info("Identified %d tile files for loading.", len(latest_tiles))
+    if ncpu > 1:
+        _load_staged(FiberAssign, _read_fiberassign,
+                     [(tileid, latest_tiles[tileid][1], hdu, last_column)
+                      for tileid in latest_tiles], ncpu=ncpu)
+        if q3c:
+            q3c_index('fiberassign', ra='target_ra')
+        return
     #
     # Read the identified tile files.
     #
@@ -841,6 +1099,9 @@ def get_options(*args):
     prsr.add_argument('-H', '--hostname', action='store', dest='hostname',
                       metavar='HOSTNAME',
                       help='If specified, connect to a PostgreSQL database on HOSTNAME.')
+    prsr.add_argument('-j', '--ncpu', action='store', dest='ncpu',
+                      type=int, default=1, metavar='N',
+                      help="Read zbest and tile files with N processes (default %(default)s).")
     prsr.add_argument('-m', '--max-rows', action='store', dest='maxrows',
                       type=int, default=0, metavar='M',
                       help="Load up to M rows in the tables (default is all rows).")
@@ -944,7 +1205,8 @@ def main():
         if q is None:
             if options.zbest and tn == 'zcat':
                 log.info("Loading %s from zbest files in %s.", tn, options.datapath)
-                load_zbest(datapath=options.datapath, q3c=postgresql)
+                load_zbest(datapath=options.datapath, q3c=postgresql,
+                           ncpu=options.ncpu)
             else:
                 log.info("Loading %s from %s.", tn, l['filepath'])
                 load_file(**l)
@@ -963,7 +1225,8 @@ def main():
     q = dbSession.query(FiberAssign).first()
     if q is None:
         log.info("Loading FiberAssign from %s.", options.datapath)
-        load_fiberassign(options.datapath, q3c=postgresql)
+        load_fiberassign(options.datapath, q3c=postgresql,
+                         ncpu=options.ncpu)
         log.info("Finished loading FiberAssign.")
     else:
         log.info("FiberAssign table already loaded.")
@@ -35,6 +35,10 @@ class DESI_DASHBOARD(object):
         self.data_dir=prod_dir+prod+"/spectro/data/"
         self.log_dir=prod_dir+prod+"/spectro/redux/daily/run/logs"
         self.redux_dir=prod_dir+prod+"/spectro/redux/daily"
+        if args.expcatalog is None:
+            self.expcatalog=self.redux_dir+"/run/exposures.db" # shared with desi_pipe
+        else:
+            self.expcatalog=args.expcatalog
 
         #############
         ## Setup ####
@@ -89,6 +93,7 @@ class DESI_DASHBOARD(object):
         parser.add_argument('-pd','--prod_dir', type=str, default = None, required = True, help="product base directory")
         parser.add_argument('-od','--output_dir', type=str, default = None, required = True, help="output portal directory for the html pages ")
         parser.add_argument('-ou','--output_url', type=str, default = None, required = True, help="output portal directory url ")
+        parser.add_argument('-ec','--expcatalog', type=str, default = None, required = False, help="exposure catalog of the raw data, default run/exposures.db in the redux directory")
         return parser
 
     def _initialize_page(self):
@@ -295,16 +300,15 @@ class DESI_DASHBOARD(object):
 
     def count_files(self):
         from os import listdir
+        from desispec.io.expcatalog import read_expcatalog
         nights=listdir(self.data_dir)
+        exposures=read_expcatalog(self.expcatalog,rawdata_dir=self.data_dir)
         output={}
         dict_all={'night':'overall','n_arc':0,'n_flat':0,'n_science':0,'preproc':0,'psf':0,'psfnight':0,'traceshift':0,'extract':0,'fiberflat':0,'fiberflatnight':0,'sky':0,'starfit':0,'fluxcalib':0,'cframe':0}
         for night in nights:
             dict_t={'night':night,'n_arc':0,'n_flat':0,'n_science':0,'preproc':0,'psf':0,'psfnight':0,'traceshift':0,'extract':0,'fiberflat':0,'fiberflatnight':0,'sky':0,'starfit':0,'fluxcalib':0,'cframe':0}
-            expids=listdir(self.data_dir+'/'+night+'/')
-            for expid in expids:
-                filename=self.data_dir+'/'+night+'/'+expid+'/desi-'+expid+'.fits.fz'
-                h=fitsio.read_header(filename,1)
-                flavor=h['flavor'].strip()
+            flavors=exposures['FLAVOR'][exposures['NIGHT']==int(night)]
+            for flavor in flavors:
                 if flavor=='arc':
                     dict_t['n_arc']=dict_t['n_arc']+1
                 elif flavor=='flat':
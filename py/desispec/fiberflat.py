@@ -12,16 +12,335 @@ from desispec.resolution import Resolution
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_solve_and_invert
 from desispec.linalg import spline_fit
+from desispec.linalg import spline_fit_batch
+from desispec.linalg import symmetric_band_to_dense
 from desispec.maskbits import specmask
 from desispec.preproc import masked_median
 from desispec import util
-import scipy,scipy.sparse
+from desispec.parallel import dist_uniform
+import scipy,scipy.sparse,scipy.linalg
 import sys
 from desiutil.log import get_logger
 import math
+import multiprocessing
 
+# number of wavelength bins of the blocks of the normal matrix in compute_fiberflat
+_wave_block_size = 256
 
-def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxval=10.,max_iterations=100,smoothing_res=5.,max_bad=100,max_rej_it=5,min_sn=0,diag_epsilon=1e-3) :
+
+# shared memory buffer of the processes of a _SharedMemoryPool
+_pool_buffer = None
+
+def _pool_initializer(buf) :
+    global _pool_buffer
+    _pool_buffer = buf
+
+def _buffer_views(buf,layout) :
+    return [np.frombuffer(buf,dtype=dtype,count=int(np.prod(shape)),offset=offset).reshape(shape) for offset,dtype,shape in layout]
+
+class _InBuffer(object) :
+    """
+    Placeholder of an argument passed through the shared memory buffer
+    """
+    pass
+
+# for multiprocessing, with the arrays in the shared memory buffer
+def _pool_worker(func,layout,narrays,args,items) :
+    views = _buffer_views(_pool_buffer,layout)
+    shared = iter(views[narrays:])
+    args = [next(shared) if isinstance(arg,_InBuffer) else arg for arg in args]
+    func(items,*views[:narrays],*args)
+
+class _SharedMemoryPool(object) :
+    """
+    Pool of nproc processes sharing one memory buffer, created once and
+    reused by all the calls to _run_parallel of a compute_fiberflat call.
+
+    The buffer holds nbytes; it is enlarged, and the pool restarted,
+    if a call needs more.
+    """
+    def __init__(self,nproc,nbytes) :
+        self.nproc = nproc
+        self.pool = None
+        self._start(nbytes)
+
+    def _start(self,nbytes) :
+        if self.pool is not None :
+            self.close()
+        self.buf = multiprocessing.RawArray('b',max(int(nbytes),1))
+        self.pool = multiprocessing.Pool(self.nproc,initializer=_pool_initializer,initargs=(self.buf,))
+
+    def run(self,func,items,arrays,args) :
+        """
+        Calls func(items,*arrays,*args) by chunks of items in the processes
+        of the pool and updates the arrays. The numpy arrays of args are also
+        passed through the shared memory buffer.
+        """
+        inputs = list(arrays) + [arg for arg in args if isinstance(arg,np.ndarray)]
+        layout = []
+        nbytes = 0
+        for array in inputs :
+            layout.append((nbytes,array.dtype,array.shape))
+            nbytes += (array.nbytes+63)//64*64 # 64 bytes alignment
+        if nbytes > len(self.buf) :
+            get_logger().debug("enlarging the shared memory buffer to {} bytes".format(nbytes))
+            self._start(nbytes)
+        views = _buffer_views(self.buf,layout)
+        for view,array in zip(views,inputs) :
+            view[...] = array
+        args = [_InBuffer() if isinstance(arg,np.ndarray) else arg for arg in args]
+        tasks = [(func,layout,len(arrays),args,items[first:first+n]) for first,n in dist_uniform(len(items),self.nproc) if n > 0]
+        self.pool.starmap(_pool_worker,tasks)
+        for array,view in zip(arrays,views) :
+            array[...] = view
+
+    def close(self) :
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+def _run_parallel(func,items,arrays,args=(),select=None,pool=None,comm=None) :
+    """
+    Calls func(items,*arrays,*args) for a list of items, where func updates
+    the arrays in place, for each item only in the part array[select(item)]
+    and independently of the other items.
+
+    This is done serially, by the processes of a _SharedMemoryPool working
+    on shared memory copies of the arrays, or by the ranks of a MPI communicator which exchange
+    their parts of the arrays. In all cases the arrays are updated item by item
+    with the same operations, so the result does not depend on the parallelization.
+
+    Args:
+        func : function(items,*arrays,*args)
+        items : list or 1D array of items (fibers, wavelength blocks ...)
+        arrays : list of numpy arrays updated by func
+
+    Options:
+        args : other (read-only) arguments of func
+        select : function returning the index of the part of the arrays
+                 updated for an item (default is the row of index item)
+        pool : _SharedMemoryPool
+        comm : MPI communicator, used instead of pool if it has several ranks
+    """
+    if comm is not None and comm.size > 1 :
+        if select is None :
+            select = lambda item : item
+        dist = dist_uniform(len(items),comm.size)
+        first,n = dist[comm.rank]
+        func(items[first:first+n],*arrays,*args)
+        parts = comm.allgather([[array[select(item)] for array in arrays] for item in items[first:first+n]])
+        for (first,n),rank_parts in zip(dist,parts) :
+            for item,item_parts in zip(items[first:first+n],rank_parts) :
+                for array,part in zip(arrays,item_parts) :
+                    array[select(item)] = part
+        return
+
+    if pool is None or len(items) <= 1 :
+        func(items,*arrays,*args)
+        return
+
+    pool.run(func,items,arrays,args)
+
+def _first_pass_fibers(fibers,smooth_fiberflat,ivar,nbad,fiber_chi2,fiber_nrej,wave,flux,mean_spectrum,smoothing_res,nsig_clipping,max_rej_it,max_bad) :
+    """
+    1st pass of compute_fiberflat for a list of fibers: smooth fiber flat without resolution
+    and outlier rejection. Updates in place the rows of the other arrays for these fibers.
+    """
+    log=get_logger()
+    fibers=np.asarray(fibers,dtype=int)
+    fiber_chi2[fibers]=0.
+    fiber_nrej[fibers]=0
+    fibers=fibers[np.sum(ivar[fibers]>0,axis=1)>0]
+    if fibers.size==0 :
+        return
+
+    # spline fits of all fibers
+    w=(mean_spectrum!=0) & (ivar[fibers]>0)
+    F=w*flux[fibers]/(mean_spectrum+(mean_spectrum==0))
+    smooth,fitted=spline_fit_batch(wave,wave,F,smoothing_res,w*ivar[fibers]*mean_spectrum**2,max_resolution=1.5*smoothing_res)
+
+    # not more than max_rej_it pixels per fiber at a time
+    for i,fib in enumerate(fibers) :
+        if fitted[i] :
+            smooth_fiberflat[fib,:] = smooth[i]
+        else :
+            log.error("Error when smoothing the flat")
+            log.error("Setting ivar=0 for fiber {} because spline fit failed".format(fib))
+            ivar[fib,:] *= 0
+        chi2 = ivar[fib,:]*(flux[fib,:]-mean_spectrum*smooth_fiberflat[fib,:])**2
+        bad=np.where(chi2>nsig_clipping**2)[0]
+        if bad.size>0 :
+            if bad.size>max_rej_it : # not more than 5 pixels at a time
+                ii=np.argsort(chi2[bad])
+                bad=bad[ii[-max_rej_it:]]
+            ivar[fib,bad] = 0
+            log.warning("1st pass: rejecting {} pixels from fiber {}".format(len(bad),fib))
+            nbad[fib]+=len(bad)
+            if nbad[fib]>=max_bad:
+                ivar[fib,:]=0
+                log.warning("1st pass: rejecting fiber {} due to too many (new) bad pixels".format(fib))
+            fiber_nrej[fib]=len(bad)
+
+        fiber_chi2[fib]=chi2.sum()
+
+def _normal_matrix_blocks(blocks,band,rows,weight,offsets) :
+    """
+    Computes the columns [begin,end) for (begin,end) in blocks of the upper band
+    of sum_fibers R^T diag(weight) R, see BatchedResolution.normal_matrix_band.
+    The band array must be initialized to zero.
+    """
+    u = band.shape[0]-1
+    n = band.shape[1]
+    for begin,end in blocks :
+        for a,oa in enumerate(offsets) :
+            for b,ob in enumerate(offsets) :
+                if ob < oa :
+                    continue
+                # row i of R contributes to A[i+oa,i+ob], stored in column i+ob
+                i0 = max(0,-oa,begin-ob)
+                i1 = min(n,end-ob)
+                if i1 <= i0 :
+                    continue
+                band[u-(ob-oa),i0+ob:i1+ob] += np.sum(weight[:,i0:i1]*rows[:,a,i0:i1]*rows[:,b,i0:i1],axis=0)
+
+def _second_pass_fibers(fibers,smooth_fiberflat,ivar,fiber_chi2,wave,flux,convolved_mean_spectrum,smoothing_res) :
+    """
+    2nd pass of compute_fiberflat for a list of fibers: smooth fiber flat given the mean
+    spectrum convolved with the fiber resolution. Updates in place the rows of the other
+    arrays for these fibers.
+    """
+    log=get_logger()
+    fibers=np.asarray(fibers,dtype=int)
+    fiber_chi2[fibers]=0.
+    M = convolved_mean_spectrum[fibers]
+    ok=(M!=0) & (ivar[fibers]>0)
+    fibers=fibers[np.sum(ok,axis=1)>0]
+    if fibers.size==0 :
+        return
+    M = convolved_mean_spectrum[fibers]
+    ok=(M!=0) & (ivar[fibers]>0)
+
+    # spline fits of all fibers
+    smooth,fitted=spline_fit_batch(wave,wave,ok*flux[fibers]/(M+(M==0)),smoothing_res,ok*ivar[fibers]*M**2,max_resolution=1.5*smoothing_res)
+
+    for i,fiber in enumerate(fibers) :
+        if fitted[i] :
+            smooth_fiberflat[fiber] = smooth[i]*(ivar[fiber,:]*M[i]**2>0)
+        else :
+            log.error("Error when smoothing the flat")
+            log.error("Setting ivar=0 for fiber {} because spline fit failed".format(fiber))
+            ivar[fiber,:] *= 0
+        chi2 = ivar[fiber]*(flux[fiber]-smooth_fiberflat[fiber]*M[i])**2
+        fiber_chi2[fiber] = chi2.sum()
+        w=np.isnan(smooth_fiberflat[fiber])
+        if w.sum()>0:
+            ivar[fiber]=0
+            smooth_fiberflat[fiber]=1
+
+def _third_pass_fibers(fibers,fiberflat,fiberflat_ivar,mask,nbad,wave,flux,ivar,convolved_mean_spectrum,smoothing_res,nsig_for_mask,fiberflat_mask) :
+    """
+    3rd pass of compute_fiberflat for a list of fibers: unsmoothed fiber flat and masking of
+    outliers. Updates in place the rows of the other arrays for these fibers.
+
+    The fibers are masked one pixel per iteration, with at each iteration one
+    spline fit of all the fibers which are not done.
+    """
+    log=get_logger()
+    fibers=np.asarray(fibers,dtype=int)
+    fibers=fibers[np.sum(ivar[fibers]>0,axis=1)>0]
+
+    M = convolved_mean_spectrum[fibers]
+    fiberflat[fibers] = (M!=0)*flux[fibers]/(M+(M==0)) + (M==0)
+    fiberflat_ivar[fibers] = ivar[fibers]*M**2
+    nbad_tot=np.zeros(fibers.size,dtype=int)
+    niter=np.zeros(fibers.size,dtype=int)
+
+    # indices in fibers of the fibers still iterating
+    active=np.arange(fibers.size)
+    iteration=0
+    while iteration<500 and active.size>0 :
+        active=active[np.sum(fiberflat_ivar[fibers[active]]>0,axis=1)>=100]
+        if active.size==0 :
+            break
+        afibers=fibers[active]
+        smooth_fiberflat,fitted=spline_fit_batch(wave,wave,fiberflat[afibers],smoothing_res,fiberflat_ivar[afibers])
+        if not np.all(fitted) :
+            log.error("spline fit failed for fibers {}".format(afibers[~fitted]))
+            raise ValueError
+        chi2=fiberflat_ivar[afibers]*(fiberflat[afibers]-smooth_fiberflat)**2
+        done=np.zeros(active.size,dtype=bool)
+        for i,fiber in enumerate(afibers) :
+            bad=np.where(chi2[i]>nsig_for_mask**2)[0]
+            if bad.size>0 :
+
+                nbadmax=1
+                if bad.size>nbadmax : # not more than nbadmax pixels at a time
+                    ii=np.argsort(chi2[i,bad])
+                    bad=bad[ii[-nbadmax:]]
+
+                mask[fiber,bad] += fiberflat_mask
+                fiberflat_ivar[fiber,bad] = 0.
+                nbad_tot[active[i]] += bad.size
+            else :
+                done[i]=True
+        niter[active[~done]] += 1
+        active=active[~done]
+        iteration += 1
+
+    for i,fiber in enumerate(fibers) :
+        nbad[fiber]=nbad_tot[i]
+        log.info("3rd pass : fiber #%d , number of iterations %d"%(fiber,niter[i]))
+
+def _interpolate_fiberflat_fibers(fibers,fiberflat,fiberflat_ivar,wave,ivar,mask,nbad,minval,maxval) :
+    """
+    Replaces the masked pixels of the fiber flat of a list of fibers by a smooth fit.
+    Updates in place the rows of the other arrays for these fibers.
+    """
+    log=get_logger()
+    for fiber in fibers :
+
+        if np.sum(ivar[fiber]>0)==0 :
+            continue
+        # replace bad by smooth fiber flat
+        bad=np.where((mask[fiber]>0)|(fiberflat_ivar[fiber]==0)|(fiberflat[fiber]<minval)|(fiberflat[fiber]>maxval))[0]
+
+        if bad.size>0 :
+
+            fiberflat_ivar[fiber,bad] = 0
+
+            # find max length of segment with bad pix
+            length=0
+            for i in range(bad.size) :
+                ib=bad[i]
+                ilength=1
+                tmp=ib
+                for jb in bad[i+1:] :
+                    if jb==tmp+1 :
+                        ilength +=1
+                        tmp=jb
+                    else :
+                        break
+                length=max(length,ilength)
+            if length>10 :
+                log.info("3rd pass : fiber #%d has a max length of bad pixels=%d"%(fiber,length))
+            smoothing_res=float(max(100,length))
+            x=np.arange(wave.size)
+
+            ok=fiberflat_ivar[fiber]>0
+            if ok.sum()==0:
+                continue
+            try:
+                smooth_fiberflat=spline_fit(x,x[ok],fiberflat[fiber,ok],smoothing_res,fiberflat_ivar[fiber,ok])
+                fiberflat[fiber,bad] = smooth_fiberflat[bad]
+            except:
+                fiberflat[fiber,bad] = 1
+                fiberflat_ivar[fiber,bad]=0
+
+        if nbad[fiber]>0 :
+            log.info("3rd pass : fiber #%d masked pixels = %d"%(fiber,nbad[fiber]))
+
+
+def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxval=10.,max_iterations=100,smoothing_res=5.,max_bad=100,max_rej_it=5,min_sn=0,diag_epsilon=1e-3,nproc=1,comm=None) :
     """Compute fiber flat by deriving an average spectrum and dividing all fiber data by this average.
     Input data are expected to be on the same wavelength grid, with uncorrelated noise.
     They however do not have exactly the same resolution.
@@ -39,6 +358,9 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
         max_rej_it: [optional] reject at most the max_rej_it worst pixels in each iteration
         min_sn: [optional] mask portions with signal to noise less than min_sn
         diag_epsilon: [optional] size of the regularization term in the deconvolution
+        nproc: [optional] number of processes for the fiber spline fits and the normal matrix
+        comm: [optional] MPI communicator, if not None the fiber spline fits and the normal matrix
+            are distributed over its ranks (and nproc is ignored). All ranks get the result.
 
 
     Returns:
@@ -59,9 +381,32 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
 
     - the fiberflat is the ratio data/mean , so this flat should be divided to the data
 
+    - the result does not depend on nproc or comm: each fiber and each wavelength block
+      of the normal matrix is computed with the same operations whatever the other
+      fibers or blocks processed with it
+
     NOTE THAT THIS CODE HAS NOT BEEN TESTED WITH ACTUAL FIBER TRANSMISSION VARIATIONS,
     OUTLIER PIXELS, DEAD COLUMNS ...
     """
+    R = frame.R
+    pool = None
+    if nproc > 1 and (comm is None or comm.size == 1) :
+        # the processes and their shared memory are reused by all the iterations;
+        # the buffer is large enough for the normal matrix and the 3rd pass
+        fluxbytes = frame.nspec*frame.nwave*8
+        pool = _SharedMemoryPool(nproc,max(R.rows.nbytes+2*fluxbytes,6*fluxbytes)+1024)
+    try :
+        return _compute_fiberflat(frame,R,nsig_clipping,accuracy,minval,maxval,max_iterations,
+                                  smoothing_res,max_bad,max_rej_it,min_sn,pool,comm)
+    finally :
+        if pool is not None :
+            pool.close()
+
+def _compute_fiberflat(frame,R,nsig_clipping,accuracy,minval,maxval,max_iterations,smoothing_res,max_bad,max_rej_it,min_sn,pool,comm) :
+    """
+    Implementation of compute_fiberflat, with the resolution matrices R of the
+    frame as a BatchedResolution and an optional _SharedMemoryPool
+    """
     log=get_logger()
     log.info("starting")
 
@@ -123,6 +468,9 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
     ## 0th pass: reject pixels according to minval and maxval
     mean_spectrum = np.zeros(flux.shape[1])
     nbad=np.zeros(nfibers,dtype=int)
+    fibers=np.arange(nfibers)
+    fiber_chi2=np.zeros(nfibers)
+    fiber_nrej=np.zeros(nfibers,dtype=int)
     for iteration in range(max_iterations):
         for i in range(flux.shape[1]):
             w = ivar[:,i]>0
@@ -155,38 +503,11 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
             if w.sum() > 0 :
                 mean_spectrum[i]=np.median(flux[w,i])
 
-        nbad_it=0
-        sum_chi2 = 0
-        # not more than max_rej_it pixels per fiber at a time
-        for fib in range(nfibers) :
-            w=ivar[fib,:]>0
-            if w.sum()==0:
-                continue
-            F = flux[fib,:]*0
-            w=(mean_spectrum!=0) & (ivar[fib,:]>0)
-            F[w]= flux[fib,w]/mean_spectrum[w]
-            try :
-                smooth_fiberflat[fib,:] = spline_fit(wave,wave[w],F[w],smoothing_res,ivar[fib,w]*mean_spectrum[w]**2,max_resolution=1.5*smoothing_res)
-            except ValueError as err  :
-                log.error("Error when smoothing the flat")
-                log.error("Setting ivar=0 for fiber {} because spline fit failed".format(fib))
-                ivar[fib,:] *= 0
-            chi2 = ivar[fib,:]*(flux[fib,:]-mean_spectrum*smooth_fiberflat[fib,:])**2
-            w=np.isnan(chi2)
-            bad=np.where(chi2>nsig_clipping**2)[0]
-            if bad.size>0 :
-                if bad.size>max_rej_it : # not more than 5 pixels at a time
-                    ii=np.argsort(chi2[bad])
-                    bad=bad[ii[-max_rej_it:]]
-                ivar[fib,bad] = 0
-                log.warning("1st pass: rejecting {} pixels from fiber {}".format(len(bad),fib))
-                nbad[fib]+=len(bad)
-                if nbad[fib]>=max_bad:
-                    ivar[fib,:]=0
-                    log.warning("1st pass: rejecting fiber {} due to too many (new) bad pixels".format(fib))
-                nbad_it+=len(bad)
-
-            sum_chi2+=chi2.sum()
+        _run_parallel(_first_pass_fibers,fibers,[smooth_fiberflat,ivar,nbad,fiber_chi2,fiber_nrej],
+                      args=(wave,flux,mean_spectrum,smoothing_res,nsig_clipping,max_rej_it,max_bad),
+                      pool=pool,comm=comm)
+        nbad_it=np.sum(fiber_nrej)
+        sum_chi2=np.sum(fiber_chi2)
         ndf=int((ivar>0).sum()-nwave-nfibers*(nwave/smoothing_res))
         chi2pdf=0.
         if ndf>0 :
@@ -207,74 +528,43 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
     median_spectrum = mean_spectrum*1.
 
     previous_smooth_fiberflat = smooth_fiberflat*0
+    # wavelength blocks for the normal matrix, fixed so that the result does not depend on nproc
+    blocks = [(begin,min(begin+_wave_block_size,nwave)) for begin in range(0,nwave,_wave_block_size)]
     previous_max_diff = 0.
     log.info("after 1st pass : nout = %d/%d"%(np.sum(ivar==0),np.size(ivar.flatten())))
     # 2nd pass is full solution including deconvolved spectrum, no outlier rejection
     for iteration in range(max_iterations) :
-        ## reset sum_chi2
-        sum_chi2=0
         log.info("2nd pass, iter %d : mean deconvolved spectrum"%iteration)
 
         # fit mean spectrum
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-
-        # this is to go a bit faster
-        sqrtwflat=np.sqrt(ivar)*smooth_fiberflat
-
-        # loop on fiber to handle resolution (this is long)
-        for fiber in range(nfibers) :
-            if fiber%100==0 :
-                log.info("2nd pass, filling matrix, iter %d fiber %d"%(iteration,fiber))
-
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]
-            SD.setdiag(sqrtwflat[fiber])
-
-            sqrtwflatR = SD*R # each row r of R is multiplied by sqrtwflat[r]
-
-            A = A+(sqrtwflatR.T*sqrtwflatR).tocsr()
-            B += sqrtwflatR.T.dot(np.sqrt(ivar[fiber])*flux[fiber])
-        A_pos_def = A.todense()
+        # A = sum_(fiber f) R_f^T diag(w_f F_f^2) R_f, computed by blocks of wavelength
+        # B = sum_(fiber f) R_f^T (w_f F_f D_f)
+        log.info("2nd pass, filling matrix, iter %d"%iteration)
+        band=np.zeros((R.ndiag,nwave))
+        _run_parallel(_normal_matrix_blocks,blocks,[band],args=(R.rows,ivar*smooth_fiberflat**2,R.offsets),
+                      select=lambda block : (slice(None),slice(block[0],block[1])),pool=pool,comm=comm)
+        B=np.sum(R.dot_transpose(ivar*smooth_fiberflat*flux),axis=0)
         log.info("deconvolving")
-        w = A.diagonal() > 0
+        w = band[-1] > 0
 
-        A_pos_def = A_pos_def[w,:]
-        A_pos_def = A_pos_def[:,w]
+        # rows and columns of A with a null diagonal are null,
+        # so they are simply replaced by those of the identity
+        # and give mean_spectrum=0 there
+        band[-1,~w] = 1.
         mean_spectrum = np.zeros(nwave)
         try:
-            mean_spectrum[w]=cholesky_solve(A_pos_def,B[w])
+            mean_spectrum=scipy.linalg.solveh_banded(band,B*w)
         except:
+            A_pos_def = symmetric_band_to_dense(band)[w][:,w]
             mean_spectrum[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
             log.info("cholesky failes, trying svd inverse in iter {}".format(iteration))
 
-        for fiber in range(nfibers) :
-
-            if np.sum(ivar[fiber]>0)==0 :
-                continue
+        # reconvolve the mean spectrum with the resolution of all fibers
+        convolved_mean_spectrum = R.dot(mean_spectrum)
 
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]
-
-            M = R.dot(mean_spectrum)
-            ok=(M!=0) & (ivar[fiber,:]>0)
-            if ok.sum()==0:
-                continue
-            try :
-                smooth_fiberflat[fiber] = spline_fit(wave,wave[ok],flux[fiber,ok]/M[ok],smoothing_res,ivar[fiber,ok]*M[ok]**2,max_resolution=1.5*smoothing_res)*(ivar[fiber,:]*M**2>0)
-            except ValueError as err  :
-                log.error("Error when smoothing the flat")
-                log.error("Setting ivar=0 for fiber {} because spline fit failed".format(fiber))
-                ivar[fiber,:] *= 0
-            chi2 = ivar[fiber]*(flux[fiber]-smooth_fiberflat[fiber]*M)**2
-            sum_chi2 += chi2.sum()
-            w=np.isnan(smooth_fiberflat[fiber])
-            if w.sum()>0:
-                ivar[fiber]=0
-                smooth_fiberflat[fiber]=1
+        _run_parallel(_second_pass_fibers,fibers,[smooth_fiberflat,ivar,fiber_chi2],
+                      args=(wave,flux,convolved_mean_spectrum,smoothing_res),pool=pool,comm=comm)
+        sum_chi2=np.sum(fiber_chi2)
 
         # normalize to get a mean fiberflat=1
         mean = np.ones(smooth_fiberflat.shape[1])
@@ -327,43 +617,13 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
 
     nsig_for_mask=nsig_clipping # only mask out N sigma outliers
 
-    for fiber in range(nfibers) :
-
-        if np.sum(ivar[fiber]>0)==0 :
-            continue
+    convolved_mean_spectrum = R.dot(mean_spectrum)
 
-        ### R = Resolution(resolution_data[fiber])
-        R = frame.R[fiber]
-        M = np.array(np.dot(R.todense(),mean_spectrum)).flatten()
-        fiberflat[fiber] = (M!=0)*flux[fiber]/(M+(M==0)) + (M==0)
-        fiberflat_ivar[fiber] = ivar[fiber]*M**2
-        nbad_tot=0
-        iteration=0
-        while iteration<500 :
-            w=fiberflat_ivar[fiber,:]>0
-            if w.sum()<100:
-                break
-            smooth_fiberflat=spline_fit(wave,wave[w],fiberflat[fiber,w],smoothing_res,fiberflat_ivar[fiber,w])
-            chi2=fiberflat_ivar[fiber]*(fiberflat[fiber]-smooth_fiberflat)**2
-            bad=np.where(chi2>nsig_for_mask**2)[0]
-            if bad.size>0 :
-                
-                nbadmax=1
-                if bad.size>nbadmax : # not more than nbadmax pixels at a time
-                    ii=np.argsort(chi2[bad])
-                    bad=bad[ii[-nbadmax:]]
-
-                mask[fiber,bad] += fiberflat_mask
-                fiberflat_ivar[fiber,bad] = 0.
-                nbad_tot += bad.size
-            else :
-                break
-            iteration += 1
+    nbad=np.zeros(nfibers,dtype=int)
+    _run_parallel(_third_pass_fibers,fibers,[fiberflat,fiberflat_ivar,mask,nbad],
+                  args=(wave,flux,ivar,convolved_mean_spectrum,smoothing_res,nsig_for_mask,fiberflat_mask),
+                  pool=pool,comm=comm)
 
-        
-        log.info("3rd pass : fiber #%d , number of iterations %d"%(fiber,iteration))
-    
-    
     # set median flat to 1
     log.info("3rd pass : set median fiberflat to 1")
 
@@ -378,48 +638,8 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
 
     log.info("3rd pass : interpolating over masked pixels")
 
-
-    for fiber in range(nfibers) :
-
-        if np.sum(ivar[fiber]>0)==0 :
-            continue
-        # replace bad by smooth fiber flat
-        bad=np.where((mask[fiber]>0)|(fiberflat_ivar[fiber]==0)|(fiberflat[fiber]<minval)|(fiberflat[fiber]>maxval))[0]
-        
-        if bad.size>0 :
-
-            fiberflat_ivar[fiber,bad] = 0
-
-            # find max length of segment with bad pix
-            length=0
-            for i in range(bad.size) :
-                ib=bad[i]
-                ilength=1
-                tmp=ib
-                for jb in bad[i+1:] :
-                    if jb==tmp+1 :
-                        ilength +=1
-                        tmp=jb
-                    else :
-                        break
-                length=max(length,ilength)
-            if length>10 :
-                log.info("3rd pass : fiber #%d has a max length of bad pixels=%d"%(fiber,length))
-            smoothing_res=float(max(100,length))
-            x=np.arange(wave.size)
-
-            ok=fiberflat_ivar[fiber]>0
-            if ok.sum()==0:
-                continue
-            try:
-                smooth_fiberflat=spline_fit(x,x[ok],fiberflat[fiber,ok],smoothing_res,fiberflat_ivar[fiber,ok])
-                fiberflat[fiber,bad] = smooth_fiberflat[bad]
-            except:
-                fiberflat[fiber,bad] = 1
-                fiberflat_ivar[fiber,bad]=0
-
-        if nbad_tot>0 :
-            log.info("3rd pass : fiber #%d masked pixels = %d (%d iterations)"%(fiber,nbad_tot,iteration))
+    _run_parallel(_interpolate_fiberflat_fibers,fibers,[fiberflat,fiberflat_ivar],
+                  args=(wave,ivar,mask,nbad,minval,maxval),pool=pool,comm=comm)
 
     # set median flat to 1
     log.info("set median fiberflat to 1")
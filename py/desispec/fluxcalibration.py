@@ -8,7 +8,7 @@ from __future__ import absolute_import
 import numpy as np
 from .resolution import Resolution
 from .linalg import cholesky_solve, cholesky_solve_and_invert, spline_fit
-from .interpolation import resample_flux
+from .interpolation import resample_flux, resample_flux_batch
 from desiutil.log import get_logger
 from .io.filters import load_legacy_survey_filter
 from desispec import util
@@ -58,7 +58,7 @@ def applySmoothingFilter(flux,width=200) :
     """ Return a smoothed version of the input flux array using a median filter
 
     Args:
-        flux  : 1D array of flux 
+        flux  : 1D array of flux, or 2D array of spectra filtered independently along the last axis
         width : size of the median filter box
             
     Returns:
@@ -67,6 +67,8 @@ def applySmoothingFilter(flux,width=200) :
 
     # it was checked that the width of the median_filter has little impact on best fit stars
     # smoothing the ouput (with a spline for instance) does not improve the fit
+    if np.ndim(flux)>1 :
+        width=(1,)*(np.ndim(flux)-1)+(width,)
     return scipy.ndimage.filters.median_filter(flux,width,mode='constant')
 #
 # Import some global constants.
@@ -123,18 +125,58 @@ def resample_template(data_wave_per_camera,resolution_data_per_camera,template_w
     return template_id,output_wave,output_flux,output_norm
 
 
-def _func(arg) :
-    """ Used for multiprocessing.Pool """
-    return resample_template(**arg)
+def resample_templates(data_wave_per_camera,resolution_data_per_camera,template_wave,template_flux) :
+    """Same as resample_template for all the templates at once. The templates share the same
+    wavelength grid so they are resampled with a single (cached) sparse matrix product
+    and convolved by the resolution of each camera with another one.
 
-def _smooth_template(template_id,camera_index,template_flux) :
-    """ Used for multiprocessing.Pool """
-    norme = applySmoothingFilter(template_flux)
-    return template_id,camera_index,norme
+    Args:
+        data_wave_per_camera : A dictionary of 1D array of vacuum wavelengths [Angstroms], one entry per camera and exposure.
+        resolution_data_per_camera :  A dictionary of resolution corresponding for the fiber, one entry per camera and exposure.
+        template_wave : 1D array, input spectral template wavelength [Angstroms] (arbitrary spacing).
+        template_flux : 2D[ntemplates, nwave] array, input spectral templates flux density.
 
-def _func2(arg) :
+    Returns:
+        output_wave   : 1D array of vacuum wavelengths, concatenation of the cameras in sorted order
+        output_flux   : 2D[ntemplates, output_wave.size] array of output template flux divided by the smoothed flux
+        output_norm   : 2D[ntemplates, output_wave.size] array of output template smoothed flux
+    """
+    template_flux=np.atleast_2d(template_flux)
+    output_wave=[]
+    output_flux=[]
+    output_norm=[]
+    sorted_keys = list(data_wave_per_camera.keys())
+    sorted_keys.sort() # force sorting the keys to agree with data
+    for cam in sorted_keys :
+        flux1=resample_flux_batch(data_wave_per_camera[cam],template_wave,template_flux)
+        flux2=Resolution(resolution_data_per_camera[cam]).dot(flux1.T).T
+        norme=applySmoothingFilter(flux2)
+        output_flux.append(flux2/(norme+(norme==0)))
+        output_norm.append(norme)
+        output_wave.append(data_wave_per_camera[cam])
+    return np.hstack(output_wave),np.hstack(output_flux),np.hstack(output_norm)
+
+# template bank of the worker processes of match_templates_many
+_template_bank = dict()
+
+def _init_template_bank(stdwave, stdflux, teff, logg, feh) :
+    """ Initializer of the multiprocessing.Pool of match_templates_many """
+    _template_bank["stdwave"] = stdwave
+    _template_bank["stdflux"] = stdflux
+    _template_bank["teff"] = teff
+    _template_bank["logg"] = logg
+    _template_bank["feh"] = feh
+
+def _match_templates_star(arg) :
     """ Used for multiprocessing.Pool """
-    return _smooth_template(**arg)
+    selection = arg.pop("selection")
+    if selection is None :
+        selection = slice(None)
+    return match_templates(stdwave=_template_bank["stdwave"],
+                           stdflux=_template_bank["stdflux"][selection],
+                           teff=_template_bank["teff"][selection],
+                           logg=_template_bank["logg"][selection],
+                           feh=_template_bank["feh"][selection], **arg)
 
 def redshift_fit(wave, flux, ivar, resolution_data, stdwave, stdflux, z_max=0.005, z_res=0.00005, template_error=0.):
     """ Redshift fit of a single template
@@ -528,7 +570,8 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         teff : 1D[nstd] effective model temperature
         logg : 1D[nstd] model surface gravity
         feh : 1D[nstd] model metallicity
-        ncpu : number of cpu for multiprocessing
+        ncpu : unused, the templates are processed all at once;
+               see match_templates_many to fit several stars in parallel
 
     Returns:
         coef : numpy.array of linear coefficient of standard stars        
@@ -644,58 +687,18 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
             
     # now we go back to the model spectra , redshift them, resample, apply resolution, normalize and chi2 match
     
-    ntemplates=stdflux.shape[0]
-
     # here we take into account the redshift once and for all
     shifted_stdwave=stdwave*(1+z)
         
-    func_args = []
-    # need to parallelize the model resampling
-    for template_id in range(ntemplates) :
-        arguments={"data_wave_per_camera":wave,
-                   "resolution_data_per_camera":resolution_data,
-                   "template_wave":shifted_stdwave,
-                   "template_flux":stdflux[template_id],
-                   "template_id":template_id}
-        func_args.append( arguments )
-    
-    
-    if ncpu > 1:
-        log.debug("creating multiprocessing pool with %d cpus"%ncpu); sys.stdout.flush()
-        pool = multiprocessing.Pool(ncpu)
-        log.debug("Running pool.map() for {} items".format(len(func_args))); sys.stdout.flush()
-        results  =  pool.map(_func, func_args)
-        log.debug("Finished pool.map()"); sys.stdout.flush()
-        pool.close()
-        pool.join()
-        log.debug("Finished pool.join()"); sys.stdout.flush()
-    else:
-        log.debug("Not using multiprocessing for {} cpus".format(ncpu))
-        
-        results = [_func(x) for x in func_args]
-        log.debug("Finished serial loop")
-
-    # collect results
-    # in case the exit of the multiprocessing pool is not ordered as the input
-    # we returned the template_id
-    template_flux=np.zeros((ntemplates,data_flux.size))
-    template_norm=np.zeros((ntemplates,data_flux.size))
-    for result in results :
-        template_id       = result[0]
-        template_tmp_wave = result[1]
-        template_tmp_flux = result[2]
-        template_tmp_norm = result[3]
-        mdiff=np.max(np.abs(data_wave-template_tmp_wave)) # just a safety check
-        if mdiff>1.e-5 :
-            log.error("error indexing of wave and flux somewhere above, checking if it's just an ordering issue, max diff=%f"%mdiff)
-            raise ValueError("wavelength array difference cannot be fixed with reordering, ordered max diff=%f"%mdiff)
-        template_flux[template_id] = template_tmp_flux
-        template_norm[template_id] = template_tmp_norm
+    # resample all the templates at once
+    template_tmp_wave,template_flux,template_norm = resample_templates(wave,resolution_data,shifted_stdwave,stdflux)
+    mdiff=np.max(np.abs(data_wave-template_tmp_wave)) # just a safety check
+    if mdiff>1.e-5 :
+        log.error("error indexing of wave and flux somewhere above, max diff=%f"%mdiff)
+        raise ValueError("wavelength array difference, max diff=%f"%mdiff)
 
     # compute model chi2
-    template_chi2=np.zeros(ntemplates)
-    for template_id in range(ntemplates) :
-        template_chi2[template_id] = np.sum(data_ivar*(data_flux-template_flux[template_id])**2)
+    template_chi2=np.sum(data_ivar*(data_flux-template_flux)**2,axis=1)
     
     best_model_id=np.argmin(template_chi2) 
     best_chi2=template_chi2[best_model_id]
@@ -720,7 +723,6 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         if c>0 : model += c*t
 
 
-    func_args=[]    
     for index in np.unique(data_index) :
         log.debug("compute calib for cam index %d"%index)
         ii=np.where(data_index==index)[0]
@@ -736,33 +738,12 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         template_flux[:,ii] *= scalib
         
         # apply this to all the templates and recompute median filter
-        for t in range(template_flux.shape[0]) :
-            arguments={"template_id":t,"camera_index":index,"template_flux":template_flux[t][ii]}
-            func_args.append(arguments)
-    
-    if ncpu > 1:
-        log.debug("divide templates by median filters using multiprocessing.Pool of ncpu=%d"%ncpu)
-        pool = multiprocessing.Pool(ncpu)
-        results  =  pool.map(_func2, func_args)
-        log.debug("finished pool.map()"); sys.stdout.flush()
-        pool.close()
-        pool.join()
-        log.debug("finished pool.join()"); sys.stdout.flush()
-    else :
-        log.debug("divide templates serially")
-        results = [_func2(x) for x in func_args]
-        log.debug("Finished serial loop")
-    
-    # collect results
-    for result in results :
-        template_id = result[0]
-        index  = result[1]
-        template_flux[template_id][data_index==index] /= (result[2] + (result[2]==0))
+        log.debug("divide templates by median filters for cam index %d"%index)
+        norme = applySmoothingFilter(template_flux[:,ii])
+        template_flux[:,ii] /= (norme + (norme==0))
     
     log.debug("refit the model ...")
-    template_chi2=np.zeros(ntemplates)
-    for template_id in range(ntemplates) :
-        template_chi2[template_id] = np.sum(data_ivar*(data_flux-template_flux[template_id])**2)
+    template_chi2=np.sum(data_ivar*(data_flux-template_flux)**2,axis=1)
     
     best_model_id=np.argmin(template_chi2) 
     best_chi2=template_chi2[best_model_id]
@@ -777,6 +758,63 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
     return coef,z,chi2/ndata
 
 
+def match_templates_many(wave, flux, ivar, resolution_data, selections, stdwave, stdflux, teff, logg, feh, ncpu=1, z_max=0.005, z_res=0.00002, template_error=0):
+    """Run match_templates for several stars, in parallel over the stars if ncpu>1.
+
+    Args:
+        wave : A dictionary of 1D array of vacuum wavelengths [Angstroms], common to all stars.
+        flux : list of dictionaries of 1D observed flux, one per star
+        ivar : list of dictionaries of 1D inverse variance of flux, one per star
+        resolution_data: list of dictionaries of resolution data, one per star
+        selections : list of 1D arrays of indices of the templates to fit, one per star,
+                     (None to fit all the templates)
+        stdwave : 1D standard star template wavelengths [Angstroms]
+        stdflux : 2D[nstd, nwave] template flux
+        teff : 1D[nstd] effective model temperature
+        logg : 1D[nstd] model surface gravity
+        feh : 1D[nstd] model metallicity
+        ncpu : number of cpu for multiprocessing
+
+    Returns:
+        list of (coef, redshift, chipdf) per star, see match_templates.
+        coef is for the selected templates.
+
+    The templates are given once to the workers of a single multiprocessing.Pool
+    with its initializer (shared copy-on-write with the default fork start method)
+    so that only the data of each star are sent with the tasks.
+    """
+    log = get_logger()
+    nstars = len(flux)
+    if selections is None :
+        selections = [None,]*nstars
+    func_args = []
+    for star in range(nstars) :
+        func_args.append({"wave":wave,"flux":flux[star],"ivar":ivar[star],
+                          "resolution_data":resolution_data[star],
+                          "selection":selections[star],
+                          "z_max":z_max,"z_res":z_res,"template_error":template_error})
+
+    ncpu = min(ncpu,nstars)
+    if ncpu > 1 :
+        log.debug("creating multiprocessing pool with %d cpus for %d stars"%(ncpu,nstars)); sys.stdout.flush()
+        pool = multiprocessing.Pool(ncpu,initializer=_init_template_bank,
+                                    initargs=(stdwave,stdflux,teff,logg,feh))
+        results = pool.map(_match_templates_star, func_args, chunksize=1)
+        log.debug("Finished pool.map()"); sys.stdout.flush()
+        pool.close()
+        pool.join()
+    else :
+        results = list()
+        for arg in func_args :
+            selection = arg.pop("selection")
+            if selection is None :
+                selection = slice(None)
+            results.append(match_templates(stdwave=stdwave, stdflux=stdflux[selection],
+                                           teff=teff[selection], logg=logg[selection],
+                                           feh=feh[selection], **arg))
+    return results
+
+
 def normalize_templates(stdwave, stdflux, mag, band, photsys):
     """Returns spectra normalized to input magnitudes.
 
@@ -860,12 +898,8 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     dwave=(stdstars.wave-np.mean(stdstars.wave))/(stdstars.wave[-1]-stdstars.wave[0]) # normalized wave for polynomial fit
 
     # resample model to data grid and convolve by resolution
-    model_flux=np.zeros((nstds, nwave))
-    convolved_model_flux=np.zeros((nstds, nwave))
-
-    for fiber in range(model_flux.shape[0]) :
-        model_flux[fiber]=resample_flux(stdstars.wave,input_model_wave,input_model_flux[fiber])
-        convolved_model_flux[fiber]=stdstars.R[fiber].dot(model_flux[fiber])
+    model_flux=resample_flux_batch(stdstars.wave,input_model_wave,input_model_flux[:nstds])
+    convolved_model_flux=stdstars.R.dot(model_flux)
 
     # iterative fitting and clipping to get precise mean spectrum
     current_ivar=stdstars.ivar*(stdstars.mask==0)
@@ -879,7 +913,7 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     chi2=np.zeros((stdstars.flux.shape))  
 
     for fiber in range(nstds) :
-        M = median_calib*stdstars.R[fiber].dot(model_flux[fiber])
+        M = median_calib*convolved_model_flux[fiber]
         
         try:
             pol=np.poly1d(np.polyfit(dwave,stdstars.flux[fiber]/(M+(M==0)),deg=deg,w=current_ivar[fiber]*M**2))
@@ -901,7 +935,9 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     D1=scipy.sparse.lil_matrix((nwave,nwave))
     D2=scipy.sparse.lil_matrix((nwave,nwave))
 
-    
+    #- the sparse matrix of each star is used at each iteration
+    Rstd = [stdstars.R[fiber] for fiber in range(nstds)]
+
     nout_tot=0
     previous_mean=0.
     for iteration in range(20) :
@@ -915,7 +951,7 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
             if fiber%10==0 :
                 log.info("iter %d fiber %d"%(iteration,fiber))
 
-            R = stdstars.R[fiber]
+            R = Rstd[fiber]
 
             # diagonal sparse matrix with content = sqrt(ivar)*flat
             D1.setdiag(sqrtw[fiber]*smooth_fiber_correction[fiber])
@@ -951,12 +987,13 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
             calibration[w] = np.linalg.lstsq(A_pos_def,B[w])[0]
 
         log.info("iter %d fit smooth correction per fiber"%iteration)
+        convolved_calib_model_flux = stdstars.R.dot(calibration*model_flux)
         # fit smooth fiberflat and compute chi2
         for fiber in range(nstds) :
             if fiber%10==0 :
                 log.info("iter %d fiber %d(smooth)"%(iteration,fiber))
 
-            M = stdstars.R[fiber].dot(calibration*model_flux[fiber])
+            M = convolved_calib_model_flux[fiber]
 
             try:
                 pol=np.poly1d(np.polyfit(dwave,stdstars.flux[fiber]/(M+(M==0)),deg=deg,w=current_ivar[fiber]*M**2))
@@ -1029,15 +1066,12 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
 
     # we also want to save the convolved calibration and a calibration variance
     # first compute average resolution
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
+    mean_res_data=np.mean(frame.R.data,axis=0)
     R = Resolution(mean_res_data)
     # compute convolved calib
-    ccalibration = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        norme = frame.R[i].dot(np.ones(calibration.shape))
-        ok=np.where(norme>0)[0]
-        if ok.size :
-            ccalibration[i][ok]=frame.R[i].dot(calibration)[ok]/norme[ok]
+    norme = frame.R.dot(np.ones(calibration.shape))
+    ok = norme>0
+    ccalibration = ok*frame.R.dot(calibration)/(norme+(~ok))
         
     # Use diagonal of mean calibration covariance for output.
     ccalibcovar=R.dot(calibcovar).dot(R.T.todense())
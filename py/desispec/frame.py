@@ -11,7 +11,7 @@ import numbers
 import numpy as np
 
 from desispec import util
-from desispec.resolution import Resolution
+from desispec.resolution import BatchedResolution
 from desiutil.log import get_logger
 from desispec import util
 
@@ -80,8 +80,8 @@ class Frame(object):
             nspec : number of spectra, flux.shape[0]
             nwave : number of wavelengths, flux.shape[1]
             specmin : minimum fiber number
-            R: array of sparse Resolution matrix objects converted
-               from resolution_data
+            R: BatchedResolution built from resolution_data on first use
+               (or array of QuickResolution objects built from wsigma)
             fibermap: fibermap table if provided
         """
         assert wave.ndim == 1
@@ -118,17 +118,18 @@ class Frame(object):
         #- Maybe setup non-None identity matrix resolution matrix instead?
         self.wsigma=wsigma
         self.resolution_data = resolution_data
+        self._R = None
         if resolution_data is not None:
             self.wsigma=None #ignore width coefficients if resolution data is given explicitly
             self.ndiag=None 
-            self.R = np.array( [Resolution(r) for r in resolution_data] )
+            #- self.R is built from resolution_data on first use
         elif wsigma is not None:
             from desispec.quicklook.qlresolution import QuickResolution
             assert ndiag is not None
             r=[]
             for sigma in wsigma:
                 r.append(QuickResolution(sigma=sigma,ndiag=self.ndiag))
-            self.R=np.array(r)
+            self.R=BatchedResolution.from_resolutions(r)
         else:
             #SK I believe this should be error, but looking at the
             #tests frame objects are allowed to not to have resolution data
@@ -166,6 +167,26 @@ class Frame(object):
         if self.meta is not None:
             self.meta['FIBERMIN'] = np.min(self.fibers)
 
+    @property
+    def R(self):
+        """Resolution matrices of the spectra
+
+        A BatchedResolution built from resolution_data the first time it is
+        used, so frames that are never convolved do not pay for it, or from
+        the QuickResolution matrices of wsigma. Indexing it with an integer
+        gives a Resolution object. Sequences of resolution matrices assigned
+        to it are converted to a BatchedResolution.
+        """
+        if self._R is None and self.resolution_data is not None:
+            self._R = BatchedResolution(self.resolution_data)
+        return self._R
+
+    @R.setter
+    def R(self, value):
+        if value is not None and not isinstance(value, BatchedResolution):
+            value = BatchedResolution.from_resolutions(value)
+        self._R = value
+
     def vet(self):
         """ Perform very basic checks on the frame
         Generally run before writing to disk (or when read)
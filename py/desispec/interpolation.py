@@ -5,7 +5,11 @@ desispec.interpolation
 Utility functions for interpolation of spectra over different wavelength grids.
 """
 
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
+import scipy.sparse
 import sys
 from desiutil.log import get_logger
 
@@ -226,3 +230,204 @@ def _unweighted_resample(output_x,input_x,input_flux_density, extrapolate=False)
     
     return np.histogram(trapeze_centers, bins=bins, weights=trapeze_integrals)[0] / binsize
 
+
+def get_resampling_matrix(global_grid,local_grid,sparse=False):
+    """Build the rectangular matrix that linearly resamples from the global grid to a local grid.
+
+    The local grid range must be contained within the global grid range.
+
+    Args:
+        global_grid(numpy.ndarray): Sorted array of n global grid wavelengths.
+        local_grid(numpy.ndarray): Sorted array of m local grid wavelengths.
+
+    Returns:
+        scipy.sparse.csc_matrix: (m,n) matrix that performs the linear resampling.
+    """
+    assert np.all(np.diff(global_grid) > 0),'Global grid is not strictly increasing.'
+    assert np.all(np.diff(local_grid) > 0),'Local grid is not strictly increasing.'
+    # Locate each local wavelength in the global grid.
+    global_index = np.searchsorted(global_grid,local_grid)
+
+    assert local_grid[0] >= global_grid[0],'Local grid extends below global grid.'
+    assert local_grid[-1] <= global_grid[-1],'Local grid extends above global grid.'
+
+    # Lookup the global-grid bracketing interval (xlo,xhi) for each local grid point.
+    # Note that this gives xlo = global_grid[-1] if local_grid[0] == global_grid[0]
+    # but this is fine since the coefficient of xlo will be zero.
+    global_xhi = global_grid[global_index]
+    global_xlo = global_grid[global_index-1]
+    # Create the sparse rectangular interpolation matrix to return.
+    alpha = (local_grid - global_xlo)/(global_xhi - global_xlo)
+    local_index = np.arange(len(local_grid),dtype=int)
+    nglobal = len(global_grid)
+    matrix = scipy.sparse.csc_matrix(
+        (np.concatenate([alpha, 1-alpha]),
+         (np.concatenate([local_index, local_index]),
+          np.concatenate([global_index, (global_index-1) % nglobal]))),
+        shape=(len(local_grid),nglobal))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+# cache of resampling matrices, see resampling_matrix
+_resampling_cache = OrderedDict()
+_resampling_cache_size = 8
+
+def resampling_matrix(output_x, input_x, extrapolate=False) :
+    """Returns the sparse matrix of the flux conserving resampling of
+    _unweighted_resample, such that
+    ``output_flux_density = R.dot(input_flux_density)``
+
+    The matrices of 1D input grids are cached, keyed by the input and
+    output grids, so that resampling many spectra on the same grids only
+    builds the matrix once. The block diagonal matrices of 2D input grids,
+    which are large and rarely reused, are not cached.
+
+    Args:
+        output_x: SORTED 1D array, not necessarily linearly spaced
+        input_x: SORTED 1D array of size nin, or 2D array (nspec,nin)
+                 with one input grid per spectrum
+
+    Options:
+        extrapolate: extrapolate using edge values of input array, default is False,
+                     in which case values outside of input array are set to zero
+
+    Returns:
+        scipy.sparse.csr_matrix of shape (nout,nin) for a 1D input_x,
+        or block diagonal matrix of shape (nspec*nout,nspec*nin)
+        for a 2D input_x, to be applied to the flattened
+        (nspec,nin) flux array.
+    """
+    output_x = np.asarray(output_x, dtype=np.float64)
+    input_x = np.asarray(input_x, dtype=np.float64)
+    if input_x.ndim > 1 :
+        return _resampling_matrix(output_x, input_x, extrapolate)
+    key = (output_x.shape, input_x.shape, bool(extrapolate),
+           hashlib.sha1(output_x.tobytes()).hexdigest(),
+           hashlib.sha1(input_x.tobytes()).hexdigest())
+    if key in _resampling_cache :
+        _resampling_cache.move_to_end(key)
+        return _resampling_cache[key]
+    matrix = _resampling_matrix(output_x, input_x, extrapolate)
+    _resampling_cache[key] = matrix
+    while len(_resampling_cache) > _resampling_cache_size :
+        _resampling_cache.popitem(last=False)
+    return matrix
+
+def _resampling_matrix(output_x, input_x, extrapolate) :
+    """Builds the matrix of resampling_matrix, without cache
+
+    Each output bin is the average over the bin of the piece-wise linear
+    function of the input nodes (see _unweighted_resample).
+    The input nodes and the output bin boundaries of each spectrum are
+    merged and sorted, and the integral of each interval of the merged
+    array is split between the two input nodes of the interval.
+    """
+    ox = output_x
+    ix = np.atleast_2d(input_x)
+    nspec, nin = ix.shape
+    nout = ox.size
+
+    # boundary of output bins
+    bins=np.zeros(nout+1)
+    bins[1:-1]=(ox[:-1]+ox[1:])/2.
+    bins[0]=1.5*ox[0]-0.5*ox[1]
+    bins[-1]=1.5*ox[-1]-0.5*ox[-2]
+    binsize = bins[1:]-bins[:-1]
+    if np.any(binsize<=0)  :
+        raise ValueError("Zero or negative bin size")
+
+    # extended nodes with the column of the input flux they refer to (-1 for a null flux).
+    # if we do not extrapolate, the edges of the first and last triangles have a zero flux density,
+    # otherwise the flux density is constant beyond the first and last nodes
+    if extrapolate :
+        xmin = np.minimum(ix[:,0],bins[0])-1.
+        xmax = np.maximum(ix[:,-1],bins[-1])+1.
+        column = np.concatenate([[0],np.arange(nin),[nin-1]])
+    else :
+        xmin = 2*ix[:,0]-ix[:,1]
+        xmax = 2*ix[:,-1]-ix[:,-2]
+        column = np.concatenate([[-1],np.arange(nin),[-1]])
+    nodes = np.hstack([xmin[:,None],ix,xmax[:,None]])
+    nnodes = nin+2
+
+    # merged and sorted nodes and bin boundaries, for all spectra at once
+    tx = np.hstack([nodes,np.tile(bins,(nspec,1))])
+    order = np.argsort(tx,axis=1,kind="stable")
+    tx = np.take_along_axis(tx,order,axis=1)
+
+    # index of the input node segment and of the output bin of each interval,
+    # from the number of nodes and bin boundaries before the interval
+    segment = np.cumsum(order<nnodes,axis=1)[:,:-1]-1
+    outbin = np.arange(tx.shape[1]-1)-segment-1
+    width = np.diff(tx,axis=1)
+    valid = (width>0)&(segment>=0)&(segment<nnodes-1)&(outbin>=0)&(outbin<nout)
+    index = np.flatnonzero(valid)
+    spec = index//(tx.shape[1]-1)
+    segment = segment.ravel()[index]
+    outbin = outbin.ravel()[index]
+    center = (tx[:,1:]+tx[:,:-1]).ravel()[index]/2.
+    width = width.ravel()[index]/binsize[outbin]
+
+    # integral of the linear function of the segment over the interval,
+    # split between the two nodes of the segment
+    x0 = nodes[spec,segment]
+    w1 = (center-x0)/(nodes[spec,segment+1]-x0)
+    rows = np.tile(outbin+nout*spec,2)
+    cols = np.concatenate([column[segment],column[segment+1]])
+    vals = np.concatenate([width*(1-w1),width*w1])
+    ok = (cols>=0)
+    cols += nin*np.tile(spec,2)
+    # duplicates are summed
+    return scipy.sparse.csr_matrix((vals[ok],(rows[ok],cols[ok])),shape=(nspec*nout,nspec*nin))
+
+def _apply_resampling(matrix, flux) :
+    """Applies the matrix of resampling_matrix to a 2D flux array (nspec,nin)"""
+    if matrix.shape[1] == flux.size :
+        # one input grid per spectrum
+        return matrix.dot(flux.ravel()).reshape(flux.shape[0],-1)
+    return matrix.dot(flux.T).T
+
+def resample_flux_batch(xout, x, flux, ivar=None, extrapolate=False) :
+    """Flux conserving resampling of many spectra at once,
+    same as calling resample_flux for each spectrum.
+
+    Args:
+        - xout: output SORTED 1D vector, not necessarily linearly spaced
+        - x: input SORTED 1D vector of size nin common to all spectra,
+          or 2D array (nspec,nin) with one input grid per spectrum
+        - flux: 2D array (nspec,nin) of input flux density dflux/dx sampled at x
+
+    Options:
+        - ivar: 2D array (nspec,nin) of weights for flux; default is unweighted resampling
+        - extrapolate: extrapolate using edge values of input array, default is False,
+          in which case values outside of input array are set to zero.
+
+    Setting both ivar and extrapolate raises a ValueError.
+
+    The sparse resampling matrix is cached (see resampling_matrix)
+    and applied to all the spectra with one matrix product.
+
+    Returns:
+        if ivar is None, returns outflux, 2D array (nspec,nout)
+        if ivar is not None, returns outflux, outivar
+    """
+    xout = np.asarray(xout)
+    x = np.asarray(x)
+    flux = np.atleast_2d(flux)
+    if ivar is None:
+        matrix = resampling_matrix(xout, x, extrapolate=extrapolate)
+        return _apply_resampling(matrix, flux)
+    if extrapolate :
+        raise ValueError("Cannot extrapolate ivar. Either set ivar=None and extrapolate=True or the opposite")
+    ivar = np.atleast_2d(ivar)
+    matrix = resampling_matrix(xout, x)
+    a = _apply_resampling(matrix, flux*ivar)
+    b = _apply_resampling(matrix, ivar)
+    mask = (b>0)
+    outflux = np.zeros(a.shape)
+    outflux[mask] = a[mask] / b[mask]
+    dx = np.gradient(x, axis=-1)
+    dxout = np.gradient(xout)
+    outivar = _apply_resampling(matrix, ivar/dx)*dxout
+    return outflux, outivar
@@ -14,12 +14,17 @@ warnings.filterwarnings('ignore', message="'.*nanomaggies.* did not parse as fit
 warnings.filterwarnings('ignore', message=".*'10\*\*6 arcsec.* did not parse as fits unit.*")
 
 from .download import download, filepath2url
+from .expcatalog import (get_expcatalog_path, update_expcatalog,
+                         read_expcatalog)
 from .fiberflat import read_fiberflat, write_fiberflat
 from .fibermap import read_fibermap, write_fibermap, empty_fibermap
 from .filters import load_filter,load_legacy_survey_filter
 from .fluxcalibration import (read_stdstar_templates, write_stdstar_models,
                               read_stdstar_models, read_flux_calibration,
-                              write_flux_calibration)
+                              write_flux_calibration,
+                              stdstar_templates_cache_entry,
+                              read_stdstar_templates_cache,
+                              write_stdstar_templates_cache)
 from .spectra import read_spectra, write_spectra, read_frame_as_spectra
 from .frame import read_meta_frame, read_frame, write_frame
 from .xytraceset import read_xytraceset, write_xytraceset
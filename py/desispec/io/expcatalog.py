@@ -0,0 +1,212 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+# -*- coding: utf-8 -*-
+"""
+desispec.io.expcatalog
+======================
+
+Persistent catalog of the exposures in the raw data tree.
+
+The catalog is a SQLite file recording the night, exposure ID, flavor,
+cameras, exposure time and file modification time of every raw exposure.
+It is refreshed incrementally: every raw data file is checked at each
+refresh, but its header is only read again if the file has changed.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import re
+import sqlite3
+
+import numpy as np
+from astropy.table import Table
+
+from desiutil.log import get_logger
+
+from .meta import rawdata_root, get_pipe_rundir
+
+
+_expcatalog_schema = """
+create table if not exists exposure (
+    night integer,
+    expid integer,
+    flavor text,
+    cameras text,
+    exptime real,
+    mtime real,
+    primary key (night, expid)
+);
+"""
+
+
+def get_expcatalog_path(specprod_dir=None):
+    """Return the default path of the exposure catalog.
+
+    Args:
+        specprod_dir (str): Optional path to production directory.  If None,
+            the this is obtained from :func:`specprod_root`.
+
+    Returns (str):
+        the value of $DESI_EXPOSURE_CATALOG if set, otherwise the file
+        exposures.db in the pipeline runtime directory.
+    """
+    if 'DESI_EXPOSURE_CATALOG' in os.environ:
+        return os.environ['DESI_EXPOSURE_CATALOG']
+    return os.path.join(get_pipe_rundir(specprod_dir), 'exposures.db')
+
+
+def _read_raw_header(filename):
+    """Read the flavor, cameras and exposure time of a raw data file.
+
+    Args:
+        filename (str): path to a raw data file.
+
+    Returns:
+        tuple: flavor, comma-separated cameras and exposure time; each of
+            them None if not found in the file.
+    """
+    import fitsio
+    flavor = None
+    exptime = None
+    cameras = list()
+    with fitsio.FITS(filename) as fx:
+        for hdu in fx:
+            extname = hdu.get_extname().strip().lower()
+            if re.match(r'^[brz]\d$', extname):
+                cameras.append(extname)
+        if len(fx) > 1:
+            header = fx[1].read_header()
+            if 'FLAVOR' in header:
+                flavor = header['FLAVOR'].strip().lower()
+            if 'EXPTIME' in header:
+                exptime = float(header['EXPTIME'])
+    if len(cameras) == 0:
+        cameras = None
+    else:
+        cameras = ','.join(sorted(cameras))
+    return (flavor, cameras, exptime)
+
+
+def update_expcatalog(catalog=None, rawdata_dir=None, nights=None, full=False):
+    """Refresh the exposure catalog from the raw data tree.
+
+    The modification time of every raw data file is checked, and its
+    header is only read if the file is new or has changed.  Exposures
+    without a raw data file yet, or whose header cannot be read (e.g. a
+    file still being written), are recorded with no flavor and are read
+    again at the next refresh.
+
+    Args:
+        catalog (str): path to the catalog file.  If None, use
+            :func:`get_expcatalog_path`.
+        rawdata_dir (str): [optional] overrides $DESI_SPECTRO_DATA
+        nights (list): only refresh these nights (YYYYMMDD strings).
+        full (bool): if True, read the headers of all raw data files again.
+
+    Returns:
+        int: the number of raw data file headers read.
+    """
+    log = get_logger()
+    if catalog is None:
+        catalog = get_expcatalog_path()
+    if rawdata_dir is None:
+        rawdata_dir = rawdata_root()
+    if nights is None:
+        nights = [n for n in os.listdir(rawdata_dir)
+                  if re.match(r'^\d{8}$', n) and
+                  os.path.isdir(os.path.join(rawdata_dir, n))]
+    catdir = os.path.dirname(os.path.abspath(catalog))
+    if not os.path.isdir(catdir):
+        os.makedirs(catdir)
+
+    nread = 0
+    conn = sqlite3.connect(catalog, timeout=60)
+    try:
+        conn.executescript(_expcatalog_schema)
+        for night in sorted(nights):
+            nightdir = os.path.join(rawdata_dir, night)
+            if not os.path.isdir(nightdir):
+                continue
+            have = dict(conn.execute('select expid, mtime from exposure '
+                                     'where night = ?', (int(night),)).fetchall())
+            rows = list()
+            expids = list()
+            for e in os.listdir(nightdir):
+                if not re.match(r'^\d{8}$', e):
+                    continue
+                expid = int(e)
+                expids.append(expid)
+                rawfile = os.path.join(nightdir, e, 'desi-{}.fits.fz'.format(e))
+                try:
+                    mtime = os.stat(rawfile).st_mtime
+                except OSError:
+                    if (expid not in have) or (have[expid] is not None):
+                        rows.append((int(night), expid, None, None, None, None))
+                    continue
+                if (not full) and (expid in have) and (have[expid] == mtime):
+                    continue
+                try:
+                    flavor, cameras, exptime = _read_raw_header(rawfile)
+                except (OSError, ValueError) as err:
+                    #- e.g. a file still being written; try again next time
+                    log.warning('Unable to read {}: {}'.format(rawfile, err))
+                    rows.append((int(night), expid, None, None, None, None))
+                    continue
+                nread += 1
+                rows.append((int(night), expid, flavor, cameras, exptime, mtime))
+            conn.executemany('insert or replace into exposure (night, expid, '
+                             'flavor, cameras, exptime, mtime) values '
+                             '(?,?,?,?,?,?)', rows)
+            gone = [(int(night), x) for x in have if x not in expids]
+            conn.executemany('delete from exposure where night = ? and '
+                             'expid = ?', gone)
+            conn.commit()
+            log.debug('Exposure catalog: night {} has {} exposures, {} updated'
+                      .format(night, len(expids), len(rows)))
+    finally:
+        conn.close()
+    log.debug('Exposure catalog {}: read {} raw headers'.format(catalog, nread))
+    return nread
+
+
+def read_expcatalog(catalog=None, rawdata_dir=None, nights=None, update=True):
+    """Read the exposure catalog, refreshing it first.
+
+    Args:
+        catalog (str): path to the catalog file.  If None, use
+            :func:`get_expcatalog_path`.
+        rawdata_dir (str): [optional] overrides $DESI_SPECTRO_DATA
+        nights (list): only return (and refresh) these nights.
+        update (bool): if False, do not refresh the catalog.
+
+    Returns:
+        Table: one row per exposure, sorted by night and exposure ID, with
+            columns NIGHT, EXPID, FLAVOR, CAMERAS, EXPTIME and MTIME.
+    """
+    if catalog is None:
+        catalog = get_expcatalog_path()
+    if update:
+        update_expcatalog(catalog, rawdata_dir=rawdata_dir, nights=nights)
+    query = 'select night, expid, flavor, cameras, exptime, mtime from exposure'
+    args = tuple()
+    if nights is not None:
+        query += ' where night in ({})'.format(','.join(['?'] * len(nights)))
+        args = tuple(int(n) for n in nights)
+    query += ' order by night, expid'
+    conn = sqlite3.connect(catalog, timeout=60)
+    try:
+        conn.executescript(_expcatalog_schema)
+        rows = conn.execute(query, args).fetchall()
+    finally:
+        conn.close()
+    names = ['NIGHT', 'EXPID', 'FLAVOR', 'CAMERAS', 'EXPTIME', 'MTIME']
+    if len(rows) == 0:
+        return Table(names=names, dtype=(np.int32, np.int32, 'U8', 'U64',
+                                         np.float64, np.float64))
+    columns = list(zip(*rows))
+    return Table([np.array(columns[0], dtype=np.int32),
+                  np.array(columns[1], dtype=np.int32),
+                  np.array(['' if x is None else x for x in columns[2]]),
+                  np.array(['' if x is None else x for x in columns[3]]),
+                  np.array([np.nan if x is None else x for x in columns[4]]),
+                  np.array([np.nan if x is None else x for x in columns[5]])],
+                 names=names)
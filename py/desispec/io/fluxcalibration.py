@@ -6,6 +6,10 @@ IO routines for flux calibration.
 """
 from __future__ import absolute_import, print_function
 import os
+import time
+import json
+import hashlib
+import shutil
 from astropy.io import fits
 import numpy,scipy
 
@@ -188,13 +192,20 @@ def read_average_flux_calibration(filename):
 
 
 
-def read_stdstar_templates(stellarmodelfile):
+_stdstar_template_names = ("wave","flux","templateid","teff","logg","feh")
+
+def read_stdstar_templates(stellarmodelfile, cachedir=None, maxentries=4):
     """
     Reads an input stellar model file
 
     Args:
         stellarmodelfile : input filename
 
+    Options:
+        cachedir : directory of the on-disk cache of stellar models,
+            see stdstar_templates_cache_entry. Default is to read the file.
+        maxentries : maximum number of stellar model files kept in the cache
+
     Returns (wave, flux, templateid, teff, logg, feh) tuple:
         wave : 1D[nwave] array of wavelengths [Angstroms]
         flux : 2D[nmodel, nwave] array of model fluxes
@@ -202,7 +213,15 @@ def read_stdstar_templates(stellarmodelfile):
         teff : 1D[nmodel] array of effective temperature for each model
         logg : 1D[nmodel] array of surface gravity for each model
         feh : 1D[nmodel] array of metallicity for each model
+
+    With a cache, the arrays are read-only memory maps of the cached files.
     """
+    if cachedir is not None:
+        entry = stdstar_templates_cache_entry(stellarmodelfile, cachedir,
+            maxentries=maxentries)
+        return tuple([ read_stdstar_templates_cache(entry, x) for x in
+            _stdstar_template_names ])
+
     phdu=fits.open(stellarmodelfile, memmap=False)
 
     #- New templates have wavelength in HDU 2
@@ -232,3 +251,130 @@ def read_stdstar_templates(stellarmodelfile):
     phdu.close()
 
     return wavebins,fluxData,templateid,teff,logg,feh
+
+
+def _file_digest(filename, blocksize=2**24):
+    """Returns the sha1 hex digest of the content of a file
+    """
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _cached_file_digest(filename, cachedir):
+    """Returns the sha1 hex digest of a file, memoized in cachedir
+
+    The digests are kept in the index file digests.json of cachedir,
+    keyed by the real path of the file along with its size and
+    modification time, so that the file is only read again if it changed.
+    """
+    indexfile = os.path.join(cachedir, "digests.json")
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    key = [st.st_size, st.st_mtime_ns]
+    try:
+        with open(indexfile) as fx:
+            index = json.load(fx)
+    except (OSError, ValueError):
+        index = dict()
+    if path in index and index[path][:2] == key:
+        return index[path][2]
+    digest = _file_digest(path)
+    index[path] = key + [digest]
+    tmpfile = "{}.tmp{}".format(indexfile, os.getpid())
+    with open(tmpfile, "w") as fx:
+        json.dump(index, fx)
+    os.replace(tmpfile, indexfile)
+    return digest
+
+
+def stdstar_templates_cache_entry(stellarmodelfile, cachedir, maxentries=4,
+    grace=3600):
+    """
+    Returns the cache directory of a stellar model file, creating it if needed
+
+    The cache is addressed by the sha1 digest of the content of the file,
+    which is only computed again if the size or modification time of the
+    file changed. An entry holds the arrays of read_stdstar_templates as
+    .npy files, along with any array derived from the templates added with
+    write_stdstar_templates_cache (keyed by their name, which should
+    include the parameters used to compute them). The least recently used
+    entries are removed when there are more than maxentries of them, but
+    never entries used in the last grace seconds, which may still be read
+    by another job.
+
+    Args:
+        stellarmodelfile : input filename
+        cachedir : directory of the cache, created if needed
+
+    Options:
+        maxentries : maximum number of stellar model files kept in the cache
+        grace : minimum age in seconds of the last use of an evicted entry
+
+    Returns:
+        path of the cache entry directory
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+    digest = _cached_file_digest(stellarmodelfile, cachedir)
+    entry = os.path.join(cachedir, digest)
+    if not os.path.isdir(entry):
+        #- write in a temporary directory, renamed at the end so that
+        #- concurrent jobs never see an incomplete entry
+        tmpentry = "{}.tmp{}".format(entry, os.getpid())
+        os.makedirs(tmpentry, exist_ok=True)
+        for name, array in zip(_stdstar_template_names,
+                               read_stdstar_templates(stellarmodelfile)):
+            numpy.save(os.path.join(tmpentry, name+".npy"), array)
+        try:
+            os.rename(tmpentry, entry)
+        except OSError:
+            #- another job created it in the mean time
+            shutil.rmtree(tmpentry, ignore_errors=True)
+    os.utime(entry)
+
+    #- least recently used eviction
+    entries = [ os.path.join(cachedir, x) for x in os.listdir(cachedir)
+        if len(x) == len(digest) and x != digest ]
+    entries = [ x for x in entries if os.path.isdir(x) ]
+    entries.sort(key=os.path.getmtime)
+    for x in entries[:max(0, len(entries)+1-maxentries)]:
+        if os.path.getmtime(x) < time.time() - grace:
+            shutil.rmtree(x, ignore_errors=True)
+
+    return entry
+
+
+def read_stdstar_templates_cache(entry, name):
+    """
+    Reads an array of a stellar model cache entry
+
+    Args:
+        entry : cache entry directory returned by stdstar_templates_cache_entry
+        name : name of the array
+
+    Returns:
+        read-only memory mapped array, or None if not in the cache
+    """
+    filename = os.path.join(entry, name+".npy")
+    if not os.path.isfile(filename):
+        return None
+    return numpy.load(filename, mmap_mode='r')
+
+
+def write_stdstar_templates_cache(entry, name, array):
+    """
+    Writes an array derived from the stellar models in a cache entry
+
+    Args:
+        entry : cache entry directory returned by stdstar_templates_cache_entry
+        name : name of the array, which should include the parameters
+            used to compute it
+        array : numpy array
+    """
+    filename = os.path.join(entry, name+".npy")
+    tmpfilename = "{}.tmp{}.npy".format(filename[:-4], os.getpid())
+    numpy.save(tmpfilename, array)
+    os.replace(tmpfilename, filename)
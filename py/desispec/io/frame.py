@@ -16,6 +16,7 @@ from desiutil.depend import add_dependencies
 from desiutil.io import encode_table
 
 from ..frame import Frame
+from .. import util
 from .meta import findfile, get_nights, get_exposures
 from .util import fitsheader, native_endian, makepath
 from desiutil.log import get_logger
@@ -132,7 +133,239 @@ def read_meta_frame(filename, extname=0):
     return hdr
 
 
-def read_frame(filename, nspec=None, skip_resolution=False):
+def _fibermap_from_hdu(hdu, rows=None):
+    """Returns the fibermap Table of a FIBERMAP HDU, optionally for a subset of rows
+    """
+    data = hdu.data
+    if rows is not None:
+        data = data[rows]
+    fibermap = Table(data)
+    if 'DESIGN_X' in fibermap.colnames:
+        fibermap.rename_column('DESIGN_X', 'FIBERASSIGN_X')
+    if 'DESIGN_Y' in fibermap.colnames:
+        fibermap.rename_column('DESIGN_Y', 'FIBERASSIGN_Y')
+    return fibermap
+
+
+def _read_image_subset(hdu, rows=None, wslice=None, dtype=None):
+    """Read an image HDU [nspec, ..., nwave], optionally for a subset of rows
+    and a wavelength slice.
+
+    For a subset, only the block of the file covering the requested rows and
+    wavelengths is read (through hdu.section), not the whole image.
+
+    Args:
+        hdu: FITS image HDU
+        rows: (optional) indices of spectra to read
+        wslice: (optional) slice of wavelength indices to read
+        dtype: (optional) output dtype; default is the on-disk type
+
+    Returns:
+        native endian numpy array
+    """
+    if rows is None and wslice is None:
+        data = hdu.data
+    else:
+        index = [slice(None),]*hdu.header['NAXIS']
+        if rows is not None:
+            rows = np.asarray(rows)
+            index[0] = slice(np.min(rows), np.max(rows)+1)
+        if wslice is not None:
+            index[-1] = wslice
+        data = hdu.section[tuple(index)]
+        if rows is not None:
+            data = data[rows-np.min(rows)]
+    if dtype is not None:
+        data = data.astype(dtype)
+    return native_endian(data)
+
+
+def _frame_subset(fx, nspec=None, fibers=None, wave_range=None):
+    """Rows and wavelength slice to read from an opened frame file.
+
+    Args:
+        fx: opened frame file (astropy.io.fits.HDUList)
+        nspec: (optional) only read the first nspec spectra
+        fibers: (optional) fiber numbers to read
+        wave_range: (optional) (wmin, wmax) wavelength range to read in Angstrom
+
+    Returns:
+        rows, wslice: indices of spectra (or None for all) and slice of
+        wavelength indices (or None for all)
+    """
+    rows = None
+    if nspec is not None or fibers is not None:
+        nspec_file = fx['FLUX'].header['NAXIS2']
+        rows = np.arange(nspec_file)
+        if nspec is not None:
+            rows = rows[0:nspec]
+        if fibers is not None:
+            if 'FIBERMAP' in fx:
+                file_fibers = fx['FIBERMAP'].data['FIBER']
+            elif 'FIBERMIN' in fx[0].header:
+                file_fibers = fx[0].header['FIBERMIN'] + np.arange(nspec_file)
+            else:
+                raise ValueError('no FIBERMAP or FIBERMIN in {}; cannot select fibers'.format(fx.filename()))
+            rows = rows[np.in1d(file_fibers[rows], fibers)]
+        if rows.size == 0:
+            raise ValueError('no spectra to read from {}'.format(fx.filename()))
+
+    wslice = None
+    if wave_range is not None:
+        wave = fx['WAVELENGTH'].data
+        wmin, wmax = wave_range
+        ii = np.where((wave >= wmin) & (wave <= wmax))[0]
+        if ii.size == 0:
+            raise ValueError('no wavelength in range [{},{}]'.format(wmin, wmax))
+        wslice = slice(ii[0], ii[-1]+1)
+
+    return rows, wslice
+
+
+class _LazyHDU(object):
+    """Descriptor of a LazyFrame attribute read from its file on first access.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, frame, objtype=None):
+        if frame is None:
+            return self
+        if self.name not in frame._data:
+            frame._data[self.name] = frame._read(self.name)
+        return frame._data[self.name]
+
+    def __set__(self, frame, value):
+        frame._data[self.name] = value
+
+
+class LazyFrame(Frame):
+    """Frame whose data are read from a frame file on first access.
+
+    Only the header, wavelength grid, fiber numbers and scores are read when
+    it is created. flux, ivar, mask, resolution_data, chi2pix and fibermap
+    are read the first time they are used, touching only the requested
+    subset of the file. They keep their on-disk precision, i.e. float32
+    for flux, ivar, resolution_data and chi2pix.
+
+    Use read_frame(filename, lazy=True) to create it.
+
+    Args:
+        filename: path to a frame file
+
+    Options:
+        nspec: only read the first nspec spectra
+        fibers: fiber numbers to read
+        wave_range: (wmin, wmax) wavelength range to read in Angstrom
+        skip_resolution: do not read the resolution data
+    """
+    flux = _LazyHDU('flux')
+    ivar = _LazyHDU('ivar')
+    mask = _LazyHDU('mask')
+    resolution_data = _LazyHDU('resolution_data')
+    chi2pix = _LazyHDU('chi2pix')
+    fibermap = _LazyHDU('fibermap')
+
+    _extnames = dict(flux='FLUX', ivar='IVAR', mask='MASK',
+                     resolution_data='RESOLUTION', chi2pix='CHI2PIX',
+                     fibermap='FIBERMAP')
+
+    def __init__(self, filename, nspec=None, fibers=None, wave_range=None,
+                 skip_resolution=False):
+        self._data = dict()
+        self._R = None
+        self.filename = filename
+        self.spectrograph = None
+
+        with fits.open(filename, uint=True, memmap=False) as fx:
+            self._hdus = [hdu.name for hdu in fx]
+            if skip_resolution and 'RESOLUTION' in self._hdus:
+                self._hdus.remove('RESOLUTION')
+
+            self._rows, self._wslice = _frame_subset(fx, nspec=nspec,
+                fibers=fibers, wave_range=wave_range)
+
+            self.meta = fx[0].header
+            wave = native_endian(fx['WAVELENGTH'].data.astype('f8'))
+            if self._wslice is not None:
+                wave = wave[self._wslice]
+            self.wave = wave
+
+            nspec_file = fx['FLUX'].header['NAXIS2']
+            if self._rows is None:
+                self.nspec = nspec_file
+            else:
+                self.nspec = len(self._rows)
+            self.nwave = self.wave.size
+
+            if 'FIBERMAP' in fx:
+                self.fibers = np.array(fx['FIBERMAP'].data['FIBER'])
+            elif 'FIBERMIN' in self.meta:
+                self.fibers = self.meta['FIBERMIN'] + np.arange(nspec_file, dtype=int)
+            else:
+                raise ValueError("Must set fibers by one of the methods!")
+            if self._rows is not None:
+                self.fibers = self.fibers[self._rows]
+
+            self.wsigma = None
+            self.ndiag = None
+            if 'RESOLUTION' not in self._hdus and not skip_resolution \
+                    and 'QUICKRESOLUTION' in fx:
+                from desispec.quicklook.qlresolution import QuickResolution
+                self.ndiag = fx['QUICKRESOLUTION'].header['NDIAG']
+                self.wsigma = _read_image_subset(fx['QUICKRESOLUTION'],
+                    self._rows, self._wslice, dtype='f4')
+                self.R = np.array([QuickResolution(sigma=sigma, ndiag=self.ndiag)
+                                   for sigma in self.wsigma])
+
+            if 'SCORES' in fx:
+                scores = fx['SCORES'].data
+                scores_comments = dict()
+                head = fx['SCORES'].header
+                for i in range(1, len(scores.columns)+1):
+                    k = 'TTYPE'+str(i)
+                    scores_comments[head[k]] = head.comments[k]
+                if self._rows is not None:
+                    scores = scores[self._rows]
+            else:
+                scores = None
+                scores_comments = None
+            self.scores = scores
+            self.scores_comments = scores_comments
+
+        if len(self.fibers) > 0:
+            self.meta['FIBERMIN'] = np.min(self.fibers)
+
+    def _read(self, name):
+        """Read attribute name from the file
+        """
+        extname = self._extnames[name]
+        if extname not in self._hdus:
+            if name == 'mask':
+                return np.zeros((self.nspec, self.nwave), dtype=np.uint32)
+            return None
+
+        log = get_logger()
+        log.debug('reading {} from {}'.format(extname, self.filename))
+        with fits.open(self.filename, uint=True, memmap=False) as fx:
+            if name == 'fibermap':
+                return _fibermap_from_hdu(fx[extname], self._rows)
+            data = _read_image_subset(fx[extname], self._rows, self._wslice)
+
+        if name == 'mask':
+            data = util.mask32(data)
+        return data
+
+    def load(self):
+        """Read all data that have not been read yet, and return self.
+        """
+        for name in self._extnames:
+            getattr(self, name)
+        return self
+
+
+def read_frame(filename, nspec=None, skip_resolution=False, lazy=False,
+               fibers=None, wave_range=None):
     """Reads a frame fits file and returns its data.
 
     Args:
@@ -140,8 +373,16 @@ def read_frame(filename, nspec=None, skip_resolution=False):
             night = string YEARMMDD
             expid = integer exposure ID
             camera = b0, r1, .. z9
+        nspec: (optional) only read the first nspec spectra
         skip_resolution: bool, option
             Speed up read time (>5x) by avoiding the Resolution matrix
+        lazy: bool, option
+            Return a LazyFrame that reads flux, ivar, mask, resolution_data,
+            chi2pix and fibermap when they are first used, keeping their
+            on-disk precision
+        fibers: (optional) list of fiber numbers to read
+        wave_range: (optional) (wmin, wmax) wavelength range to read,
+            in Angstrom
 
     Returns:
         desispec.Frame object with attributes wave, flux, ivar, etc.
@@ -156,13 +397,22 @@ def read_frame(filename, nspec=None, skip_resolution=False):
     if not os.path.isfile(filename) :
         raise IOError("cannot open"+filename)
 
+    if lazy:
+        #- no vetting here because it would read the flux
+        return LazyFrame(filename, nspec=nspec, fibers=fibers,
+                         wave_range=wave_range, skip_resolution=skip_resolution)
+
     fx = fits.open(filename, uint=True, memmap=False)
+    rows, wslice = _frame_subset(fx, nspec=nspec, fibers=fibers, wave_range=wave_range)
+
     hdr = fx[0].header
-    flux = native_endian(fx['FLUX'].data.astype('f8'))
-    ivar = native_endian(fx['IVAR'].data.astype('f8'))
+    flux = _read_image_subset(fx['FLUX'], rows, wslice, dtype='f8')
+    ivar = _read_image_subset(fx['IVAR'], rows, wslice, dtype='f8')
     wave = native_endian(fx['WAVELENGTH'].data.astype('f8'))
+    if wslice is not None:
+        wave = wave[wslice]
     if 'MASK' in fx:
-        mask = native_endian(fx['MASK'].data)
+        mask = _read_image_subset(fx['MASK'], rows, wslice)
     else:
         mask = None   #- let the Frame object create the default mask
 
@@ -178,23 +428,19 @@ def read_frame(filename, nspec=None, skip_resolution=False):
     if skip_resolution:
         pass
     elif 'RESOLUTION' in fx:
-        resolution_data = native_endian(fx['RESOLUTION'].data.astype('f8'))
+        resolution_data = _read_image_subset(fx['RESOLUTION'], rows, wslice, dtype='f8')
     elif 'QUICKRESOLUTION' in fx:
         qr=fx['QUICKRESOLUTION'].header
         qndiag =qr['NDIAG']
-        qwsigma=native_endian(fx['QUICKRESOLUTION'].data.astype('f4'))
+        qwsigma=_read_image_subset(fx['QUICKRESOLUTION'], rows, wslice, dtype='f4')
 
     if 'FIBERMAP' in fx:
-        fibermap = Table(fx['FIBERMAP'].data)
-        if 'DESIGN_X' in fibermap.colnames:
-            fibermap.rename_column('DESIGN_X', 'FIBERASSIGN_X')
-        if 'DESIGN_Y' in fibermap.colnames:
-            fibermap.rename_column('DESIGN_Y', 'FIBERASSIGN_Y')
+        fibermap = _fibermap_from_hdu(fx['FIBERMAP'], rows)
     else:
         fibermap = None
 
     if 'CHI2PIX' in fx:
-        chi2pix = native_endian(fx['CHI2PIX'].data.astype('f8'))
+        chi2pix = _read_image_subset(fx['CHI2PIX'], rows, wslice, dtype='f8')
     else:
         chi2pix = None
 
@@ -206,24 +452,14 @@ def read_frame(filename, nspec=None, skip_resolution=False):
         for i in range(1,len(scores.columns)+1) :
             k='TTYPE'+str(i)
             scores_comments[head[k]]=head.comments[k]
+        if rows is not None:
+            scores = scores[rows]
     else:
         scores = None
         scores_comments = None
 
     fx.close()
 
-    if nspec is not None:
-        flux = flux[0:nspec]
-        ivar = ivar[0:nspec]
-        if resolution_data is not None:
-            resolution_data = resolution_data[0:nspec]
-        else:
-            qwsigma=qwsigma[0:nspec]
-        if chi2pix is not None:
-            chi2pix = chi2pix[0:nspec]
-        if mask is not None:
-            mask = mask[0:nspec]
-
     # return flux,ivar,wave,resolution_data, hdr
     frame = Frame(wave, flux, ivar, mask, resolution_data, meta=hdr, fibermap=fibermap, chi2pix=chi2pix,
                   scores=scores,scores_comments=scores_comments,
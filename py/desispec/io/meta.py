@@ -82,6 +82,7 @@ def findfile(filetype, night=None, expid=None, camera=None, groupname=None,
         psfboot = '{specprod_dir}/exposures/{night}/{expid:08d}/psfboot-{camera}-{expid:08d}.fits',
         fibermap = '{rawdata_dir}/{night}/{expid:08d}/fibermap-{expid:08d}.fits',
         zcatalog = '{specprod_dir}/zcatalog-{specprod}.fits',
+        exp2healpix = '{specprod_dir}/spectra-{nside}/exp2healpix-{nside}.fits',
         spectra = '{specprod_dir}/spectra-{nside}/{hpixdir}/spectra-{nside}-{groupname}.fits',
         redrock = '{specprod_dir}/spectra-{nside}/{hpixdir}/redrock-{nside}-{groupname}.h5',
         coadd = '{specprod_dir}/spectra-{nside}/{hpixdir}/coadd-{nside}-{groupname}.fits',
@@ -257,7 +258,8 @@ def find_exposure_night(expid):
                 return night
 
 
-def get_exposures(night, raw=False, rawdata_dir=None, specprod_dir=None):
+def get_exposures(night, raw=False, rawdata_dir=None, specprod_dir=None,
+                  catalog=None):
     """Get a list of available exposures for the specified night.
 
     Exposures are identified as correctly formatted subdirectory names within the
@@ -271,6 +273,9 @@ def get_exposures(night, raw=False, rawdata_dir=None, specprod_dir=None):
         specprod_dir(str): Path containing the exposures/ directory to use. If the value
             is None, then the value of :func:`specprod_root` is used instead. Ignored
             when raw is True.
+        catalog(str): [optional] path to an exposure catalog (see
+            :mod:`desispec.io.expcatalog`), refreshed and used instead of listing
+            the night directory when raw is True.
 
     Returns:
         list: List of integer exposure numbers available for the specified night. The
@@ -294,6 +299,12 @@ def get_exposures(night, raw=False, rawdata_dir=None, specprod_dir=None):
     if not os.path.exists(night_path):
         raise RuntimeError('Non-existent night {0}'.format(night))
 
+    if raw and (catalog is not None):
+        from .expcatalog import read_expcatalog
+        exposures = read_expcatalog(catalog, rawdata_dir=rawdata_dir,
+                                    nights=[night])
+        return sorted(exposures['EXPID'].tolist())
+
     exposures = []
 
     for entry in glob.glob(os.path.join(night_path, '*')):
@@ -66,6 +66,111 @@ def cholesky_invert(A) :
     return inv
 
 
+def cholesky_invert_banded(ab,bandwidth=None) :
+    """
+    returns a band of the inverse of a banded positive definite matrix
+
+    Only the elements of the inverse within bandwidth of the diagonal are
+    computed, with the recursion of Takahashi et al. (1973) on the banded
+    Cholesky decomposition of A, so neither A nor its inverse are ever
+    stored as dense matrices.
+
+    Args :
+         ab : 2D (u+1,n) upper band of a (n,n) positive definite matrix A,
+              stored as in scipy.linalg.cholesky_banded : ab[u+i-j,j] = A[i,j] for i<=j
+
+    Options :
+        bandwidth : number of upper diagonals of the inverse to compute, must be >= u (default is u)
+
+    Returns:
+         cov : 2D (bandwidth+1,n) upper band of the inverse of A, stored like ab
+    """
+    u = ab.shape[0]-1
+    n = ab.shape[1]
+    if bandwidth is None :
+        bandwidth = u
+    if bandwidth < u :
+        raise ValueError("bandwidth {} of inverse must be at least the bandwidth {} of the input matrix".format(bandwidth,u))
+    q = bandwidth
+
+    # A = U^T U with U upper triangular, LAPACK pbtrf
+    cb = scipy.linalg.cholesky_banded(ab,lower=False)
+
+    # A = L D L^T with L[i+d,i] = U[i,i+d]/U[i,i] and D[i] = U[i,i]**2
+    udiag = cb[u]
+    ldiag = np.zeros((n,max(u,1)))
+    for d in range(1,u+1) :
+        ldiag[:n-d,d-1] = cb[u-d,d:]/udiag[:n-d]
+    invd = 1./udiag**2
+
+    # offdiag[i,d-1] = inverse[i,i+d]
+    diag    = np.zeros(n)
+    offdiag = np.zeros((n,q))
+
+    # block = inverse[i+1:i+q+2,i+1:i+q+2], zero beyond the matrix size
+    block = np.zeros((q+1,q+1))
+    for i in range(n-1,-1,-1) :
+        li = ldiag[i,:u]
+        row = -li.dot(block[:u,:q])
+        diag[i] = invd[i]-li.dot(row[:u])
+        offdiag[i] = row
+        block[1:,1:] = block[:q,:q].copy()
+        block[0,0] = diag[i]
+        block[0,1:] = row
+        block[1:,0] = row
+
+    cov = np.zeros((q+1,n))
+    cov[q] = diag
+    for d in range(1,q+1) :
+        cov[q-d,d:] = offdiag[:n-d,d-1]
+    return cov
+
+
+def symmetric_band_to_dense(ab) :
+    """
+    returns the dense symmetric matrix from its upper band
+
+    Args :
+         ab : 2D (u+1,n) upper band of a symmetric (n,n) matrix A,
+              stored as in scipy.linalg.cholesky_banded : ab[u+i-j,j] = A[i,j] for i<=j
+
+    Returns:
+         A : 2D (n,n) symmetric matrix
+    """
+    u = ab.shape[0]-1
+    n = ab.shape[1]
+    A = np.zeros((n,n),dtype=ab.dtype)
+    for d in range(u+1) :
+        i = np.arange(n-d)
+        A[i,i+d] = ab[u-d,d:]
+        A[i+d,i] = ab[u-d,d:]
+    return A
+
+
+def _spline_knots(input_wave,w1,w2,required_resolution) :
+    """
+    Interior knots of spline_fit between w1 and w2, with the knots farther than
+    the knot spacing from any input_wave sample removed.
+
+    Args:
+        input_wave : 1D sorted array of wavelengths
+        w1,w2 : range of the knots
+        required_resolution (float) : knot spacing
+
+    Returns (knots, res) where res is the actual knot spacing
+    """
+    res=required_resolution
+    n=int((w2-w1)/res)
+    res=(w2-w1)/(n+1)
+    knots=w1+res*(0.5+np.arange(n))
+
+    ## check that nodes are close to pixels
+    i=np.clip(np.searchsorted(input_wave,knots),1,input_wave.size-1)
+    mins=np.minimum(np.abs(knots-input_wave[i-1]),np.abs(knots-input_wave[i]))
+    knots = knots[mins<res]
+    return knots,res
+
+
 def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=None,order=3,max_resolution=None):
     """Performs spline fit of input_flux vs. input_wave and resamples at output_wave
 
@@ -82,6 +187,8 @@ def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=
 
     Returns:
         output_flux : 1D array of flux sampled at output_wave
+
+    See spline_fit_batch to fit many spectra on the same wavelength grid.
     """
     if input_ivar is not None :
         selection=np.where(input_ivar>0)[0]
@@ -95,16 +202,7 @@ def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=
         w1=input_wave[0]
         w2=input_wave[-1]
 
-    res=required_resolution
-    n=int((w2-w1)/res)
-    res=(w2-w1)/(n+1)
-    knots=w1+res*(0.5+np.arange(n))
-
-    ## check that nodes are close to pixels
-    dknots = abs(knots[:,None]-input_wave)
-    mins = np.amin(dknots,axis=1)
-    w=mins<res
-    knots = knots[w]
+    knots,res = _spline_knots(input_wave,w1,w2,required_resolution)
     try :
         toto=scipy.interpolate.splrep(input_wave,input_flux,w=input_ivar,k=order,task=-1,t=knots)
         output_flux = scipy.interpolate.splev(output_wave,toto)
@@ -117,3 +215,174 @@ def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=
             log.error("spline fit failed")
             raise ValueError
     return output_flux
+
+
+def bspline_basis(knots,order,x) :
+    """
+    Non-zero B-spline basis functions at x, with the Cox-de Boor recursion
+
+    Args:
+        knots : 1D array of the full (non-decreasing) knot vector, with order+1
+                repeated knots at each end
+        order (int) : spline order
+        x : 1D array of positions
+
+    Returns (index, values), where values[i,j], j=0..order, is the value at x[i]
+    of the basis function (or spline coefficient) index[i]+j. The polynomials of
+    the first and last knot intervals are extrapolated outside of the knots range.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    ncoef = knots.size-order-1
+    # knot interval knots[m] <= x < knots[m+1]
+    m = np.clip(np.searchsorted(knots,x,side='right')-1,order,ncoef-1)
+    values = np.zeros((x.size,order+1))
+    values[:,0] = 1.
+    left  = np.zeros((order+1,x.size))
+    right = np.zeros((order+1,x.size))
+    for j in range(1,order+1) :
+        left[j]  = x-knots[m+1-j]
+        right[j] = knots[m+j]-x
+        saved = np.zeros(x.size)
+        for r in range(j) :
+            temp = values[:,r]/(right[r+1]+left[j-r])
+            values[:,r] = saved+right[r+1]*temp
+            saved = left[j-r]*temp
+        values[:,j] = saved
+    return m-order,values
+
+
+def _spline_fit_knots(output_wave,wave,input_flux,input_ivar,good,knots,order) :
+    """Least square B-spline fits of spectra with the same knots,
+    with the weights of scipy.interpolate.splrep (input_ivar**2), resampled at output_wave.
+    The fit of each spectrum only depends on its own data.
+
+    Returns:
+        output_flux, solved : 2D array (nspec,output_wave.size) and 1D boolean array,
+        False where the normal equations could not be solved
+    """
+    nspec = input_flux.shape[0]
+    ncoef = knots.size+order+1
+    t = np.concatenate([np.repeat(wave[0],order+1),knots,np.repeat(wave[-1],order+1)])
+    index,values = bspline_basis(t,order,wave)
+
+    # normal equations A c = B
+    weight = np.where(good,input_ivar,0.)**2
+    flux = np.where(good,input_flux,0.)
+    weighted_flux = weight*flux
+    # pixels are sorted by knot interval: sums over the runs of pixels with the same index
+    starts = np.concatenate([[0],np.where(np.diff(index)!=0)[0]+1])
+    columns = index[starts]
+    ab  = np.zeros((nspec,order+1,ncoef))
+    rhs = np.zeros((nspec,ncoef))
+    for a in range(order+1) :
+        rhs[:,columns+a] += np.add.reduceat(weighted_flux*values[:,a],starts,axis=1)
+        for b in range(a,order+1) :
+            # upper band, ab[order+i-j,j] = A[i,j]
+            ab[:,order-(b-a),columns+b] += np.add.reduceat(weight*(values[:,a]*values[:,b]),starts,axis=1)
+
+    coef = np.zeros((ncoef,nspec))
+    solved = np.ones(nspec,dtype=bool)
+    for i in range(nspec) :
+        try :
+            coef[:,i] = scipy.linalg.solveh_banded(ab[i],rhs[i])
+        except np.linalg.LinAlgError :
+            solved[i] = False
+    output_flux = np.zeros((nspec,output_wave.size))
+    if np.sum(solved) > 0 :
+        spline = scipy.interpolate.BSpline(t,coef[:,solved],order,extrapolate=True)
+        output_flux[solved] = spline(output_wave).T
+    return output_flux,solved
+
+def spline_fit_batch(output_wave,input_wave,input_flux,required_resolution,input_ivar=None,order=3,max_resolution=None):
+    """Performs spline fits of many spectra sharing the same input wavelength grid,
+    and resamples them at output_wave
+
+    This gives the same results, up to rounding errors, as spline_fit for each
+    row with its pixels of input_ivar>0 (spline_fit(output_wave,input_wave[ok],
+    input_flux[i,ok],required_resolution,input_ivar[i,ok],...) with
+    ok=input_ivar[i]>0), but the rows that have the same spline knots, which
+    are all of them unless their range of valid pixels or masked regions differ,
+    are fitted together: the B-spline basis is computed once and the banded
+    normal equations are solved for each row. The result of a row does not
+    depend on the other rows, so it is the same whatever the batch it is part of.
+    Only the rows whose normal equations cannot be solved are fitted with spline_fit.
+
+    As in spline_fit, input_ivar is used as the weights of scipy.interpolate.splrep,
+    so the residuals are weighted by input_ivar**2.
+
+    Args:
+        output_wave : 1D array of output wavelength samples
+        input_wave : 1D array of nwave input wavelengths (sorted)
+        input_flux : 2D array (nspec,nwave) of input flux density
+        required_resolution (float) : resolution for spline knot placement (same unit as wavelength)
+
+    Options:
+        input_ivar : 2D array (nspec,nwave) of weights for input_flux
+        order (int) : spline order
+        max_resolution (float) : if not None and a fit fails, try once this resolution
+
+    Returns:
+        output_flux, ok : 2D array (nspec,output_wave.size) of flux sampled at output_wave,
+        and 1D boolean array, False for the spectra where the fit failed (with zero flux)
+    """
+    log = get_logger()
+    input_wave = np.asarray(input_wave,dtype=np.float64)
+    input_flux = np.atleast_2d(input_flux)
+    output_wave = np.asarray(output_wave)
+    nspec,nwave = input_flux.shape
+    if input_ivar is None :
+        input_ivar = np.ones(input_flux.shape)
+    input_ivar = np.atleast_2d(input_ivar)
+    good = input_ivar>0
+
+    output_flux = np.zeros((nspec,output_wave.size))
+    ok = np.zeros(nspec,dtype=bool)
+
+    # range of valid pixels of each spectrum
+    ngood = np.sum(good,axis=1)
+    first = np.argmax(good,axis=1)
+    last  = nwave-1-np.argmax(good[:,::-1],axis=1)
+
+    # splrep needs more points than the spline order
+    valid = np.where(ngood>order)[0]
+    for i in np.where(ngood<=order)[0] :
+        log.error("cannot do spline fit of spectrum {} because only {} values with ivar>0".format(i,ngood[i]))
+
+    # the spectra are fitted by groups sharing the same range of valid pixels
+    # and the same knots, which only depend on the valid pixels of each spectrum,
+    # so the result of a spectrum does not depend on the other ones
+    unfitted = list()
+    for key in np.unique(first[valid]*nwave+last[valid]) :
+        i1 = key//nwave
+        i2 = key%nwave
+        rows = valid[(first[valid]==i1)&(last[valid]==i2)]
+        wave = input_wave[i1:i2+1]
+
+        # initial knots, and those close to the valid pixels of each spectrum
+        knots,res = _spline_knots(wave,wave[0],wave[-1],required_resolution)
+        cgood = np.zeros((rows.size,wave.size+1),dtype=int)
+        cgood[:,1:] = np.cumsum(good[rows,i1:i2+1],axis=1)
+        lo = np.searchsorted(wave,knots-res,side='right')
+        hi = np.searchsorted(wave,knots+res,side='left')
+        covered = (cgood[:,hi]-cgood[:,lo])>0
+        patterns,group = np.unique(covered,axis=0,return_inverse=True)
+        group = np.asarray(group).ravel()
+        for g in range(patterns.shape[0]) :
+            grows = rows[group==g]
+            flux,solved = _spline_fit_knots(output_wave,wave,input_flux[grows,i1:i2+1],
+                                            input_ivar[grows,i1:i2+1],good[grows,i1:i2+1],
+                                            knots[patterns[g]],order)
+            output_flux[grows[solved]] = flux[solved]
+            ok[grows[solved]] = True
+            unfitted += list(grows[~solved])
+
+    # spectra for which the normal equations could not be solved
+    for i in sorted(unfitted) :
+        try :
+            output_flux[i] = spline_fit(output_wave,input_wave[good[i]],input_flux[i,good[i]],required_resolution,
+                                        input_ivar=input_ivar[i,good[i]],order=order,max_resolution=max_resolution)
+            ok[i] = True
+        except ValueError :
+            log.error("spline fit failed for spectrum {}".format(i))
+
+    return output_flux,ok
@@ -289,6 +289,72 @@ def dist_discrete(worksizes, workers, workerid, power=1.0):
     return allworkers[workerid]
 
 
+# Functions for dynamic distribution
+
+def dist_dynamic(nwork, comm=None, root=0):
+    """
+    Dynamically distribute some number of items among processes.
+
+    This is a generator yielding the indices of the items processed by
+    this process.  Each process takes the next item from a counter shared
+    by all processes (an atomic fetch-and-add on a one-sided MPI window
+    of the root process) every time it is ready for more work, so that
+    the processes which are faster, or get cheaper items, process more
+    of them, with no process dedicated to the scheduling.
+
+    All the processes of the communicator must call this function
+    and iterate until the end, since the creation and release of
+    the MPI window are collective.
+
+    The window memory is allocated by MPI (``MPI.Win.Allocate``) so that
+    the atomic operations can be done without the root process, e.g. in
+    shared memory or by the network hardware.  Otherwise the requests of
+    the other processes are only serviced when the root process makes MPI
+    calls, which it does not while it processes its own items; with such
+    MPI libraries, asynchronous progress should be enabled (for instance
+    ``MPICH_ASYNC_PROGRESS=1`` with MPICH and Cray MPICH) to keep the
+    other processes from waiting.
+
+    Args:
+        nwork (int): the number of things to distribute.
+        comm:  mpi4py.MPI.Comm or None, in which case all the items
+            are yielded in order.
+        root (int): the rank of the process holding the counter.
+
+    Yields (int):
+        The index of the next item to process.
+
+    """
+    if comm is None or comm.size == 1:
+        for i in range(nwork):
+            yield i
+        return
+
+    from mpi4py import MPI
+
+    itemsize = np.dtype(np.int64).itemsize
+    win = MPI.Win.Allocate(itemsize if comm.rank == root else 0,
+        disp_unit=itemsize, comm=comm)
+    if comm.rank == root:
+        win.Lock(root)
+        np.frombuffer(win.tomemory(), dtype=np.int64)[0] = 0
+        win.Unlock(root)
+    comm.Barrier()
+
+    one = np.ones(1, dtype=np.int64)
+    item = np.zeros(1, dtype=np.int64)
+    try:
+        while True:
+            win.Lock(root)
+            win.Fetch_and_op([one, MPI.INT64_T], [item, MPI.INT64_T], root, 0, op=MPI.SUM)
+            win.Unlock(root)
+            if item[0] >= nwork:
+                break
+            yield int(item[0])
+    finally:
+        win.Free()
+
+
 @contextmanager
 def stdouterr_redirected(to=None, comm=None):
     """
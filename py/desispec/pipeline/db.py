@@ -75,7 +75,7 @@ def task_sort(tasks):
     return ret
 
 
-def all_tasks(night, nside, expid=None):
+def all_tasks(night, nside, expid=None, catalog=None):
     """Get all possible tasks for a single night.
 
     This uses the filesystem to query the raw data for a particular night and
@@ -87,6 +87,8 @@ def all_tasks(night, nside, expid=None):
         night (str): The night to scan for tasks.
         nside (int): The HEALPix NSIDE value to use.
         expid (int): Only get tasks for this single exposure.
+        catalog (str): Optional path to an exposure catalog used to find the
+            exposures of the night.
 
     Returns:
         dict: a dictionary whose keys are the task types and where each value
@@ -99,7 +101,7 @@ def all_tasks(night, nside, expid=None):
 
     log.debug("io.get_exposures night={}".format(night))
 
-    expids = io.get_exposures(night, raw=True)
+    expids = io.get_exposures(night, raw=True, catalog=catalog)
 
     full = dict()
     for t in all_task_types():
@@ -369,39 +371,151 @@ def check_tasks(tasklist, db=None, inputs=None):
     return states
 
 
+def fit_task_runtime(nproc, walltime, parallel=True):
+    """Fit a runtime model to measured task run times.
+
+    The model is runtime = serial + parallel / procs, fit by linear least
+    squares with non-negative terms.  If all measurements used the same
+    number of processes, or if the task is not parallel, only one term is
+    used.
+
+    Args:
+        nproc (array): number of processes of each run.
+        walltime (array): measured run time of each run, in minutes.
+        parallel (bool): if False, the task does not run faster with more
+            processes and the model is a constant.
+
+    Returns:
+        tuple: the (serial, parallel) terms in minutes.
+
+    """
+    nproc = np.asarray(nproc, dtype=np.float64)
+    walltime = np.asarray(walltime, dtype=np.float64)
+    if not parallel:
+        return (np.mean(walltime), 0.0)
+    if len(np.unique(nproc)) == 1:
+        # All the time scales with the number of processes
+        return (0.0, np.mean(walltime * nproc))
+    A = np.vstack([np.ones(nproc.size), 1.0 / nproc]).T
+    serial, par = np.linalg.lstsq(A, walltime, rcond=None)[0]
+    if par < 0:
+        # No speedup with more processes
+        return (np.mean(walltime), 0.0)
+    if serial < 0:
+        return (0.0, np.mean(walltime * nproc))
+    return (serial, par)
+
+
 class DataBase:
     """Class for tracking pipeline processing objects and state.
+
+    Queries are written with "?" parameter placeholders (see DataBase.sql),
+    and the state of many tasks is set with one bulk statement (see
+    DataBase.update_many) rather than one statement per task.
     """
+    # Maximum number of parameters of the "name in (...)" selections.
+    _max_params = 500
+
     def __init__(self):
         self._conn = None
+        self._runtime_models = dict()
+        self._have_runtime_table = False
+        return
+
+
+    def sql(self, cmd):
+        """Convert the "?" parameter placeholders of a query for this backend.
+
+        Args:
+            cmd (str): the SQL command, with "?" placeholders.
+
+        Returns:
+            str: the command for the cursor of this backend.
+
+        """
+        return cmd
+
+
+    def executemany(self, cur, cmd, params):
+        """Execute a command for each set of parameters.
+
+        Args:
+            cur (DB cursor): the database cursor of an open connection.
+            cmd (str): the SQL command, with "?" placeholders.
+            params (list): list of tuples of parameters.
+
+        """
+        if len(params) > 0:
+            cur.executemany(self.sql(cmd), params)
         return
 
 
-    def get_states_type(self, tasktype, tasks):
+    def update_many(self, cur, table, column, values, key="name"):
+        """Set a column of many rows of a table.
+
+        Args:
+            cur (DB cursor): the database cursor of an open connection.
+            table (str): the table.
+            column (str): the column to set.
+            values (list): list of tuples (key, value), where key selects
+                the rows with this value of the key column.  If a key appears
+                several times, the last value is used.
+            key (str): the key column.
+
+        """
+        values = OrderedDict(values)
+        cmd = "update {} set {} = ? where {} = ?".format(table, column, key)
+        self.executemany(cur, cmd, [ (v, k) for k, v in values.items() ])
+        return
+
+
+    def select_in(self, cur, cmd, keys, params=()):
+        """Run a selection on many values of a column.
+
+        The selection is done by chunks of keys.
+
+        Args:
+            cur (DB cursor): the database cursor of an open connection.
+            cmd (str): the SQL command, with "?" placeholders for params and
+                "{}" where the list of placeholders of the keys goes, as in
+                "select name, state from psf where name in ({})".
+            keys (list): the values of the column.
+            params (tuple): parameters of the command, before the keys.
+
+        Returns:
+            list: the selected rows.
+
+        """
+        keys = list(keys)
+        rows = list()
+        for i in range(0, len(keys), self._max_params):
+            chunk = keys[i:i+self._max_params]
+            cur.execute(self.sql(cmd.format(",".join(["?"]*len(chunk)))),
+                tuple(params) + tuple(chunk))
+            rows.extend(cur.fetchall())
+        return rows
+
+
+    def get_states_type(self, tasktype, tasks, cur=None):
         """Efficiently get the state of many tasks of a single type.
 
         Args:
             tasktype (str): the type of these tasks.
             tasks (list): list of task names.
+            cur (DB cursor): optional cursor of an open connection.
 
         Returns:
             dict: the state of each task.
 
         """
-        states = None
-        namelist = ",".join([ "'{}'".format(x) for x in tasks ])
-
-        log = get_logger()
-        log.debug("opening db")
+        if cur is None:
+            with self.cursor() as cur:
+                return self.get_states_type(tasktype, tasks, cur=cur)
 
-        with self.cursor() as cur:
-            log.debug("selecting in db")
-            cur.execute(\
-                'select name, state from {} where name in ({})'.format(tasktype,
-                namelist))
-            st = cur.fetchall()
-            log.debug("done")
-            states = { x[0] : task_int_to_state[x[1]] for x in st }
+        st = self.select_in(cur,
+            "select name, state from {} where name in ({{}})".format(tasktype),
+            tasks)
+        states = { x[0] : task_int_to_state[x[1]] for x in st }
         return states
 
 
@@ -419,43 +533,45 @@ class DataBase:
             state_count[state] = 0
 
         with self.cursor() as cur:
-            cur.execute( 'select name, state from {}'.format(tasktype))
-            for name, intstate in cur.fetchall():
-                state_count[task_int_to_state[intstate]] += 1
+            cur.execute("select state, count(*) from {} group by state"\
+                .format(tasktype))
+            for intstate, count in cur.fetchall():
+                state_count[task_int_to_state[intstate]] += count
 
         return state_count
 
 
-    def get_states(self, tasks):
+    def get_states(self, tasks, cur=None):
         """Efficiently get the state of many tasks at once.
 
         Args:
             tasks (list): list of task names.
+            cur (DB cursor): optional cursor of an open connection.
 
         Returns:
             dict: the state of each task.
 
         """
-        from .tasks.base import task_classes, task_type
-
         # Sort by type
         taskbytype = task_sort(tasks)
 
         # Get state of each type
         states = dict()
         for t, tlist in taskbytype.items():
-            states.update(self.get_states_type(t, tlist))
+            states.update(self.get_states_type(t, tlist, cur=cur))
 
         return states
 
 
     def set_states_type(self, tasktype, tasks, postprocessing=True):
-        """Efficiently get the state of many tasks of a single type.
+        """Efficiently set the state of many tasks of a single type.
 
         Args:
             tasktype (str): the type of these tasks.
             tasks (list): list of tuples containing the task name and the
                 state to set.
+            postprocessing (bool): if True, run the DB postprocessing of the
+                tasks set to done.
 
         Returns:
             Nothing.
@@ -466,12 +582,17 @@ class DataBase:
         log = get_logger()
         log.debug("opening db")
 
+        states = OrderedDict(tasks)
+
         with self.cursor() as cur:
             log.debug("updating in db")
-            for tsk in tasks:
-                cur.execute("update {} set state = {} where name = '{}'".format(tasktype, task_state_to_int[tsk[1]], tsk[0]))
-                if postprocessing and tsk[1]=="done" :
-                    task_classes[tasktype].postprocessing(db=self,name=tsk[0],cur=cur)
+            self.update_many(cur, tasktype, "state",
+                [ (x, task_state_to_int[y]) for x, y in states.items() ])
+            if postprocessing:
+                for name, state in states.items():
+                    if state == "done":
+                        task_classes[tasktype].postprocessing(db=self,
+                            name=name, cur=cur)
             log.debug("done")
         return
 
@@ -518,20 +639,18 @@ class DataBase:
                 the task has been submitted).
 
         """
-        from .tasks.base import task_type
         # Sort by type
         taskbytype = task_sort(tasks)
 
         # Process each type
         submitted = dict()
-        for t, tlist in taskbytype.items():
-            if (t == "spectra") or (t == "redshift"):
-                raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
-            namelist = ",".join([ "'{}'".format(x) for x in tlist ])
-            with self.cursor() as cur:
-                cur.execute(\
-                    'select name, submitted from {} where name in ({})'.format(t, namelist))
-                sb = cur.fetchall()
+        with self.cursor() as cur:
+            for t, tlist in taskbytype.items():
+                if (t == "spectra") or (t == "redshift"):
+                    raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
+                sb = self.select_in(cur,
+                    "select name, submitted from {} where name in ({{}})"\
+                    .format(t), tlist)
                 submitted.update({ x[0] : x[1] for x in sb })
         return submitted
 
@@ -553,8 +672,8 @@ class DataBase:
         if unset:
             val = 0
         with self.cursor() as cur:
-            for tsk in tasks:
-                cur.execute("update {} set submitted = {} where name = '{}'".format(tasktype, val, tsk))
+            self.update_many(cur, tasktype, "submitted",
+                [ (x, val) for x in tasks ])
         return
 
 
@@ -570,7 +689,6 @@ class DataBase:
             Nothing.
 
         """
-        from .tasks.base import task_type
         # Sort by type
         taskbytype = task_sort(tasks)
 
@@ -578,11 +696,11 @@ class DataBase:
         for t, tlist in taskbytype.items():
             if (t == "spectra") or (t == "redshift"):
                 raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
-            self.set_submitted_type(tlist, unset=unset)
+            self.set_submitted_type(t, tlist, unset=unset)
         return
 
 
-    def update(self, night, nside, expid=None):
+    def update(self, night, nside, expid=None, catalog=None):
         """Update DB based on raw data.
 
         This will use the usual io.meta functions to find raw exposures.  For
@@ -593,39 +711,48 @@ class DataBase:
             night (str): The night to scan for updates.
             nside (int): The current NSIDE value used for pixel grouping.
             expid (int): Only update the DB for this exposure.
+            catalog (str): Optional path to an exposure catalog used to find
+                the exposures of the night.
 
         """
         from .tasks.base import task_classes, task_type
 
         log = get_logger()
 
-        alltasks, healpix_frames = all_tasks(night, nside, expid=expid)
+        alltasks, healpix_frames = all_tasks(night, nside, expid=expid,
+                                             catalog=catalog)
 
         with self.cursor() as cur:
             # insert or ignore all healpix_frames
             log.debug("updating healpix_frame ...")
+            expids = sorted(set([ x["expid"] for x in healpix_frames ]))
+            have_rows = set(self.select_in(cur,
+                "select expid, spec, nside, pixel from healpix_frame where expid in ({})",
+                expids))
+            newrows = list()
             for entry in healpix_frames:
-                # see if we already have this entry
-                cmd = "select exists(select 1 from healpix_frame where (expid = {} and spec = {} and nside = {} and pixel = {} ))".format(entry["expid"], entry["spec"], entry["nside"], entry["pixel"])
-                cur.execute(cmd)
-                have_row = cur.fetchone()[0]
-
-                if not have_row:
-                    cur.execute("insert into healpix_frame (night,expid,spec,nside,pixel,ntargets,state) values({},{},{},{},{},{},{})".format(entry["night"],entry["expid"],entry["spec"],entry["nside"],entry["pixel"],entry["ntargets"],0))
-
-            # read what is already in db
-            tasks_in_db = {}
-            for tt in all_task_types():
-                cur.execute("select name from {}".format(tt))
-                tasks_in_db[tt] = [ x for (x, ) in cur.fetchall()]
+                key = (entry["expid"], entry["spec"], entry["nside"],
+                    entry["pixel"])
+                if key not in have_rows:
+                    have_rows.add(key)
+                    newrows.append((entry["night"], entry["expid"],
+                        entry["spec"], entry["nside"], entry["pixel"],
+                        entry["ntargets"], 0))
+            self.executemany(cur, "insert into healpix_frame (night,expid,spec,nside,pixel,ntargets,state) values (?,?,?,?,?,?,?)", newrows)
 
             for tt in all_task_types():
                 log.debug("updating {} ...".format(tt))
+                # read what is already in db
+                cur.execute("select name from {}".format(tt))
+                tasks_in_db = set([ x for (x, ) in cur.fetchall() ])
+                newtasks = list()
                 for tsk in alltasks[tt]:
                     tname = task_classes[tt].name_join(tsk)
-                    if tname not in tasks_in_db[tt] :
+                    if tname not in tasks_in_db:
                         log.debug("adding {}".format(tname))
-                        task_classes[tt].insert(cur, tsk)
+                        tasks_in_db.add(tname)
+                        newtasks.append(tsk)
+                task_classes[tt].insert_many(self, newtasks, cur=cur)
 
         return
 
@@ -643,6 +770,9 @@ class DataBase:
         from .tasks.base import task_classes
         log = get_logger()
 
+        # Databases created before the indexes were introduced
+        self.create_indexes()
+
         # Get the list of task types excluding spectra and redshifts,
         # which will be handled separately.
         ttypes = [ t for t in all_task_types() if (t != "spectra") \
@@ -653,8 +783,8 @@ class DataBase:
         with self.cursor() as cur:
             tasks_in_db = {}
             for tt in ttypes:
-                cur.execute("select name from {} where night = {}"\
-                    .format(tt, night))
+                cur.execute(self.sql("select name from {} where night = ?"\
+                    .format(tt)), (night, ))
                 tasks_in_db[tt] = [ x for (x, ) in cur.fetchall() ]
 
         # For each task type, check status WITHOUT the DB, then set state.
@@ -698,71 +828,55 @@ class DataBase:
                     red_exists[row["pixel"]] = False
                     break
 
-        # Now use all this info.  Some internal helpers to avoid code
-        # duplication
-        def set_hpx_frame_0(row, spec, red, cur):
-            self.update_healpix_frame_state(row, 0, cur)
-            task_classes["spectra"].state_set(
-                self, spec, "waiting", cur)
-            task_classes["redshift"].state_set(
-                self, red, "waiting", cur)
-            return
-
-        def set_hpx_frame_1(row, spec, red, cur):
-            self.update_healpix_frame_state(row, 1, cur)
-            # getready() will do this for us:
-            #task_classes["spectra"].state_set(
-            #    self, spec, "ready", cur)
-            task_classes["redshift"].state_set(
-                self, red, "waiting", cur)
-            return
+        # Now use all this info.  The healpix_frame states and the spectra
+        # and redshift states are collected and then set in bulk, in
+        # the order of the rows.
+        frame_states = list()
+        spec_states = list()
+        red_states = list()
+        for row in pixrows:
+            cfdone = True
+            cfprops = row.copy()
+            for band in ["b", "r", "z"]:
+                cfprops["band"] = band
+                cf_name = task_classes["cframe"].name_join(cfprops)
+                if cfstates[cf_name] != "done":
+                    cfdone = False
 
-        def set_hpx_frame_2(row, spec, red, cur):
-            self.update_healpix_frame_state(row, 2, cur)
-            task_classes["spectra"].state_set(
-                self, spec, "done", cur)
-            # getready() will do this:
-            #task_classes["redshift"].state_set(
-            #    self, red, "ready", cur)
-            return
+            spec_name = task_classes["spectra"].name_join(row)
+            red_name = task_classes["redshift"].name_join(row)
 
-        def set_hpx_frame_3(row, spec, red, cur):
-            self.update_healpix_frame_state(row, 3, cur)
-            task_classes["spectra"].state_set(
-                self, spec, "done", cur)
-            task_classes["redshift"].state_set(
-                self, red, "done", cur)
-            return
+            if (not cfdone) and (not specdone) :
+                # The cframes do not exist, so reset the state of the
+                # spectra and redshift tasks.
+                frame_states.append((row, 0))
+                spec_states.append((spec_name, "waiting"))
+                red_states.append((red_name, "waiting"))
+            else:
+                # The cframe exists...
+                if spec_exists[row["pixel"]]:
+                    if red_exists[row["pixel"]]:
+                        # We are all done (state 3)
+                        frame_states.append((row, 3))
+                        spec_states.append((spec_name, "done"))
+                        red_states.append((red_name, "done"))
+                    else:
+                        # We are only at state 2.
+                        # getready() will set the redshift to ready.
+                        frame_states.append((row, 2))
+                        spec_states.append((spec_name, "done"))
+                else:
+                    # We are at just at state 1.
+                    # getready() will set the spectra to ready.
+                    frame_states.append((row, 1))
+                    red_states.append((red_name, "waiting"))
 
         with self.cursor() as cur:
-            for row in pixrows:
-                cfdone = True
-                cfprops = row.copy()
-                for band in ["b", "r", "z"]:
-                    cfprops["band"] = band
-                    cf_name = task_classes["cframe"].name_join(cfprops)
-                    if cfstates[cf_name] != "done":
-                        cfdone = False
-
-                spec_name = task_classes["spectra"].name_join(row)
-                red_name = task_classes["redshift"].name_join(row)
-
-                if (not cfdone) and (not specdone) :
-                    # The cframes do not exist, so reset the state of the
-                    # spectra and redshift tasks.
-                    set_hpx_frame_0(row, spec_name, red_name, cur)
-                else:
-                    # The cframe exists...
-                    if spec_exists[row["pixel"]]:
-                        if red_exists[row["pixel"]]:
-                            # We are all done (state 3)
-                            set_hpx_frame_3(row, spec_name, red_name, cur)
-                        else:
-                            # We are only at state 2
-                            set_hpx_frame_2(row, spec_name, red_name, cur)
-                    else:
-                        # We are at just at state 1
-                        set_hpx_frame_1(row, spec_name, red_name, cur)
+            self.update_healpix_frame_states(frame_states, cur)
+            for tt, states in [ ("spectra", spec_states),
+                                ("redshift", red_states) ]:
+                self.update_many(cur, tt, "state",
+                    [ (x, task_state_to_int[y]) for x, y in states ])
 
         # Update ready state of tasks
         self.getready(night=night)
@@ -801,6 +915,11 @@ class DataBase:
                         .format(tt))
             ttypes = tasktypes
 
+        # The states to clean
+        states = [ task_state_to_int["running"] ]
+        if cleanfailed:
+            states.append(task_state_to_int["failed"])
+
         # Grab existing nightly tasks
         with self.cursor() as cur:
             tasks_running = {}
@@ -809,26 +928,21 @@ class DataBase:
                             "redshift"])
                 if hasexpid:
                     # This task type has an expid property.
-                    cmd = None
                     if expid is not None:
                         # We are cleaning only a single exposure.
-                        cmd = "select name from {} where expid = {} and ( state = {}".format(tt, expid, task_state_to_int["running"])
+                        tasks_running[tt] = [ x for (x, ) in self.select_in(
+                            cur, "select name from {} where expid = ? and state in ({{}})".format(tt),
+                            states, params=(expid, )) ]
                     else:
                         # We are cleaning all exposures for this task type.
-                        cmd = "select name from {} where ( state = {}".format(tt, task_state_to_int["running"])
-                    if cleanfailed:
-                        cmd = "{} or state = {} )".format(cmd,
-                            task_state_to_int["failed"])
-                    else:
-                        cmd = "{} )".format(cmd)
-                    cur.execute(cmd)
-                    tasks_running[tt] = [ x for (x, ) in cur.fetchall() ]
+                        tasks_running[tt] = [ x for (x, ) in self.select_in(
+                            cur, "select name from {} where state in ({{}})".format(tt),
+                            states) ]
                     if cleansubmitted:
                         if expid is not None:
-                            cmd = "update {} set submitted = 0 where expid = {}".format(tt, expid)
+                            cur.execute(self.sql("update {} set submitted = 0 where expid = ?".format(tt)), (expid, ))
                         else:
-                            cmd = "update {} set submitted = 0".format(tt)
-                        cur.execute(cmd)
+                            cur.execute("update {} set submitted = 0".format(tt))
                 else:
                     # This task type has no concept of an exposure ID
                     if expid is not None:
@@ -838,18 +952,12 @@ class DataBase:
                         continue
                     else:
                         # cleanup this task type.
-                        cmd = "select name from {} where ( state = {}".format(tt, task_state_to_int["running"])
-                        if cleanfailed:
-                            cmd = "{} or state = {} )".format(cmd,
-                                task_state_to_int["failed"])
-                        else:
-                            cmd = "{} )".format(cmd)
-                        cur.execute(cmd)
-                        tasks_running[tt] = [ x for (x, ) in cur.fetchall() ]
+                        tasks_running[tt] = [ x for (x, ) in self.select_in(
+                            cur, "select name from {} where state in ({{}})".format(tt),
+                            states) ]
                         if cleansubmitted:
                             if (tt != "spectra") and (tt != "redshift"):
-                                cmd = "update {} set submitted = 0".format(tt)
-                                cur.execute(cmd)
+                                cur.execute("update {} set submitted = 0".format(tt))
 
         for tt in ttypes:
             if len(tasks_running[tt]) > 0:
@@ -864,6 +972,11 @@ class DataBase:
     def getready(self, night=None):
         """Update DB, changing waiting to ready depending on status of dependencies .
 
+        The dependencies of the waiting tasks of each type are checked
+        together (see BaseTask.getready_many), and the spectra and redshift
+        tasks are updated from the healpix_frame table with one statement
+        for each state change.
+
         Args:
             night (str): The night to process.
 
@@ -879,15 +992,16 @@ class DataBase:
         with self.cursor() as cur:
             for tt in ttypes:
                 # for each type of task, get the list of tasks in waiting mode
-                cmd = "select name from {} where state = {}".format(tt, task_state_to_int["waiting"])
+                cmd = "select name from {} where state = ?".format(tt)
+                params = [ task_state_to_int["waiting"] ]
                 if night is not None:
-                    cmd = "{} and night = {}".format(cmd, night)
-                cur.execute(cmd)
+                    cmd = "{} and night = ?".format(cmd)
+                    params.append(night)
+                cur.execute(self.sql(cmd), params)
                 tasks = [ x for (x, ) in cur.fetchall()]
                 if len(tasks) > 0:
                     log.debug("checking {} {} tasks ...".format(len(tasks),tt))
-                for tsk in tasks:
-                    task_classes[tt].getready(db=self, name=tsk, cur=cur)
+                task_classes[tt].getready_many(db=self, names=tasks, cur=cur)
 
             for tt in [ "spectra" , "redshift" ]:
                 if tt == "spectra":
@@ -897,44 +1011,66 @@ class DataBase:
                     required_healpix_frame_state = 2
                     # means we have an updated spectra file
 
-                cur.execute('select nside,pixel from healpix_frame where state = {}'.format(required_healpix_frame_state))
-                entries = cur.fetchall()
-                for entry in entries :
-                    log.debug("{} of pixel {} is ready to run".format(tt,entry[1]))
-                    cur.execute('update {} set state = {} where nside = {} and pixel = {}'.format(tt,task_state_to_int["ready"],entry[0],entry[1]))
+                log.debug("setting {} tasks with healpix_frame state {} to ready ...".format(tt, required_healpix_frame_state))
+                cur.execute(self.sql("update {0} set state = ? where exists (select 1 from healpix_frame where healpix_frame.state = ? and healpix_frame.nside = {0}.nside and healpix_frame.pixel = {0}.pixel)".format(tt)),
+                    (task_state_to_int["ready"], required_healpix_frame_state))
+
+                if tt == "spectra":
+                    required_healpix_frame_state = 2
+                elif tt == "redshift":
+                    required_healpix_frame_state = 3
 
                 log.debug("checking waiting {} tasks to see if they are done...".format(tt))
-                cmd = "select pixel from {} where state = {}".format(tt, task_state_to_int["waiting"])
-                cur.execute(cmd)
-                pixels = [ x for (x, ) in cur.fetchall()]
-                if len(pixels) > 0:
-                    log.debug("checking {} {} ...".format(len(pixels),tt))
-                    if tt == "spectra":
-                        required_healpix_frame_state = 2
-                    elif tt == "redshift":
-                        required_healpix_frame_state = 3
-                    for pixel in pixels:
-                        cur.execute('select pixel from healpix_frame where pixel = {} and state != {}'.format(pixel,required_healpix_frame_state))
-                        entries = cur.fetchall()
-                        if len(entries)==0 :
-                            log.debug("{} task of pixel {} is done".format(tt,pixel))
-                            cur.execute('update {} set state = {} where pixel = {}'.format(tt,task_state_to_int["done"],pixel))
+                # done if all the healpix_frame entries of the pixel have
+                # the required state
+                cur.execute(self.sql("update {0} set state = ? where state = ? and not exists (select 1 from healpix_frame where healpix_frame.pixel = {0}.pixel and healpix_frame.state != ?)".format(tt)),
+                    (task_state_to_int["done"], task_state_to_int["waiting"],
+                    required_healpix_frame_state))
         return
 
 
-    def update_healpix_frame_state(self, props, state, cur):
+    def _healpix_frame_state_cmd(self, props, state):
+        """Command and parameters of update_healpix_frame_state.
+        """
         if "expid" in props :
             # update from a cframe
-            cmd = "update healpix_frame set state = {} where expid = {} and spec = {} and state = {}".format(state,props["expid"],props["spec"],props["state"])
+            cmd = "update healpix_frame set state = ? where expid = ? and spec = ? and state = ?"
+            params = (state, props["expid"], props["spec"], props["state"])
         else :
             # update from a spectra or redshift task
-            cmd = "update healpix_frame set state = {} where nside = {} and pixel = {} and state = {}".format(state,props["nside"],props["pixel"],props["state"])
+            cmd = "update healpix_frame set state = ? where nside = ? and pixel = ? and state = ?"
+            params = (state, props["nside"], props["pixel"], props["state"])
+        return cmd, params
+
 
+    def update_healpix_frame_state(self, props, state, cur):
+        cmd, params = self._healpix_frame_state_cmd(props, state)
         if cur is None :
             with self.cursor() as cur:
-                cur.execute(cmd)
+                cur.execute(self.sql(cmd), params)
         else :
-            cur.execute(cmd)
+            cur.execute(self.sql(cmd), params)
+        return
+
+
+    def update_healpix_frame_states(self, changes, cur):
+        """Apply update_healpix_frame_state to a list of (props, state).
+
+        The updates are done in order, with one executemany per run of
+        updates of the same kind.
+        """
+        runcmd = None
+        runparams = list()
+        for props, state in changes:
+            cmd, params = self._healpix_frame_state_cmd(props, state)
+            if cmd != runcmd:
+                if runcmd is not None:
+                    self.executemany(cur, runcmd, runparams)
+                runcmd = cmd
+                runparams = list()
+            runparams.append(params)
+        if runcmd is not None:
+            self.executemany(cur, runcmd, runparams)
         return
 
 
@@ -942,12 +1078,8 @@ class DataBase:
         res = []
         with self.cursor() as cur:
             cmd = "select * from healpix_frame where "
-            first=True
-            for k in props.keys() :
-                if not first : cmd += " and "
-                first=False
-                cmd += "{}={}".format(k,props[k])
-            cur.execute(cmd)
+            cmd += " and ".join([ "{} = ?".format(k) for k in props.keys() ])
+            cur.execute(self.sql(cmd), tuple(props.values()))
             entries = cur.fetchall()
             # convert that to list of dictionaries
             for entry in entries :
@@ -967,6 +1099,138 @@ class DataBase:
         return
 
 
+    def create_indexes(self):
+        """Create the indexes of the task and healpix_frame tables, if they
+        do not exist.
+
+        The task tables are indexed on their (night, expid, state) and
+        (nside, pixel) columns (see BaseTask.index_columns), and the
+        healpix_frame table on (nside, pixel) and night.
+        """
+        from .tasks.base import task_classes
+        indexes = list()
+        for tt, tc in task_classes.items():
+            for cols in tc.index_columns():
+                indexes.append((tt, cols))
+        indexes.append(("healpix_frame", ["nside", "pixel"]))
+        indexes.append(("healpix_frame", ["night"]))
+        with self.cursor() as cur:
+            for table, cols in indexes:
+                cur.execute("create index if not exists {}_{} on {} ({})"\
+                    .format(table, "_".join(cols), table, ", ".join(cols)))
+        return
+
+
+    def create_task_runtime_table(self):
+        """Create the table of measured task run times, if it does not exist.
+
+        Each row is one run of a task with its type, model category (e.g. the
+        camera band), number of processes, wall time in minutes, peak resident
+        memory per process in GB, whether it failed and when it finished.
+        """
+        if self._have_runtime_table:
+            return
+        with self.cursor() as cur:
+            cmd = "create table if not exists task_runtime (name text, type text, category text, nproc integer, walltime real, maxrss real, failed integer, finished real)"
+            cur.execute(cmd)
+        self._have_runtime_table = True
+        return
+
+
+    def record_task_runtime(self, name, tasktype, category, nproc, walltime,
+                            maxrss, failed=0):
+        """Record the measured run time of a task.
+
+        Args:
+            name (str): the task name.
+            tasktype (str): the task type.
+            category (str): the runtime model category of the task (see
+                BaseTask.runtime_category).
+            nproc (int): the number of processes used.
+            walltime (float): the wall time in minutes.
+            maxrss (float): the peak resident memory per process in GB, or
+                None if it was not measured.
+            failed (int): the number of processes that failed.
+
+        """
+        import time
+        self.create_task_runtime_table()
+        with self.cursor() as cur:
+            cmd = "insert into task_runtime values (?, ?, ?, ?, ?, ?, ?, ?)"
+            cur.execute(self.sql(cmd), (name, tasktype, category, nproc,
+                walltime, maxrss, failed, time.time()))
+        #- Refit the model of this task type at the next request
+        if tasktype in self._runtime_models:
+            del self._runtime_models[tasktype]
+        return
+
+
+    def get_task_runtimes(self, tasktype):
+        """Get the measured run times of the successful runs of a task type.
+
+        Args:
+            tasktype (str): the task type.
+
+        Returns:
+            list: tuples (name, category, nproc, walltime, maxrss) of the
+                successful runs, in minutes and GB.
+
+        """
+        if not self._have_runtime_table:
+            #- e.g. a database created before this table existed
+            if not self.has_table("task_runtime"):
+                return list()
+            self._have_runtime_table = True
+        with self.cursor() as cur:
+            cur.execute(self.sql("select name, category, nproc, walltime, maxrss from task_runtime where type = ? and failed = 0"), (tasktype, ))
+            rows = cur.fetchall()
+        return rows
+
+
+    def task_runtime_model(self, tasktype, parallel=True, min_samples=3):
+        """Runtime and memory models of a task type from its measured runs.
+
+        The models are cached and refit after a new run time of this task type
+        is recorded with this DB instance.
+
+        Args:
+            tasktype (str): the task type.
+            parallel (bool): if False, the run time does not depend on the
+                number of processes.
+            min_samples (int): minimum number of successful runs of a category
+                to fit its model.
+
+        Returns:
+            dict: keyed by category, with values (serial, parallel, maxrss,
+                nsample), see fit_task_runtime.  maxrss is the 90th percentile
+                of the measured peak memory per process in GB, or zero if no
+                run has a measured peak memory.
+
+        """
+        if tasktype not in self._runtime_models:
+            rows = self.get_task_runtimes(tasktype)
+            bycat = dict()
+            for name, category, nproc, walltime, maxrss in rows:
+                bycat.setdefault(category, list()).append(
+                    (nproc, walltime, maxrss))
+            models = dict()
+            for category, runs in bycat.items():
+                if len(runs) < min_samples:
+                    continue
+                runs = np.array(runs, dtype=np.float64)
+                serial, par = fit_task_runtime(runs[:, 0], runs[:, 1],
+                    parallel=parallel)
+                #- Runs without a measured peak memory have NULL maxrss
+                mem = np.sort(runs[:, 2][np.isfinite(runs[:, 2])])
+                if len(mem) > 0:
+                    mem = mem[int(np.ceil(0.9 * len(mem))) - 1]
+                else:
+                    mem = 0.0
+                models[category] = (serial, par, mem, len(runs))
+            self._runtime_models[tasktype] = models
+        return self._runtime_models[tasktype]
+
+
 class DataBaseSqlite(DataBase):
     """Pipeline database using sqlite3 as the backend.
 
@@ -1064,6 +1328,14 @@ class DataBaseSqlite(DataBase):
             self._close()
 
 
+    def has_table(self, table):
+        """Returns True if the table exists in the database.
+        """
+        with self.cursor() as cur:
+            cur.execute("select name FROM sqlite_master WHERE type='table' and name=?", (table, ))
+            return len(cur.fetchall()) > 0
+
+
     def initdb(self):
         """Create DB tables for all tasks if they do not exist.
         """
@@ -1081,6 +1353,11 @@ class DataBaseSqlite(DataBase):
 
         if "healpix_frame" not in tables_in_db:
             self.create_healpix_frame_table()
+
+        if "task_runtime" not in tables_in_db:
+            self.create_task_runtime_table()
+
+        self.create_indexes()
         return
 
 
@@ -1111,6 +1388,9 @@ class DataBasePostgres(DataBase):
         self._port = port
         self._authorize = authorize
 
+        # Number of rows per statement of the bulk updates
+        self._page_size = 1000
+
         self._proddir = os.path.abspath(io.specprod_root())
 
         create = False
@@ -1165,14 +1445,42 @@ class DataBasePostgres(DataBase):
         return
 
 
+    def sql(self, cmd):
+        """See DataBase.sql: psycopg2 uses "%s" placeholders.
+        """
+        return cmd.replace("?", "%s")
+
+
+    def executemany(self, cur, cmd, params):
+        """See DataBase.executemany: the commands are sent by pages.
+        """
+        from psycopg2.extras import execute_batch
+        if len(params) > 0:
+            execute_batch(cur, self.sql(cmd), params, page_size=self._page_size)
+        return
+
+
+    def update_many(self, cur, table, column, values, key="name"):
+        """See DataBase.update_many: one "update ... from (values ...)"
+        statement per page of values.
+        """
+        from psycopg2.extras import execute_values
+        values = OrderedDict(values)
+        if len(values) > 0:
+            cmd = "update {0} set {1} = v.val from (values %s) as v(key, val) where {0}.{2} = v.key".format(table, column, key)
+            execute_values(cur, cmd, list(values.items()),
+                page_size=self._page_size)
+        return
+
+
     @property
     def schema(self):
         return self._schema
 
 
     def _have_schema(self, cur):
-        com = "select exists(select 1 from pg_namespace where nspname = '{}')".format(self._schema)
-        cur.execute(com)
+        com = "select exists(select 1 from pg_namespace where nspname = %s)"
+        cur.execute(com, (self._schema, ))
         return cur.fetchone()[0]
 
 
@@ -1204,6 +1512,14 @@ class DataBasePostgres(DataBase):
             self._close()
 
 
+    def has_table(self, table):
+        """Returns True if the table exists in the database schema.
+        """
+        with self.cursor() as cur:
+            cur.execute("select tablename from pg_tables where schemaname = %s and tablename = %s", (self.schema, table))
+            return len(cur.fetchall()) > 0
+
+
     def initdb(self):
         """Create DB tables for all tasks if they do not exist.
         """
@@ -1252,18 +1568,15 @@ class DataBasePostgres(DataBase):
                 .format(self._schema)
             log.debug(com)
             cur.execute(com)
-            com = "insert into {}.info values ('{}', '{}')"\
-                .format(self._schema, "path", self._proddir)
+            com = "insert into {}.info values (%s, %s)".format(self._schema)
             log.debug(com)
-            cur.execute(com)
+            cur.execute(com, ("path", self._proddir))
             if 'USER' in os.environ:
-                com = "insert into {}.info values ('{}', '{}')"\
-                    .format(self._schema, "created_by", os.environ['USER'])
                 log.debug(com)
-                cur.execute(com)
+                cur.execute(com, ("created_by", os.environ['USER']))
 
             # check existing tables
-            cur.execute("select tablename from pg_tables where schemaname =  '{}'".format(self.schema))
+            cur.execute("select tablename from pg_tables where schemaname = %s", (self.schema, ))
             tables_in_db = [x for (x, ) in cur.fetchall()]
 
         # Create a table for every task type
@@ -1275,6 +1588,11 @@ class DataBasePostgres(DataBase):
         if "healpix_frame" not in tables_in_db:
             self.create_healpix_frame_table()
 
+        if "task_runtime" not in tables_in_db:
+            self.create_task_runtime_table()
+
+        self.create_indexes()
+
         return
 
 
@@ -250,6 +250,12 @@ def update_prod(nightstr=None, hpxnside=64, expid=None):
         raise RuntimeError("If updating a production for one exposure, only "
                            "a single night should be specified.")
 
+    # The exposures of each night are found through the exposure catalog,
+    # which only reads the raw data headers that changed since the last
+    # update.
+
+    catalog = io.get_expcatalog_path()
+
     # Create per-night directories and update the DB for each night.
 
     for nt in nights:
@@ -269,7 +275,7 @@ def update_prod(nightstr=None, hpxnside=64, expid=None):
         if not os.path.isdir(nscr):
             os.makedirs(nscr)
 
-        db.update(nt, hpxnside, expid)
+        db.update(nt, hpxnside, expid, catalog=catalog)
 
         # make per-exposure dirs
         exps = None
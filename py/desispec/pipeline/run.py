@@ -87,7 +87,10 @@ def run_task(name, opts, comm=None, logfile=None, db=None):
 
     #- Set timeout alarm to avoid runaway tasks
     old_sighandler = signal.signal(signal.SIGALRM, _timeout_handler)
-    expected_run_time = task_classes[ttype].run_time(name, procs=nproc, db=db)
+    #- The default estimate is used rather than the mean measured run time,
+    #- which would time out the slower half of the tasks.
+    expected_run_time = task_classes[ttype].run_time(name, procs=nproc, db=db,
+        history=False)
 
     # Are we running on a slower/faster node than default timing?
     timefactor = float(os.getenv("DESI_PIPE_RUN_TIMEFACTOR", default=1.0))
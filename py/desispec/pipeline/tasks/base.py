@@ -17,6 +17,7 @@ import re
 import time
 import socket
 import traceback
+import resource
 from ..defs import (task_name_sep, task_state_to_int, task_int_to_state)
 
 from desiutil.log import get_logger
@@ -51,6 +52,66 @@ def task_type(name):
     return tt
 
 
+def _process_maxrss():
+    """Peak resident memory of this process over its lifetime, in GB.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        maxrss *= 1024 # kB
+    return maxrss / 1024.0**3
+
+
+def start_peak_memory():
+    """Start measuring the peak memory of a task in this process.
+
+    On Linux, the high water mark of the resident memory (VmHWM) is reset
+    to the current resident memory by writing to /proc/self/clear_refs.
+
+    Returns:
+        tuple: whether the high water mark was reset, and the lifetime peak
+            resident memory of the process in GB at the start of the task.
+
+    """
+    # The reset also lowers ru_maxrss on Linux, so read it first.
+    before = _process_maxrss()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        reset = True
+    except (IOError, OSError):
+        reset = False
+    return (reset, before)
+
+
+def task_peak_memory(start):
+    """Peak resident memory of this process since start_peak_memory.
+
+    If the high water mark could not be reset, the lifetime peak of the
+    process is only attributed to the task when the task raised it.
+    Otherwise the peak of the task is unknown.
+
+    Args:
+        start (tuple): the value returned by start_peak_memory.
+
+    Returns:
+        float: the peak resident memory in GB, or None if unknown.
+
+    """
+    reset, before = start
+    if reset:
+        try:
+            with open("/proc/self/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return float(line.split()[1]) / 1024.0**2 # kB
+        except (IOError, OSError):
+            pass
+    after = _process_maxrss()
+    if after > before:
+        return after
+    return None
+
+
 # This class is named "BaseTask", not "TaskBase" to avoid regex matching with
 # the automatic loading found in _taskclass.py.
 
@@ -148,10 +209,30 @@ class BaseTask(object):
         return
 
 
+    def index_columns(self):
+        """The column groups of the indexes of the table of this task type.
+
+        These are the (night, expid, state) columns of the task, and its
+        (nside, pixel) columns, if any.
+
+        Returns:
+            list: list of lists of column names.
+
+        """
+        indexes = list()
+        cols = [ x for x in ["night", "expid", "state"] if x in self._cols ]
+        if len(cols) > 0:
+            indexes.append(cols)
+        if ("nside" in self._cols) and ("pixel" in self._cols):
+            indexes.append(["nside", "pixel"])
+        return indexes
+
+
     def create(self, db):
         """Initialize a database for this task type.
 
-        This may include creating one or more tables.
+        This may include creating one or more tables.  The indexes of the
+        tables are created by DataBase.create_indexes.
 
         Args:
             db (pipeline.DB): the database instance.
@@ -161,53 +242,71 @@ class BaseTask(object):
         return
 
 
-    def _insert(self, cursor, props):
-        """See BaseTask.insert.
+    def _insert(self, db, proplist, cur):
+        """See BaseTask.insert_many.
         """
         log = get_logger()
 
-        name = self.name_join(props)
-        colstr = '(name'
-        valstr = "('{}'".format(name)
-
-        #cmd='insert or replace into {} values ("{}"'.format(self._type, name)
-        for k, ktype in zip(self._cols, self._coltypes):
-            colstr += ', {}'.format(k)
-            if k == "state":
-                if k in props:
-                    valstr += ', {}'.format(task_state_to_int[props["state"]])
-                else:
-                    valstr += ', {}'.format(task_state_to_int["waiting"])
-            else:
-                if ktype == "text":
-                    valstr += ", '{}'".format(props[k])
+        cols = ["name"] + list(self._cols) + ["submitted"]
+        rows = list()
+        for props in proplist:
+            row = [ self.name_join(props) ]
+            for k in self._cols:
+                if k == "state":
+                    if k in props:
+                        row.append(task_state_to_int[props["state"]])
+                    else:
+                        row.append(task_state_to_int["waiting"])
                 else:
-                    valstr += ', {}'.format(props[k])
-        colstr += ', submitted)'
-        valstr += ', 0)'
-
-        cmd = 'insert into {} {} values {}'.format(self._type, colstr, valstr)
-        log.debug(cmd)
-        cursor.execute(cmd)
+                    row.append(props[k])
+            row.append(0)
+            rows.append(tuple(row))
+
+        cmd = "insert into {} ({}) values ({})".format(self._type,
+            ", ".join(cols), ", ".join(["?"]*len(cols)))
+        log.debug("{} x {}".format(cmd, len(rows)))
+        db.executemany(cur, cmd, rows)
         return
 
 
-    def insert(self, cursor, props):
-        """Insert a task into a database.
+    def insert_many(self, db, proplist, cur=None):
+        """Insert many tasks into a database.
 
         This uses the name and extra keywords to update one or more
         task-specific tables.
 
         Args:
-            cursor (DB cursor): the database cursor of an open connection.
+            db (pipeline.DB): the database instance.
+            proplist (list): list of dictionaries of properties of the tasks.
+            cur (DB cursor): optional cursor of an open connection.
+
+        """
+        if len(proplist) == 0:
+            return
+        if cur is None:
+            with db.cursor() as cur:
+                self._insert(db, proplist, cur)
+        else:
+            self._insert(db, proplist, cur)
+        return
+
+
+    def insert(self, db, props, cur=None):
+        """Insert a task into a database.
+
+        See insert_many to insert many tasks.
+
+        Args:
+            db (pipeline.DB): the database instance.
             props (dict): dictionary of properties for the task.
+            cur (DB cursor): optional cursor of an open connection.
 
         """
 
         log = get_logger()
         log.debug("inserting {}".format(self.name_join(props)))
 
-        self._insert(cursor, props)
+        self.insert_many(db, [props], cur=cur)
         return
 
 
@@ -216,8 +315,8 @@ class BaseTask(object):
         """
         ret = dict()
         with db.cursor() as cur:
-            cur.execute(\
-                "select * from {} where name = '{}'".format(self._type,name))
+            cur.execute(db.sql("select * from {} where name = ?"\
+                .format(self._type)), (name, ))
             row = cur.fetchone()
             if row is None:
                 raise RuntimeError("task {} not in database".format(name))
@@ -252,14 +351,15 @@ class BaseTask(object):
         """
         start = time.time()
 
-        cmd="update {} set state = {} where name = '{}'"\
-            .format(self._type, task_state_to_int[state], name)
+        cmd = db.sql("update {} set state = ? where name = ?"\
+            .format(self._type))
+        params = (task_state_to_int[state], name)
 
         if cur is None :
             with db.cursor() as cur:
-                cur.execute(cmd)
+                cur.execute(cmd, params)
         else :
-            cur.execute(cmd)
+            cur.execute(cmd, params)
 
         stop = time.time()
         log  = get_logger()
@@ -272,14 +372,14 @@ class BaseTask(object):
         """
 
         st = None
-        cmd = "select state from {} where name = '{}'"\
-            .format(self._type,name)
+        cmd = db.sql("select state from {} where name = ?"\
+            .format(self._type))
         if cur is None :
             with db.cursor() as cur:
-                cur.execute(cmd)
+                cur.execute(cmd, (name, ))
                 row = cur.fetchone()
         else :
-            cur.execute(cmd)
+            cur.execute(cmd, (name, ))
             row = cur.fetchone()
 
         if row is None:
@@ -374,7 +474,10 @@ class BaseTask(object):
         """Maximum memory in GB per process required.
 
         If zero is returned, it indicates that the memory requirement is so
-        small that the code can run fully-packed on any system.
+        small that the code can run fully-packed on any system.  If the
+        database has measured runs of tasks of the same category, the 90th
+        percentile of their peak memory is used if it is larger than the
+        default.
 
         Args:
             name (str): the name of the task.
@@ -384,7 +487,11 @@ class BaseTask(object):
             float: the required RAM in GB per process.
 
         """
-        return self._run_max_mem_proc(name, db)
+        mem = self._run_max_mem_proc(name, db)
+        model = self.runtime_model(name, db)
+        if model is not None:
+            mem = max(mem, model[2])
+        return mem
 
 
     def _run_max_mem_task(self, name, db):
@@ -416,21 +523,70 @@ class BaseTask(object):
         return None
 
 
-    def run_time(self, name, procs, db=None):
+    def run_time(self, name, procs, db=None, history=True):
         """Estimated runtime for a task at maximum concurrency.
 
+        If the database has enough measured runs of tasks of the same
+        category, the estimate comes from a model fit to those runs.
+        Otherwise the default estimate of the task type is used.
+
         Args:
             name (str): the name of the task.
             procs (int): the total number of processes used for this task.
             db (pipeline.DB): the optional database instance.
+            history (bool): if False, always use the default estimate.
 
         Returns:
             int: estimated minutes of run time.
 
         """
+        if history:
+            model = self.runtime_model(name, db)
+            if model is not None:
+                return model[0] + model[1] / procs
         return self._run_time(name, procs, db)
 
 
+    def runtime_category(self, name):
+        """Category of a task for its runtime and memory models.
+
+        Tasks of the same type and category are expected to have similar run
+        times and memory.  The default is the camera band of the task, or an
+        empty string for tasks without band.
+
+        Args:
+            name (str): the name of the task.
+
+        Returns:
+            str: the category.
+
+        """
+        props = self.name_split(name)
+        if "band" in props:
+            return str(props["band"])
+        return ""
+
+
+    def runtime_model(self, name, db=None):
+        """Runtime and memory model fit to the measured runs of similar tasks.
+
+        Args:
+            name (str): the name of the task.
+            db (pipeline.DB): the optional database instance.
+
+        Returns:
+            tuple: (serial, parallel, maxrss, nsample) model of the task
+                category (see pipeline.db.DataBase.task_runtime_model), or
+                None if there is no database or not enough measured runs.
+
+        """
+        if db is None:
+            return None
+        models = db.task_runtime_model(self._type,
+            parallel=(self._run_max_procs() != 1))
+        return models.get(self.runtime_category(name), None)
+
+
     def _run_defaults(self):
         raise NotImplementedError("You should not use a BaseTask object "
             " directly")
@@ -556,21 +712,62 @@ class BaseTask(object):
 
         return failcount
 
-    def getready(self, db, name, cur):
-        """Checks whether dependencies are ready"""
+    def ready_tasks(self, db, names, cur):
+        """Select the tasks whose dependencies are all done.
+
+        The states of the dependencies of all the tasks are read with one
+        query per dependency type.
+
+        Args:
+            db (pipeline.DB): the database instance.
+            names (list): the task names.
+            cur (DB cursor): the cursor of an open connection.
+
+        Returns:
+            list: the names of the tasks which are ready to run.
+
+        """
+        deps = dict()
+        for name in names:
+            deps[name] = list()
+            for dep in self.deps(name, db=db, inputs=None).values():
+                if isinstance(dep, list):
+                    deps[name].extend(dep)
+                else:
+                    deps[name].append(dep)
+        alldeps = set([ x for dlist in deps.values() for x in dlist ])
+        depstates = db.get_states(list(alldeps), cur=cur)
+        for dep in alldeps:
+            if dep not in depstates:
+                raise RuntimeError("task {} not in database".format(dep))
+        # ready if all dependencies are done
+        return [ x for x in names if all([ depstates[y] == "done" \
+            for y in deps[x] ]) ]
+
+
+    def getready_many(self, db, names, cur):
+        """Set the tasks whose dependencies are done to ready.
+
+        Args:
+            db (pipeline.DB): the database instance.
+            names (list): the task names.
+            cur (DB cursor): the cursor of an open connection.
+
+        """
+        if len(names) == 0:
+            return
         log  = get_logger()
-        deps = self.deps(name, db=db, inputs=None)
-        ready = True
-        for dep in deps.values() :
-            # for each dependency, guess its type
-            deptype  = dep.split(task_name_sep)[0]
-            # based on the type and dependency name, read state from db
-            depstate = task_classes[deptype].state_get(db=db,name=dep,cur=cur)
-            ready   &= (depstate=="done") # ready if all dependencies are done
-        if ready :
-            # change state to ready
+        ready = self.ready_tasks(db, names, cur)
+        for name in ready:
             log.debug("{} is ready to run".format(name))
-            self.state_set(db=db,name=name,state="ready",cur=cur)
+        db.update_many(cur, self._type, "state",
+            [ (x, task_state_to_int["ready"]) for x in ready ])
+        return
+
+
+    def getready(self, db, name, cur):
+        """Checks whether dependencies are ready"""
+        self.getready_many(db, [name], cur)
 
 
 
@@ -586,6 +783,12 @@ class BaseTask(object):
         The state of the task is marked as "done" if the command completes
         without raising an exception and if the output files exist.
 
+        The wall time, process count and peak memory of the run are recorded
+        in the database and used for the runtime and memory estimates of
+        later tasks (see run_time and run_max_mem_proc).  The peak memory is
+        only recorded if it can be measured for this task alone (see
+        task_peak_memory).
+
         Args:
             db (pipeline.db.DB): The database.
             name (str): the name of this task.
@@ -602,9 +805,23 @@ class BaseTask(object):
             nproc = comm.size
             rank = comm.rank
 
+        start_time = time.time()
+        peakmem = start_peak_memory()
+
         failed = self.run(name, opts, comm=comm, db=db)
 
+        # Peak resident memory of the processes during this task, or None
+        # if it could not be separated from the previous tasks of a process.
+        maxrss = task_peak_memory(peakmem)
+        if comm is not None:
+            from mpi4py import MPI
+            if comm.allreduce(maxrss is None, op=MPI.LOR):
+                maxrss = None
+            else:
+                maxrss = comm.allreduce(maxrss, op=MPI.MAX)
+
         if rank == 0:
+            runtime = (time.time() - start_time) / 60
             if failed > 0:
                 self.state_set(db, name, "failed")
             else:
@@ -620,4 +837,12 @@ class BaseTask(object):
                     # post processing is now done by a single rank in run.run_task_list
                 else:
                     self.state_set(db, name, "failed")
+            try:
+                db.record_task_runtime(name, self._type,
+                    self.runtime_category(name), nproc, runtime, maxrss,
+                    failed=failed)
+            except Exception as err:
+                log = get_logger()
+                log.warning("Could not record run time of {}: {}".format(
+                    name, err))
         return failed
@@ -132,11 +132,9 @@ class TaskCFrame(BaseTask):
         db.update_healpix_frame_state(props,state=1,cur=cur) # 1=has a cframe
 
         log = get_logger()
-        # call getready on all spectra ... might be super inefficient
+        # set to ready the spectra of the pixels of this cframe
         tt="spectra"
         required_healpix_frame_state = 1 # means we have a cframe
-        cur.execute('select nside,pixel from healpix_frame where state = {} and expid = {} and spec = {}'.format(required_healpix_frame_state,props["expid"],props["spec"]))
-        entries = cur.fetchall()
-        log.debug("from {} set spectra to ready : {}".format(name,entries))
-        for entry in entries :
-            cur.execute('update {} set state = {} where nside = {} and pixel = {}'.format(tt,task_state_to_int["ready"],entry[0],entry[1]))
+        log.debug("from {} set spectra of expid {} spec {} to ready".format(name,props["expid"],props["spec"]))
+        cur.execute(db.sql("update {0} set state = ? where exists (select 1 from healpix_frame where healpix_frame.state = ? and healpix_frame.expid = ? and healpix_frame.spec = ? and healpix_frame.nside = {0}.nside and healpix_frame.pixel = {0}.pixel)".format(tt)),
+            (task_state_to_int["ready"], required_healpix_frame_state, props["expid"], props["spec"]))
@@ -126,9 +126,8 @@ class TaskFluxCalib(BaseTask):
         props = self.name_split(name)
         log  = get_logger()
         tt="cframe"
-        cmd = "select name from {} where night={} and expid={} and spec={} and band='{}' and state=0".format(tt,props["night"],props["expid"],props["spec"],props["band"])
-        cur.execute(cmd)
+        cmd = db.sql("select name from {} where night = ? and expid = ? and spec = ? and band = ? and state = 0".format(tt))
+        cur.execute(cmd, (props["night"], props["expid"], props["spec"], props["band"]))
         tasks = [ x for (x,) in cur.fetchall() ]
         log.debug("checking {}".format(tasks))
-        for task in tasks :
-            task_classes[tt].getready( db=db,name=task,cur=cur)
+        task_classes[tt].getready_many(db=db, names=tasks, cur=cur)
@@ -122,25 +122,28 @@ class TaskPSFNight(BaseTask):
 
         return
 
-    def getready(self, db, name, cur):
-        """Checks whether dependencies are ready"""
+    def ready_tasks(self, db, names, cur):
+        """See BaseTask.ready_tasks.
+        """
         log  = get_logger()
+        ready = list()
+        for name in names:
+            # look for the state of psf with same night,band,spectro
+            props = self.name_split(name)
 
-        # look for the state of psf with same night,band,spectro
-        props = self.name_split(name)
+            cmd = db.sql("select state from psf where night = ? and band = ? and spec = ?")
+            cur.execute(cmd, (props["night"], props["band"], props["spec"]))
+            states = np.array([ x for (x,) in cur.fetchall() ])
+            log.debug("states={}".format(states))
 
-        cmd = "select state from psf where night={} and band='{}' and spec={}".format(props["night"],props["band"],props["spec"])
-        cur.execute(cmd)
-        states = np.array([ x for (x,) in cur.fetchall() ])
-        log.debug("states={}".format(states))
+            # psfnight ready if all psf from the night have been processed, and at least one is done (failures are allowed)
+            n_done   = np.sum(states==task_state_to_int["done"])
+            n_failed = np.sum(states==task_state_to_int["failed"])
 
-        # psfnight ready if all psf from the night have been processed, and at least one is done (failures are allowed)
-        n_done   = np.sum(states==task_state_to_int["done"])
-        n_failed = np.sum(states==task_state_to_int["failed"])
+            if (n_done > 0) & ( (n_done + n_failed) == states.size ):
+                ready.append(name)
+        return ready
 
-        ready    = (n_done > 0) & ( (n_done + n_failed) == states.size )
-        if ready :
-            self.state_set(db=db,name=name,state="ready",cur=cur)
 
     def postprocessing(self, db, name, cur):
         """For successful runs, postprocessing on DB"""
@@ -148,9 +151,8 @@ class TaskPSFNight(BaseTask):
         props = self.name_split(name)
         log  = get_logger()
         tt  = "traceshift"
-        cmd = "select name from {} where night={} and band='{}' and spec={} and state=0".format(tt,props["night"],props["band"],props["spec"])
-        cur.execute(cmd)
+        cmd = db.sql("select name from {} where night = ? and band = ? and spec = ? and state = 0".format(tt))
+        cur.execute(cmd, (props["night"], props["band"], props["spec"]))
         tasks = [ x for (x,) in cur.fetchall() ]
         log.debug("checking {}".format(tasks))
-        for task in tasks :
-            task_classes[tt].getready( db=db,name=task,cur=cur)
+        task_classes[tt].getready_many(db=db, names=tasks, cur=cur)
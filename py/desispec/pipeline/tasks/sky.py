@@ -123,9 +123,8 @@ class TaskSky(BaseTask):
         props = self.name_split(name)
         log  = get_logger()
         tt="starfit"
-        cmd = "select name from {} where night={} and expid={} and spec={} and state=0".format(tt,props["night"],props["expid"],props["spec"])
-        cur.execute(cmd)
+        cmd = db.sql("select name from {} where night = ? and expid = ? and spec = ? and state = 0".format(tt))
+        cur.execute(cmd, (props["night"], props["expid"], props["spec"]))
         tasks = [ x for (x,) in cur.fetchall() ]
         log.debug("checking {}".format(tasks))
-        for task in tasks :
-            task_classes[tt].getready( db=db,name=task,cur=cur)
+        task_classes[tt].getready_many(db=db, names=tasks, cur=cur)
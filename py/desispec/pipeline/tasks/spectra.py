@@ -190,8 +190,8 @@ class TaskSpectra(BaseTask):
                         db.update_healpix_frame_state(props,state=2,cur=cur)
                         # directly set the corresponding redshift to ready
                         cur.execute(
-                            'update redshift set state={} where nside = {} and pixel = {}'
-                            .format(
+                            db.sql('update redshift set state = ? where nside = ? and pixel = ?'),
+                            (
                                 task_state_to_int["ready"],
                                 props["nside"],
                                 props["pixel"]
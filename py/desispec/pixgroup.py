@@ -19,17 +19,116 @@ import desiutil.depend
 from . import io
 from .maskbits import specmask
 
-def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
+def fibermap2healpix(fibermap, nside=64):
     '''
-    Returns table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS
+    Returns array of NESTED healpix pixels of the fibermap TARGET_RA,TARGET_DEC
+
+    Args:
+        fibermap: fibermap table
+
+    Options:
+        nside: healpix nside, must be power of 2
+
+    Targets with NaN coordinates have pixel -1
+    '''
+    ra = np.asarray(fibermap['TARGET_RA'], dtype=float)
+    dec = np.asarray(fibermap['TARGET_DEC'], dtype=float)
+    ok = ~np.isnan(ra) & ~np.isnan(dec)
+    allpix = np.full(len(ra), -1, dtype='i8')
+    if np.any(ok):
+        allpix[ok] = desimodel.footprint.radec2pix(nside, ra[ok], dec[ok])
+    return allpix
+
+_exp2healpix_index_dtype = [('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
+    ('FIBER', 'i4'), ('HEALPIX', 'i8'), ('MTIME', 'f8')]
+
+def read_exp2healpix_index(filename, nside=64):
+    '''
+    Returns exposure to healpix index table read from `filename`,
+    or an empty table if the file does not exist
+
+    Args:
+        filename: path to the index file
+
+    Options:
+        nside: healpix nside, must match the one of the index file
+
+    See get_exp2healpix_index for the table columns. Index files without
+    MTIME have MTIME=-1, so that their exposures are mapped again.
+    '''
+    if not os.path.exists(filename):
+        return np.zeros(0, dtype=_exp2healpix_index_dtype)
+
+    index, header = fitsio.read(filename, 'EXP2HEALPIX', header=True)
+    if header['HPXNSIDE'] != nside:
+        raise ValueError('{} has nside={} instead of {}'.format(
+            filename, header['HPXNSIDE'], nside))
+
+    result = np.zeros(len(index), dtype=_exp2healpix_index_dtype)
+    result['MTIME'] = -1
+    for name in index.dtype.names:
+        if name in result.dtype.names:
+            result[name] = index[name]
+
+    return result
+
+def write_exp2healpix_index(filename, index, nside=64, append=False):
+    '''
+    Write exposure to healpix index table to `filename`
+
+    Args:
+        filename: path to the index file
+        index: table from get_exp2healpix_index
+
+    Options:
+        nside: healpix nside of the index
+        append: if True and `filename` exists, add the rows of `index`
+            to it instead of replacing it
+    '''
+    if append and os.path.exists(filename):
+        with fitsio.FITS(filename, 'rw') as fx:
+            fx['EXP2HEALPIX'].append(index)
+        return
+
+    dirname = os.path.dirname(filename)
+    if dirname != '' and not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    header = dict(HPXNSIDE=nside, HPXNEST=True)
+    tmpout = filename + '.tmp'
+    fitsio.write(tmpout, index, extname='EXP2HEALPIX', header=header,
+        clobber=True)
+    os.rename(tmpout, filename)
+
+def _index_keys(index):
+    '''
+    Returns set of (NIGHT, EXPID, SPECTRO) of the rows of an index table
+    '''
+    return set(zip(index['NIGHT'].tolist(), index['EXPID'].tolist(),
+                   index['SPECTRO'].tolist()))
+
+def get_exp2healpix_index(nights=None, specprod_dir=None, nside=64, comm=None,
+        indexfile=None):
+    '''
+    Returns table with columns NIGHT EXPID SPECTRO FIBER HEALPIX MTIME, with
+    one row per spectrum of every exposure and spectrograph, in fibermap order
 
     Options:
         nights: list of YEARMMDD to scan for exposures
         specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
         nside: healpix nside, must be power of 2
         comm: MPI communicator
+        indexfile: index file of previous calls, updated with new exposures
 
-    Note: This could be replaced by a DB query when the production DB exists.
+    MTIME is the latest modification time of the cframe files of the
+    exposure spectrograph. Only the cframe fibermaps of the (NIGHT, EXPID,
+    SPECTRO) that are not already in `indexfile` with the same MTIME are
+    read; new exposures are appended to `indexfile`, which is only rewritten
+    if some exposures were reprocessed. HEALPIX is -1 for NaN coordinates.
+    The returned table only includes the requested nights.
+
+    With `comm`, each rank maps the exposures of some nights, and the table
+    is only returned on rank 0 (None on the other ranks).
     '''
     log = get_logger()
     if comm is None:
@@ -43,71 +142,180 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
     if nights is None and rank == 0:
         nights = io.get_nights(specprod_dir=specprod_dir)
 
+    index = None
+    if rank == 0:
+        if indexfile is not None:
+            index = read_exp2healpix_index(indexfile, nside=nside)
+            log.debug('Read {} exposure spectrographs from {}'.format(
+                len(_index_keys(index)), indexfile))
+        else:
+            index = np.zeros(0, dtype=_exp2healpix_index_dtype)
+
+    #- Each rank only gets the MTIME of the indexed exposure spectrographs
+    #- of the nights it scans
     if comm:
         nights = comm.bcast(nights, root=0)
+    ranknights = [nights[r::size] for r in range(size)]
+    if rank == 0:
+        rankmtimes = list()
+        for r in range(size):
+            ii = np.where(np.in1d(index['NIGHT'],
+                np.array(ranknights[r]).astype(int)))[0]
+            rankmtimes.append(dict(zip(zip(index['NIGHT'][ii].tolist(),
+                index['EXPID'][ii].tolist(), index['SPECTRO'][ii].tolist()),
+                index['MTIME'][ii].tolist())))
+    else:
+        rankmtimes = None
+    if comm:
+        mtimes = comm.scatter(rankmtimes, root=0)
+    else:
+        mtimes = rankmtimes[0]
 
     #-----
     #- Distribute nights over ranks, scanning their exposures to build
     #- map of exposures -> healpix
 
-    #- Rows to add to the output table
+    #- Rows to add to the index
     rows = list()
 
-    #- for tracking exposures that we've already mapped in a different band
-    night_expid_spectro = set()
-
-    for night in nights[rank::size]:
+    for night in ranknights[rank]:
         night = str(night)
-        nightdir = os.path.join(specprod_dir, 'exposures', night)
         for expid in io.get_exposures(night, specprod_dir=specprod_dir,
                                       raw=False):
             tmpframe = io.findfile('cframe', night, expid, 'r0',
                                    specprod_dir=specprod_dir)
             expdir = os.path.split(tmpframe)[0]
-            cframefiles = sorted(glob.glob(expdir + '/cframe*.fits'))
-            for filename in cframefiles:
+            cframefiles = dict()
+            for filename in sorted(glob.glob(expdir + '/cframe*.fits')):
                 #- parse 'path/night/expid/cframe-r0-12345678.fits'
                 camera = os.path.basename(filename).split('-')[1]
-                channel, spectro = camera[0], int(camera[1])
+                cframefiles.setdefault(int(camera[1]), list()).append(filename)
 
-                #- skip if we already have this expid/spectrograph
-                if (night, expid, spectro) in night_expid_spectro:
+            for spectro in sorted(cframefiles.keys()):
+                #- skip if this expid/spectrograph is indexed and unchanged
+                mtime = max([os.stat(filename).st_mtime
+                             for filename in cframefiles[spectro]])
+                if mtimes.get((int(night), expid, spectro)) == mtime:
                     continue
-                else:
-                    night_expid_spectro.add((night, expid, spectro))
 
+                filename = cframefiles[spectro][0]
                 log.debug('Rank {} mapping {} {}'.format(rank, night,
                     os.path.basename(filename)))
                 sys.stdout.flush()
 
                 #- Determine healpix, allowing for NaN
-                columns = ['TARGET_RA', 'TARGET_DEC']
+                columns = ['FIBER', 'TARGET_RA', 'TARGET_DEC']
                 fibermap = fitsio.read(filename, 'FIBERMAP', columns=columns)
-                ra, dec = fibermap['TARGET_RA'], fibermap['TARGET_DEC']
-                ok = ~np.isnan(ra) & ~np.isnan(dec)
-                ra, dec = ra[ok], dec[ok]
-                allpix = desimodel.footprint.radec2pix(nside, ra, dec)
+                allpix = fibermap2healpix(fibermap, nside)
 
                 #- Add rows for final output
-                for pix, ntargets in sorted(Counter(allpix).items()):
-                    rows.append((night, expid, spectro, pix, ntargets))
-
-    #- Collect rows from individual ranks back to rank 0
+                newrows = np.zeros(len(fibermap), dtype=_exp2healpix_index_dtype)
+                newrows['NIGHT'] = int(night)
+                newrows['EXPID'] = expid
+                newrows['SPECTRO'] = spectro
+                newrows['FIBER'] = fibermap['FIBER']
+                newrows['HEALPIX'] = allpix
+                newrows['MTIME'] = mtime
+                rows.append(newrows)
+
+    #- Collect the new rows of the individual ranks
     if comm:
         rank_rows = comm.gather(rows, root=0)
-        if rank == 0:
-            rows = list()
-            for r in rank_rows:
-                rows.extend(r)
-        else:
-            rows = None
+        if rank != 0:
+            return None
+        rows = list()
+        for r in rank_rows:
+            rows.extend(r)
+
+    if len(rows) > 0:
+        rows = np.hstack(rows)
+        #- reprocessed exposure spectrographs replace their previous rows
+        stale = np.array([key in _index_keys(rows) for key in zip(
+            index['NIGHT'].tolist(), index['EXPID'].tolist(),
+            index['SPECTRO'].tolist())], dtype=bool)
+        index = np.hstack([index[~stale], rows])
+        if indexfile is not None:
+            log.info('Adding {} exposure spectrographs to {}'.format(
+                len(_index_keys(rows)), indexfile))
+            write_exp2healpix_index(indexfile, index if np.any(stale) else rows,
+                nside=nside, append=not np.any(stale))
+
+    #- Only keep the requested nights
+    keep = np.in1d(index['NIGHT'], np.array(nights).astype(int))
+
+    return index[keep]
+
+def exp2healpix_index_to_map(index):
+    '''
+    Returns table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS
 
-        rows = comm.bcast(rows, root=0)
+    Args:
+        index: table from get_exp2healpix_index
+    '''
+    index = index[index['HEALPIX'] >= 0]
+    keys, counts = np.unique(index[['NIGHT', 'EXPID', 'SPECTRO', 'HEALPIX']],
+        return_counts=True)
 
-    #- Create the final output table
-    exp2healpix = np.array(rows, dtype=[
+    exp2healpix = np.zeros(len(keys), dtype=[
         ('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
         ('HEALPIX', 'i8'), ('NTARGETS', 'i8')])
+    for name in keys.dtype.names:
+        exp2healpix[name] = keys[name]
+    exp2healpix['NTARGETS'] = counts
+
+    return exp2healpix
+
+def split_exp2healpix_index(index, keys=None):
+    '''
+    Returns dict of the index rows of each (NIGHT, EXPID, SPECTRO)
+
+    Args:
+        index: table from get_exp2healpix_index
+
+    Options:
+        keys: only return the rows of these (NIGHT, EXPID, SPECTRO)
+    '''
+    if len(index) == 0:
+        return dict()
+
+    #- rows of each exposure spectrograph are contiguous in the index
+    indexkeys = index[['NIGHT', 'EXPID', 'SPECTRO']]
+    starts = np.concatenate([[0], np.where(indexkeys[1:] != indexkeys[:-1])[0]+1])
+    ends = np.concatenate([starts[1:], [len(index)]])
+    if keys is not None:
+        keys = set([(int(n), int(e), int(s)) for n, e, s in keys])
+    rows = dict()
+    for i, j in zip(starts, ends):
+        night, expid, spectro = indexkeys[i]
+        key = (int(night), int(expid), int(spectro))
+        if keys is None or key in keys:
+            rows[key] = index[i:j]
+
+    return rows
+
+def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None,
+        indexfile=None):
+    '''
+    Returns table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS
+
+    Options:
+        nights: list of YEARMMDD to scan for exposures
+        specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
+        nside: healpix nside, must be power of 2
+        comm: MPI communicator
+        indexfile: index file of previous calls, updated with new exposures
+
+    Note: This could be replaced by a DB query when the production DB exists.
+    See get_exp2healpix_index for the per-spectrum table.
+    '''
+    index = get_exp2healpix_index(nights=nights, specprod_dir=specprod_dir,
+        nside=nside, comm=comm, indexfile=indexfile)
+
+    exp2healpix = None
+    if index is not None:
+        exp2healpix = exp2healpix_index_to_map(index)
+    if comm:
+        exp2healpix = comm.bcast(exp2healpix, root=0)
 
     return exp2healpix
 
@@ -119,7 +327,8 @@ class FrameLite(object):
     This is intended for I/O without the overheads of float32 -> float64
     conversion, correcting endianness, etc.
     '''
-    def __init__(self, wave, flux, ivar, mask, rdat, fibermap, header, scores=None):
+    def __init__(self, wave, flux, ivar, mask, rdat, fibermap, header, scores=None,
+            healpix=None):
         '''
         Create a new FrameLite object
 
@@ -134,6 +343,7 @@ class FrameLite(object):
 
         Options:
             scores: table of QA scores
+            healpix: dict of healpix pixel arrays of the spectra, keyed by nside
         '''
         self.wave = wave
         self.flux = flux
@@ -143,6 +353,19 @@ class FrameLite(object):
         self.fibermap = fibermap
         self.header = header
         self.scores = scores
+        if healpix is None:
+            healpix = dict()
+        self.healpix = healpix
+
+    def get_healpix(self, nside=64):
+        '''
+        Return NESTED healpix pixels of the spectra, -1 for NaN coordinates
+
+        The pixels are computed from the fibermap on the first call for `nside`
+        '''
+        if nside not in self.healpix:
+            self.healpix[nside] = fibermap2healpix(self.fibermap, nside)
+        return self.healpix[nside]
 
     def __getitem__(self, index):
         '''Return a subset of the original FrameLight'''
@@ -154,9 +377,13 @@ class FrameLite(object):
         else:
             scores = None
 
+        healpix = dict()
+        for nside, allpix in self.healpix.items():
+            healpix[nside] = allpix[index]
+
         return FrameLite(self.wave, self.flux[index], self.ivar[index],
             self.mask[index], self.rdat[index], self.fibermap[index],
-            self.header, scores)
+            self.header, scores, healpix)
 
     @classmethod
     def read(cls, filename):
@@ -422,7 +649,7 @@ def add_missing_frames(frames):
             #- Add the blank FrameLite object
             frames[(night,expid,xcam)] = FrameLite(
                 wave[x], flux, ivar, mask, rdat,
-                frame.fibermap, header, scores)
+                frame.fibermap, header, scores, frame.healpix)
 
 def frames2spectra(frames, pix, nside=64):
     '''
@@ -462,12 +689,7 @@ def frames2spectra(frames, pix, nside=64):
         rdat[x] = list()
         scores[x] = list()
         for xf in xframes:
-            ra, dec = xf.fibermap['TARGET_RA'], xf.fibermap['TARGET_DEC']
-            ok = ~np.isnan(ra) & ~np.isnan(dec)
-            ra[~ok] = 0.0
-            dec[~ok] = 0.0
-            allpix = desimodel.footprint.radec2pix(nside, ra, dec)
-            ii = (allpix == pix) & ok
+            ii = (xf.get_healpix(nside) == pix)
             flux[x].append(xf.flux[ii])
             ivar[x].append(xf.ivar[ii])
             mask[x].append(xf.mask[ii])
@@ -511,7 +733,8 @@ def frames2spectra(frames, pix, nside=64):
 
     return SpectraLite(bands, wave, flux, ivar, mask, rdat, fibermap, scores)
 
-def update_frame_cache(frames, framekeys, specprod_dir=None):
+def update_frame_cache(frames, framekeys, specprod_dir=None, healpix=None,
+        nside=64):
     '''
     Update a cache of FrameLite objects to match requested frameskeys
 
@@ -519,6 +742,14 @@ def update_frame_cache(frames, framekeys, specprod_dir=None):
         frames: dict of FrameLite objects, keyed by (night, expid, camera)
         framekeys: list of desired (night, expid, camera)
 
+    Options:
+        specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
+        healpix: dict of index rows keyed by (night, expid, spectro) from
+            split_exp2healpix_index; their HEALPIX are used for the frames
+            that are read, if they have the same FIBER, instead of recomputing
+            them from their fibermap
+        nside: healpix nside of `healpix`
+
     Updates `frames` in-place
 
     Notes:
@@ -547,6 +778,11 @@ def update_frame_cache(frames, framekeys, specprod_dir=None):
             log.debug('  Reading {}'.format(os.path.basename(framefile)))
             nadd += 1
             frames[key] = FrameLite.read(framefile)
+            spectro = int(camera[1:])
+            if healpix is not None and (night, expid, spectro) in healpix:
+                rows = healpix[(night, expid, spectro)]
+                if np.array_equal(rows['FIBER'], frames[key].fibermap['FIBER']):
+                    frames[key].healpix[nside] = rows['HEALPIX']
 
     log.debug('Frame cache: {} kept, {} added, {} dropped, now have {}'.format(
          nkeep, nadd, ndrop, len(frames)))
@@ -8,6 +8,7 @@ import numpy as np
 import scipy.interpolate
 import yaml
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 from pkg_resources import resource_exists, resource_filename
 
 from desispec.image import Image
@@ -16,6 +17,7 @@ from desispec.maskbits import ccdmask
 from desiutil.log import get_logger
 from desispec.calibfinder import CalibFinder
 from desispec.darktrail import correct_dark_trail
+from desispec.robuststats import clipped_mean_and_rms, patch_medians
 
 # log = get_logger()
 
@@ -94,28 +96,34 @@ def _overscan(pix, nsigma=5, niter=3):
         nsigma (float) : number of standard deviations for sigma clipping
         niter (int) : number of iterative refits
     '''
-    log=get_logger()
-    #- normalized median absolute deviation as robust version of RMS
-    #- see https://en.wikipedia.org/wiki/Median_absolute_deviation
-    overscan = np.median(pix)
-    absdiff = np.abs(pix - overscan)
-    readnoise = 1.4826*np.median(absdiff)
+    overscan, readnoise = _overscan_per_row(np.ravel(pix)[None,:], nsigma=nsigma, niter=niter)
+    return overscan[0], readnoise[0]
+
+def _overscan_per_row(pix, nsigma=5, niter=3):
+    '''
+    returns overscan, readnoise arrays from each row of overscan image pixels
+
+    The overscan is a sigma clipped mean and the readnoise a sigma clipped rms,
+    corrected for the clipping, both starting from the median and normalized median
+    absolute deviation (see desispec.robuststats.clipped_mean_and_rms).
+    All rows are processed at once.
 
+    Args:
+        pix (ndarray) : 2D overscan pixels from CCD image
+
+    Optional:
+        nsigma (float) : number of standard deviations for sigma clipping
+        niter (int) : number of iterative refits
+    '''
     #- input pixels are integers, so iteratively refit
-    for i in range(niter):
-        absdiff = np.abs(pix - overscan)
-        good = absdiff < nsigma*readnoise
-        if np.sum(good)<5 :
-            log.error("error in sigma clipping for overscan measurement, return result without clipping")
-            overscan = np.median(pix)
-            absdiff = np.abs(pix - overscan)
-            readnoise = 1.4826*np.median(absdiff)
-            return overscan,readnoise
-        overscan = np.mean(pix[good])
-        readnoise = np.std(pix[good])
+    overscan, readnoise, clipped = clipped_mean_and_rms(pix, nsigma=nsigma, niter=niter)
+
+    if not np.all(clipped) :
+        log=get_logger()
+        log.error("error in sigma clipping for overscan measurement of {} rows, return result without clipping".format(np.sum(~clipped)))
 
     #- correct for bias from sigma clipping
-    readnoise /= _clipped_std_bias(nsigma)
+    readnoise[clipped] /= _clipped_std_bias(nsigma)
 
     return overscan, readnoise
 
@@ -134,13 +142,9 @@ def _global_background(image,patch_width=200) :
 
     Returns background image with same shape as input image
     '''
-    bkg=np.zeros_like(image)
-    bins0=np.linspace(0,image.shape[0],float(image.shape[0])/patch_width).astype(int)
-    bins1=np.linspace(0,image.shape[1],float(image.shape[1])/patch_width).astype(int)
-    bkg_grid=np.zeros((bins0.size-1,bins1.size-1))
-    for j in range(bins1.size-1) :
-        for i in range(bins0.size-1) :
-            bkg_grid[i,j]=np.median(image[bins0[i]:bins0[i+1],bins1[j]:bins1[j+1]])
+    bins0=np.linspace(0,image.shape[0],int(image.shape[0]/patch_width)).astype(int)
+    bins1=np.linspace(0,image.shape[1],int(image.shape[1]/patch_width)).astype(int)
+    bkg_grid=patch_medians(image,bins0,bins1)
 
     nodes0=bins0[:-1]+(bins0[1]-bins0[0])/2.
     nodes1=bins1[:-1]+(bins1[1]-bins0[0])/2.
@@ -209,13 +213,11 @@ def _background(image,header,patch_width=200,stitch_width=10,stitch=False) :
             ii0=parse_sec_keyword(header['CCDSEC%d'%amp0])
             ii1=parse_sec_keyword(header['CCDSEC%d'%amp1])
             pos=ii0[axis].stop
-            bins=np.linspace(ii0[axis-1].start,ii0[axis-1].stop,float(ii0[axis-1].stop-ii0[axis-1].start)/patch_width).astype(int)
-            delta=np.zeros((bins.size-1))
-            for i in range(bins.size-1) :
-                if axis==0 :
-                    delta[i]=np.median(tmp_image[pos-stitch_width:pos,bins[i]:bins[i+1]])-np.median(tmp_image[pos:pos+stitch_width,bins[i]:bins[i+1]])
-                else :
-                    delta[i]=np.median(tmp_image[bins[i]:bins[i+1],pos-stitch_width:pos])-np.median(tmp_image[bins[i]:bins[i+1],pos:pos+stitch_width])
+            bins=np.linspace(ii0[axis-1].start,ii0[axis-1].stop,int((ii0[axis-1].stop-ii0[axis-1].start)/patch_width)).astype(int)
+            if axis==0 :
+                delta=patch_medians(tmp_image,[pos-stitch_width,pos],bins)[0]-patch_medians(tmp_image,[pos,pos+stitch_width],bins)[0]
+            else :
+                delta=patch_medians(tmp_image,bins,[pos-stitch_width,pos])[:,0]-patch_medians(tmp_image,bins,[pos,pos+stitch_width])[:,0]
             nodes=bins[:-1]+(bins[1]-bins[0])/2.
 
             log.info("AMPS %d:%d mean diff=%f"%(amp0,amp1,np.mean(delta)))
@@ -290,11 +292,123 @@ def get_calibration_image(cfinder,keyword,entry) :
         raise ValueError("Don't known how to read %s in %s"%(keyword,path))
     return False
 
+def _map_amps(func, amp_args, nthreads=1) :
+    """
+    Returns [func(*args) for args in amp_args], using a pool of nthreads threads
+    if nthreads>1 (numpy releases the GIL in the array operations)
+    """
+    if nthreads > 1 and len(amp_args) > 1 :
+        with ThreadPoolExecutor(max_workers=nthreads) as pool :
+            return list(pool.map(lambda args : func(*args), amp_args))
+    return [func(*args) for args in amp_args]
+
+def _preproc_amp(rawimage, bias, dark, exptime, image, readnoise, mask, datasec, ccdsec,
+                 ov_col, ov_row, gain, saturlev, overscan_per_row) :
+    """
+    Subtract bias, overscan and dark and apply gain to the data of one amplifier,
+    writing the results in place in image[ccdsec], readnoise[ccdsec] and mask[ccdsec].
+
+    Args:
+        rawimage : 2D raw image (any type)
+        bias : 2D bias image with the shape of rawimage, or False
+        dark : 2D dark image (per unit of exposure time) with the shape of image, or False
+        exptime : exposure time for the dark
+        image, readnoise, mask : 2D output arrays
+        datasec : tuple of slices of the amplifier data in rawimage (DATASEC)
+        ccdsec : tuple of slices of the amplifier data in image (CCDSEC)
+        ov_col : tuple of slices of the overscan columns in rawimage (BIASSEC)
+        ov_row : tuple of slices of the overscan rows in rawimage (ORSEC), or None
+        gain : gain in electrons/ADU
+        saturlev : saturation level in ADU
+        overscan_per_row : if True, subtract the overscan row by row
+
+    Returns (median_overscan, median_rdnoise), overscan in ADU, readnoise in electrons
+    """
+    log=get_logger()
+
+    def _raw(xyslice) :
+        #- raw pixels of a region, in float64, minus bias
+        pix = rawimage[xyslice].astype(np.float64)
+        if bias is not False :
+            pix -= bias[xyslice]
+        return pix
+
+    # Generate the overscan images
+    raw_overscan_col = _raw(ov_col)
+
+    if ov_row is not None :
+        raw_overscan_row = _raw(ov_row)
+
+        # Remove overscan_col from overscan_row
+        raw_overscan_squared = _raw((ov_row[0], ov_col[1]))
+        o,r = _overscan_per_row(raw_overscan_squared)
+        overscan_row = raw_overscan_row - o[:,None]
+
+    # Now remove the overscan_col
+    nrows=raw_overscan_col.shape[0]
+    log.info("nrows in overscan=%d"%nrows)
+    if overscan_per_row :
+        overscan_col, rdnoise = _overscan_per_row(raw_overscan_col)
+    else :
+        o,r =  _overscan(raw_overscan_col)
+        overscan_col = np.full(nrows, o)
+        rdnoise = np.full(nrows, r)
+
+    rdnoise *= gain
+    median_rdnoise  = np.median(rdnoise)
+    median_overscan = np.median(overscan_col)
+    log.info("Median rdnoise and overscan= %f %f"%(median_rdnoise,median_overscan))
+
+    readnoise[ccdsec][:nrows] = rdnoise[:,None]
+
+    #- subtract overscan from data region and apply gain, in place
+    data = image[ccdsec]
+    data[:] = rawimage[datasec]
+    if bias is not False :
+        data -= bias[datasec]
+
+    #- apply saturlev (defined in ADU), prior to multiplication by gain
+    saturated = (data>=saturlev)
+    mask[ccdsec][saturated] |= ccdmask.SATURATED
+    del saturated
+
+    # Subtract columns
+    data[:nrows] -= overscan_col[:,None]
+    # And now the rows
+    if ov_row is not None :
+        o,r = _overscan(overscan_row)
+        data -= o
+
+    #- subtract dark prior to multiplication by gain
+    if dark is not False  :
+        data -= dark[ccdsec]*exptime
+
+    data *= gain
+
+    return median_overscan, median_rdnoise
+
+def _pixflat_and_ivar_amp(image, readnoise, ivar, pixflat, ccdsec) :
+    """
+    Divide image[ccdsec] and readnoise[ccdsec] by the pixflat (if not False)
+    and compute ivar[ccdsec], in place
+    """
+    if pixflat is not False :
+        almost_zero = 0.001
+        pixflat = pixflat[ccdsec]
+        good = (pixflat > almost_zero )
+        np.divide(image[ccdsec], pixflat, out=image[ccdsec], where=good)
+        np.divide(readnoise[ccdsec], pixflat, out=readnoise[ccdsec], where=good)
+
+    var = image[ccdsec].clip(0)
+    var += readnoise[ccdsec]**2
+    ok = (var>0)
+    ivar[ccdsec][ok] = 1.0 / var[ok]
+
 def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True, mask=True,
             bkgsub=False, nocosmic=False, cosmics_nsig=6, cosmics_cfudge=3., cosmics_c2fudge=0.5,
             ccd_calibration_filename=None, nocrosstalk=False, nogain=False,
             overscan_per_row=False, use_overscan_row=True,
-            nodarktrail=False):
+            nodarktrail=False, dtype=np.float64, nthreads=None):
 
     '''
     preprocess image using metadata in header
@@ -333,6 +447,15 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         cosmics_cfudge: number of sigma inconsistent with PSF required
         cosmics_c2fudge:  fudge factor applied to PSF
 
+    Optional memory and speed features:
+        dtype: working precision and type of the output image, readnoise
+            and ivar arrays; np.float32 halves their memory footprint
+            (overscan and readnoise levels are always measured in float64)
+        nthreads: number of threads processing the amplifiers in parallel,
+            also used for the cosmic ray rejection. If None, the amplifiers
+            are processed serially and the cosmic ray rejection uses the
+            default number of numba threads.
+
     Returns Image object with member variables:
         image : 2D preprocessed image in units of electrons per pixel
         ivar : 2D inverse variance of image
@@ -362,6 +485,10 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
 
     The inverse variance is estimated from the readnoise and the image itself,
     and thus is biased.
+
+    The raw image is never converted to floating point as a whole: each
+    amplifier is processed separately, and written directly in place in the
+    output arrays, to limit the memory usage.
     '''
     log=get_logger()
 
@@ -377,17 +504,12 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
     #- Subtract bias image
     camera = header['CAMERA'].lower()
 
-    #- convert rawimage to float64 : this is the output format of read_image
-    rawimage = rawimage.astype(np.float64)
-
     bias = get_calibration_image(cfinder,"BIAS",bias)
 
     if bias is not False : #- it's an array
-        if bias.shape == rawimage.shape  :
-            log.info("subtracting bias")
-            rawimage = rawimage - bias
-        else:
+        if bias.shape != rawimage.shape  :
             raise ValueError('shape mismatch bias {} != rawimage {}'.format(bias.shape, rawimage.shape))
+        log.info("subtracting bias")
 
     #- Check if this file uses amp names 1,2,3,4 (old) or A,B,C,D (new)
     amp_ids = get_amp_ids(header)
@@ -411,7 +533,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         yy, xx = parse_sec_keyword(header['CCDSEC%s'%amp])
         ny=max(ny,yy.stop)
         nx=max(nx,xx.stop)
-    image = np.zeros( (ny,nx) )
+    image = np.zeros( (ny,nx), dtype=dtype )
 
     readnoise = np.zeros_like(image)
 
@@ -426,6 +548,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
 
     #- Load dark
     dark = get_calibration_image(cfinder,"DARK",dark)
+    exptime = None
 
     if dark is not False :
         if dark.shape != image.shape :
@@ -441,16 +564,20 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         exptime =  primary_header[exptime_key]
 
         log.info("Multiplying dark by exptime %f"%(exptime))
-        dark *= exptime
 
+    #- Parameters of each amplifier
+    amp_args = list()
     for amp in amp_ids :
         # Grab the sections
         ov_col = parse_sec_keyword(header['BIASSEC'+amp])
+        ov_row = None
         if 'ORSEC'+amp in header.keys():
             ov_row = parse_sec_keyword(header['ORSEC'+amp])
         elif use_overscan_row:
             log.error('No ORSEC{} keyword; not using overscan_row'.format(amp))
             use_overscan_row = False
+        if not use_overscan_row :
+            ov_row = None
 
         if nogain :
             gain = 1.
@@ -478,49 +605,24 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
                 saturlev = 200000
                 log.warning('Missing keyword SATURLEV{} in header and nothing in calib data; using 200000'.format(amp,saturlev))
 
-        # Generate the overscan images
-        raw_overscan_col = rawimage[ov_col].copy()
-
-        if use_overscan_row:
-            raw_overscan_row = rawimage[ov_row].copy()
-            overscan_row = np.zeros_like(raw_overscan_row)
-
-            # Remove overscan_col from overscan_row
-            raw_overscan_squared = rawimage[ov_row[0], ov_col[1]].copy()
-            for row in range(raw_overscan_row.shape[0]):
-                o,r = _overscan(raw_overscan_squared[row])
-                overscan_row[row] = raw_overscan_row[row] - o
-
-        # Now remove the overscan_col
-        nrows=raw_overscan_col.shape[0]
-        log.info("nrows in overscan=%d"%nrows)
-        overscan_col = np.zeros(nrows)
-        rdnoise  = np.zeros(nrows)
         if (cfinder and cfinder.haskey('OVERSCAN'+amp) and cfinder.value("OVERSCAN"+amp).upper()=="PER_ROW") or overscan_per_row:
             log.info("Subtracting overscan per row for amplifier %s of camera %s"%(amp,camera))
-            for j in range(nrows) :
-                if np.isnan(np.sum(overscan_col[j])) :
-                    log.warning("NaN values in row %d of overscan of amplifier %s of camera %s"%(j,amp,camera))
-                    continue
-                o,r =  _overscan(raw_overscan_col[j])
-                #log.info("%d %f %f"%(j,o,r))
-                overscan_col[j]=o
-                rdnoise[j]=r
+            per_row = True
         else :
             log.info("Subtracting average overscan for amplifier %s of camera %s"%(amp,camera))
-            o,r =  _overscan(raw_overscan_col)
-            overscan_col += o
-            rdnoise  += r
-
-        rdnoise *= gain
-        median_rdnoise  = np.median(rdnoise)
-        median_overscan = np.median(overscan_col)
-        log.info("Median rdnoise and overscan= %f %f"%(median_rdnoise,median_overscan))
+            per_row = False
 
+        jj = parse_sec_keyword(header['DATASEC'+amp])
         kk = parse_sec_keyword(header['CCDSEC'+amp])
-        for j in range(nrows) :
-            readnoise[kk][j] = rdnoise[j]
+        amp_args.append((rawimage, bias, dark, exptime, image, readnoise, mask,
+                         jj, kk, ov_col, ov_row, gain, saturlev, per_row))
 
+    #- overscan, bias, dark and gain for each amplifier
+    amp_nthreads = 1 if nthreads is None else nthreads
+    results = _map_amps(_preproc_amp, amp_args, amp_nthreads)
+
+    for amp, args, (median_overscan, median_rdnoise) in zip(amp_ids, amp_args, results) :
+        gain = args[11]
         header['OVERSCN'+amp] = (median_overscan,'ADUs (gain not applied)')
         if gain != 1 :
             rdnoise_message = 'electrons (gain is applied)'
@@ -551,30 +653,6 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
 
         log.info("Measured readnoise for AMP %s = %f"%(amp,median_rdnoise))
 
-        #- subtract overscan from data region and apply gain
-        jj = parse_sec_keyword(header['DATASEC'+amp])
-
-        data = rawimage[jj].copy()
-        # Subtract columns
-        for k in range(nrows):
-            data[k] -= overscan_col[k]
-        # And now the rows
-        if use_overscan_row:
-            #oimg_row = np.outer(np.ones(data.shape[0]), np.median(overscan_row, axis=0))
-            o,r = _overscan(overscan_row)
-            data -= o
-
-        #- apply saturlev (defined in ADU), prior to multiplication by gain
-        saturated = (rawimage[jj]>=saturlev)
-        mask[kk][saturated] |= ccdmask.SATURATED
-
-        #- subtract dark prior to multiplication by gain
-        if dark is not False  :
-            log.info("subtracting dark for amp %s"%amp)
-            data -= dark[kk]
-
-        image[kk] = data*gain
-
     if not nocrosstalk :
         #- apply cross-talk
 
@@ -645,24 +723,21 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
             raise ValueError('shape mismatch pixflat {} != image {}'.format(pixflat.shape, image.shape))
 
         almost_zero = 0.001
-        
-        if np.all(pixflat > almost_zero ):
-            image /= pixflat
-            readnoise /= pixflat
-        else:
-            good = (pixflat > almost_zero )
-            image[good] /= pixflat[good]
-            readnoise[good] /= pixflat[good]
+
+        good = (pixflat > almost_zero )
+        if not np.all(good) :
             mask[~good] |= ccdmask.PIXFLATZERO
+        del good
 
         lowpixflat = (0 < pixflat) & (pixflat < 0.1)
         if np.any(lowpixflat):
             mask[lowpixflat] |= ccdmask.PIXFLATLOW
+        del lowpixflat
 
-    #- Inverse variance, estimated directly from the data (BEWARE: biased!)
-    var = image.clip(0) + readnoise**2
-    ivar = np.zeros(var.shape)
-    ivar[var>0] = 1.0 / var[var>0]
+    #- pixflat and inverse variance, estimated directly from the data (BEWARE: biased!)
+    ivar = np.zeros_like(image)
+    amp_args = [(image, readnoise, ivar, pixflat, parse_sec_keyword(header['CCDSEC'+amp])) for amp in amp_ids]
+    _map_amps(_pixflat_and_ivar_amp, amp_args, amp_nthreads)
 
     if bkgsub :
         bkg = _background(image,header)
@@ -674,7 +749,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
     #- update img.mask to mask cosmic rays
 
     if not nocosmic :
-        cosmics.reject_cosmic_rays(img,nsig=cosmics_nsig,cfudge=cosmics_cfudge,c2fudge=cosmics_c2fudge)
+        cosmics.reject_cosmic_rays(img,nsig=cosmics_nsig,cfudge=cosmics_cfudge,c2fudge=cosmics_c2fudge,nthreads=nthreads)
 
     return img
 
@@ -4,7 +4,6 @@ desispec.qproc.qextract
 """
 import time
 import numpy as np
-from numpy.polynomial.legendre import legval
 import numba
 
 from desiutil.log import get_logger
@@ -14,25 +13,78 @@ from desispec.io.fibermap import empty_fibermap
 from desispec.qproc.qframe import QFrame
 
 
-@numba.jit
-def numba_extract(image_flux,image_var,x,hw=3) :
+@numba.jit(nopython=True)
+def _numba_interp_rows(ty,values,out) :
+    """Same as np.interp(np.arange(out.size),ty,values) for an increasing ty"""
+    n=ty.size
+    k=0
+    for j in range(out.size) :
+        if j<=ty[0] :
+            out[j]=values[0]
+            continue
+        if j>=ty[n-1] :
+            out[j]=values[n-1]
+            continue
+        while ty[k+1]<=j :
+            k+=1
+        out[j]=values[k]+(values[k+1]-values[k])/(ty[k+1]-ty[k])*(j-ty[k])
+
+@numba.jit(nopython=True,parallel=True)
+def numba_extract_all(image_flux,image_ivar,ty,tx,ts,twave,hw,flux,ivar,wave,sigma) :
+    """Boxcar extraction of all fibers, fibers are processed in parallel threads.
+
+    Args:
+        image_flux : 2D image (n0,n1)
+        image_ivar : 2D inverse variance image (n0,n1), 0 for masked pixels
+        ty : 2D array (nfibers,ntwave), CCD row of the trace at the wavelength twave
+        tx : 2D array (nfibers,ntwave), CCD column of the trace at the wavelength twave
+        ts : 2D array (nfibers,ntwave), PSF sigma at the wavelength twave, not used if sigma.size==0
+        twave : 1D array (ntwave) of wavelength
+        hw : boxcar half width in pixels
+        flux, ivar, wave, sigma : output 2D arrays (nfibers,n0), sigma can be of size 0
+
+    Returns a 1D array (nfibers) of booleans, True for the fibers with a negative
+    or null wavelength step, for which flux and ivar are not computed
+    """
+    nfibers=ty.shape[0]
     n0=image_flux.shape[0]
-    flux=np.zeros(n0)
-    ivar=np.zeros(n0)
-    for j in range(n0) :
-        var=0
-        for i in range(int(x[j]-hw),int(x[j]+hw+1)) :
-            flux[j] += image_flux[j,i]
-            if image_var[j,i]>0 :
-                var += image_var[j,i]
+    ntw=twave.size
+    bad=np.zeros(nfibers,dtype=np.bool_)
+    for f in numba.prange(nfibers) :
+        x_of_y=np.zeros(n0)
+        _numba_interp_rows(ty[f],twave,wave[f])
+        _numba_interp_rows(ty[f],tx[f],x_of_y)
+        if sigma.size>0 :
+            _numba_interp_rows(ty[f],ts[f],sigma[f])
+        # linear extrapolation of the wavelength
+        for j in range(n0) :
+            if j<ty[f,0] :
+                wave[f,j]=twave[0]+(twave[1]-twave[0])/(ty[f,1]-ty[f,0])*(j-ty[f,0])
+            elif j>ty[f,ntw-1] :
+                wave[f,j]=twave[ntw-1]+(twave[ntw-2]-twave[ntw-1])/(ty[f,ntw-2]-ty[f,ntw-1])*(j-ty[f,ntw-1])
+        for j in range(n0) :
+            if j==0 :
+                dwave=2*(wave[f,1]-wave[f,0])-(wave[f,2]-wave[f,1])
             else :
-                flux[j]=0
-                ivar[j]=0
-                var=0
+                dwave=wave[f,j]-wave[f,j-1]
+            if dwave<=0 :
+                bad[f]=True
                 break
-        if var>0 : 
-            ivar[j] = 1./var
-    return flux,ivar
+            tflux=0.
+            var=0.
+            for i in range(int(x_of_y[j]-hw),int(x_of_y[j]+hw+1)) :
+                tflux += image_flux[j,i]
+                if image_ivar[j,i]>0 :
+                    var += 1./image_ivar[j,i]
+                else :
+                    tflux=0.
+                    var=0.
+                    break
+            # flux density
+            flux[f,j]=tflux/dwave
+            if var>0 :
+                ivar[f,j]=dwave**2/var
+    return bad
 
 
 
@@ -59,8 +111,6 @@ def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=No
     
     wavemin = xytraceset.wavemin
     wavemax = xytraceset.wavemax
-    xcoef   = xytraceset.x_vs_wave_traceset._coeff 
-    ycoef   = xytraceset.y_vs_wave_traceset._coeff 
     
     spectrograph = 0
     if "CAMERA" in image.meta :
@@ -68,7 +118,7 @@ def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=No
         spectrograph = int(camera[-1])
         log.info("camera='{}' -> spectrograph={}. I AM USING THIS TO DEFINE THE FIBER NUMBER (ASSUMING 500 FIBERS PER SPECTRO).".format(camera,spectrograph))
     
-    allfibers = np.arange(xcoef.shape[0])+500*spectrograph
+    allfibers = np.arange(xytraceset.nspec)+500*spectrograph
     
     if fibers is None :
         fibers = allfibers
@@ -80,68 +130,40 @@ def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=No
     if image.mask is not None :
         image.ivar *= (image.mask==0)
     
-    #  Applying a mask that keeps positive value to get the Variance by inversing the inverse variance.
-    var=np.zeros(image.ivar.size)
-    ok=image.ivar.ravel()>0
-    var[ok] = 1./image.ivar.ravel()[ok]
-    var=var.reshape(image.ivar.shape)
-
-    badimage=(image.ivar==0)
-    
     n0 = image.pix.shape[0]
-    n1 = image.pix.shape[1]
     
     frame_flux = np.zeros((fibers.size,n0))
     frame_ivar = np.zeros((fibers.size,n0))
     frame_wave = np.zeros((fibers.size,n0))
 
     frame_sigma = None
-    ysigcoef = None
     if save_sigma :
         if  xytraceset.ysig_vs_wave_traceset is None :
             log.warning("will not save sigma in qframe because missing in traceset")
         else :
             frame_sigma = np.zeros((fibers.size,n0))
-            ysigcoef    = xytraceset.ysig_vs_wave_traceset._coeff
 
-    xx         = np.tile(np.arange(n1),(n0,1))
     hw = width//2
     
     
     twave=np.linspace(wavemin, wavemax, n0//4) # this number of bins n0//p is calibrated to give a negligible difference of wavelength precision
-    rwave=(twave-wavemin)/(wavemax-wavemin)*2-1.
-    y=np.arange(n0).astype(float)
-    
     
-    dwave = np.zeros(n0)
-    for f,fiber in enumerate(fibers) :
-        log.debug("extracting fiber #%03d"%fiber)
-        ty = legval(rwave, ycoef[f])
-        tx = legval(rwave, xcoef[f])
-        frame_wave[f] = np.interp(y,ty,twave)
-        x_of_y        = np.interp(y,ty,tx)        
-
-        i=np.where(y<ty[0])[0]
-        if i.size>0 : # need extrapolation
-            frame_wave[f,i] = twave[0]+(twave[1]-twave[0])/(ty[1]-ty[0])*(y[i]-ty[0])
-        i=np.where(y>ty[-1])[0]
-        if i.size>0 : # need extrapolation
-            frame_wave[f,i] = twave[-1]+(twave[-2]-twave[-1])/(ty[-2]-ty[-1])*(y[i]-ty[-1])
-
-        dwave[1:]     = frame_wave[f,1:]-frame_wave[f,:-1]
-        dwave[0]      = 2*dwave[1]-dwave[2]
-        if np.any(dwave<=0) :
-            log.error("neg. or null dwave")
-            raise ValueError("neg. or null dwave")
-
-        frame_flux[f],frame_ivar[f] = numba_extract(image.pix,var,x_of_y,hw)
-        # flux density
-        frame_flux[f] /= dwave
-        frame_ivar[f] *= dwave**2
-
-        if frame_sigma is not None :
-            ts = legval(rwave, ysigcoef[f])
-            frame_sigma[f] = np.interp(y,ty,ts)
+    # traces of all fibers at once
+    nfibers = fibers.size
+    all_ty = xytraceset.y_vs_wave_all(twave)[:nfibers]
+    all_tx = xytraceset.x_vs_wave_all(twave)[:nfibers]
+    if frame_sigma is not None :
+        all_ts = xytraceset.ysig_vs_wave_all(twave)[:nfibers]
+        sigma = frame_sigma
+    else :
+        all_ts = all_ty
+        sigma = np.zeros((0,0))
+
+    # extraction of all fibers and rows in parallel
+    bad = numba_extract_all(image.pix,image.ivar,all_ty,all_tx,all_ts,twave,hw,frame_flux,frame_ivar,frame_wave,sigma)
+    if np.any(bad) :
+        log.error("neg. or null dwave for fibers {}".format(fibers[bad]))
+        raise ValueError("neg. or null dwave")
 
     t1=time.time()
     log.info(" done {} fibers in {:3.1f} sec".format(len(fibers),t1-t0))
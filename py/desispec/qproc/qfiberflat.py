@@ -3,7 +3,7 @@ import numpy as np
 import scipy.ndimage
 
 from desiutil.log import get_logger
-from desispec.linalg import spline_fit
+from desispec.linalg import spline_fit_batch
 from desispec.qproc.qframe import QFrame
 from desispec.fiberflat import FiberFlat
 
@@ -67,64 +67,73 @@ def qproc_compute_fiberflat(qframe,niter_meanspec=4,nsig_clipping=3.,spline_res_
     fivar=tivar*mflux**2
     
     mask=np.zeros((fflat.shape), dtype='uint32')
-    chi2=0
     # special case with test slit
     mask_lines = ( qframe.flux.shape[0]<50 ) 
     if mask_lines :
         log.warning("Will interpolate over absorption lines in input continuum spectrum from illumination bench")
         
 
-    # spline fit to reject outliers and smooth the flat
-    for fiber in range(fflat.shape[0]) :
+    # spline fit to reject outliers and smooth the flat,
+    # with one fit of all the fibers still iterating per iteration
+    nfibers=fflat.shape[0]
+    max_rej_it=5# not more than 5 pixels at a time
+    max_bad=1000
+    nbad_tot=np.zeros(nfibers,dtype=int)
+    fchi2=np.zeros(fflat.shape)
+    active=np.arange(nfibers)
+    for loop in range(20) :
         # iterative spline fit
-        max_rej_it=5# not more than 5 pixels at a time
-        max_bad=1000
-        nbad_tot=0
-        for loop in range(20) :
-            good=(fivar[fiber]>0)
-            splineflat = spline_fit(twave,twave[good],fflat[fiber,good],required_resolution=spline_res_clipping,input_ivar=fivar[fiber,good],max_resolution=3*spline_res_clipping)
-            fchi2 = fivar[fiber]*(fflat[fiber]-splineflat)**2
-            bad=np.where(fchi2>nsig_clipping**2)[0]
+        splineflat,ok = spline_fit_batch(twave,twave,fflat[active],required_resolution=spline_res_clipping,input_ivar=fivar[active],max_resolution=3*spline_res_clipping)
+        fchi2[active] = fivar[active]*(fflat[active]-splineflat)**2
+        done = np.zeros(active.size,dtype=bool)
+        for i,fiber in enumerate(active) :
+            bad=np.where(fchi2[fiber]>nsig_clipping**2)[0]
             if bad.size>0 :
                 if bad.size>max_rej_it : # not more than 5 pixels at a time
-                    ii=np.argsort(fchi2[bad])
+                    ii=np.argsort(fchi2[fiber,bad])
                     bad=bad[ii[-max_rej_it:]]
                 fivar[fiber,bad] = 0
-                nbad_tot += len(bad)
-                #log.warning("iteration {} rejecting {} pixels (tot={}) from fiber {}".format(loop,len(bad),nbad_tot,fiber))
-                if nbad_tot>=max_bad:
+                nbad_tot[fiber] += len(bad)
+                #log.warning("iteration {} rejecting {} pixels (tot={}) from fiber {}".format(loop,len(bad),nbad_tot[fiber],fiber))
+                if nbad_tot[fiber]>=max_bad:
                     fivar[fiber,:]=0
                     log.warning("1st pass: rejecting fiber {} due to too many (new) bad pixels".format(fiber))
             else :
-                break
-        
-        chi2 += np.sum(fchi2)
-        
-        min_ivar = 0.1*np.median(fivar[fiber])
-        med_flat = np.median(fflat[fiber])
-         
-        good=(fivar[fiber]>0)
-        splineflat = spline_fit(twave,twave[good],fflat[fiber,good],required_resolution=spline_res_flat,input_ivar=fivar[fiber,good],max_resolution=3*spline_res_flat)
-        fflat[fiber] = splineflat # replace by spline
-        
-        ii=np.where(fivar[fiber]>min_ivar)[0]
-        if ii.size<2 :
+                done[i] = True
+        active = active[~done]
+        if active.size == 0 :
+            break
+
+    chi2 = np.sum(fchi2)
+
+    min_ivar = 0.1*np.median(fivar,axis=1)
+    med_flat = np.median(fflat,axis=1)
+
+    splineflat,ok = spline_fit_batch(twave,twave,fflat,required_resolution=spline_res_flat,input_ivar=fivar,max_resolution=3*spline_res_flat)
+
+    for fiber in range(nfibers) :
+        fflat[fiber] = splineflat[fiber] # replace by spline
+
+        ii=np.where(fivar[fiber]>min_ivar[fiber])[0]
+        if ii.size<2 or not ok[fiber] :
             fflat[fiber] = 1
             fivar[fiber] = 0
-        
+            mask[fiber] = 1
+            continue
+
         # set flat in unknown edges to median value of fiber (and ivar to 0)
         b=ii[0]
         e=ii[-1]+1
-        fflat[fiber,:b]=med_flat # default
+        fflat[fiber,:b]=med_flat[fiber] # default
         fivar[fiber,:b]=0 
         mask[fiber,:b]=1 # need to change this
-        fflat[fiber,e:]=med_flat # default
+        fflat[fiber,e:]=med_flat[fiber] # default
         fivar[fiber,e:]=0 
         mask[fiber,e:]=1 # need to change this
         
         # internal interpolation
-        bad=(fivar[fiber][b:e]<=min_ivar)
-        good=(fivar[fiber][b:e]>min_ivar)
+        bad=(fivar[fiber][b:e]<=min_ivar[fiber])
+        good=(fivar[fiber][b:e]>min_ivar[fiber])
         fflat[fiber][b:e][bad]=np.interp(twave[b:e][bad],twave[b:e][good],fflat[fiber][b:e][good])
 
         # special case with test slit
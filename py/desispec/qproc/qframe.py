@@ -12,7 +12,7 @@ import numpy as np
 
 from desispec import util
 from desispec.frame import Frame
-from desispec.interpolation import resample_flux
+from desispec.interpolation import resample_flux_batch
 from desiutil.log import get_logger
 
 class QFrame(object):
@@ -150,15 +150,11 @@ class QFrame(object):
             n=int((wmax-wmin)/dwave)+1
             wavelength=np.linspace(wmin,wmax,n)
         
-        rflux = np.zeros((self.nspec,wavelength.size))
-        rivar = np.zeros((self.nspec,wavelength.size))
         if self.mask is None :
-            for i in range(self.nspec) :
-                rflux[i],rivar[i] = resample_flux(wavelength,self.wave[i],self.flux[i],self.ivar[i],extrapolate=False)
+            rflux,rivar = resample_flux_batch(wavelength,self.wave,self.flux,self.ivar,extrapolate=False)
         else :
-            for i in range(self.nspec) :
-                rflux[i],rivar[i] = resample_flux(wavelength,self.wave[i],self.flux[i],self.ivar[i]*(self.mask[i]==0),extrapolate=False)
-        
+            rflux,rivar = resample_flux_batch(wavelength,self.wave,self.flux,self.ivar*(self.mask==0),extrapolate=False)
+
             
         return Frame(wave=wavelength,flux=rflux,ivar=rivar,mask=None,resolution_data=None,\
                      fibers=self.fibers, spectrograph=None, meta=self.meta, fibermap=self.fibermap,\
@@ -145,8 +145,9 @@ def write_psffile(infile,wcoeffs,wcoeffs_wavemin,wcoeffs_wavemax,outfile,waveste
     wave      = np.linspace(tset.wavemin,tset.wavemax,nw)
     wsig_set  = TraceSet(wcoeffs,[wcoeffs_wavemin,wcoeffs_wavemax]) 
     wsig_vals = np.zeros((nfiber,nw))
+    all_y_vals = tset.y_vs_wave_all(wave)
     for f in range(nfiber) :
-        y_vals = tset.y_vs_wave(f,wave)
+        y_vals = all_y_vals[f]
         dydw   = np.gradient(y_vals)/np.gradient(wave)
         wsig_vals[f]=wsig_set.eval(f,wave)*dydw
     tset.ysig_vs_wave_traceset = fit_traces(wave, wsig_vals, deg=ncoef-1, domain=(tset.wavemin,tset.wavemax))
@@ -131,8 +131,9 @@ def get_resolution(wave,nspec,tset,usesigma=False):
     resolution_data=np.zeros((nspec,nband,nwave))
     
     if usesigma: #- use sigmas for resolution based on psffile type
+        sigma=tset.ysig_vs_wave_all(wave) #- in pixel units
         for ispec in range(nspec):
-            thissigma=tset.ysig_vs_wave(ispec,wave) #- in pixel units
+            thissigma=sigma[ispec]
             Rsig=QuickResolution(sigma=thissigma,ndiag=nband)
             resolution_data[ispec]=Rsig.data
             
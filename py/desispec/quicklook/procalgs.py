@@ -370,11 +370,10 @@ class BoxcarExtract(pas.PipelineAlg):
             wsigma=np.zeros(flux.shape)
             if tset.ysig_vs_wave_traceset is not None :
                 dw = np.gradient(outwave)
-                for i in range(nspec):
-                    ysig = tset.ysig_vs_wave(i,outwave)
-                    y    = tset.y_vs_wave(i,outwave)
-                    dydw = np.gradient(y)/dw
-                    wsigma[i] = ysig/dydw # in A
+                ysig = tset.ysig_vs_wave_all(outwave)[:nspec]
+                y    = tset.y_vs_wave_all(outwave)[:nspec]
+                dydw = np.gradient(y,axis=1)/dw
+                wsigma[:] = ysig/dydw # in A
         frame = fr(outwave, flux, ivar, resolution_data=Rdata,fibers=fibers, 
                    meta=input_image.meta, fibermap=fibermap,
                    wsigma=wsigma,ndiag=qndiag)
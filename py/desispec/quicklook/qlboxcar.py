@@ -26,8 +26,8 @@ def do_boxcar(image,tset,outwave,boxwidth=2.5,nspec=500,maskFile=None,usesigma=F
         wmin=tset.wavemin
         wmax=tset.wavemax
         waves=np.arange(wmin,wmax,0.25)
-        xs=tset.x_vs_wave(np.arange(tset.nspec),waves) #- xtraces # doing the full image here.
-        ys=tset.y_vs_wave(np.arange(tset.nspec),waves) #- ytraces
+        xs=tset.x_vs_wave_all(waves) #- xtraces # doing the full image here.
+        ys=tset.y_vs_wave_all(waves) #- ytraces
 
         camera=image.camera
         spectrograph=int(camera[1:]) #- first char is "r", "b", or "z"
@@ -122,8 +122,9 @@ def do_boxcar(image,tset,outwave,boxwidth=2.5,nspec=500,maskFile=None,usesigma=F
 
     #- convert to per angstrom first and then resample to desired wave length grid.
 
+    all_ww=tset.wave_vs_y_all(np.arange(0,tset.npix_y))
     for spec in range(nspec):
-        ww=tset.wave_vs_y(spec,np.arange(0,tset.npix_y))
+        ww=all_ww[spec]
         dwave=np.gradient(ww)
         flux[:,spec]/=dwave
         ivar[:,spec]*=dwave**2
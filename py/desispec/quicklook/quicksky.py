@@ -140,7 +140,7 @@ def compute_sky(fframe,fibermap=None,nsig_clipping=4., apply_resolution=False):
         # Use diagonal of skycovar convolved with mean resolution of all fibers
         # first compute average resolution
         #- computing mean from matrix itself
-        R= (fframe.R.sum()/fframe.nspec).todia()
+        R= (sum(fframe.R[i] for i in range(fframe.nspec))/fframe.nspec).todia()
         #mean_res_data=np.mean(fframe.resolution_data,axis=0)
         #R = Resolution(mean_res_data)
         # compute convolved sky and ivar
@@ -9,6 +9,7 @@ Use ``python -m desispec.resolution`` to run unit tests.
 
 from __future__ import division, absolute_import
 
+import numbers
 import numpy as np
 import scipy.sparse
 import scipy.special
@@ -153,6 +154,169 @@ class Resolution(scipy.sparse.dia_matrix):
         """
         return self.data
 
+
+class BatchedResolution(object):
+    """Resolution matrices of many spectra sharing a wavelength grid.
+
+    This is backed by the raw array[nspec, ndiag, nwave] of diagonals, as
+    stored in FITS files, and operates on all spectra at once with array
+    operations instead of going through one sparse matrix per spectrum.
+
+    Indexing with an integer returns the Resolution object of that spectrum,
+    and indexing with a slice or an array of indices returns a
+    BatchedResolution of the subset, so this can be used in place of a numpy
+    array of Resolution objects. The Resolution objects are not cached: each
+    integer index builds a new sparse matrix with a copy of the diagonals, so
+    loops that use the matrix of a spectrum several times should keep it, and
+    loops that only apply it should use the batched methods instead.
+
+    Args:
+        data: 3D numpy array[nspec, ndiag, nwave] of resolution matrix
+            diagonals, each following the Resolution format.
+
+    Raises:
+        ValueError: Invalid input shape.
+    """
+    def __init__(self, data):
+        data = np.asarray(data)
+        if data.ndim != 3:
+            raise ValueError('Cannot initialize BatchedResolution with array of {} dimensions'.format(data.ndim))
+        self.data = data
+        self.nspec, self.ndiag, self.nwave = data.shape
+        if self.ndiag%2 == 0:
+            raise ValueError("Number of diagonals ({}) should be odd".format(self.ndiag))
+        self.offsets = np.arange(self.ndiag//2,-(self.ndiag//2)-1,-1)
+        self._rows = None
+
+    @classmethod
+    def from_resolutions(cls, matrices):
+        """Returns the BatchedResolution of a sequence of resolution matrices
+
+        Args:
+            matrices: sequence of Resolution objects or of sparse matrices in
+                DIA format accepted by Resolution (e.g. QuickResolution), all
+                with the same shape and number of diagonals.
+        """
+        return cls(np.array([Resolution(matrix).data for matrix in matrices]))
+
+    def __len__(self):
+        return self.nspec
+
+    def __getitem__(self, index):
+        if isinstance(index, numbers.Integral):
+            return Resolution(self.data[index])
+        if not isinstance(index, slice):
+            index = np.atleast_1d(index)
+        return BatchedResolution(self.data[index])
+
+    def __iter__(self):
+        for i in range(self.nspec):
+            yield self[i]
+
+    @property
+    def rows(self):
+        """Matrix elements ordered by rows, array[nspec, ndiag, nwave]
+        with rows[s, k, i] = R[s][i, i+offsets[k]] (zero outside of the matrix).
+        Computed on first use.
+        """
+        if self._rows is None:
+            rows = np.zeros(self.data.shape)
+            n = self.nwave
+            for k, offset in enumerate(self.offsets):
+                if offset >= 0:
+                    rows[:, k, :n-offset] = self.data[:, k, offset:]
+                else:
+                    rows[:, k, -offset:] = self.data[:, k, :n+offset]
+            self._rows = rows
+        return self._rows
+
+    def dot(self, x):
+        """Apply the resolution matrices.
+
+        Args:
+            x: 1D[nwave] array applied to all spectra, or 2D[nspec, nwave]
+                array with one vector per spectrum.
+
+        Returns:
+            2D[nspec, nwave] array, with R[s].dot(x[s]) for each spectrum s.
+        """
+        x = np.asarray(x)
+        n = self.nwave
+        result = np.zeros((self.nspec, n), dtype=np.result_type(self.data, x))
+        for k, offset in enumerate(self.offsets):
+            #- R[i, i+offset] = data[k, i+offset]
+            tmp = self.data[:, k]*x
+            if offset >= 0:
+                result[:, :n-offset] += tmp[:, offset:]
+            else:
+                result[:, -offset:] += tmp[:, :n+offset]
+        return result
+
+    def dot_transpose(self, x):
+        """Apply the transposed resolution matrices.
+
+        Args:
+            x: 1D[nwave] array applied to all spectra, or 2D[nspec, nwave]
+                array with one vector per spectrum.
+
+        Returns:
+            2D[nspec, nwave] array, with R[s].T.dot(x[s]) for each spectrum s.
+        """
+        x = np.broadcast_to(np.asarray(x), (self.nspec, self.nwave))
+        n = self.nwave
+        result = np.zeros((self.nspec, n), dtype=np.result_type(self.data, x))
+        for k, offset in enumerate(self.offsets):
+            #- R[j-offset, j] = data[k, j]
+            if offset >= 0:
+                result[:, offset:] += self.data[:, k, offset:]*x[:, :n-offset]
+            else:
+                result[:, :n+offset] += self.data[:, k, :n+offset]*x[:, -offset:]
+        return result
+
+    def diagonal(self):
+        """Returns 2D[nspec, nwave] array of the diagonals of the matrices.
+        """
+        return self.data[:, self.ndiag//2].copy()
+
+    def to_dense(self, fiber):
+        """Returns the dense 2D[nwave, nwave] resolution matrix of one spectrum.
+
+        Args:
+            fiber: index of the spectrum in this batch
+        """
+        return Resolution(self.data[fiber]).toarray()
+
+    def normal_matrix_band(self, weight):
+        """Compute sum over spectra of R[s].T.diag(weight[s]).R[s]
+
+        This matrix has twice the number of diagonals of the resolution
+        matrices, so only its upper band is computed.
+
+        Args:
+            weight: 2D[nspec, nwave] array of weights (for instance inverse variances)
+
+        Returns:
+            2D[u+1, nwave] upper band A of the matrix, stored as in
+            scipy.linalg.cholesky_banded, i.e. A[u+i-j, j] = M[i, j] for i<=j,
+            where u = ndiag-1
+        """
+        n = self.nwave
+        u = self.ndiag-1
+        rows = self.rows
+        wrows = rows*weight[:, None, :]
+        band = np.zeros((u+1, n))
+        for a, oa in enumerate(self.offsets):
+            for b, ob in enumerate(self.offsets):
+                if ob < oa:
+                    continue
+                #- row i of R contributes to M[i+oa, i+ob]
+                tmp = np.einsum('si,si->i', wrows[:, a], rows[:, b])
+                begin = max(0, -oa)
+                end = min(n, n-ob)
+                band[u-(ob-oa), begin+ob:end+ob] += tmp[begin:end]
+        return band
+
+
 def _gauss_pix(x, mean=0.0, sigma=1.0):
     """
     Utility function to integrate Gaussian density within pixels
@@ -0,0 +1,102 @@
+"""
+desispec.robuststats
+====================
+
+Robust statistics (median, median absolute deviation, sigma clipped mean
+and rms) of many samples at once, like all the rows of an overscan region
+or all the patches of an image, computed with array operations
+(np.median and np.partition along one axis) instead of a python loop
+over the samples.
+"""
+
+import numpy as np
+
+
+def median_and_mad_rms(data):
+    """
+    Median and rms estimated from the median absolute deviation of each row of data
+
+    Args:
+        data : 2D array (nsamples,npix), or 1D array for a single sample
+
+    Returns (median, rms), 1D arrays of size nsamples,
+    with rms = 1.4826 * median(|data - median|)
+    (see https://en.wikipedia.org/wiki/Median_absolute_deviation)
+    """
+    data = np.atleast_2d(data)
+    median = np.median(data, axis=1)
+    rms = 1.4826*np.median(np.abs(data-median[:,None]), axis=1)
+    return median, rms
+
+def clipped_mean_and_rms(data, nsigma=5, niter=3, min_good=5):
+    """
+    Iterative sigma clipped mean and rms of each row of data
+
+    Starting from the median and the MAD rms (see median_and_mad_rms),
+    the mean and standard deviation of the pixels closer than nsigma*rms
+    to the previous mean are computed niter times. The rows with fewer than
+    min_good pixels left at any iteration keep their median and MAD rms.
+
+    The rms is not corrected for the bias due to the clipping.
+
+    Args:
+        data : 2D array (nsamples,npix), or 1D array for a single sample
+
+    Options:
+        nsigma : clipping threshold in units of rms
+        niter : number of iterations
+        min_good : minimum number of pixels left after clipping
+
+    Returns (mean, rms, clipped), 1D arrays of size nsamples,
+    clipped is False for the rows where the clipping failed.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    median, mad_rms = median_and_mad_rms(data)
+    mean = median
+    rms = mad_rms
+    clipped = np.ones(median.size, dtype=bool)
+    for i in range(niter):
+        good = np.abs(data-mean[:,None]) < nsigma*rms[:,None]
+        ngood = np.sum(good, axis=1)
+        clipped &= (ngood >= min_good)
+        ngood = np.maximum(ngood, 1)
+        cmean = np.sum(np.where(good, data, 0.), axis=1)/ngood
+        cvar = np.sum(np.where(good, data-cmean[:,None], 0.)**2, axis=1)/ngood
+        mean = np.where(clipped, cmean, median)
+        rms = np.where(clipped, np.sqrt(cvar), mad_rms)
+    return mean, rms, clipped
+
+def patch_medians(image, edges0, edges1):
+    """
+    Median of the image in each patch
+    image[edges0[i]:edges0[i+1],edges1[j]:edges1[j+1]]
+
+    Patches can have different sizes. The image is processed by bands
+    of rows, with one np.median call for each run of adjacent patches
+    of the same width in the band.
+
+    Args:
+        image : 2D array
+        edges0 : increasing indices of the patch boundaries along axis 0
+        edges1 : increasing indices of the patch boundaries along axis 1
+
+    Returns 2D array (len(edges0)-1, len(edges1)-1) of medians
+    """
+    edges0 = np.asarray(edges0, dtype=int)
+    edges1 = np.asarray(edges1, dtype=int)
+    widths = np.diff(edges1)
+
+    # runs of adjacent patches of same width
+    runs = np.concatenate([[0], np.where(np.diff(widths) != 0)[0]+1, [widths.size]])
+
+    medians = np.zeros((edges0.size-1, widths.size))
+    for i in range(edges0.size-1):
+        for begin, end in zip(runs[:-1], runs[1:]):
+            npatch = end-begin
+            width = widths[begin]
+            band = image[edges0[i]:edges0[i+1], edges1[begin]:edges1[end]]
+            # pixels ordered by patch, a copy unless the band is contiguous
+            band = band.reshape(band.shape[0], npatch, width).transpose(1, 0, 2).reshape(npatch, -1)
+            overwrite = not np.shares_memory(band, image)
+            medians[i, begin:end] = np.median(band, axis=1, overwrite_input=overwrite)
+    return medians
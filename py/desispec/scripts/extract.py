@@ -12,6 +12,7 @@ import os.path
 import time
 import argparse
 import numpy as np
+from astropy.io import fits
 
 import specter
 from specter.psf import load_psf
@@ -21,6 +22,7 @@ from desispec import io
 from desiutil.log import get_logger
 from desispec.frame import Frame
 from desispec.maskbits import specmask
+from desispec.parallel import dist_dynamic
 
 import desispec.scripts.mergebundles as mergebundles
 from desispec.specscore import compute_and_append_frame_scores
@@ -61,6 +63,8 @@ def parse(options=None):
     parser.add_argument("--fibermap-index", type=int, default=None, required=False,
                         help="start at this index in the fibermap table instead of using the spectro id from the camera")
     parser.add_argument("--heliocentric-correction", action="store_true", help="apply heliocentric correction to wavelength")
+    parser.add_argument("--merge-bundle-files", action="store_true",
+                        help="with main_mpi, write each bundle to a file and merge them with desi_merge_bundles, instead of gathering them in memory")
     
     args = None
     if options is None:
@@ -262,7 +266,6 @@ regularize: {regularize}
     io.write_frame(args.output, frame)
 
     if args.model is not None:
-        from astropy.io import fits
         fits.writeto(args.model, results['modelimage'], header=frame.meta, overwrite=True)
 
     print('Done {} spectra {}:{} at {}'.format(os.path.basename(input_file),
@@ -273,6 +276,146 @@ regularize: {regularize}
 #- recent addition of mask and chi2pix code required nearly identical edits
 #- in two places.  Could main(args) just call main_mpi(args, comm=None) ?
 
+def gather_bundles(frames, comm=None, root=0, nspec=500):
+    """
+    Assemble the frames of the extracted bundles of all processes
+    into a single frame, as desispec.scripts.mergebundles does with files.
+
+    The spectra are sent to the root process with MPI Gatherv into
+    preallocated arrays; only the (small) fibermaps, wavelength and
+    header are pickled.
+
+    Args:
+        frames: list of Frame objects of the bundles extracted by this process,
+            on the same wavelength grid (can be empty)
+
+    Options:
+        comm: MPI communicator; if None all bundles are in frames
+        root: rank of the process receiving the merged frame
+        nspec: number of fibers per spectrograph; spectra are stored at
+            the index fiber % nspec of the output frame
+
+    Returns:
+        Frame with nspec spectra on the root process, None on the others
+    """
+    rank = 0
+    if comm is not None:
+        rank = comm.rank
+
+    keys = ["flux", "ivar", "mask", "resolution_data", "chi2pix"]
+    local = dict()
+    if len(frames) > 0:
+        fibers = np.concatenate([ fr.fibers for fr in frames ])
+        for key in keys:
+            local[key] = np.ascontiguousarray(np.concatenate(
+                [ getattr(fr, key) for fr in frames ]))
+        fibermap = None
+        if frames[0].fibermap is not None:
+            from astropy.table import vstack
+            fibermap = vstack([ fr.fibermap for fr in frames ]).as_array()
+        info = dict(fibers=fibers, fibermap=fibermap, wave=frames[0].wave,
+                    meta=frames[0].meta, spectrograph=frames[0].spectrograph,
+                    shapes=dict([ (key, local[key].shape) for key in keys ]),
+                    dtypes=dict([ (key, local[key].dtype) for key in keys ]))
+    else:
+        info = None
+
+    if comm is None:
+        infos = [ info, ]
+    else:
+        infos = comm.gather(info, root=root)
+
+    if rank == root:
+        ref = None
+        for x in infos:
+            if x is not None:
+                ref = x
+                break
+        if ref is None:
+            raise RuntimeError("no extracted bundle to gather")
+        counts = [ (0 if x is None else x["fibers"].size) for x in infos ]
+        allfibers = np.concatenate([ x["fibers"] for x in infos if x is not None ])
+
+    #- gather the spectra of all processes, in rank order
+    if comm is None:
+        gathered = local
+    else:
+        #- processes without bundle send empty arrays of the same type
+        shapes, dtypes = comm.bcast(
+            (ref["shapes"], ref["dtypes"]) if rank == root else None, root=root)
+        gathered = dict()
+        for key in keys:
+            sendbuf = local.get(key, None)
+            if sendbuf is None:
+                sendbuf = np.empty((0,)+shapes[key][1:], dtype=dtypes[key])
+            recvbuf = None
+            if rank == root:
+                gathered[key] = np.empty((allfibers.size,)+shapes[key][1:],
+                                         dtype=dtypes[key])
+                rowsize = int(np.prod(shapes[key][1:]))
+                recvbuf = [gathered[key], [ c*rowsize for c in counts ]]
+            comm.Gatherv(sendbuf, recvbuf, root=root)
+
+    if rank != root:
+        return None
+
+    #- Fill the output arrays at the index of each fiber
+    ii = allfibers % nspec
+    merged = dict()
+    for key in keys:
+        shape = ref["shapes"][key]
+        merged[key] = np.zeros((nspec,)+shape[1:], dtype=ref["dtypes"][key])
+        merged[key][ii] = gathered[key]
+
+    fibermap = None
+    if ref["fibermap"] is not None:
+        fibermap = np.zeros(nspec, dtype=ref["fibermap"].dtype)
+        fibermin = (allfibers[0] // nspec) * nspec
+        fibermap['FIBER'] = np.arange(fibermin, fibermin+nspec)
+        fibermap[ii] = np.concatenate([ x["fibermap"] for x in infos if x is not None ])
+
+    spectrograph = ref["spectrograph"]
+    if spectrograph is None:
+        spectrograph = int(allfibers[0] // nspec)
+
+    return Frame(ref["wave"], merged["flux"], merged["ivar"], mask=merged["mask"],
+                 resolution_data=merged["resolution_data"],
+                 fibers=(None if fibermap is not None else
+                         spectrograph*nspec + np.arange(nspec)),
+                 spectrograph=spectrograph, meta=ref["meta"],
+                 fibermap=fibermap, chi2pix=merged["chi2pix"])
+
+
+def reduce_model(model, shape, dtype=np.float64, comm=None, root=0):
+    """
+    Sum the 2D pixel model images of the bundles extracted by all processes
+
+    Args:
+        model: 2D model image of the bundles of this process, or None
+        shape: shape of the image
+
+    Options:
+        dtype: data type of the summed image, the same on all processes
+            (processes without bundles have no model to take it from)
+        comm: MPI communicator; if None model is returned
+        root: rank of the process receiving the sum
+
+    Returns:
+        summed model image on the root process, None on the others
+    """
+    if model is None:
+        model = np.zeros(shape, dtype=dtype)
+    model = np.ascontiguousarray(model, dtype=dtype)
+    if comm is None:
+        return model
+    from mpi4py import MPI
+    total = None
+    if comm.rank == root:
+        total = np.zeros(shape, dtype=dtype)
+    comm.Reduce(model, total, op=MPI.SUM, root=root)
+    return total
+
+
 def main_mpi(args, comm=None, timing=None):
 
     mark_start = time.time()
@@ -383,7 +526,7 @@ def main_mpi(args, comm=None, timing=None):
         else:
             bnspec[b] = bundlesize
 
-    # Now we assign bundles to processes
+    # Bundles are assigned dynamically to processes in the loop below
 
     nproc = 1
     rank = 0
@@ -391,15 +534,6 @@ def main_mpi(args, comm=None, timing=None):
         nproc = comm.size
         rank = comm.rank
 
-    mynbundle = int(nbundle // nproc)
-    myfirstbundle = 0
-    leftover = nbundle % nproc
-    if rank < leftover:
-        mynbundle += 1
-        myfirstbundle = rank * mynbundle
-    else:
-        myfirstbundle = ((mynbundle + 1) * leftover) + (mynbundle * (rank - leftover))
-
     if rank == 0:
         #- Print parameters
         log.info("extract:  input = {}".format(input_file))
@@ -433,7 +567,18 @@ def main_mpi(args, comm=None, timing=None):
 
     failcount = 0
 
-    for b in range(myfirstbundle, myfirstbundle+mynbundle):
+    #- extracted bundles and summed model image of this rank, gathered
+    #- on rank 0 at the end unless they are written to files
+    myframes = list()
+    mymodel = None
+
+    mybundles = list()
+
+    #- each process takes the next bundle when it is done with the previous
+    #- one, so that the extraction time is balanced whatever the number of
+    #- processes and the cost of each bundle
+    for b in dist_dynamic(nbundle, comm=comm):
+        mybundles.append(b)
         mark_iteration_start = time.time()
         outbundle = "{}_{:02d}.fits".format(outroot, b)
         outmodel = "{}_model_{:02d}.fits".format(outroot, b)
@@ -496,17 +641,24 @@ def main_mpi(args, comm=None, timing=None):
             #   wavelength node to an electron 'density'
             frame.meta['BUNIT'] = 'count/Angstrom'
 
-            #- Add scores to frame
-            compute_and_append_frame_scores(frame,suffix="RAW")
-
             mark_extraction = time.time()
 
-            #- Write output
-            io.write_frame(outbundle, frame)
+            if args.merge_bundle_files:
+                #- Add scores to frame
+                compute_and_append_frame_scores(frame,suffix="RAW")
+
+                #- Write output
+                io.write_frame(outbundle, frame)
 
-            if args.model is not None:
-                from astropy.io import fits
-                fits.writeto(outmodel, results['modelimage'], header=frame.meta)
+                if args.model is not None:
+                    fits.writeto(outmodel, results['modelimage'], header=frame.meta)
+            else:
+                myframes.append(frame)
+                if args.model is not None:
+                    if mymodel is None:
+                        mymodel = results['modelimage'].copy()
+                    else:
+                        mymodel += results['modelimage']
 
             log.info('extract:  Done {} spectra {}:{} at {}'.format(os.path.basename(input_file),
                 bspecmin[b], bspecmin[b]+bnspec[b], time.asctime()))
@@ -526,15 +678,50 @@ def main_mpi(args, comm=None, timing=None):
             failcount += 1
             sys.stdout.flush()
 
+    #- time waiting for the other processes to finish their bundles
+    mark_idle_start = time.time()
+    if comm is not None:
+        comm.barrier()
+    time_idle = time.time() - mark_idle_start
+
     if comm is not None:
         failcount = comm.allreduce(failcount)
+        allbundles = comm.gather(mybundles, root=0)
+        allidle = comm.gather(time_idle, root=0)
+    else:
+        allbundles = [ mybundles, ]
+        allidle = [ time_idle, ]
+
+    if rank == 0:
+        for p in range(nproc):
+            log.info("extract:  Rank {} extracted bundles {}, idle {:.1f} sec".format(
+                p, allbundles[p], allidle[p]))
+        log.info("extract:  idle time max {:.1f} sec, mean {:.1f} sec".format(
+            np.max(allidle), np.mean(allidle)))
 
     if failcount > 0:
         # all processes throw
         raise RuntimeError("some extraction bundles failed")
 
     time_merge = None
-    if rank == 0:
+    if not args.merge_bundle_files:
+        mark_merge_start = time.time()
+        frame = gather_bundles(myframes, comm=comm)
+        model = None
+        if args.model is not None:
+            model = reduce_model(mymodel, img.pix.shape, dtype=np.float64,
+                                 comm=comm)
+        if rank == 0:
+            #- Add scores to frame
+            compute_and_append_frame_scores(frame,suffix="RAW")
+            io.write_frame(args.output, frame)
+            log.info("extract:  wrote {}".format(args.output))
+            if model is not None:
+                fits.writeto(args.model, model)
+        mark_merge_end = time.time()
+        time_merge = mark_merge_end - mark_merge_start
+
+    elif rank == 0:
         mark_merge_start = time.time()
         mergeopts = [
             '--output', args.output,
@@ -570,3 +757,4 @@ def main_mpi(args, comm=None, timing=None):
         timing["total_extraction"] = time_total_extraction
         timing["total_write_output"] = time_total_write_output
         timing["merge"] = time_merge
+        timing["idle"] = time_idle
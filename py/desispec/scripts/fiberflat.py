@@ -39,6 +39,10 @@ def parse(options=None):
                         help = 'resolution for spline fit to reject outliers')
     parser.add_argument('--cosmics-nsig', type = float, default = 0, required=False,
                         help = 'n sigma rejection for cosmics in 1D (default, no rejection)')
+    parser.add_argument('--nproc', type = int, default = 1, required=False,
+                        help = 'number of processes for the fiber flat fit (multiprocessing)')
+    parser.add_argument('--mpi', action = 'store_true',
+                        help = 'distribute the fiber flat fit over the MPI ranks')
     
 
     args = None
@@ -49,18 +53,30 @@ def parse(options=None):
     return args
 
 
-def main(args) :
+def main(args, comm=None) :
 
     log=get_logger()
     log.info("starting at {}".format(time.asctime()))
 
+    if comm is None and args.mpi :
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    rank = 0
+    if comm is not None :
+        rank = comm.rank
+
     # Process
     frame = read_frame(args.infile)
     
     if args.cosmics_nsig>0 : # Reject cosmics         
         reject_cosmic_rays_1d(frame,args.cosmics_nsig)
     
-    fiberflat = compute_fiberflat(frame,nsig_clipping=args.nsig,accuracy=args.acc,smoothing_res=args.smoothing_resolution)
+    fiberflat = compute_fiberflat(frame,nsig_clipping=args.nsig,accuracy=args.acc,smoothing_res=args.smoothing_resolution,
+                                  nproc=args.nproc,comm=comm)
+
+    # all ranks have the result, only the first one writes it
+    if rank > 0 :
+        return
 
     # QA
     if (args.qafile is not None):
@@ -11,8 +11,9 @@ from desiutil.log import get_logger
 
 from .. import io
 from ..pixgroup import FrameLite, SpectraLite
-from ..pixgroup import (get_exp2healpix_map, add_missing_frames,
-        frames2spectra, update_frame_cache)
+from ..pixgroup import (get_exp2healpix_index, exp2healpix_index_to_map,
+        split_exp2healpix_index, add_missing_frames, frames2spectra,
+        update_frame_cache)
 
 def parse(options=None):
     import argparse
@@ -22,6 +23,10 @@ def parse(options=None):
     parser.add_argument("--nights", type=str,  help="YEARMMDD to add")
     parser.add_argument("--nside", type=int,default=64,help="input spectra healpix nside")
     parser.add_argument("-o", "--outdir", type=str,  help="output directory")
+    parser.add_argument("--indexfile", type=str,
+            help="exposure to healpix index file, updated with new exposures; default exp2healpix-NSIDE.fits in --outdir if set, otherwise spectra-NSIDE/exp2healpix-NSIDE.fits in the production directory")
+    parser.add_argument("--no-index", action="store_true",
+            help="do not read nor update the exposure to healpix index file")
     parser.add_argument("--mpi", action="store_true",
             help="Use MPI for parallelism")
 
@@ -59,10 +64,27 @@ def main(args=None, comm=None):
     else:
         nights = None
 
-    #- Get table NIGHT EXPID SPECTRO HEALPIX NTARGETS 
+    if args.no_index:
+        indexfile = None
+    elif args.indexfile:
+        indexfile = args.indexfile
+    else:
+        indexfile = io.findfile('exp2healpix', nside=args.nside,
+                specprod_dir=args.reduxdir, outdir=args.outdir)
+
+    #- Get table NIGHT EXPID SPECTRO FIBER HEALPIX MTIME on rank 0, only
+    #- reading the fibermaps of exposures that are not already in indexfile,
+    #- and summary table NIGHT EXPID SPECTRO HEALPIX NTARGETS
     t0 = time.time()
-    exp2pix = get_exp2healpix_map(nights=nights, comm=comm,
-                                  specprod_dir=args.reduxdir)
+    index = get_exp2healpix_index(nights=nights, comm=comm,
+                                  specprod_dir=args.reduxdir,
+                                  nside=args.nside, indexfile=indexfile)
+    if rank == 0:
+        exp2pix = exp2healpix_index_to_map(index)
+    else:
+        exp2pix = None
+    if comm:
+        exp2pix = comm.bcast(exp2pix, root=0)
     assert len(exp2pix) > 0
     if rank == 0:
         dt = time.time() - t0
@@ -70,7 +92,25 @@ def main(args=None, comm=None):
         sys.stdout.flush()
 
     allpix = sorted(set(exp2pix['HEALPIX']))
-    mypix = np.array_split(allpix, size)[rank]
+    rankpix = np.array_split(allpix, size)
+    mypix = rankpix[rank]
+
+    #- Send each rank the index rows of the exposures of its pixels
+    if rank == 0:
+        rankrows = list()
+        for pixels in rankpix:
+            ii = np.in1d(exp2pix['HEALPIX'], pixels)
+            keys = zip(exp2pix['NIGHT'][ii], exp2pix['EXPID'][ii],
+                       exp2pix['SPECTRO'][ii])
+            rankrows.append(split_exp2healpix_index(index, keys=keys))
+        del index
+    else:
+        rankrows = None
+    if comm:
+        fiberpix = comm.scatter(rankrows, root=0)
+    else:
+        fiberpix = rankrows[0]
+
     log.info('Rank {} will process {} pixels'.format(rank, len(mypix)))
     sys.stdout.flush()
 
@@ -119,13 +159,14 @@ def main(args=None, comm=None):
 
         #- Load new frames to add
         log.info('pix {} has {} frames to add'.format(pix, len(framekeys)))
-        update_frame_cache(frames, framekeys, specprod_dir=args.reduxdir)
+        update_frame_cache(frames, framekeys, specprod_dir=args.reduxdir,
+                healpix=fiberpix, nside=args.nside)
 
         #- add any missing frames
         add_missing_frames(frames)
 
         #- convert individual FrameLite objects into SpectraLite
-        newspectra = frames2spectra(frames, pix)
+        newspectra = frames2spectra(frames, pix, nside=args.nside)
 
         #- Combine with any previous spectra if needed
         if oldspectra:
@@ -7,6 +7,7 @@ Command line wrappers for pre-processing a DESI raw exposure
 from __future__ import absolute_import, division
 
 import argparse
+import numpy as np
 
 import os
 import sys
@@ -78,6 +79,10 @@ to use, but also only if a single camera is specified.
     parser.add_argument('--ccd-calib-filename', required=False, default=None,
                         help = 'specify a difference ccd calibration filename (for dev. purpose), default is in desispec/data/ccd')
     parser.add_argument('--fill-header', type = str, default = None,  nargs ='*', help="fill camera header with contents of those of other hdus")
+    parser.add_argument('--float32', action='store_true',
+                        help = 'process the image in float32 instead of float64 to save memory')
+    parser.add_argument('--nthreads', type = int, default = None, required=False,
+                        help = 'number of threads processing the amplifiers and rejecting cosmic rays in parallel (default: amplifiers processed serially, all numba threads for the cosmic rays)')
 
     #- uses sys.argv if options=None
     args = parser.parse_args(options)
@@ -155,6 +160,8 @@ def main(args=None):
                               nogain=args.nogain,
                               nodarktrail=args.nodarktrail,
                               fill_header=args.fill_header,
+                              dtype=(np.float32 if args.float32 else np.float64),
+                              nthreads=args.nthreads,
             )
         except IOError:
             log.error('Error while reading or preprocessing camera {} in {}'.format(camera, args.infile))
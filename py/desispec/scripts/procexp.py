@@ -1,7 +1,10 @@
-
 """
 This script processes an exposure by applying fiberflat, sky subtraction,
 spectro-photometric calibration depending on input.
+
+Several frames (e.g. the cameras of an exposure) can be processed
+concurrently; each frame is taken through all the steps in memory
+and the optional intermediate frames are written by a background thread.
 """
 
 from desispec.io import read_frame, write_frame
@@ -15,25 +18,33 @@ from desiutil.log import get_logger
 from desispec.cosmics import reject_cosmic_rays_1d
 from desispec.specscore import compute_and_append_frame_scores
 
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import copy
 import sys
 
 def parse(options=None):
     parser = argparse.ArgumentParser(description="Apply fiberflat, sky subtraction and calibration.")
-    parser.add_argument('-i','--infile', type = str, default = None, required=True,
-                        help = 'path of DESI exposure frame fits file')
-    parser.add_argument('--fiberflat', type = str, default = None,
-                        help = 'path of DESI fiberflat fits file')
-    parser.add_argument('--sky', type = str, default = None,
-                        help = 'path of DESI sky fits file')
-    parser.add_argument('--calib', type = str, default = None,
-                        help = 'path of DESI calibration fits file')
-    parser.add_argument('-o','--outfile', type = str, default = None, required=True,
-                        help = 'path of DESI sky fits file')
+    parser.add_argument('-i','--infile', type = str, default = None, required=True, nargs='+',
+                        help = 'path of DESI exposure frame fits file(s)')
+    parser.add_argument('--fiberflat', type = str, default = None, nargs='+',
+                        help = 'path of DESI fiberflat fits file(s), one per input frame')
+    parser.add_argument('--sky', type = str, default = None, nargs='+',
+                        help = 'path of DESI sky fits file(s), one per input frame')
+    parser.add_argument('--calib', type = str, default = None, nargs='+',
+                        help = 'path of DESI calibration fits file(s), one per input frame')
+    parser.add_argument('-o','--outfile', type = str, default = None, required=True, nargs='+',
+                        help = 'path of output DESI frame fits file(s), one per input frame')
+    parser.add_argument('--fframe', type = str, default = None, nargs='+',
+                        help = 'optional path of output fiber flatfielded frame file(s), one per input frame')
+    parser.add_argument('--sframe', type = str, default = None, nargs='+',
+                        help = 'optional path of output sky subtracted frame file(s), one per input frame')
     parser.add_argument('--cosmics-nsig', type = float, default = 0, required=False,
                         help = 'n sigma rejection for cosmics in 1D (default, no rejection)')
     parser.add_argument('--sky-throughput-correction', action='store_true',
                         help = 'apply a throughput correction when subtraction the sky')
+    parser.add_argument('--nthreads', type = int, default = 1, required=False,
+                        help = 'number of frames processed concurrently')
 
     args = None
     if options is None:
@@ -43,68 +54,147 @@ def parse(options=None):
     return args
 
 
-def main(args):
+def process_frame(frame, fiberflat=None, skymodel=None, fluxcalib=None,
+                  cosmics_nsig=0, sky_throughput_correction=False, intermediate=None):
+    """
+    Apply fiberflat, sky subtraction and calibration to a frame, in place.
 
-    log = get_logger()
+    Args:
+        frame : desispec.frame.Frame object
 
-    if (args.fiberflat is None) and (args.sky is None) and (args.calib is None):
-        log.critical('no --fiberflat, --sky, or --calib; nothing to do ?!?')
-        sys.exit(12)
+    Options:
+        fiberflat : desispec.fiberflat.FiberFlat object
+        skymodel : desispec.sky.SkyModel object
+        fluxcalib : desispec.fluxcalibration.FluxCalib object
+        cosmics_nsig : n sigma rejection for cosmics in 1D (default, no rejection)
+        sky_throughput_correction : apply a throughput correction when subtraction the sky
+        intermediate : function called as intermediate(suffix, frame) after
+            each step, with suffix "FFLAT", "SKYSUB" or "CALIB"
 
-    frame = read_frame(args.infile)
+    Returns:
+        frame
+    """
+    log = get_logger()
 
     #- Raw scores already added in extraction, but just in case they weren't
     #- it is harmless to rerun to make sure we have them.
     compute_and_append_frame_scores(frame,suffix="RAW")
 
-    if args.cosmics_nsig>0 and args.sky==None : # Reject cosmics (otherwise do it after sky subtraction)
+    if cosmics_nsig>0 and skymodel is None : # Reject cosmics (otherwise do it after sky subtraction)
         log.info("cosmics ray 1D rejection")
-        reject_cosmic_rays_1d(frame,args.cosmics_nsig)
+        reject_cosmic_rays_1d(frame,cosmics_nsig)
 
-    if args.fiberflat!=None :
+    if fiberflat is not None :
         log.info("apply fiberflat")
-        # read fiberflat
-        fiberflat = read_fiberflat(args.fiberflat)
-
         # apply fiberflat to all fibers
         apply_fiberflat(frame, fiberflat)
         compute_and_append_frame_scores(frame,suffix="FFLAT")
+        if intermediate is not None :
+            intermediate("FFLAT", frame)
 
-    if args.sky!=None :
+    if skymodel is not None :
 
-        # read sky
-        skymodel=read_sky(args.sky)
-
-        if args.cosmics_nsig>0 :
+        if cosmics_nsig>0 :
 
             # first subtract sky without throughput correction
             subtract_sky(frame, skymodel, throughput_correction = False)
 
             # then find cosmics
             log.info("cosmics ray 1D rejection after sky subtraction")
-            reject_cosmic_rays_1d(frame,args.cosmics_nsig)
+            reject_cosmic_rays_1d(frame,cosmics_nsig)
 
-            if args.sky_throughput_correction :
+            if sky_throughput_correction :
                 # and (re-)subtract sky, but just the correction term
                 subtract_sky(frame, skymodel, throughput_correction = True, default_throughput_correction = 0.)
 
         else :
             # subtract sky
-            subtract_sky(frame, skymodel, throughput_correction = args.sky_throughput_correction )
+            subtract_sky(frame, skymodel, throughput_correction = sky_throughput_correction )
 
         compute_and_append_frame_scores(frame,suffix="SKYSUB")
+        if intermediate is not None :
+            intermediate("SKYSUB", frame)
 
-
-    if args.calib!=None :
+    if fluxcalib is not None :
         log.info("calibrate")
-        # read calibration
-        fluxcalib=read_flux_calibration(args.calib)
         # apply calibration
         apply_flux_calibration(frame, fluxcalib)
         compute_and_append_frame_scores(frame,suffix="CALIB")
+        if intermediate is not None :
+            intermediate("CALIB", frame)
+
+    return frame
 
 
-    # save output
-    write_frame(args.outfile, frame, units='10**-17 erg/(s cm2 Angstrom)')
+def _check_nfiles(args, key):
+    """
+    Returns the list of files of option key, or a list of None if not set
+    """
+    nframes = len(args.infile)
+    files = getattr(args, key)
+    if files is None:
+        return [None,]*nframes
+    if len(files) != nframes:
+        raise ValueError("{} {} files for {} input frames".format(
+            len(files), key, nframes))
+    return files
+
+
+def main(args):
+
+    log = get_logger()
+
+    if (args.fiberflat is None) and (args.sky is None) and (args.calib is None):
+        log.critical('no --fiberflat, --sky, or --calib; nothing to do ?!?')
+        sys.exit(12)
+
+    nframes = len(args.infile)
+    keys = ["infile", "fiberflat", "sky", "calib", "outfile", "fframe", "sframe"]
+    files = dict([ (key, _check_nfiles(args, key)) for key in keys ])
+
+    #- the intermediate frames are copied and written in the background
+    writer = ThreadPoolExecutor(max_workers=1)
+    writes = list()
+
+    def _write_frame(filename, frame, units=None):
+        write_frame(filename, frame, units=units)
+        log.info("successfully wrote %s"%filename)
+
+    def _process(i):
+        frame = read_frame(files["infile"][i])
+        fiberflat = skymodel = fluxcalib = None
+        if files["fiberflat"][i] is not None :
+            fiberflat = read_fiberflat(files["fiberflat"][i])
+        if files["sky"][i] is not None :
+            skymodel = read_sky(files["sky"][i])
+        if files["calib"][i] is not None :
+            fluxcalib = read_flux_calibration(files["calib"][i])
+
+        intermediate_files = {"FFLAT":files["fframe"][i], "SKYSUB":files["sframe"][i]}
+        def _intermediate(suffix, frame):
+            if intermediate_files.get(suffix) is not None :
+                writes.append(writer.submit(_write_frame,
+                    intermediate_files[suffix], copy.deepcopy(frame)))
+
+        process_frame(frame, fiberflat=fiberflat, skymodel=skymodel,
+                      fluxcalib=fluxcalib, cosmics_nsig=args.cosmics_nsig,
+                      sky_throughput_correction=args.sky_throughput_correction,
+                      intermediate=_intermediate)
+
+        # save output
+        _write_frame(files["outfile"][i], frame,
+                     units='10**-17 erg/(s cm2 Angstrom)')
+
+    try :
+        if args.nthreads > 1 and nframes > 1 :
+            with ThreadPoolExecutor(max_workers=args.nthreads) as pool :
+                #- list() to raise the exceptions of the threads
+                list(pool.map(_process, range(nframes)))
+        else :
+            for i in range(nframes) :
+                _process(i)
+    finally :
+        writer.shutdown(wait=True)
 
-    log.info("successfully wrote %s"%args.outfile)
+    for w in writes :
+        w.result()
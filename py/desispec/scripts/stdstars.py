@@ -7,6 +7,8 @@ Get the normalized best template to do flux calibration.
 #- TODO: refactor algorithmic code into a separate module/function
 
 import argparse
+import hashlib
+import os
 import sys
 
 import numpy as np
@@ -15,7 +17,7 @@ from astropy import units
 from astropy.table import Table
 
 from desispec import io
-from desispec.fluxcalibration import match_templates,normalize_templates,isStdStar
+from desispec.fluxcalibration import match_templates_many,normalize_templates,isStdStar
 from desispec.interpolation import resample_flux
 from desiutil.log import get_logger
 from desispec.parallel import default_nproc
@@ -37,6 +39,7 @@ def parse(options=None):
     parser.add_argument('--color', type = str, default = "G-R", choices=['G-R', 'R-Z'], required = False, help = 'color for selection of standard stars')
     parser.add_argument('--z-max', type = float, default = 0.008, required = False, help = 'max peculiar velocity (blue/red)shift range')
     parser.add_argument('--z-res', type = float, default = 0.00002, required = False, help = 'dz grid resolution')
+    parser.add_argument('--template-cache', type = str, default = os.environ.get('DESI_STDSTAR_CACHE'), required = False, help = 'directory of the on-disk cache of stellar models and model magnitudes (default $DESI_STDSTAR_CACHE, no cache if not set)')
     parser.add_argument('--template-error', type = float, default = 0.1, required = False, help = 'fractional template error used in chi2 computation (about 0.1 for BOSS b1)')
     
     log = get_logger()
@@ -193,7 +196,11 @@ def main(args) :
     # READ MODELS
     ############################################
     log.info("reading star models in %s"%args.starmodels)
-    stdwave,stdflux,templateid,teff,logg,feh=io.read_stdstar_templates(args.starmodels)
+    cache_entry=None
+    if args.template_cache is not None :
+        log.info("using cache of star models in %s"%args.template_cache)
+        cache_entry=io.stdstar_templates_cache_entry(args.starmodels,args.template_cache)
+    stdwave,stdflux,templateid,teff,logg,feh=io.read_stdstar_templates(args.starmodels,cachedir=args.template_cache)
 
     # COMPUTE MAGS OF MODELS FOR EACH STD STAR MAG
     ############################################
@@ -219,7 +226,17 @@ def main(args) :
     model_mags = dict()
     fluxunits = 1e-17 * units.erg / units.s / units.cm**2 / units.Angstrom
     for filter_name, filter_response in model_filters.items():
+        if cache_entry is not None :
+            # the filter curve is part of the key in case it changes
+            sha = hashlib.sha1(np.ascontiguousarray(filter_response.wavelength,dtype=float))
+            sha.update(np.ascontiguousarray(filter_response.response,dtype=float))
+            cache_name = "abmag-%s-%s"%(filter_name,sha.hexdigest()[:16])
+            model_mags[filter_name] = io.read_stdstar_templates_cache(cache_entry,cache_name)
+            if model_mags[filter_name] is not None :
+                continue
         model_mags[filter_name] = filter_response.get_ab_magnitude(stdflux*fluxunits,stdwave)
+        if cache_entry is not None :
+            io.write_stdstar_templates_cache(cache_entry,cache_name,model_mags[filter_name])
     log.info("done computing model mags")
 
     # LOOP ON STARS TO FIND BEST MODEL
@@ -245,22 +262,31 @@ def main(args) :
 
     fitted_model_colors = np.zeros(nstars)
 
+    # np.array of wave,flux,ivar,resol
+    wave = {}
+    for camera in frames :
+        for i,frame in enumerate(frames[camera]) :
+            identifier="%s-%d"%(camera,i)
+            wave[identifier]=frame.wave
+
+    star_flux = []
+    star_ivar = []
+    star_resolution_data = []
+    selections = []
     for star in range(nstars) :
 
-        log.info("finding best model for observed star #%d"%star)
-
-        # np.array of wave,flux,ivar,resol
-        wave = {}
         flux = {}
         ivar = {}
         resolution_data = {}
         for camera in frames :
             for i,frame in enumerate(frames[camera]) :
                 identifier="%s-%d"%(camera,i)
-                wave[identifier]=frame.wave
                 flux[identifier]=frame.flux[star]
                 ivar[identifier]=frame.ivar[star]
                 resolution_data[identifier]=frame.resolution_data[star]
+        star_flux.append(flux)
+        star_ivar.append(ivar)
+        star_resolution_data.append(resolution_data)
 
         # preselect models based on magnitudes
         photsys=fibermap['PHOTSYS'][star]
@@ -277,21 +303,26 @@ def main(args) :
         new_selection &= (logg>=np.min(logg[selection]))&(logg<=np.max(logg[selection]))
         new_selection &= (feh>=np.min(feh[selection]))&(feh<=np.max(feh[selection]))
         selection = np.where(new_selection)[0]
+        selections.append(selection)
 
         log.info("star#%d fiber #%d, %s = %f, number of pre-selected models = %d/%d"%(
             star, starfibers[star], args.color, star_unextincted_colors[args.color][star],
             selection.size, stdflux.shape[0]))
-        
-        # Match unextincted standard stars to data
-        coefficients, redshift[star], chi2dof[star] = match_templates(
-            wave, flux, ivar, resolution_data,
-            stdwave, stdflux[selection],
-            teff[selection], logg[selection], feh[selection],
-            ncpu=args.ncpu, z_max=args.z_max, z_res=args.z_res,
-            template_error=args.template_error
-            )
-        
-        linear_coefficients[star,selection] = coefficients
+
+    # Match unextincted standard stars to data, the stars are distributed
+    # among the processes of a single pool that holds the templates
+    log.info("finding best models for %d observed stars with ncpu=%d"%(nstars,args.ncpu))
+    results = match_templates_many(
+        wave, star_flux, star_ivar, star_resolution_data, selections,
+        stdwave, stdflux, teff, logg, feh,
+        ncpu=args.ncpu, z_max=args.z_max, z_res=args.z_res,
+        template_error=args.template_error
+        )
+
+    for star in range(nstars) :
+
+        coefficients, redshift[star], chi2dof[star] = results[star]
+        linear_coefficients[star,selections[star]] = coefficients
         
         log.info('Star Fiber: {0}; TEFF: {1}; LOGG: {2}; FEH: {3}; Redshift: {4}; Chisq/dof: {5}'.format(
             starfibers[star],
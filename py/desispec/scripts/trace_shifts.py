@@ -291,11 +291,8 @@ def fit_trace_shifts(image,args) :
     
     # compute x y to record max deviations
     wave = np.linspace(tset.wavemin,tset.wavemax,5)
-    x0 = np.zeros((tset.nspec,wave.size))
-    y0 = np.zeros((tset.nspec,wave.size))
-    for s in range(tset.nspec) :
-        x0[s]=tset.x_vs_wave(s,wave)
-        y0[s]=tset.y_vs_wave(s,wave)
+    x0 = tset.x_vs_wave_all(wave)
+    y0 = tset.y_vs_wave_all(wave)
     
     tset.x_vs_wave_traceset._coeff,tset.y_vs_wave_traceset._coeff = recompute_legendre_coefficients(xcoef=tset.x_vs_wave_traceset._coeff,
                                                                                                     ycoef=tset.y_vs_wave_traceset._coeff,
@@ -316,11 +313,8 @@ def fit_trace_shifts(image,args) :
                                                                              spectrum_filename=spectrum_filename,
                                                                              degyy=args.degyy,width=7)
     
-    x = np.zeros(x0.shape)
-    y = np.zeros(x0.shape)
-    for s in range(tset.nspec) :
-        x[s]=tset.x_vs_wave(s,wave)
-        y[s]=tset.y_vs_wave(s,wave)
+    x = tset.x_vs_wave_all(wave)
+    y = tset.y_vs_wave_all(wave)
     dx = x-x0
     dy = y-y0
     if tset.meta is None : tset.meta = dict()
@@ -8,13 +8,16 @@ Utility functions to compute a sky model and subtract it.
 
 import numpy as np
 from desispec.resolution import Resolution
+from desispec.resolution import BatchedResolution
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_invert
+from desispec.linalg import cholesky_invert_banded
+from desispec.linalg import symmetric_band_to_dense
 from desispec.linalg import spline_fit
 from desiutil.log import get_logger
 from desispec import util
 from desiutil import stats as dustat
-import scipy,scipy.sparse,scipy.stats,scipy.ndimage
+import scipy,scipy.sparse,scipy.stats,scipy.ndimage,scipy.linalg
 import sys
 
 def compute_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=False,add_variance=True,angular_variation_deg=0,chromatic_variation_deg=0) :
@@ -119,6 +122,33 @@ def _model_variance(frame,cskyflux,cskyivar,skyfibers) :
     
 
      
+def _convolved_variance(R, covar) :
+    """Returns the diagonal of R.covar.R^T
+
+    Args:
+        R : BatchedResolution with a single resolution matrix
+        covar : 2D[q+1, nwave] upper band of a symmetric matrix, with q>=R.ndiag-1
+
+    Returns:
+        1D[nwave] variance
+    """
+    q, nwave = covar.shape[0]-1, covar.shape[1]
+    rows = R.rows[0]
+    offsets = R.offsets
+    var = np.zeros(nwave)
+    for a,oa in enumerate(offsets) :
+        for b,ob in enumerate(offsets) :
+            if ob < oa : continue
+            # covar[i+oa,i+ob]
+            begin = max(0,-oa)
+            end   = min(nwave,nwave-ob)
+            tmp = rows[a,begin:end]*rows[b,begin:end]*covar[q-(ob-oa),begin+ob:end+ob]
+            if ob > oa :
+                tmp *= 2
+            var[begin:end] += tmp
+    return var
+
+
 def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=False,add_variance=True) :
     """Compute a sky model.
     
@@ -156,6 +186,7 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
 
     current_ivar=frame.ivar[skyfibers].copy()*(frame.mask[skyfibers]==0)
     flux = frame.flux[skyfibers]
+
     Rsky = frame.R[skyfibers]
     
     input_ivar=None 
@@ -174,9 +205,6 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
             current_ivar[f][ii] = input_ivar[f][ii]
     
 
-    sqrtw=np.sqrt(current_ivar)
-    sqrtwflux=sqrtw*flux
-
     chi2=np.zeros(flux.shape)
 
     
@@ -199,50 +227,35 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
         # so, d(model)/di[fiber,w] = R[fiber][w,i]
         # this gives
         # A_ij = sum_fiber  sum_wave_w ivar[fiber,w] R[fiber][w,i] R[fiber][w,j]
-        # A = sum_fiber ( diag(sqrt(ivar))*R[fiber] ) ( diag(sqrt(ivar))* R[fiber] )^t
-        # A = sum_fiber sqrtwR[fiber] sqrtwR[fiber]^t
         # and 
-        # B = sum_fiber sum_wave_w ivar[fiber,w] R[fiber][w] * flux[fiber,w]
-        # B = sum_fiber sum_wave_w sqrt(ivar)[fiber,w]*flux[fiber,w] sqrtwR[fiber,wave]
-        
-        #A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        A=np.zeros((nwave,nwave))
-        B=np.zeros((nwave))
+        # B_i = sum_fiber sum_wave_w ivar[fiber,w] R[fiber][w,i] * flux[fiber,w]
         
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
+        # R[fiber] is banded, so is A, with twice the number of diagonals.
+        # We only store the upper band of A, accumulated for all fibers at once.
         
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
-            R = Rsky[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)
-            SD.setdiag(sqrtw[fiber])
-
-            sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
-            A += (sqrtwR.T*sqrtwR).todense()
-            B += sqrtwR.T*sqrtwflux[fiber]
+        log.info("iter %d accumulating normal equations"%iteration)
+        A = Rsky.normal_matrix_band(current_ivar)
+        B = np.sum(Rsky.dot_transpose(current_ivar*flux),axis=0)
+        u = A.shape[0]-1
                         
         log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
+        # parameters with no data are set to zero
+        w = A[u]>0
+        A_pos_def = A.copy()
+        A_pos_def[u][~w] = 1.
+        parameters = B*w
         try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
+            parameters = scipy.linalg.cho_solve_banded((scipy.linalg.cholesky_banded(A_pos_def,lower=False),False),parameters)
+        except np.linalg.LinAlgError :
             log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
+            parameters[w]=np.linalg.lstsq(symmetric_band_to_dense(A)[w][:,w],B[w],rcond=-1)[0]
         
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-            # the parameters are directly the unconvolve sky flux
-            # so we simply have to reconvolve it
-            fiber_convolved_sky_flux = Rsky[fiber].dot(parameters)
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-fiber_convolved_sky_flux)**2
+        # the parameters are directly the unconvolve sky flux
+        # so we simply have to reconvolve it
+        convolved_sky_flux = Rsky.dot(parameters)
+        chi2=current_ivar*(flux-convolved_sky_flux)**2
             
         log.info("rejecting")
 
@@ -256,16 +269,12 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
             for i in selection :
                 worst_entry=np.argmax(chi2[:,i])
                 current_ivar[worst_entry,i]=0
-                sqrtw[worst_entry,i]=0
-                sqrtwflux[worst_entry,i]=0
                 nout_iter += 1
 
         else :
             # remove all of them at once
             bad=(chi2>nsig_clipping**2)
             current_ivar *= (bad==0)
-            sqrtw *= (bad==0)
-            sqrtwflux *= (bad==0)
             nout_iter += np.sum(bad)
 
         nout_tot += nout_iter
@@ -289,32 +298,29 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     # no need to restore the original ivar to compute the model errors when modeling ivar
     # the sky inverse variances are very similar
     
-    log.info("compute the parameter covariance")
-    # we may have to use a different method to compute this
-    # covariance
-   
-    try :
-        parameter_covar=cholesky_invert(A)
-        # the above is too slow
-        # maybe invert per block, sandwich by R 
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
-    
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
     # we use the average resolution of all fibers in the frame:
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
-    Rmean = Resolution(mean_res_data)
-    
-    log.info("compute convolved sky and ivar")
+    mean_res_data=np.mean(frame.R.data,axis=0)
     
-    # The parameters are directly the unconvolved sky
-    # First convolve with average resolution :
-    convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
+    log.info("compute the parameter covariance")
+    # we only need the band of the covariance that is
+    # sandwiched by the mean resolution matrix
+    try :
+        parameter_covar=cholesky_invert_banded(A_pos_def)
+        parameter_covar[u][~w] = 0.
         
-    # and keep only the diagonal
-    convolved_sky_var=np.diagonal(convolved_sky_covar)
+        log.info("compute convolved sky and ivar")
+        
+        # The parameters are directly the unconvolved sky
+        # First convolve with average resolution, keeping only the diagonal
+        convolved_sky_var=_convolved_variance(BatchedResolution(mean_res_data[None]), parameter_covar)
+    except np.linalg.LinAlgError :
+        log.warning("cholesky_invert_banded failed, switching to np.linalg.pinv")
+        parameter_covar = np.linalg.pinv(symmetric_band_to_dense(A))
+        Rmean = Resolution(mean_res_data)
+        convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
+        convolved_sky_var=np.asarray(np.diagonal(convolved_sky_covar))
         
     # inverse
     convolved_sky_ivar=(convolved_sky_var>0)/(convolved_sky_var+(convolved_sky_var==0))
@@ -323,9 +329,7 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     cskyivar = np.tile(convolved_sky_ivar, frame.nspec).reshape(frame.nspec, nwave)
 
     # The sky model for each fiber (simple convolution with resolution of each fiber)
-    cskyflux = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        cskyflux[i] = frame.R[i].dot(parameters)
+    cskyflux = frame.R.dot(parameters)
         
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
     if skyfibers.size > 1 and add_variance :
@@ -378,6 +382,8 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     current_ivar=frame.ivar[skyfibers].copy()*(frame.mask[skyfibers]==0)
     flux = frame.flux[skyfibers]
     Rsky = frame.R[skyfibers]
+    #- the sparse matrix of each fiber is used twice per iteration
+    Rsky_matrices = [Rsky[fiber] for fiber in range(nfibers)]
     
 
     input_ivar=None 
@@ -468,7 +474,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
                 log.info("iter %d sky fiber (1st fit) %d/%d"%(iteration,fiber,nfibers))
             D.setdiag(sqrtw[fiber])
             D2.setdiag(Pol[fiber])
-            sqrtwRP = D.dot(Rsky[fiber]).dot(D2) # each row r of R is multiplied by sqrtw[r]
+            sqrtwRP = D.dot(Rsky_matrices[fiber]).dot(D2) # each row r of R is multiplied by sqrtw[r]
             A += (sqrtwRP.T*sqrtwRP).todense()
             B += sqrtwRP.T*sqrtwflux[fiber]
         
@@ -492,7 +498,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
             if fiber%10==0 :
                 log.info("iter %d sky fiber  (2nd fit) %d/%d"%(iteration,fiber,nfibers))
             D.setdiag(sqrtw[fiber])
-            sqrtwRSM = D.dot(Rsky[fiber]).dot(D2).dot(skyfibers_monomials[:,fiber,:].T)
+            sqrtwRSM = D.dot(Rsky_matrices[fiber]).dot(D2).dot(skyfibers_monomials[:,fiber,:].T)
             Ap += sqrtwRSM.T.dot(sqrtwRSM)
             Bp += sqrtwRSM.T.dot(sqrtwflux[fiber])
         
@@ -513,8 +519,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
         
         # chi2 and outlier rejection
         log.info("iter %d compute chi2"%iteration)
-        for fiber in range(nfibers) :
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-Rsky[fiber].dot(Pol[fiber]*parameters))**2
+        chi2=current_ivar*(flux-Rsky.dot(Pol*parameters))**2
         
         log.info("rejecting")
 
@@ -576,7 +581,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
     # we use the average resolution of all fibers in the frame:
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
+    mean_res_data=np.mean(frame.R.data,axis=0)
     Rmean = Resolution(mean_res_data)
     
     log.info("compute convolved sky and ivar")
@@ -598,8 +603,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     cskyflux = np.zeros(frame.flux.shape)
     
     Pol = allfibers_monomials.T.dot(coef).T
-    for fiber in range(frame.nspec):
-        cskyflux[fiber] = frame.R[fiber].dot(Pol[fiber]*parameters)
+    cskyflux = frame.R.dot(Pol*parameters)
         
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
     if skyfibers.size > 1 and add_variance :
@@ -653,6 +657,8 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     current_ivar=frame.ivar[skyfibers].copy()*(frame.mask[skyfibers]==0)
     flux = frame.flux[skyfibers]
     Rsky = frame.R[skyfibers]
+    #- the sparse matrix of each fiber is used at each iteration
+    Rsky_matrices = [Rsky[fiber] for fiber in range(nfibers)]
     
     
     # need focal plane coordinates of fibers
@@ -736,7 +742,7 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
         for fiber in range(nfibers) :
             if fiber%10==0 :
                 log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
-            R = Rsky[fiber]
+            R = Rsky_matrices[fiber]
 
             # diagonal sparse matrix with content = sqrt(ivar)
             SD.setdiag(sqrtw[fiber])
@@ -766,15 +772,12 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
         
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-            # loop on polynomial indices
-            unconvolved_fiber_sky_flux = np.zeros(nwave)
-            for p in range(ncoef) :
-                unconvolved_fiber_sky_flux += monomials[p,fiber]*parameters[p*nwave:(p+1)*nwave]
-            # then convolve
-            fiber_convolved_sky_flux = Rsky[fiber].dot(unconvolved_fiber_sky_flux)
+        # sum on polynomial indices
+        unconvolved_sky_flux = monomials.T.dot(parameters.reshape(ncoef,nwave))
+        # then convolve
+        convolved_sky_flux = Rsky.dot(unconvolved_sky_flux)
             
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-fiber_convolved_sky_flux)**2
+        chi2=current_ivar*(flux-convolved_sky_flux)**2
             
         log.info("rejecting")
 
@@ -832,12 +835,11 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
     # we use the average resolution of all fibers in the frame:
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
+    mean_res_data=np.mean(frame.R.data,axis=0)
     Rmean = Resolution(mean_res_data)
     
     log.info("compute convolved sky and ivar")
         
-    cskyflux = np.zeros(frame.flux.shape)
     cskyivar = np.zeros(frame.flux.shape)
 
     log.info("compute convolved parameter covariance")
@@ -879,6 +881,7 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     # so that a target fiber distant for a sky fiber will naturally have a larger
     # sky model variance
     log.info("compute sky and variance per fiber")        
+    unconvolved_sky_flux=np.zeros((frame.nspec,nwave))
     for i in range(frame.nspec):
         # compute monomials
         M = []
@@ -889,19 +892,18 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
                 M.append((xi**dx)*(yi**dy))
         M = np.array(M)
 
-        unconvolved_fiber_sky_flux=np.zeros(nwave)
         convolved_fiber_skyvar=np.zeros(nwave)
         for p in range(ncoef) :
-            unconvolved_fiber_sky_flux += M[p]*parameters[p*nwave:(p+1)*nwave]
+            unconvolved_sky_flux[i] += M[p]*parameters[p*nwave:(p+1)*nwave]
             for k in range(ncoef) :
                 convolved_fiber_skyvar += M[p]*M[k]*convolved_parameter_covar[p,k]
 
-        # convolve sky model with this fiber's resolution
-        cskyflux[i] = frame.R[i].dot(unconvolved_fiber_sky_flux)
-
         # save inverse of variance
         cskyivar[i] = (convolved_fiber_skyvar>0)/(convolved_fiber_skyvar+(convolved_fiber_skyvar==0))
 
+    # convolve sky model with the resolution of each fiber
+    cskyflux = frame.R.dot(unconvolved_sky_flux)
+
     
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
     if skyfibers.size > 1 and add_variance :
@@ -23,6 +23,21 @@ from desiutil.io import encode_table
 from .maskbits import specmask
 from .resolution import Resolution
 
+def _expid_fiber_keys(fibermap):
+    """
+    Combine the EXPID and FIBER columns of a fibermap into a single key.
+
+    Args:
+        fibermap: table with integer EXPID and FIBER columns (32-bit values).
+
+    Returns (array):
+        int64 array with one unique key per (EXPID, FIBER) pair.
+    """
+    expid = np.asarray(fibermap["EXPID"]).astype(np.int64)
+    fiber = np.asarray(fibermap["FIBER"]).astype(np.uint32).astype(np.int64)
+    return (expid << 32) + fiber
+
+
 class Spectra(object):
     """Represents a grouping of spectra.
 
@@ -70,6 +85,7 @@ class Spectra(object):
             self._ftype = np.float32
 
         self.scores = scores
+        self._index = None
         self.meta = None
         if meta is None:
             self.meta = {}
@@ -314,6 +330,25 @@ class Spectra(object):
         return ret
 
 
+    def _expid_fiber_index(self):
+        """
+        Return the (EXPID, FIBER) index of the fibermap.
+
+        The index is built on first use and kept up to date by update(), so
+        that repeated updates do not have to rebuild it.  It is rebuilt if
+        the fibermap was replaced.
+
+        Returns (tuple):
+            sorted array of keys from _expid_fiber_keys(), and the fibermap
+            row of each key.
+        """
+        if self._index is None or self._index[0] is not self.fibermap:
+            keys = _expid_fiber_keys(self.fibermap)
+            rows = np.argsort(keys, kind='stable')
+            self._index = (self.fibermap, keys[rows], rows)
+        return self._index[1:]
+
+
     def update(self, other):
         """
         Overwrite or append new data.
@@ -397,21 +432,21 @@ class Spectra(object):
             if self.extra is None:
                 add_extra = True
 
-        # Compute which targets / exposures are new
+        # Compute which targets / exposures are new, by looking up the
+        # (EXPID, FIBER) of the other spectra in the sorted index of ours
 
         nother = len(other.fibermap)
-        exists = np.zeros(nother, dtype=np.int)
+        exists = np.zeros(nother, dtype=int)
 
         indx_original = []
 
         if self.fibermap is not None:
-            for r in range(nother):
-                expid = other.fibermap[r]["EXPID"]
-                fiber = other.fibermap[r]["FIBER"]
-                for i, row in enumerate(self.fibermap):
-                    if (expid == row["EXPID"]) and (fiber == row["FIBER"]):
-                        indx_original.append(i)
-                        exists[r] += 1
+            keys, rows = self._expid_fiber_index()
+            otherkeys = _expid_fiber_keys(other.fibermap)
+            first = np.searchsorted(keys, otherkeys, side='left')
+            last = np.searchsorted(keys, otherkeys, side='right')
+            exists = last - first
+            indx_original = rows[first[exists == 1]]
 
         if len(np.where(exists > 1)[0]) > 0:
             raise RuntimeError("found duplicate spectra (same EXPID and FIBER) in the fibermap")
@@ -537,6 +572,23 @@ class Spectra(object):
             if newres is not None:
                 newR[b] = np.array( [ Resolution(r) for r in newres[b] ] )
 
+        # Update the (EXPID, FIBER) index with the appended spectra;
+        # the keys of the updated ones did not change
+
+        if self.fibermap is None:
+            self._index = None
+        elif nnew > 0:
+            keys, rows = self._index[1:]
+            newkeys = _expid_fiber_keys(other.fibermap[indx_new])
+            newrows = nold + np.arange(nnew)
+            order = np.argsort(newkeys, kind='stable')
+            pos = np.searchsorted(keys, newkeys[order], side='right')
+            keys = np.insert(keys, pos, newkeys[order])
+            rows = np.insert(rows, pos, newrows[order])
+            self._index = (newfmap, keys, rows)
+        else:
+            self._index = (newfmap,) + self._index[1:]
+
         # Swap data into place
 
         self._bands = bands
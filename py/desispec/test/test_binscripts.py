@@ -18,6 +18,7 @@ import desispec.scripts
 import desispec.scripts.sky
 import desispec.scripts.fiberflat
 import desispec.scripts.fluxcalibration
+import desispec.scripts.procexp
 
 class TestBinScripts(unittest.TestCase):
 
@@ -239,6 +240,47 @@ class TestBinScripts(unittest.TestCase):
             inputs=inputs, outputs=outputs, clobber=True)
         self.assertEqual(err, None)
 
+    def test_process_exposure(self):
+        """
+        Tests desi_process_exposure on two frames at once, with the intermediate frames
+        """
+        self._write_frame(flavor='science', camera='b0')
+        self._write_fiberflat()
+        self._write_skymodel()
+
+        id = uuid4().hex
+        cframes = [ 'cframe-{}-{}.fits'.format(i, id) for i in range(2) ]
+        sframes = [ 'sframe-{}-{}.fits'.format(i, id) for i in range(2) ]
+        cmd = "{} {}/desi_process_exposure --infile {} {} --fiberflat {} {} --sky {} {} --outfile {} {} --sframe {} {} --nthreads 2".format(
+            sys.executable, self.binDir, self.framefile, self.framefile, self.fiberflatfile, self.fiberflatfile,
+            self.skyfile, self.skyfile, cframes[0], cframes[1], sframes[0], sframes[1])
+        inputs  = [self.framefile, self.fiberflatfile, self.skyfile]
+        outputs = cframes + sframes
+        err = runcmd(cmd, inputs=inputs, outputs=outputs, clobber=True)
+        self.assertEqual(err, 0, 'FAILED: {}'.format(cmd))
+
+        #- Remove outputs and call again via function instead of system call
+        self._remove_files(outputs)
+        args = desispec.scripts.procexp.parse(cmd.split()[2:])
+        err = runcmd(desispec.scripts.procexp.main, args=[args,],
+            inputs=inputs, outputs=outputs, clobber=True)
+        self.assertEqual(err, None)
+
+        #- without calibration, the final frame is the sky subtracted one
+        for cframe, sframe in zip(cframes, sframes):
+            fx = io.read_frame(cframe)
+            sx = io.read_frame(sframe)
+            self.assertTrue(np.allclose(fx.flux, 0.9))
+            self.assertTrue(np.all(fx.flux == sx.flux))
+            self.assertTrue(np.all(fx.ivar == sx.ivar))
+        self._remove_files(outputs)
+
+        #- the number of files must match the number of frames
+        args = desispec.scripts.procexp.parse(['--infile', self.framefile, self.framefile,
+            '--sky', self.skyfile, '--outfile', cframes[0], cframes[1]])
+        with self.assertRaises(ValueError):
+            desispec.scripts.procexp.main(args)
+
 def test_suite():
     """Allows testing of only this module with the command::
 
@@ -28,7 +28,46 @@ class TestCoadd(unittest.TestCase):
         """Test coaddition"""
         s1 = self._random_spectra(3,10)
         coadd(s1)
-        
+
+    def test_coadd_targets(self):
+        """Test coaddition of several targets with masks"""
+        ns, nw = 7, 10
+        s1 = self._random_spectra(ns,nw)
+        s1.fibermap["TARGETID"] = [3,1,3,2,1,3,1]
+        s1.mask = {"x":np.zeros((ns,nw),dtype=np.int32)}
+        s1.mask["x"][0,2] = 1
+        s1.mask["x"][[1,4,6],5] = 2
+        flux = s1.flux["x"].copy()
+        ivar = s1.ivar["x"].copy()
+        mask = s1.mask["x"].copy()
+        coadd(s1)
+        self.assertEqual(list(s1.fibermap["TARGETID"]), [1,2,3])
+        for i,tid in enumerate([1,2,3]) :
+            jj = np.where(np.array([3,1,3,2,1,3,1])==tid)[0]
+            mivar = ivar[jj]*(mask[jj]==0)
+            tivar = np.sum(mivar,axis=0)
+            tflux = np.sum(mivar*flux[jj],axis=0)
+            bad = (tivar==0)
+            tivar[bad] = np.sum(ivar[jj][:,bad],axis=0)
+            tflux[bad] = np.sum(ivar[jj][:,bad]*flux[jj][:,bad],axis=0)
+            self.assertTrue(np.allclose(s1.ivar["x"][i], tivar))
+            self.assertTrue(np.allclose(s1.flux["x"][i], tflux/tivar))
+            self.assertTrue(np.all(s1.mask["x"][i] == np.bitwise_and.reduce(mask[jj],axis=0)))
+            self.assertTrue(np.allclose(s1.resolution_data["x"][i,1], 0.5))
+        self.assertEqual(s1.mask["x"][0,5], 2)
+
+    def test_coadd_cosmics(self):
+        """Test cosmic ray rejection in coaddition"""
+        s1 = self._random_spectra(4,20)
+        s1.fibermap["TARGETID"] = [1,2,1,1]
+        s1.ivar["x"][:] = 1.
+        s1.flux["x"][2,10] += 100.
+        flux = s1.flux["x"].copy()
+        coadd(s1, cosmics_nsig=4.)
+        self.assertEqual(s1.ivar["x"][0,10], 2.)
+        self.assertTrue(np.allclose(s1.flux["x"][0,10], (flux[0,10]+flux[3,10])/2.))
+        self.assertTrue(np.allclose(s1.flux["x"][1], flux[1]))
+
     def test_spectroperf_resample(self):
         """Test spectroperf_resample"""
         s1 = self._random_spectra(1,20)
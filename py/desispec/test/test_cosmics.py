@@ -6,6 +6,8 @@ import unittest
 import numpy as np
 from desispec.image import Image
 from desispec.cosmics import reject_cosmic_rays_ala_sdss, reject_cosmic_rays
+from desispec.cosmics import dilate_numba, _reject_cosmic_rays_ala_sdss_single_numba
+import scipy.ndimage
 from desiutil.log import get_logger
 from desispec.maskbits import ccdmask
 
@@ -87,6 +89,81 @@ class TestCosmics(unittest.TestCase):
         cosmic = (image.pix > 0)
         self.assertTrue(np.all(image.mask[cosmic] & ccdmask.COSMIC))
 
+    def test_dilate(self):
+        """
+        Compare dilate_numba to scipy for input pixels not on the edges
+        """
+        np.random.seed(0)
+        x = np.random.uniform(size=(31,37)) < 0.05
+        x[0,3] = x[5,-1] = True
+        inner = np.zeros(x.shape, dtype=bool)
+        inner[1:-1,1:-1] = x[1:-1,1:-1]
+        #- neighbors only, without the central pixel
+        expected = scipy.ndimage.binary_dilation(inner, structure=[[1,1,1],[1,0,1],[1,1,1]])
+        self.assertTrue(np.all(dilate_numba(x,False) == expected))
+        self.assertTrue(np.all(dilate_numba(x,True) == (expected | x)))
+
+    def test_tiles(self):
+        """
+        The result does not depend on the tile size
+        """
+        np.random.seed(1)
+        pix = np.random.normal(size=(53,50)) + self.pix + 10*self.psfpix
+        pix[np.random.uniform(size=pix.shape)<0.01] += 50.
+        ivar = np.ones(pix.shape)
+        selection = pix*np.sqrt(ivar) > 6
+        psf_gradients = np.array([0.819245,0.847529,0.617514,0.656629])
+        ref = _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,6.,3.,0.5,tile_size=100)
+        self.assertTrue(np.any(ref))
+        for tile_size in [1,7,16] :
+            rejected = _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,6.,3.,0.5,tile_size=tile_size)
+            self.assertTrue(np.all(rejected == ref))
+
+    def test_nthreads_restored(self):
+        """
+        The number of numba threads is restored, also on errors
+        """
+        import numba
+        from unittest.mock import patch
+        nthreads = numba.get_num_threads()
+        image = Image(self.pix, self.ivar, camera="r0")
+        reject_cosmic_rays_ala_sdss(image, nthreads=1)
+        self.assertEqual(numba.get_num_threads(), nthreads)
+        with patch('desispec.cosmics._reject_cosmic_rays_ala_sdss_single_numba',
+                   side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                reject_cosmic_rays_ala_sdss(image, nthreads=1)
+        self.assertEqual(numba.get_num_threads(), nthreads)
+
+    def test_fork_after_threads(self):
+        """
+        Processes can be forked after the multi-threaded rejection, and
+        importing desispec.cosmics does not change numba's configuration
+        """
+        import os, sys, subprocess
+        #- in a new process, before numba starts its threads
+        script = '\n'.join([
+            'import numba, multiprocessing',
+            'priority = list(numba.config.THREADING_LAYER_PRIORITY)',
+            'from desispec.test.test_cosmics import TestCosmics',
+            'from desispec.cosmics import reject_cosmic_rays_ala_sdss',
+            'from desispec.image import Image',
+            'assert numba.config.THREADING_LAYER_PRIORITY == priority',
+            'test = TestCosmics()',
+            'test.setUp()',
+            'reject_cosmic_rays_ala_sdss(Image(test.pix, test.ivar, camera="r0"), nthreads=2)',
+            'assert numba.config.THREADING_LAYER_PRIORITY[0] == "workqueue"',
+            'with multiprocessing.get_context("fork").Pool(2) as pool:',
+            '    assert pool.map(abs, [-1, -2]) == [1, 2]',
+            'pool.join()',
+            ])
+        env = dict(os.environ)
+        env.pop('NUMBA_THREADING_LAYER', None)
+        env.pop('NUMBA_THREADING_LAYER_PRIORITY', None)
+        result = subprocess.run([sys.executable, '-c', script], env=env,
+                                timeout=300)
+        self.assertEqual(result.returncode, 0)
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()
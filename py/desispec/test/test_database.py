@@ -107,6 +107,105 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(ts.microsecond, 247000)
         self.assertIs(ts.tzinfo, utc)
 
+    @unittest.skipUnless(sqlalchemy_available, "SQLAlchemy not installed; skipping load_file test.")
+    def test_load_file(self):
+        """Test desispec.database.redshift.load_file in chunks.
+        """
+        import numpy as np
+        from astropy.table import Table
+        from sqlalchemy import create_engine
+        from ..database import redshift
+        from ..database.redshift import Base, ObsList, load_file, _csv_column
+        os.makedirs(self.testDir, exist_ok=True)
+        fitsfile = os.path.join(self.testDir, 'exposures.fits')
+        n = 7
+        data = Table()
+        data['EXPID'] = np.arange(n, dtype=np.int32)
+        data['TILEID'] = np.arange(n, dtype=np.int32) + 1000
+        data['PASS'] = np.arange(n, dtype=np.int16) % 4
+        data['NIGHT'] = ['2020010{0:d}'.format(i) for i in range(n)]
+        data['MJD'] = 58849.0 + np.arange(n)
+        data['EXPTIME'] = 1000.0 * np.ones(n)
+        data['PROGRAM'] = ['dark', 'gray', 'bright', 'dark', 'dark', 'gray', 'bright']
+        data['FLAVOR'] = 'science'
+        data.write(fitsfile)
+        dbfile = os.path.join(self.testDir, 'redshift.db')
+        engine = redshift.engine
+        try:
+            redshift.engine = create_engine('sqlite:///' + dbfile)
+            Base.metadata.create_all(redshift.engine, tables=[ObsList.__table__])
+            load_file(fitsfile, ObsList, expand={'PASS': 'passnum'},
+                      convert={'program': str.upper},
+                      rowfilter=lambda x: x['EXPID'] != 3,
+                      chunksize=2, maxrows=6)
+            conn = redshift.engine.raw_connection()
+            rows = conn.cursor().execute('SELECT expid, passnum, night, mjd, program FROM obslist ORDER BY expid').fetchall()
+            conn.close()
+        finally:
+            redshift.engine.dispose()
+            redshift.engine = engine
+        self.assertEqual([r[0] for r in rows], [0, 1, 2, 4, 5])
+        self.assertEqual([r[1] for r in rows], [0, 1, 2, 0, 1])
+        self.assertEqual(rows[4][2], '20200105')
+        self.assertEqual(rows[4][3], 58854.0)
+        self.assertEqual([r[4] for r in rows], ['DARK', 'GRAY', 'BRIGHT', 'DARK', 'GRAY'])
+        #
+        # Text sent to PostgreSQL COPY.
+        #
+        self.assertEqual(_csv_column(np.array([1.5, 2.0])).tolist(), ['1.5', '2.0'])
+        self.assertEqual(_csv_column(np.array(['a', 'b"c'])).tolist(), ['"a"', '"b""c"'])
+        self.assertEqual(_csv_column(np.array(['a', None], dtype=object)).tolist(), ['"a"', ''])
+
+    @unittest.skipUnless(sqlalchemy_available, "SQLAlchemy not installed; skipping load_fiberassign test.")
+    def test_load_fiberassign_staged(self):
+        """Test loading tile files in parallel through a staging table.
+        """
+        import numpy as np
+        from astropy.table import Table
+        from sqlalchemy import create_engine, inspect
+        from ..database import redshift
+        from ..database.redshift import Base, FiberAssign, dbSession, load_fiberassign
+        tiledir = os.path.join(self.testDir, 'tiles')
+        os.makedirs(tiledir, exist_ok=True)
+        n = 5
+        for tileid in (1001, 1002, 1003):
+            data = Table()
+            for c in FiberAssign.__table__.columns:
+                if c.name == 'tileid':
+                    continue
+                if isinstance(c.type, redshift.String):
+                    data[c.name.upper()] = ['{0}{1:d}'.format(c.name, i) for i in range(n)]
+                elif isinstance(c.type, redshift.Float):
+                    data[c.name.upper()] = np.arange(n) + 0.25 * tileid
+                else:
+                    data[c.name.upper()] = np.arange(n) + tileid
+            data['EXTRA'] = np.zeros(n)
+            data.meta['EXTNAME'] = 'FIBERASSIGN'
+            data.write(os.path.join(tiledir, 'tile-{0:06d}.fits'.format(tileid)))
+        engine = redshift.engine
+        rows = dict()
+        try:
+            for ncpu in (1, 2):
+                redshift.engine = create_engine('sqlite:///' +
+                    os.path.join(self.testDir, 'fiberassign{0:d}.db'.format(ncpu)))
+                dbSession.remove()
+                dbSession.configure(bind=redshift.engine)
+                Base.metadata.create_all(redshift.engine, tables=[FiberAssign.__table__])
+                load_fiberassign(tiledir, ncpu=ncpu)
+                conn = redshift.engine.raw_connection()
+                rows[ncpu] = conn.cursor().execute('SELECT * FROM fiberassign ORDER BY tileid, fiber').fetchall()
+                conn.close()
+                tables = inspect(redshift.engine).get_table_names()
+                indexes = inspect(redshift.engine).get_indexes('fiberassign')
+                redshift.engine.dispose()
+        finally:
+            dbSession.remove()
+            redshift.engine = engine
+        self.assertEqual(len(rows[2]), 3 * n)
+        self.assertEqual(rows[1], rows[2])
+        self.assertEqual(tables, ['fiberassign'])
+        self.assertEqual(len(indexes), len(FiberAssign.__table__.indexes))
+
 
 def test_suite():
     """Allows testing of only this module with the command::
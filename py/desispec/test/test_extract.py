@@ -139,6 +139,32 @@ class TestExtract(unittest.TestCase):
         #- pixel model isn't valid for small bundles that actually overlap; don't test
         # self.assertTrue(np.allclose(model1, model2, rtol=1e-15, atol=1e-15))
 
+    @unittest.skipIf(nospecter, 'specter not installed; skipping extraction test')
+    def test_merge_bundle_files(self):
+        #- bundles gathered in memory or merged from files give the same frame
+        template = "desi_extract_spectra -i {} -p {} -w 7500,7530,0.75 --nwavestep 10 -f {} --bundlesize 3 -o {} -m {} -s 0 -n 5"
+        cmd = template.format(self.imgfile, self.psffile, self.fibermapfile, self.outfile, self.outmodel)
+        opts = cmd.split(" ")[1:]
+        args = desispec.scripts.extract.parse(opts + ["--merge-bundle-files",])
+        desispec.scripts.extract.main_mpi(args, comm=None)
+        frame1 = desispec.io.read_frame(self.outfile)
+        model1 = fits.getdata(self.outmodel)
+        os.remove(self.outfile)
+        os.remove(self.outmodel)
+
+        args = desispec.scripts.extract.parse(opts)
+        desispec.scripts.extract.main_mpi(args, comm=None)
+        frame2 = desispec.io.read_frame(self.outfile)
+        model2 = fits.getdata(self.outmodel)
+
+        #- no bundle file left behind
+        self.assertEqual(len(glob('test-out-{}_*.fits'.format(self.testhash))), 0)
+        for key in ['wave', 'flux', 'ivar', 'mask', 'chi2pix', 'resolution_data']:
+            self.assertTrue(np.all(getattr(frame1, key) == getattr(frame2, key)), key)
+        self.assertTrue(np.all(frame1.fibermap['FIBER'] == frame2.fibermap['FIBER']))
+        self.assertTrue(np.all(model1 == model2))
+        self.assertEqual(frame2.meta['BUNIT'], 'count/Angstrom')
+
     #- traditional and MPI versions agree when starting at spectrum 0
     def test_bundles1(self):
         self._test_bundles("desi_extract_spectra -i {} -p {} -w 7500,7530,0.75 --nwavestep 10 -f {} --bundlesize 3 -o {} -m {} -s {} -n {}", 0, 5)
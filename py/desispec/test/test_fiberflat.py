@@ -7,13 +7,14 @@ from __future__ import division
 import unittest
 import copy
 import os
+import threading
 from uuid import uuid1
 
 import numpy as np
 import scipy.sparse
 
 from desispec.maskbits import specmask
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, BatchedResolution
 from desispec.frame import Frame
 from desispec.fiberflat import FiberFlat
 from desispec.fiberflat import compute_fiberflat, apply_fiberflat
@@ -23,6 +24,12 @@ import desispec.io as io
 
 from desispec.scripts import fiberflat as ffscript
 
+try:
+    import mpi4py
+    _has_mpi4py = True
+except ImportError:
+    _has_mpi4py = False
+
 
 def _get_data():
     """
@@ -42,6 +49,55 @@ def _get_data():
     return wave, flux, ivar, mask
 
 
+def _get_convolved_frame(masked=False):
+    """
+    Return a Frame of the test data convolved with resolutions and
+    throughputs that vary with fiber, with noise, and if masked
+    with masks and outliers that differ from fiber to fiber
+    """
+    wave, flux, ivar, mask = _get_data()
+    nspec, nwave = flux.shape
+
+    sigma = np.linspace(2, 4, nspec)
+    ndiag = 11
+    xx = np.linspace(-(ndiag-1)/2.0, +(ndiag-1)/2.0, ndiag)
+    Rdata = np.zeros( (nspec, ndiag, nwave) )
+    throughput = np.linspace(0.9, 1.1, nspec)
+    for i in range(nspec):
+        kernel = np.exp(-xx**2/(2*sigma[i]**2))
+        kernel /= sum(kernel)
+        Rdata[i] = kernel[:,None]
+        flux[i] = throughput[i]*Resolution(Rdata[i]).dot(flux[i])
+    np.random.seed(0)
+    flux += np.random.normal(scale=0.01, size=flux.shape)
+    ivar *= 1e4
+    if masked:
+        mask[:3, :40] = 1
+        mask[5, 60:70] = 1
+        mask[8, ::7] = 1
+        flux[4, 50] += 1.
+        flux[6, 20:22] -= 0.5
+
+    return Frame(wave, flux, ivar, mask, Rdata, spectrograph=0)
+
+
+class _ThreadComm(object):
+    """
+    Minimal stand-in for a MPI communicator whose ranks are threads
+    """
+    def __init__(self, rank, size, shared):
+        self.rank = rank
+        self.size = size
+        self.shared = shared
+
+    def allgather(self, obj):
+        self.shared['data'][self.rank] = obj
+        self.shared['barrier'].wait()
+        result = copy.deepcopy(self.shared['data'])
+        self.shared['barrier'].wait()
+        return result
+
+
 class TestFiberFlat(unittest.TestCase):
 
 
@@ -129,6 +185,79 @@ class TestFiberFlat(unittest.TestCase):
         #- These fiber flats should all be ~1
         self.assertTrue( np.all(np.abs(ff.fiberflat-1) < 0.001) )
 
+    def _assert_same_fiberflat(self, ff1, ff2):
+        self.assertTrue(np.all(ff1.fiberflat == ff2.fiberflat))
+        self.assertTrue(np.all(ff1.ivar == ff2.ivar))
+        self.assertTrue(np.all(ff1.mask == ff2.mask))
+        self.assertTrue(np.all(ff1.meanspec == ff2.meanspec))
+
+    def test_nproc(self):
+        """
+        Test that the fiberflat computed with several processes is identical
+        to the serial one
+        """
+        for masked in (False, True):
+            frame = _get_convolved_frame(masked)
+            ff1 = compute_fiberflat(frame)
+            for nproc in (2, 3):
+                ff2 = compute_fiberflat(frame, nproc=nproc)
+                self._assert_same_fiberflat(ff1, ff2)
+
+    def test_comm(self):
+        """
+        Test that the fiberflat computed by the ranks of a communicator
+        is identical to the serial one
+        """
+        for masked in (False, True):
+            frame = _get_convolved_frame(masked)
+            ff1 = compute_fiberflat(frame)
+            #- ranks run by threads, which exchange their fibers
+            for size in (2, 3):
+                shared = dict(data=[None]*size, barrier=threading.Barrier(size))
+                results = [None]*size
+                def run(rank):
+                    comm = _ThreadComm(rank, size, shared)
+                    results[rank] = compute_fiberflat(copy.deepcopy(frame), comm=comm)
+                threads = [threading.Thread(target=run, args=(rank,)) for rank in range(size)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                for ff2 in results:
+                    self._assert_same_fiberflat(ff1, ff2)
+
+    @unittest.skipUnless(_has_mpi4py, "mpi4py not installed")
+    def test_comm_self(self):
+        """
+        Test compute_fiberflat with a MPI communicator of a single rank
+        """
+        from mpi4py import MPI
+        for masked in (False, True):
+            frame = _get_convolved_frame(masked)
+            ff1 = compute_fiberflat(frame)
+            ff2 = compute_fiberflat(frame, nproc=2, comm=MPI.COMM_SELF)
+            self._assert_same_fiberflat(ff1, ff2)
+
+    def test_quick_resolution(self):
+        """
+        Test a frame with the QuickResolution matrices of quicklook
+        """
+        from desispec.quicklook.qlresolution import QuickResolution
+        frame = _get_convolved_frame()
+        wsigma = np.tile(np.linspace(2, 4, frame.nspec)[:,None], (1, frame.nwave))
+        qframe = Frame(frame.wave, frame.flux, frame.ivar, frame.mask,
+                       wsigma=wsigma, ndiag=11, spectrograph=0)
+        self.assertIsInstance(qframe.R, BatchedResolution)
+        ff = compute_fiberflat(qframe)
+        #- same result with the same matrices as resolution_data
+        Rdata = np.array([Resolution(QuickResolution(sigma=sigma, ndiag=11)).data
+                          for sigma in wsigma])
+        self.assertTrue(np.all(qframe.R.data == Rdata))
+        rframe = Frame(frame.wave, frame.flux, frame.ivar, frame.mask, Rdata,
+                       spectrograph=0)
+        self._assert_same_fiberflat(ff, compute_fiberflat(rframe))
+        self._assert_same_fiberflat(ff, compute_fiberflat(qframe, nproc=2))
+
     def test_throughput(self):
         """
         Test that spectra with different throughputs but the same resolution
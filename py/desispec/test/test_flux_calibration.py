@@ -68,6 +68,38 @@ class TestFluxCalibration(unittest.TestCase):
 
             #- TODO: come up with assertions for new return values
 
+    def test_match_templates_many(self):
+        """
+        Test that fitting several stars at once gives the same result as one at a time
+        """
+        from desispec.fluxcalibration import match_templates, match_templates_many
+        frame=get_frame_data()
+        wave={"b":frame.wave,"r":frame.wave+10}
+        nmodels = 10
+        modelwave,modelflux=get_models(nmodels)
+        modelflux *= np.linspace(0.8, 1.2, nmodels)[:,None]
+        teff = np.linspace(5000, 7000, nmodels)
+        logg = np.linspace(4.0, 5.0, nmodels)
+        feh = np.linspace(-2.5, -0.5, nmodels)
+
+        stars = [0, 1, 2]
+        flux = [ {"b":frame.flux[i],"r":frame.flux[i]*1.1} for i in stars ]
+        ivar = [ {"b":frame.ivar[i],"r":frame.ivar[i]/1.1} for i in stars ]
+        resol_data = [ {"b":frame.resolution_data[i],"r":frame.resolution_data[i]} for i in stars ]
+        selections = [np.arange(nmodels), np.arange(2, 8), None]
+
+        results = match_templates_many(wave, copy.deepcopy(flux), copy.deepcopy(ivar), resol_data,
+            selections, modelwave, modelflux, teff, logg, feh, ncpu=2)
+        self.assertEqual(len(results), len(stars))
+        for i in range(len(stars)):
+            s = slice(None) if selections[i] is None else selections[i]
+            coef, redshift, chi2 = match_templates(wave, copy.deepcopy(flux[i]),
+                copy.deepcopy(ivar[i]), resol_data[i], modelwave, modelflux[s],
+                teff[s], logg[s], feh[s])
+            self.assertTrue(np.allclose(results[i][0], coef))
+            self.assertAlmostEqual(results[i][1], redshift)
+            self.assertAlmostEqual(results[i][2], chi2)
+
     def test_normalize_templates(self):
         """
         Test for normalization to a given magnitude for calibration
@@ -105,6 +137,27 @@ class TestFluxCalibration(unittest.TestCase):
         #- nothing should be masked for this test case
         self.assertFalse(np.any(fluxCalib.mask))
 
+    def test_quick_resolution(self):
+        """Test compute_flux_calibration with the QuickResolution matrices
+        of quicklook frames
+        """
+        frame = get_frame_data()
+        modelwave, modelflux = get_models()
+        nstd = 3
+        frame.fibermap['OBJTYPE'][0:nstd] = 'STD'
+        wsigma = np.tile(np.linspace(1.5, 2.5, frame.nspec)[:,None], (1, frame.nwave))
+        qframe = Frame(frame.wave, frame.flux, frame.ivar, frame.mask,
+                       wsigma=wsigma, ndiag=11, fibermap=frame.fibermap,
+                       meta=frame.meta)
+        rframe = Frame(frame.wave, frame.flux, frame.ivar, frame.mask,
+                       qframe.R.data, fibermap=frame.fibermap, meta=frame.meta)
+        qcalib = compute_flux_calibration(qframe, modelwave, modelflux[0:nstd],
+                                          input_model_fibers=np.arange(nstd))
+        rcalib = compute_flux_calibration(rframe, modelwave, modelflux[0:nstd],
+                                          input_model_fibers=np.arange(nstd))
+        self.assertTrue(np.allclose(qcalib.calib, rcalib.calib))
+        self.assertTrue(np.allclose(qcalib.ivar, rcalib.ivar))
+
     def test_outliers(self):
         '''Test fluxcalib when input starts with large outliers'''
         frame = get_frame_data()
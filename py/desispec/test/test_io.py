@@ -372,6 +372,55 @@ class TestIO(unittest.TestCase):
             match = np.all(fibermap[name] == frame.fibermap[name])
             self.assertTrue(match, 'Fibermap column {} mismatch'.format(name))
 
+    def test_frame_lazy_subset(self):
+        """Test lazy reading and reading subsets of Frame files.
+        """
+        from ..io.frame import read_frame, write_frame, LazyFrame
+        from ..io.fibermap import empty_fibermap
+        nspec, nwave, ndiag = 5, 10, 3
+        wave = np.arange(nwave) + 5000.
+        flux = np.random.uniform(size=(nspec, nwave))
+        ivar = np.random.uniform(size=(nspec, nwave))
+        mask = np.zeros((nspec, nwave), dtype=np.uint32)
+        mask[1, 2] = 4
+        R = np.random.uniform( size=(nspec, ndiag, nwave) )
+        fibermap = empty_fibermap(nspec, specmin=500)
+        fibermap['TARGETID'] = np.arange(nspec)*2
+        frx = Frame(wave, flux, ivar, mask, R, fibermap=fibermap,
+                    chi2pix=2*flux, meta=dict(FLAVOR='science'))
+        write_frame(self.testfile, frx)
+
+        frame = read_frame(self.testfile, lazy=True)
+        self.assertTrue(isinstance(frame, LazyFrame))
+        self.assertEqual(len(frame._data), 0)
+        self.assertEqual((frame.nspec, frame.nwave), (nspec, nwave))
+        self.assertTrue(np.all(frame.fibers == fibermap['FIBER']))
+        self.assertEqual(frame.flux.dtype, np.float32)
+        self.assertTrue(frame.flux.dtype.isnative)
+        self.assertEqual(list(frame._data.keys()), ['flux'])
+        self.assertTrue(np.all(frame.flux == flux.astype('f4')))
+        self.assertTrue(np.all(frame.mask == mask))
+        self.assertTrue(np.all(frame.resolution_data == R.astype('f4')))
+        self.assertTrue(np.all(frame.fibermap['TARGETID'] == fibermap['TARGETID']))
+
+        fibers = [501, 503]
+        wave_range = (5002, 5005.5)
+        for lazy in (True, False):
+            frame = read_frame(self.testfile, lazy=lazy, fibers=fibers,
+                               wave_range=wave_range)
+            self.assertTrue(np.all(frame.fibers == fibers))
+            self.assertTrue(np.all(frame.wave == wave[2:6]))
+            self.assertEqual(frame.flux.shape, (2, 4))
+            self.assertEqual(frame.resolution_data.shape, (2, ndiag, 4))
+            self.assertTrue(np.all(frame.flux == flux[[1,3], 2:6].astype('f4')))
+            self.assertTrue(np.all(frame.ivar == ivar[[1,3], 2:6].astype('f4')))
+            self.assertTrue(np.all(frame.mask == mask[[1,3], 2:6]))
+            self.assertTrue(np.all(frame.chi2pix == (2*flux)[[1,3], 2:6].astype('f4')))
+            self.assertTrue(np.all(frame.fibermap['TARGETID'] == [2, 6]))
+
+        with self.assertRaises(ValueError):
+            read_frame(self.testfile, fibers=[10])
+
     def test_sky_rw(self):
         """Test reading and writing sky files.
         """
@@ -494,6 +543,64 @@ class TestIO(unittest.TestCase):
         self.assertTrue(np.all(wx == wave.astype('f4').astype('f8')))
         self.assertTrue(np.all(fibx == fibers))
 
+    def test_stdstar_templates_cache(self):
+        """Test the on-disk cache of stellar models.
+        """
+        import json
+        from ..io.fluxcalibration import (read_stdstar_templates,
+            stdstar_templates_cache_entry, read_stdstar_templates_cache,
+            write_stdstar_templates_cache)
+        cachedir = os.path.join(self.testDir, 'stdstar_cache')
+        nmodel = 4
+        filenames = list()
+        for i in range(3):
+            hdus = fits.HDUList()
+            hdus.append(fits.PrimaryHDU(np.random.uniform(size=(nmodel, 20))))
+            params = Table()
+            params['TEMPLATEID'] = np.arange(nmodel)
+            params['TEFF'] = np.linspace(5000, 7000, nmodel)
+            params['LOGG'] = np.linspace(4, 5, nmodel)
+            params['FEH'] = np.linspace(-2, -1, nmodel)
+            hdus.append(fits.table_to_hdu(params))
+            hdus.append(fits.ImageHDU(np.linspace(3600., 9800., 20)))
+            filenames.append(os.path.join(self.testDir, 'stdstar_templates_{}.fits'.format(i)))
+            hdus.writeto(filenames[-1], overwrite=True)
+
+        ref = read_stdstar_templates(filenames[0])
+        cached = read_stdstar_templates(filenames[0], cachedir=cachedir)
+        for x, y in zip(ref, cached):
+            self.assertTrue(np.all(x == y))
+        self.assertFalse(cached[1].flags.writeable)
+
+        entry = stdstar_templates_cache_entry(filenames[0], cachedir)
+        self.assertIsNone(read_stdstar_templates_cache(entry, 'mags'))
+        write_stdstar_templates_cache(entry, 'mags', np.arange(nmodel))
+        self.assertTrue(np.all(read_stdstar_templates_cache(entry, 'mags') == np.arange(nmodel)))
+
+        #- the least recently used entry is removed
+        os.utime(entry, (0, 0))
+        for filename in filenames[1:]:
+            stdstar_templates_cache_entry(filename, cachedir, maxentries=2)
+        self.assertFalse(os.path.exists(entry))
+        entries = [x for x in os.listdir(cachedir) if os.path.isdir(os.path.join(cachedir, x))]
+        self.assertEqual(len(entries), 2)
+
+        #- recently used entries are kept
+        stdstar_templates_cache_entry(filenames[0], cachedir, maxentries=1)
+        entries = [x for x in os.listdir(cachedir) if os.path.isdir(os.path.join(cachedir, x))]
+        self.assertEqual(len(entries), 3)
+
+        #- the digest of an unchanged file is not computed again
+        with open(os.path.join(cachedir, 'digests.json')) as fx:
+            index = json.load(fx)
+        self.assertEqual(len(index), 3)
+        index[os.path.realpath(filenames[0])][2] = 'x' * 40
+        with open(os.path.join(cachedir, 'digests.json'), 'w') as fx:
+            json.dump(index, fx)
+        entry = stdstar_templates_cache_entry(filenames[0], cachedir)
+        self.assertEqual(os.path.basename(entry), 'x' * 40)
+        rmtree(cachedir)
+
     def test_fluxcalib(self):
         """Test reading and writing flux calibration files.
         """
@@ -766,6 +873,64 @@ class TestIO(unittest.TestCase):
         night1 = find_exposure_night(150)
         self.assertEqual(night1, '20150102')
 
+    def test_expcatalog(self):
+        """ Test desispec.io.expcatalog
+        """
+        import fitsio
+        from ..io import get_exposures, read_expcatalog, update_expcatalog
+        from ..io.util import makepath
+        catalog = os.path.join(self.testDir, 'exposures.db')
+        if os.path.exists(catalog):
+            os.remove(catalog)
+
+        def write_raw(night, expid, flavor, cameras=('b0', 'r0')):
+            rawfile = os.path.join(self.datadir, night, '{:08d}'.format(expid),
+                                   'desi-{:08d}.fits.fz'.format(expid))
+            makepath(rawfile)
+            with fitsio.FITS(rawfile, 'rw', clobber=True) as fx:
+                for camera in cameras:
+                    fx.write(np.zeros((2, 2), dtype=np.int16), extname=camera.upper(),
+                             header=dict(FLAVOR=flavor, EXPTIME=10.0))
+
+        write_raw('20200101', 1, 'arc')
+        write_raw('20200101', 2, 'science', cameras=('b1', 'z1', 'r1'))
+        write_raw('20200102', 3, 'flat')
+        #- An exposure without its raw data file yet
+        os.makedirs(os.path.join(self.datadir, '20200102', '00000004'))
+        exp = read_expcatalog(catalog)
+        self.assertEqual(exp['EXPID'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(exp['FLAVOR'].tolist(), ['arc', 'science', 'flat', ''])
+        self.assertEqual(exp['CAMERAS'][1], 'b1,r1,z1')
+        self.assertEqual(exp['EXPTIME'][0], 10.0)
+        for night in ('20200101', '20200102'):
+            self.assertEqual(get_exposures(night, raw=True, catalog=catalog),
+                             get_exposures(night, raw=True))
+        #- Unchanged files are not read again
+        self.assertEqual(update_expcatalog(catalog), 0)
+        write_raw('20200102', 4, 'science')
+        write_raw('20200103', 5, 'arc')
+        self.assertEqual(update_expcatalog(catalog), 2)
+        exp = read_expcatalog(catalog, nights=['20200102'], update=False)
+        self.assertEqual(exp['FLAVOR'].tolist(), ['flat', 'science'])
+        #- A file replaced inside an existing exposure directory is read again
+        write_raw('20200101', 1, 'zero')
+        rawfile = os.path.join(self.datadir, '20200101', '00000001',
+                               'desi-00000001.fits.fz')
+        os.utime(rawfile, (0, os.stat(rawfile).st_mtime + 10))
+        self.assertEqual(update_expcatalog(catalog), 1)
+        self.assertEqual(read_expcatalog(catalog, update=False)['FLAVOR'][0], 'zero')
+        #- A partially written file does not stop the update
+        with open(rawfile, 'wb') as fx:
+            fx.write(b'SIMPLE  =')
+        self.assertEqual(update_expcatalog(catalog), 0)
+        exp = read_expcatalog(catalog, update=False)
+        self.assertEqual(exp['FLAVOR'][0], '')
+        self.assertTrue(np.isnan(exp['MTIME'][0]))
+        write_raw('20200101', 1, 'arc')
+        self.assertEqual(update_expcatalog(catalog), 1)
+        self.assertEqual(update_expcatalog(catalog, full=True), 5)
+        self.assertEqual(len(read_expcatalog(catalog)), 5)
+
     @unittest.skipUnless(os.path.exists(os.path.join(os.environ['HOME'],'.netrc')),"No ~/.netrc file detected.")
     @unittest.skipIf(True, "NERSC is out; download will fail")
     def test_download(self):
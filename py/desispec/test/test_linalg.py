@@ -9,6 +9,8 @@ import numpy.random
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_solve_and_invert
 from desispec.linalg import cholesky_invert
+from desispec.linalg import cholesky_invert_banded
+from desispec.linalg import spline_fit, spline_fit_batch, bspline_basis
 
 class TestLinalg(unittest.TestCase):
     
@@ -81,6 +83,73 @@ class TestLinalg(unittest.TestCase):
         d=np.inner(delta,delta)
         self.assertAlmostEqual(d,0.)
         
+    def test_cholesky_invert_banded(self): 
+        # create a random banded positive definite matrix A
+        n = 30
+        u = 3
+        A = np.zeros((n,n))
+        for i in range(n-u) :
+            H = np.zeros(n)
+            H[i:i+u+1] = numpy.random.random(u+1)
+            A += np.outer(H,H.T)
+        A += np.eye(n)
+        # upper band of A
+        ab = np.zeros((u+1,n))
+        for d in range(u+1) :
+            ab[u-d,d:] = np.diag(A,d)
+        Ai = np.linalg.inv(A)
+        for q in [u,2*u] :
+            cov = cholesky_invert_banded(ab,bandwidth=q)
+            self.assertEqual(cov.shape,(q+1,n))
+            for d in range(q+1) :
+                self.assertTrue(np.allclose(cov[q-d,d:],np.diag(Ai,d)))
+        with self.assertRaises(ValueError) :
+            cholesky_invert_banded(ab,bandwidth=u-1)
+
+    def test_bspline_basis(self):
+        import scipy.interpolate
+        order = 3
+        knots = np.concatenate([[0.]*(order+1),np.sort(numpy.random.uniform(0,10,8)),[10.]*(order+1)])
+        ncoef = knots.size-order-1
+        x = np.linspace(-1,11,50)
+        index,values = bspline_basis(knots,order,x)
+        for j in range(ncoef) :
+            c = np.zeros(ncoef)
+            c[j] = 1.
+            ref = scipy.interpolate.splev(x,(knots,c,order))
+            val = np.zeros(x.size)
+            for k in range(order+1) :
+                val[index+k==j] = values[index+k==j,k]
+            self.assertTrue(np.allclose(val,ref))
+
+    def test_spline_fit_batch(self):
+        nspec = 20
+        wave = np.linspace(5000.,6000.,800)
+        flux = 1+0.1*np.sin(wave/30.)[None,:]*numpy.random.uniform(0.5,1.5,(nspec,1))
+        flux += numpy.random.normal(0,0.01,flux.shape)
+        ivar = numpy.random.uniform(0.5,1.5,flux.shape)*1e4
+        ivar[numpy.random.uniform(size=ivar.shape)<0.02] = 0
+        ivar[3,:50]  = 0 # different range of valid pixels
+        ivar[5,400:450] = 0 # masked region without knot
+        ivar[7] = 0 # no data
+        output_wave = np.linspace(4990.,6010.,300)
+        out,ok = spline_fit_batch(output_wave,wave,flux,10.,ivar)
+        self.assertEqual(out.shape,(nspec,output_wave.size))
+        self.assertEqual(list(np.where(~ok)[0]),[7])
+        for i in np.where(ok)[0] :
+            good = ivar[i]>0
+            ref = spline_fit(output_wave,wave[good],flux[i,good],10.,ivar[i,good])
+            self.assertTrue(np.allclose(out[i],ref,rtol=0,atol=1e-10))
+        #- without ivar
+        out,ok = spline_fit_batch(output_wave,wave,flux[:2],10.)
+        self.assertTrue(np.all(ok))
+        self.assertTrue(np.allclose(out[1],spline_fit(output_wave,wave,flux[1],10.),rtol=0,atol=1e-10))
+        #- the fit of a spectrum does not depend on the other spectra of the batch
+        out,ok = spline_fit_batch(output_wave,wave,flux,10.,ivar)
+        for rows in ([3],[5],[0,3],[5,6,8],list(range(10,20))) :
+            sout,sok = spline_fit_batch(output_wave,wave,flux[rows],10.,ivar[rows])
+            self.assertTrue(np.all(sok == ok[rows]))
+            self.assertTrue(np.all(sout == out[rows]))
         
                 
     def runTest(self):
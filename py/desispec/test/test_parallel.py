@@ -94,6 +94,24 @@ class TestParallel(unittest.TestCase):
         assert(ret == "turns_{}".format(rank))
 
 
+    def test_dist_dynamic(self):
+
+        comm = None
+        if use_mpi:
+            import mpi4py.MPI as MPI
+            comm = MPI.COMM_WORLD
+
+        mywork = list(dist_dynamic(self.ntask, comm=comm))
+        if comm is None:
+            assert(mywork == list(range(self.ntask)))
+        else:
+            allwork = comm.allgather(mywork)
+            #- every item is processed once
+            assert(sorted(sum(allwork, [])) == list(range(self.ntask)))
+
+        assert(list(dist_dynamic(0, comm=comm)) == [])
+
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+"""
+tests desispec.pipeline.db
+"""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+
+class TestPipelineDB(unittest.TestCase):
+
+    def setUp(self):
+        from desispec.pipeline.db import DataBaseSqlite
+        from desispec.pipeline.tasks.base import task_classes
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DataBaseSqlite(os.path.join(self.tmpdir, "test.db"), "w")
+        #- small selections to test the chunks of "name in (...)"
+        self.db._max_params = 2
+        self.night = 20200101
+        self.tc = task_classes
+
+        with self.db.cursor() as cur:
+            for expid in [1, 2]:
+                props = dict(night=self.night, expid=expid, flavor="arc")
+                for tt in ["rawdata", "fibermap"]:
+                    self.tc[tt].insert(self.db, props, cur=cur)
+                plist = list()
+                for band in ["b", "r"]:
+                    p = props.copy()
+                    p["band"] = band
+                    p["spec"] = 0
+                    plist.append(p)
+                self.tc["preproc"].insert_many(self.db, plist, cur=cur)
+                self.tc["psf"].insert_many(self.db, plist, cur=cur)
+            self.tc["psfnight"].insert_many(self.db,
+                [ dict(night=self.night, band=x, spec=0) for x in ["b", "r"] ],
+                cur=cur)
+            for tt in ["spectra", "redshift"]:
+                self.tc[tt].insert_many(self.db,
+                    [ dict(nside=64, pixel=x) for x in [100, 101] ], cur=cur)
+            self.db.executemany(cur, "insert into healpix_frame (night,expid,spec,nside,pixel,ntargets,state) values (?,?,?,?,?,?,?)",
+                [(self.night, 1, 0, 64, 100, 10, 1),
+                 (self.night, 2, 0, 64, 100, 10, 1),
+                 (self.night, 1, 0, 64, 101, 10, 0)])
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def names(self, tasktype, expid=None):
+        with self.db.cursor() as cur:
+            if expid is None:
+                cur.execute("select name from {}".format(tasktype))
+            else:
+                cur.execute("select name from {} where expid = ?".format(
+                    tasktype), (expid, ))
+            return sorted([ x for (x, ) in cur.fetchall() ])
+
+    def states(self, tasktype):
+        names = self.names(tasktype)
+        states = self.db.get_states_type(tasktype, names)
+        return [ states[x] for x in names ]
+
+    def test_states(self):
+        db = self.db
+        self.assertEqual(db.count_task_states("psf")["waiting"], 4)
+        self.assertEqual(self.states("preproc"), ["waiting"]*4)
+
+        #- dependencies of the preproc are done
+        for tt in ["rawdata", "fibermap"]:
+            db.set_states_type(tt, [ (x, "done") for x in self.names(tt) ])
+        db.getready(night=self.night)
+        self.assertEqual(self.states("preproc"), ["ready"]*4)
+        self.assertEqual(self.states("psf"), ["waiting"]*4)
+
+        #- postprocessing of the done preproc
+        db.set_states_type("preproc",
+            [ (x, "done") for x in self.names("preproc", expid=1) ])
+        states = db.get_states(self.names("psf"))
+        for name in self.names("psf"):
+            expid = self.tc["psf"].name_split(name)["expid"]
+            self.assertEqual(states[name], "ready" if expid == 1 else "waiting")
+
+        #- psfnight is ready when all psf are processed, failures included,
+        #- which needs the states to be all set before the postprocessing
+        db.set_states(
+            [ (x, "done") for x in self.names("psf", expid=1) ] +
+            [ (x, "failed") for x in self.names("psf", expid=2) ])
+        self.assertEqual(self.states("psfnight"), ["ready"]*2)
+
+        #- healpix_frame states
+        self.assertEqual(self.states("spectra"), ["ready", "waiting"])
+        db.update_healpix_frame_state(dict(nside=64, pixel=101, state=0),
+            2, None)
+        db.getready(night=self.night)
+        self.assertEqual(self.states("spectra"), ["ready", "done"])
+        self.assertEqual(self.states("redshift"), ["waiting", "ready"])
+
+        #- cleanup
+        db.set_states_type("psf", [ (x, "running") for x in
+            self.names("psf", expid=2) ])
+        db.cleanup(tasktypes=["psf"], expid=1)
+        self.assertEqual(db.count_task_states("psf")["running"], 2)
+        #- the preproc of expid 2 are not done
+        db.cleanup(tasktypes=["psf"])
+        self.assertEqual(self.states("psf"), ["done", "waiting"]*2)
+
+    def test_submitted(self):
+        names = self.names("psf")
+        self.db.set_submitted(names[:3])
+        sub = self.db.get_submitted(names)
+        self.assertEqual([ sub[x] for x in names ], [1, 1, 1, 0])
+        self.db.set_submitted(names[1:], unset=True)
+        sub = self.db.get_submitted(names)
+        self.assertEqual([ sub[x] for x in names ], [1, 0, 0, 0])
+        with self.assertRaises(RuntimeError):
+            self.db.get_submitted(self.names("spectra"))
+
+    def test_indexes(self):
+        with self.db.cursor() as cur:
+            cur.execute("select name from sqlite_master where type = 'index'")
+            indexes = [ x for (x, ) in cur.fetchall() ]
+        for name in ["preproc_night_expid_state", "psfnight_night_state",
+                     "spectra_state", "spectra_nside_pixel",
+                     "healpix_frame_nside_pixel"]:
+            self.assertIn(name, indexes)
+        #- idempotent
+        self.db.create_indexes()
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -82,6 +82,77 @@ class TestPipelineRun(unittest.TestCase):
         pass
 
 
+    def test_runtime_model(self):
+        import tempfile
+        from desispec.pipeline.db import DataBaseSqlite, fit_task_runtime
+        from desispec.pipeline.tasks.base import task_classes
+
+        # serial + parallel / nproc
+        serial, par = fit_task_runtime([10, 20, 40], [4.0, 2.5, 1.75])
+        self.assertAlmostEqual(serial, 1.0)
+        self.assertAlmostEqual(par, 30.0)
+        self.assertEqual(fit_task_runtime([20, 20], [1.0, 2.0]), (0.0, 30.0))
+        self.assertEqual(fit_task_runtime([1, 1], [1.0, 2.0], parallel=False), (1.5, 0.0))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = DataBaseSqlite(os.path.join(tmpdir, "test.db"), "w")
+            task = task_classes["extract"]
+            props = dict(night=20200101, band="b", spec=0, expid=1)
+            name = task.name_join(props)
+            default = task.run_time(name, 20, db=db)
+
+            # not enough runs, use default estimate
+            for nproc in [10, 40]:
+                db.record_task_runtime(name, "extract", "b", nproc,
+                    1.0 + 30.0 / nproc, 2.0)
+            self.assertEqual(task.run_time(name, 20, db=db), default)
+
+            # failed runs are ignored
+            db.record_task_runtime(name, "extract", "b", 20, 100.0, 10.0,
+                failed=20)
+            self.assertEqual(task.run_time(name, 20, db=db), default)
+
+            db.record_task_runtime(name, "extract", "b", 20, 2.5, 3.0)
+            self.assertAlmostEqual(task.run_time(name, 20, db=db), 2.5)
+            self.assertEqual(task.run_time(name, 20, db=db, history=False),
+                default)
+            self.assertEqual(task.run_max_mem_proc(name, db=db), 3.0)
+
+            # memory is a high percentile of the measured runs, and runs
+            # without a measured peak memory are ignored
+            for i in range(7):
+                db.record_task_runtime(name, "extract", "b", 20, 2.5, 2.0)
+            db.record_task_runtime(name, "extract", "b", 20, 2.5, None)
+            self.assertEqual(task.run_max_mem_proc(name, db=db), 2.0)
+
+            # other bands keep the default estimate
+            props["band"] = "r"
+            self.assertEqual(task.run_time(task.name_join(props), 20, db=db),
+                default)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_task_peak_memory(self):
+        import numpy as np
+        from desispec.pipeline.tasks.base import (start_peak_memory,
+            task_peak_memory)
+        # a large allocation of an earlier task
+        x = np.ones(50 * 1024**2)
+        del x
+        start = start_peak_memory()
+        y = np.ones(1024**2)
+        mem = task_peak_memory(start)
+        del y
+        if start[0]:
+            # measured for this task alone
+            self.assertGreater(mem, 8.0 / 1024)
+            self.assertLess(mem, start[1])
+        else:
+            self.assertIsNone(mem)
+
+
 def test_suite():
     """Allows testing of only this module with the command::
         python setup.py test -m <modulename>
@@ -10,6 +10,9 @@ if __name__ == '__main__':
 from ..test.util import get_frame_data
 from ..io import findfile, write_frame, read_spectra, specprod_root
 from ..scripts import group_spectra
+from ..pixgroup import (get_exp2healpix_index, get_exp2healpix_map,
+        read_exp2healpix_index, write_exp2healpix_index,
+        split_exp2healpix_index, update_frame_cache)
 
 class TestPixGroup(unittest.TestCase):
 
@@ -140,6 +143,78 @@ class TestPixGroup(unittest.TestCase):
         self.assertEqual(len(spectra.fibermap), nspec)
         self.assertEqual(spectra.flux['b'].shape[0], nspec)
 
+    def test_exp2healpix_index(self):
+        #- the index has one row per spectrum of each exposure spectrograph
+        indexfile = os.path.join(self.outdir, 'exp2healpix-64.fits')
+        index = get_exp2healpix_index(indexfile=indexfile)
+        nexp = self.nframe_per_night * len(self.nights)
+        self.assertEqual(len(index), nexp * self.nspec_per_frame)
+        self.assertTrue(os.path.exists(indexfile))
+        self.assertTrue(np.all(read_exp2healpix_index(indexfile) == index))
+
+        #- summary map
+        exp2pix = get_exp2healpix_map(indexfile=indexfile)
+        self.assertEqual(len(exp2pix), nexp)
+        self.assertTrue(np.all(exp2pix['HEALPIX'] == 19456))
+        self.assertTrue(np.all(exp2pix['NTARGETS'] == self.nspec_per_frame))
+
+        #- subset of nights
+        index1 = get_exp2healpix_index(nights=self.nights[0:1], indexfile=indexfile)
+        self.assertEqual(len(index1), self.nframe_per_night * self.nspec_per_frame)
+        self.assertTrue(np.all(index1['NIGHT'] == self.nights[0]))
+
+        #- exposures already in the index are not rescanned
+        index['HEALPIX'][0] = 123
+        write_exp2healpix_index(indexfile, index)
+        index2 = get_exp2healpix_index(indexfile=indexfile)
+        self.assertEqual(len(index2), len(index))
+        self.assertEqual(index2['HEALPIX'][0], 123)
+
+        #- unless their cframes were modified
+        cframe = findfile('cframe', index['NIGHT'][0], index['EXPID'][0], 'b0')
+        mtime = os.stat(cframe).st_mtime
+        os.utime(cframe, (mtime+10, mtime+10))
+        try:
+            index2 = get_exp2healpix_index(indexfile=indexfile)
+        finally:
+            os.utime(cframe, (mtime, mtime))
+        self.assertEqual(len(index2), len(index))
+        self.assertTrue(np.all(index2['HEALPIX'] == 19456))
+        self.assertEqual(np.max(read_exp2healpix_index(indexfile)['MTIME']), mtime+10)
+
+        #- new exposures are appended to the index file
+        oldindex = index[index['NIGHT'] != self.nights[-1]]
+        write_exp2healpix_index(indexfile, oldindex)
+        index3 = get_exp2healpix_index(indexfile=indexfile)
+        self.assertEqual(len(index3), len(index))
+        index4 = read_exp2healpix_index(indexfile)
+        self.assertEqual(len(index4), len(index))
+        self.assertTrue(np.all(index4[0:len(oldindex)] == oldindex))
+
+        #- nside must match
+        with self.assertRaises(ValueError):
+            read_exp2healpix_index(indexfile, nside=32)
+
+    def test_update_frame_cache(self):
+        #- the healpix of the index are only used for the same fibers
+        index = get_exp2healpix_index(nights=self.nights[1:2])
+        index['HEALPIX'] = 123
+        rows = split_exp2healpix_index(index)
+        night, expid, spectro = key = sorted(rows.keys())[0]
+        self.assertEqual(len(rows[key]), self.nspec_per_frame)
+        framekeys = [(night, expid, 'b0'), (night, expid, 'r0')]
+        frames = dict()
+        update_frame_cache(frames, framekeys, healpix=rows)
+        self.assertTrue(np.all(frames[framekeys[0]].get_healpix() == 123))
+
+        rows[key]['FIBER'] += 1
+        frames = dict()
+        update_frame_cache(frames, framekeys, healpix=rows)
+        self.assertTrue(np.all(frames[framekeys[0]].get_healpix() == 19456))
+
+        #- rows of a subset of exposure spectrographs
+        self.assertEqual(list(split_exp2healpix_index(index, keys=[key]).keys()), [key])
+
 def test_suite():
     """Allows testing of only this module with the command::
 
@@ -10,6 +10,7 @@ from pkg_resources import resource_filename
 
 import desispec.scripts.preproc
 from desispec.preproc import preproc, parse_sec_keyword, _clipped_std_bias
+from desispec.preproc import _overscan, _overscan_per_row, _global_background
 from desispec.preproc import get_amp_ids
 from desispec import io
 
@@ -178,6 +179,20 @@ class TestPreProc(unittest.TestCase):
             self.assertAlmostEqual(np.std(pix), self.rdnoise[amp], delta=0.2)
             self.assertAlmostEqual(rdnoise, self.rdnoise[amp], delta=0.2)
 
+    def test_preproc_float32_threads(self):
+        """float32 working precision and threads give the same result"""
+        image = preproc(self.rawimage, self.header, primary_header = self.primary_header)
+        image2 = preproc(self.rawimage, self.header, primary_header = self.primary_header, nthreads=4)
+        image3 = preproc(self.rawimage, self.header, primary_header = self.primary_header, dtype=np.float32)
+        self.assertTrue(np.all(image.pix == image2.pix))
+        self.assertTrue(np.all(image.ivar == image2.ivar))
+        self.assertTrue(np.all(image.mask == image2.mask))
+        self.assertEqual(image3.pix.dtype, np.float32)
+        self.assertEqual(image3.ivar.dtype, np.float32)
+        self.assertTrue(np.allclose(image.pix, image3.pix, atol=1e-3))
+        self.assertTrue(np.allclose(image.ivar, image3.ivar, rtol=1e-5))
+        self.assertTrue(np.all(image.mask == image3.mask))
+
     def test_preproc1234(self):
         """Should also work with old amp names 1-4 instead of A-D"""
         hdr = self.header.copy()
@@ -399,6 +414,23 @@ class TestPreProc(unittest.TestCase):
         biased_std = np.std(x[np.abs(x)<3])
         self.assertAlmostEqual(biased_std, _clipped_std_bias(3), places=3)
 
+    def test_overscan_per_row(self):
+        np.random.seed(2)
+        pix = (1000 + np.random.normal(0, 3, (30, 40))).astype(np.int32)
+        pix[np.random.uniform(size=pix.shape)<0.02] += 2000
+        overscan, readnoise = _overscan_per_row(pix)
+        for i in range(pix.shape[0]):
+            o, r = _overscan(pix[i])
+            self.assertAlmostEqual(overscan[i], o)
+            self.assertAlmostEqual(readnoise[i], r)
+
+    def test_global_background(self):
+        image = np.outer(np.linspace(1, 2, 600), np.linspace(3, 4, 500))
+        bkg = _global_background(image, patch_width=100)
+        self.assertEqual(bkg.shape, image.shape)
+        #- the spline is constant beyond the centers of the edge patches
+        self.assertLess(np.max(np.abs(bkg-image)[60:540,62:438]), 0.01)
+
     #- Not implemented yet, but flag these as expectedFailures instead of
     #- successful tests of raising NotImplementedError
     def test_default_bias(self):
@@ -0,0 +1,66 @@
+"""
+tests desispec.qproc.qextract
+"""
+
+import unittest
+
+import numpy as np
+from astropy.table import Table
+
+try:
+    import specter
+    nospecter = False
+except ImportError:
+    nospecter = True
+
+
+@unittest.skipIf(nospecter, 'specter not installed; skipping qproc extraction tests')
+class TestQExtract(unittest.TestCase):
+
+    def setUp(self):
+        from desispec.xytraceset import XYTraceSet
+        from desispec.image import Image
+        nspec = 10
+        rng = np.random.RandomState(0)
+        xcoef = np.zeros((nspec, 3))
+        ycoef = np.zeros((nspec, 3))
+        xcoef[:, 0] = 20.+15.*np.arange(nspec)
+        xcoef[:, 1] = rng.normal(0, 0.5, nspec)
+        ycoef[:, 0] = 200.
+        ycoef[:, 1] = 210.
+        ysigcoef = np.tile([1., 0.1], (nspec, 1))
+        self.tset = XYTraceSet(xcoef, ycoef, 5000., 6000., 400, ysigcoef=ysigcoef)
+        pix = rng.normal(10., 1., (400, 180))
+        ivar = np.ones(pix.shape)
+        ivar[100, 30:60] = 0.
+        self.image = Image(pix, ivar, meta={})
+        self.fibermap = Table()
+        self.fibermap['FIBER'] = np.arange(nspec)
+
+    def test_boxcar(self):
+        from desispec.qproc.qextract import qproc_boxcar_extraction
+        width = 5
+        qframe = qproc_boxcar_extraction(self.tset, self.image, width=width,
+                                         fibermap=self.fibermap)
+        self.assertEqual(qframe.flux.shape, (10, 400))
+        y = np.arange(400)
+        pix = self.image.pix
+        for f in range(10):
+            wave = qframe.wave[f]
+            self.assertTrue(np.all(np.diff(wave) > 0))
+            self.assertTrue(np.allclose(self.tset.y_vs_wave(f, wave[10:-10]), y[10:-10], atol=1e-3))
+            x = self.tset.x_vs_wave(f, wave)
+            dwave = np.gradient(wave)
+            for j in [0, 100, 250, 399]:
+                i = int(x[j]-width//2)
+                flux = np.sum(pix[j, i:int(x[j]+width//2+1)])
+                if np.any(self.image.ivar[j, i:int(x[j]+width//2+1)] == 0):
+                    self.assertEqual(qframe.ivar[f, j], 0.)
+                    self.assertEqual(qframe.flux[f, j], 0.)
+                else:
+                    self.assertAlmostEqual(qframe.flux[f, j]*dwave[j], flux, places=3)
+                    self.assertAlmostEqual(qframe.ivar[f, j]/dwave[j]**2, 1./width, places=3)
+            self.assertTrue(np.allclose(qframe.sigma[f], self.tset.ysig_vs_wave(f, wave), atol=1e-3))
+
+if __name__ == '__main__':
+    unittest.main()
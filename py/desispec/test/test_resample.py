@@ -6,7 +6,7 @@ import unittest, os
 import numpy as np
 from math import log
 
-from desispec.interpolation import resample_flux
+from desispec.interpolation import resample_flux, resample_flux_batch, resampling_matrix
 
 class TestResample(unittest.TestCase):
     """
@@ -81,6 +81,55 @@ class TestResample(unittest.TestCase):
             self.assertAlmostEqual(ivar_in,ivar_out)
 
 
+    def test_resample_batch(self):
+        '''resample_flux_batch gives the same result as resample_flux'''
+        rng = np.random.RandomState(0)
+        x = np.sort(rng.uniform(0, 100, 150))
+        flux = rng.normal(size=(5, x.size))
+        ivar = rng.uniform(0.5, 2, size=(5, x.size))
+        ivar[:, ::7] = 0.
+        for xout in (np.linspace(10, 90, 61), np.linspace(-10, 110, 300), x[::3]):
+            for extrapolate in (False, True):
+                yout = resample_flux_batch(xout, x, flux, extrapolate=extrapolate)
+                for i in range(flux.shape[0]):
+                    yy = resample_flux(xout, x, flux[i], extrapolate=extrapolate)
+                    self.assertTrue(np.allclose(yout[i], yy, rtol=1e-12, atol=1e-12))
+            #- one input grid per spectrum
+            xx = x + rng.uniform(-0.1, 0.1, size=(flux.shape[0], 1))
+            for xin in (x, xx):
+                yout, ivout = resample_flux_batch(xout, xin, flux, ivar)
+                for i in range(flux.shape[0]):
+                    yy, iv = resample_flux(xout, np.atleast_2d(xin)[-1 if xin.ndim == 1 else i], flux[i], ivar[i])
+                    self.assertTrue(np.allclose(ivout[i], iv, rtol=1e-12, atol=1e-12))
+                    ok = iv > 1e-3
+                    self.assertTrue(np.allclose(yout[i][ok], yy[ok], rtol=1e-10, atol=1e-10))
+        with self.assertRaises(ValueError):
+            resample_flux_batch(xout, x, flux, ivar, extrapolate=True)
+
+    def test_resampling_matrix_cache(self):
+        '''the resampling matrix is cached for identical grids'''
+        x = np.linspace(0, 100, 200)
+        xout = np.linspace(0, 100, 50)
+        m1 = resampling_matrix(xout, x)
+        self.assertIs(resampling_matrix(xout.copy(), x.copy()), m1)
+        self.assertIsNot(resampling_matrix(xout, x, extrapolate=True), m1)
+        self.assertIsNot(resampling_matrix(xout+0.1, x), m1)
+        self.assertEqual(m1.shape, (xout.size, x.size))
+        #- block diagonal matrices of 2D input grids are not cached
+        x2 = np.vstack([x, x+0.1])
+        self.assertIsNot(resampling_matrix(xout, x2), resampling_matrix(xout, x2))
+
+    def test_get_resampling_matrix(self):
+        '''linear interpolation matrix from a global grid to a local grid'''
+        from desispec.interpolation import get_resampling_matrix
+        x = np.linspace(0, 100, 201)
+        xloc = np.concatenate([x[:3], np.linspace(1.2, 99.7, 50), x[-2:]])
+        xloc.sort()
+        y = np.random.uniform(size=x.size)
+        m = get_resampling_matrix(x, xloc)
+        self.assertEqual(m.shape, (xloc.size, x.size))
+        self.assertTrue(np.allclose(m.dot(y), np.interp(xloc, x, y), rtol=1e-12, atol=1e-12))
+
     # def test_same_bin(self):
     #     '''test reproducibility if two input bins are the same'''
     #     x  = np.array([1, 2, 3, 3, 4, 5])
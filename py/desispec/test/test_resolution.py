@@ -6,7 +6,7 @@ import unittest
 import numpy as np
 import scipy.sparse
 
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, BatchedResolution
 import desispec.resolution
 
 class TestResolution(unittest.TestCase):
@@ -145,6 +145,70 @@ class TestResolution(unittest.TestCase):
         self.assertTrue(data is data2)
         self.assertTrue(offsets is offsets2)
 
+    def test_batched_resolution(self):
+        nspec, ndiag, nwave = 4, 7, 30
+        data = np.random.uniform(size=(nspec, ndiag, nwave))
+        R = BatchedResolution(data)
+        self.assertEqual(len(R), nspec)
+        self.assertTrue(isinstance(R[1], Resolution))
+        self.assertTrue(isinstance(R[1:3], BatchedResolution))
+        self.assertEqual(len(R[[0,2,3]]), 3)
+
+        x = np.random.uniform(size=nwave)
+        xx = np.random.uniform(size=(nspec, nwave))
+        Rx = R.dot(x)
+        Rxx = R.dot(xx)
+        RTxx = R.dot_transpose(xx)
+        diag = R.diagonal()
+        for i in range(nspec):
+            Ri = Resolution(data[i])
+            dense = R.to_dense(i)
+            self.assertTrue(np.allclose(dense, Ri.toarray()))
+            self.assertTrue(np.allclose(Rx[i], Ri.dot(x)))
+            self.assertTrue(np.allclose(Rxx[i], Ri.dot(xx[i])))
+            self.assertTrue(np.allclose(RTxx[i], Ri.T.dot(xx[i])))
+            self.assertTrue(np.allclose(diag[i], Ri.diagonal()))
+
+        #- upper band of sum_i R_i^T W_i R_i
+        weight = np.random.uniform(size=(nspec, nwave))
+        band = R.normal_matrix_band(weight)
+        u = ndiag-1
+        self.assertEqual(band.shape, (u+1, nwave))
+        A = np.zeros((nwave, nwave))
+        for i in range(nspec):
+            dense = R.to_dense(i)
+            A += dense.T.dot(weight[i][:,None]*dense)
+        for d in range(u+1):
+            self.assertTrue(np.allclose(band[u-d, d:], np.diag(A, d)))
+
+        with self.assertRaises(ValueError):
+            BatchedResolution(data[0])
+
+    def test_batched_quick_resolution(self):
+        from desispec.quicklook.qlresolution import QuickResolution
+        from desispec.frame import Frame
+        nspec, ndiag, nwave = 3, 11, 40
+        wsigma = np.tile(np.linspace(1.5, 2.5, nspec)[:,None], (1, nwave))
+        matrices = [QuickResolution(sigma=sigma, ndiag=ndiag) for sigma in wsigma]
+        R = BatchedResolution.from_resolutions(matrices)
+        self.assertEqual(R.data.shape, (nspec, ndiag, nwave))
+        x = np.random.uniform(size=nwave)
+        for i in range(nspec):
+            self.assertTrue(np.allclose(R.dot(x)[i], matrices[i].dot(x)))
+            self.assertTrue(np.allclose(R.to_dense(i), matrices[i].toarray()))
+
+        #- frames with wsigma, or with an array of matrices, have a BatchedResolution
+        flux = np.ones((nspec, nwave))
+        frame = Frame(np.arange(nwave), flux, flux, wsigma=wsigma, ndiag=ndiag,
+                      spectrograph=0)
+        self.assertTrue(isinstance(frame.R, BatchedResolution))
+        self.assertTrue(np.all(frame.R.data == R.data))
+        frame.R = np.array(matrices)
+        self.assertTrue(isinstance(frame.R, BatchedResolution))
+        self.assertTrue(np.all(frame.R.data == R.data))
+        with self.assertRaises(ValueError):
+            BatchedResolution(np.ones((nspec, 6, nwave)))
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()           
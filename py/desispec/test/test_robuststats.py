@@ -0,0 +1,74 @@
+"""
+test desispec.robuststats
+"""
+
+import unittest
+
+import numpy as np
+from desispec.robuststats import median_and_mad_rms, clipped_mean_and_rms, patch_medians
+
+class TestRobustStats(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = (1000 + rng.normal(0, 3, (50, 40))).astype(np.int32)
+        self.data[rng.uniform(size=self.data.shape)<0.02] += 3000
+
+    def test_median_and_mad_rms(self):
+        median, rms = median_and_mad_rms(self.data)
+        for i, row in enumerate(self.data):
+            self.assertEqual(median[i], np.median(row))
+            self.assertAlmostEqual(rms[i], 1.4826*np.median(np.abs(row-np.median(row))))
+        #- 1D input is a single sample
+        median, rms = median_and_mad_rms(self.data[0])
+        self.assertEqual(median.shape, (1,))
+
+    def test_clipped_mean_and_rms(self):
+        nsigma, niter = 5, 3
+        mean, rms, clipped = clipped_mean_and_rms(self.data, nsigma=nsigma, niter=niter)
+        self.assertTrue(np.all(clipped))
+        for i, row in enumerate(self.data):
+            m = np.median(row)
+            r = 1.4826*np.median(np.abs(row-m))
+            for j in range(niter):
+                good = np.abs(row-m) < nsigma*r
+                m = np.mean(row[good])
+                r = np.std(row[good])
+            self.assertAlmostEqual(mean[i], m, places=10)
+            self.assertAlmostEqual(rms[i], r, places=10)
+
+    def test_clipped_failure(self):
+        #- rows with a null MAD cannot be clipped and keep the median
+        data = np.zeros((3, 20))
+        data[1] = np.arange(20)
+        data[2, 0] = 100.
+        mean, rms, clipped = clipped_mean_and_rms(data, min_good=5)
+        self.assertEqual(list(clipped), [False, True, False])
+        self.assertEqual(mean[2], 0.)
+        self.assertEqual(rms[2], 0.)
+        self.assertAlmostEqual(mean[1], 9.5)
+
+    def test_patch_medians(self):
+        rng = np.random.RandomState(1)
+        image = rng.normal(size=(103, 211))
+        for edges0, edges1 in [
+                ([0, 50, 103], [0, 70, 140, 211]),
+                ([0, 103], [0, 211]),
+                ([10, 11, 30], [3, 4, 5, 100, 101, 200]),
+                (np.linspace(0, 103, 4).astype(int), np.linspace(0, 211, 7).astype(int)),
+                ]:
+            copy = image.copy()
+            medians = patch_medians(image, edges0, edges1)
+            self.assertEqual(medians.shape, (len(edges0)-1, len(edges1)-1))
+            for i in range(len(edges0)-1):
+                for j in range(len(edges1)-1):
+                    self.assertEqual(medians[i, j],
+                        np.median(image[edges0[i]:edges0[i+1], edges1[j]:edges1[j+1]]))
+            #- input image is not modified
+            self.assertTrue(np.array_equal(image, copy))
+
+    def runTest(self):
+        pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -110,6 +110,28 @@ class TestSky(unittest.TestCase):
         #- allow some slop in the sky subtraction
         self.assertTrue(np.allclose(spectra.flux, 0, rtol=1e-3, atol=1e-3))
     
+    def test_quick_resolution(self):
+        """
+        Frames with the QuickResolution matrices of quicklook give the same
+        sky as with the same matrices as resolution_data
+        """
+        spectra = self._get_spectra(with_gradient=True)
+        wsigma = np.tile(np.linspace(1.5, 2.5, self.nspec)[:,None], (1, self.nwave))
+        qframe = Frame(self.wave, spectra.flux, spectra.ivar, spectra.mask,
+                       wsigma=wsigma, ndiag=11, spectrograph=2,
+                       fibermap=spectra.fibermap)
+        rframe = Frame(self.wave, spectra.flux, spectra.ivar, spectra.mask,
+                       qframe.R.data, spectrograph=2, fibermap=spectra.fibermap)
+        for angular_variation_deg, chromatic_variation_deg in [(0,0), (1,1), (1,-1)]:
+            qsky = compute_sky(qframe, angular_variation_deg=angular_variation_deg,
+                               chromatic_variation_deg=chromatic_variation_deg,
+                               add_variance=self.add_variance)
+            rsky = compute_sky(rframe, angular_variation_deg=angular_variation_deg,
+                               chromatic_variation_deg=chromatic_variation_deg,
+                               add_variance=self.add_variance)
+            self.assertTrue(np.allclose(qsky.flux, rsky.flux))
+            self.assertTrue(np.allclose(qsky.ivar, rsky.ivar))
+
     def test_main(self):
         pass
         
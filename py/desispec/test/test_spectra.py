@@ -11,7 +11,7 @@ import copy
 import numpy as np
 import numpy.testing as nt
 
-#from astropy.table import Table
+from astropy.table import vstack
 
 from desiutil.io import encode_table
 from desispec.io import empty_fibermap
@@ -173,6 +173,40 @@ class TestSpectra(unittest.TestCase):
         self.verify(nt, self.fmap2)
 
 
+    def test_update_existing(self):
+        spec = Spectra(bands=self.bands, wave=self.wave, flux=self.flux, ivar=self.ivar, 
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap1, 
+            meta=self.meta, extra=self.extra)
+
+        # same EXPID and FIBER: spectra are overwritten, not appended
+        newflux = {b : self.flux[b] + 1.0 for b in self.bands}
+        other = Spectra(bands=self.bands, wave=self.wave, flux=newflux, ivar=self.ivar, 
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap1[::-1], 
+            meta=self.meta, extra=self.extra)
+        other.flux = {b : other.flux[b][::-1] for b in self.bands}
+        spec.update(other)
+        self.assertEqual(spec.num_spectra(), self.nspec)
+        for b in self.bands:
+            nt.assert_array_almost_equal(spec.flux[b], newflux[b])
+
+        # repeated updates with new spectra only append them once
+        other = Spectra(bands=self.bands, wave=self.wave, flux=self.flux, ivar=self.ivar, 
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap2, 
+            meta=self.meta, extra=self.extra)
+        spec.update(other)
+        spec.update(other)
+        self.assertEqual(spec.num_spectra(), 2*self.nspec)
+        nt.assert_array_equal(spec.fibermap[self.nspec:], self.fmap2)
+
+        # duplicates in the existing spectra are detected
+        dup = Spectra(bands=["b"], wave={"b" : self.wave["b"]},
+            flux={"b" : np.vstack([self.flux["b"], self.flux["b"]])},
+            ivar={"b" : np.vstack([self.ivar["b"], self.ivar["b"]])},
+            fibermap=vstack([self.fmap1, self.fmap1]))
+        with self.assertRaises(RuntimeError):
+            dup.update(spec)
+
+
 def test_suite():
     """Allows testing of only this module with the command::
 
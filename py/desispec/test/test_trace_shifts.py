@@ -0,0 +1,54 @@
+"""
+tests desispec.trace_shifts
+"""
+
+import unittest
+
+import numpy as np
+
+try:
+    import specter
+    nospecter = False
+except ImportError:
+    nospecter = True
+
+
+@unittest.skipIf(nospecter, 'specter not installed; skipping trace shifts tests')
+class TestTraceShifts(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.wave = np.arange(5000., 5400., 0.2)
+        self.ref = np.ones(self.wave.size)
+        for line in rng.uniform(5010., 5390., 20):
+            self.ref += rng.uniform(5., 50.)*np.exp(-0.5*((self.wave-line)/0.7)**2)
+        self.shifts = np.array([-0.4, -0.1, 0., 0.25, 0.5])
+        self.flux = np.array([np.interp(self.wave+s, self.wave, self.ref) for s in self.shifts])
+        self.ivar = np.ones(self.flux.shape)
+
+    def test_cross_correlation(self):
+        from desispec.trace_shifts import compute_dy_from_spectral_cross_correlation
+        for i in range(self.shifts.size):
+            delta, sigma = compute_dy_from_spectral_cross_correlation(self.flux[i],
+                self.wave, self.ref, ivar=self.ivar[i], hw=3.)
+            self.assertAlmostEqual(delta, self.shifts[i], delta=0.02)
+            self.assertLess(sigma, 1.)
+
+    def test_cross_correlation_batch(self):
+        from desispec.trace_shifts import compute_dy_from_spectral_cross_correlation, \
+            compute_dy_from_spectral_cross_correlation_batch
+        flux = self.flux.copy()
+        #- shift larger than the scan, the chi2 minimum is on the edge
+        flux[0] = np.interp(self.wave+5., self.wave, self.ref)
+        delta, sigma = compute_dy_from_spectral_cross_correlation_batch(flux,
+            self.wave, self.ref, ivar=self.ivar, hw=3.)
+        self.assertEqual(delta[0], 0.)
+        self.assertEqual(sigma[0], 100.)
+        for i in range(1, self.shifts.size):
+            d, s = compute_dy_from_spectral_cross_correlation(flux[i],
+                self.wave, self.ref, ivar=self.ivar[i], hw=3.)
+            self.assertAlmostEqual(delta[i], d, places=10)
+            self.assertAlmostEqual(sigma[i], s, places=10)
+
+if __name__ == '__main__':
+    unittest.main()
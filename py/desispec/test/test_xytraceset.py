@@ -0,0 +1,67 @@
+"""
+tests desispec.xytraceset
+"""
+
+import unittest
+
+import numpy as np
+
+try:
+    import specter
+    nospecter = False
+except ImportError:
+    nospecter = True
+
+
+@unittest.skipIf(nospecter, 'specter not installed; skipping xytraceset tests')
+class TestXYTraceSet(unittest.TestCase):
+
+    def setUp(self):
+        from desispec.xytraceset import XYTraceSet
+        nspec = 20
+        rng = np.random.RandomState(0)
+        xcoef = np.zeros((nspec, 5))
+        ycoef = np.zeros((nspec, 5))
+        xcoef[:, 0] = 10+7.*np.arange(nspec)
+        xcoef[:, 1:] = rng.normal(0, 0.5, (nspec, 4))
+        ycoef[:, 0] = 2000.
+        ycoef[:, 1] = 1900.
+        ycoef[:, 2:] = rng.normal(0, 2, (nspec, 3))
+        ysigcoef = np.tile([1., 0.1, 0.01], (nspec, 1))
+        self.tset = XYTraceSet(xcoef, ycoef, 3600., 5800., 4000, ysigcoef=ysigcoef)
+        self.wave = np.linspace(3600., 5800., 50)
+
+    def test_vs_wave_all(self):
+        tset = self.tset
+        x = tset.x_vs_wave_all(self.wave)
+        y = tset.y_vs_wave_all(self.wave)
+        ysig = tset.ysig_vs_wave_all(self.wave)
+        self.assertEqual(x.shape, (tset.nspec, self.wave.size))
+        for i in range(tset.nspec):
+            self.assertTrue(np.allclose(x[i], tset.x_vs_wave(i, self.wave)))
+            self.assertTrue(np.allclose(y[i], tset.y_vs_wave(i, self.wave)))
+            self.assertTrue(np.allclose(ysig[i], tset.ysig_vs_wave(i, self.wave)))
+        with self.assertRaises(RuntimeError):
+            tset.xsig_vs_wave_all(self.wave)
+
+    def test_vs_y_all(self):
+        tset = self.tset
+        y = np.linspace(10., 3990., 30)
+        wave = tset.wave_vs_y_all(y)
+        x = tset.x_vs_y_all(y)
+        for i in range(tset.nspec):
+            self.assertTrue(np.allclose(wave[i], tset.wave_vs_y(i, y)))
+            self.assertTrue(np.allclose(x[i], tset.x_vs_y(i, y)))
+
+    def test_cache(self):
+        tset = self.tset
+        x = tset.x_vs_wave_all(self.wave)
+        self.assertIs(tset.x_vs_wave_all(self.wave.copy()), x)
+        self.assertFalse(x.flags.writeable)
+        #- modified coefficients are not read from the cache
+        tset.x_vs_wave_traceset._coeff[:, 0] += 1.
+        x2 = tset.x_vs_wave_all(self.wave)
+        self.assertTrue(np.allclose(x2, x+1.))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -212,12 +212,8 @@ def compute_dy_from_spectral_cross_correlation(flux,wave,refflux,ivar=None,hw=3.
         hw     : half width in Angstrom of the cross-correlation chi2 scan, default=3A corresponding approximatly to 5 pixels for DESI
 
     Returns:
-        x  : 1D array of x coordinates on CCD (axis=1 in numpy image array, AXIS=0 in FITS, cross-dispersion axis = fiber number direction)
-        y  : 1D array of y coordinates on CCD (axis=0 in numpy image array, AXIS=1 in FITS, wavelength dispersion axis)
-        dx : 1D array of shifts along x coordinates on CCD
-        ex : 1D array of uncertainties on dx
-        fiber : 1D array of fiber ID (first fiber = 0)
-        wave  : 1D array of wavelength
+        delta : wavelength offset in Angstrom
+        sigma : uncertainty on delta
     """
 
 
@@ -232,69 +228,78 @@ def compute_dy_from_spectral_cross_correlation(flux,wave,refflux,ivar=None,hw=3.
             scale=f1/f2
             refflux *= scale
 
+    if ivar is None :
+        ivar=np.ones(flux.shape)
+
+    delta,sigma = compute_dy_from_spectral_cross_correlation_batch(flux[None,:],wave,refflux,ivar=ivar[None,:],hw=hw)
 
+    return delta[0],sigma[0]
+
+def compute_dy_from_spectral_cross_correlation_batch(flux,wave,refflux,ivar=None,hw=3.) :
+    """
+    Measure y offsets of several spectra with respect to a reference spectrum,
+    all on the same wavelength grid, like compute_dy_from_spectral_cross_correlation
+    (without the relative calibration).
 
+    The chi2 of all the lags and all the spectra are computed at once
+    with two matrix products, and the minima of the chi2 are refined with
+    one quadratic fit of all the spectra.
+
+    Args:
+        flux    : 2D array (nspec,nwave) of spectral flux as a function of wavelenght
+        wave    : 1D array of wavelength (in Angstrom)
+        refflux : 1D array of reference spectral flux
+
+    Optional:
+        ivar   : 2D array (nspec,nwave) of inverse variance of flux
+        hw     : half width in Angstrom of the cross-correlation chi2 scan, default=3A corresponding approximatly to 5 pixels for DESI
+
+    Returns:
+        delta : 1D array (nspec) of wavelength offsets in Angstrom
+        sigma : 1D array (nspec) of uncertainties on delta, 100 if the fit failed
+    """
     error_floor=0.01 #A
 
+    flux=np.atleast_2d(flux)
     if ivar is None :
         ivar=np.ones(flux.shape)
+    ivar=np.atleast_2d(ivar)
+    nspec=flux.shape[0]
+
     dwave=wave[1]-wave[0]
     ihw=int(hw/dwave)+1
-    chi2=np.zeros((2*ihw+1))
-    ndata=np.sum(ivar[ihw:-ihw]>0)
-    for i in range(2*ihw+1) :
-        d=i-ihw
-        b=ihw+d
-        e=-ihw+d
-        if e==0 :
-            e=wave.size
-        chi2[i] = np.sum(ivar[ihw:-ihw]*(flux[ihw:-ihw]-refflux[b:e])**2)
-
-
-    i=np.argmin(chi2)
-    if i<2 or i>=chi2.size-2 :
-        # something went wrong
-        delta=0.
-        sigma=100.
-    else :
-        # refine minimum
-        hh=int(0.6/dwave)+1
-        b=i-hh
-        e=i+hh+1
-        if b<0 :
-            b=0
-            e=b+2*hh+1
-        if e>2*ihw+1 :
-            e=2*ihw+1
-            b=e-(2*hh+1)
-        x=dwave*(np.arange(b,e)-ihw)
-        c=np.polyfit(x,chi2[b:e],2)
-        if c[0]>0 :
-            delta=-c[1]/(2.*c[0])
-            sigma=np.sqrt(1./c[0] + error_floor**2)
-            # do not scale error bars using chi2pdf because the
-            # two spectra do not necessarily match
-            # (for instance dark vs bright time sky spectrum)
-        else :
-            # something else went wrong
-            delta=0.
-            sigma=100.
-
-    '''
-    print("dw= %f +- %f"%(delta,sigma))
-    if np.abs(delta)>1. :
-        print("chi2/ndf=%f/%d=%f"%(chi2[i],(ndata-1),chi2[i]/(ndata-1)))
-        import matplotlib.pyplot as plt
-        x=dwave*(np.arange(chi2.size)-ihw)
-        plt.plot(x,chi2,"o-")
-        pol=np.poly1d(c)
-        xx=np.linspace(x[b],x[e-1],20)
-        plt.plot(xx,pol(xx))
-        plt.axvline(delta)
-        plt.axvline(delta-sigma)
-        plt.axvline(delta+sigma)
-        plt.show()
-    '''
+    nlag=2*ihw+1
+    tflux=flux[:,ihw:-ihw]
+    tivar=ivar[:,ihw:-ihw]
+    # chi2[:,i] = sum ivar*(flux-refflux shifted by i-ihw)**2 for all lags i at once,
+    # with matrix products of the flux and the sliding windows of refflux
+    windows=np.lib.stride_tricks.sliding_window_view(refflux,tflux.shape[1])
+    chi2 = np.sum(tivar*tflux**2,axis=1)[:,None] - 2*(tivar*tflux).dot(windows.T) + tivar.dot((windows**2).T)
+
+    delta=np.zeros(nspec)
+    sigma=100.*np.ones(nspec)
+
+    # refine minimum, with a quadratic fit of 2*hh+1 lags around it
+    # (something went wrong if the minimum is at the edge of the scan)
+    i=np.argmin(chi2,axis=1)
+    ok=(i>=2)&(i<nlag-2)
+    if not np.any(ok) :
+        return delta,sigma
+    hh=int(0.6/dwave)+1
+    b=np.clip(i[ok]-hh,0,nlag-(2*hh+1))
+    u=np.arange(2*hh+1)
+    c=np.polyfit(u,chi2[ok][np.arange(b.size)[:,None],b[:,None]+u].T,2)
+    # from lag index u to wavelength offset x = dwave*(b+u-ihw)
+    good=(c[0]>0)
+    tdelta=np.zeros(b.size)
+    tsigma=100.*np.ones(b.size)
+    tdelta[good]=dwave*(b[good]-ihw-c[1,good]/(2.*c[0,good]))
+    tsigma[good]=np.sqrt(dwave**2/c[0,good] + error_floor**2)
+    # do not scale error bars using chi2pdf because the
+    # two spectra do not necessarily match
+    # (for instance dark vs bright time sky spectrum)
+    delta[ok]=tdelta
+    sigma[ok]=tsigma
 
     return delta,sigma
 
@@ -303,7 +308,7 @@ def compute_dy_from_spectral_cross_correlations_of_frame(flux, ivar, wave , xcoe
     """
     Measures y offsets from a set of resampled spectra and a reference spectrum that are on the same wavelength grid.
     reference_flux is the assumed well calibrated spectrum.
-    Calls compute_dy_from_spectral_cross_correlation per fiber
+    Calls compute_dy_from_spectral_cross_correlation_batch per wavelength bin
 
     Args:
         flux    : 2D np.array of shape (nfibers,nwave)
@@ -325,51 +330,47 @@ def compute_dy_from_spectral_cross_correlations_of_frame(flux, ivar, wave , xcoe
     """
     log=get_logger()
 
-    x_for_dy=np.array([])
-    y_for_dy=np.array([])
-    dy=np.array([])
-    ey=np.array([])
-    fiber_for_dy=np.array([])
-    wave_for_dy=np.array([])
-
     nfibers = flux.shape[0]
 
-    for fiber in range(nfibers) :
-        if fiber %10==0 :
-            log.info("computing dy for fiber #%03d"%fiber)
+    # offsets of all fibers in each wavelength bin
+    dwave = np.zeros((nfibers,n_wavelength_bins))
+    err = np.zeros((nfibers,n_wavelength_bins))
+    block_wave = np.zeros((nfibers,n_wavelength_bins))
+    valid = np.zeros((nfibers,n_wavelength_bins),dtype=bool)
+    for b in range(n_wavelength_bins) :
+        wmin=wave[0]+((wave[-1]-wave[0])/n_wavelength_bins)*b
+        if b<n_wavelength_bins-1 :
+            wmax=wave[0]+((wave[-1]-wave[0])/n_wavelength_bins)*(b+1)
+        else :
+            wmax=wave[-1]
+        log.info("computing dy for wavelength bin #%d [%d,%d]"%(b,wmin,wmax))
+        # wave is sorted, wave[ok] = wave[wmin<=wave<=wmax]
+        ok=slice(np.searchsorted(wave,wmin),np.searchsorted(wave,wmax,side="right"))
+        weight=ivar[:,ok]*flux[:,ok]*(flux[:,ok]>0)
+        sw=np.sum(weight,axis=1)
+        fibers=np.where(sw>0)[0]
+        if fibers.size == 0 :
+            continue
 
-        for b in range(n_wavelength_bins) :
-            wmin=wave[0]+((wave[-1]-wave[0])/n_wavelength_bins)*b
-            if b<n_wavelength_bins-1 :
-                wmax=wave[0]+((wave[-1]-wave[0])/n_wavelength_bins)*(b+1)
-            else :
-                wmax=wave[-1]
-            ok=(wave>=wmin)&(wave<=wmax)
-            sw=np.sum(ivar[fiber,ok]*flux[fiber,ok]*(flux[fiber,ok]>0))
-            if sw<=0 :
-                continue
-
-            dwave,err = compute_dy_from_spectral_cross_correlation(flux[fiber,ok],wave[ok],reference_flux[ok],ivar=ivar[fiber,ok],hw=3.)
-
-            if err > 1 :
-                continue
-
-            block_wave = np.sum(ivar[fiber,ok]*flux[fiber,ok]*(flux[fiber,ok]>0)*wave[ok])/sw
-            rw = legx(block_wave,wavemin,wavemax)
-            tx = legval(rw,xcoef[fiber])
-            ty = legval(rw,ycoef[fiber])
-            eps=0.1
-            yp = legval(legx(block_wave+eps,wavemin,wavemax),ycoef[fiber])
-            dydw = (yp-ty)/eps
-            tdy = -dwave*dydw
-            tey = err*dydw
-
-            x_for_dy=np.append(x_for_dy,tx)
-            y_for_dy=np.append(y_for_dy,ty)
-            dy=np.append(dy,tdy)
-            ey=np.append(ey,tey)
-            fiber_for_dy=np.append(fiber_for_dy,fiber)
-            wave_for_dy=np.append(wave_for_dy,block_wave)
+        dwave[fibers,b],err[fibers,b] = compute_dy_from_spectral_cross_correlation_batch(flux[fibers,ok],wave[ok],reference_flux[ok],ivar=ivar[fibers,ok],hw=3.)
+        block_wave[fibers,b] = weight[fibers].dot(wave[ok])/sw[fibers]
+        valid[fibers,b] = (err[fibers,b]<=1)
+
+    # in the same order as the loop on fibers and wavelength bins
+    fiber_for_dy,b = np.where(valid)
+    dwave = dwave[fiber_for_dy,b]
+    err = err[fiber_for_dy,b]
+    wave_for_dy = block_wave[fiber_for_dy,b]
+
+    rw = legx(wave_for_dy,wavemin,wavemax)
+    x_for_dy = legval(rw,xcoef[fiber_for_dy].T,tensor=False)
+    y_for_dy = legval(rw,ycoef[fiber_for_dy].T,tensor=False)
+    eps=0.1
+    yp = legval(legx(wave_for_dy+eps,wavemin,wavemax),ycoef[fiber_for_dy].T,tensor=False)
+    dydw = (yp-y_for_dy)/eps
+    dy = -dwave*dydw
+    ey = err*dydw
+    fiber_for_dy = fiber_for_dy.astype(float)
 
     return x_for_dy,y_for_dy,dy,ey,fiber_for_dy,wave_for_dy
 
@@ -518,12 +519,15 @@ def compute_dx_from_cross_dispersion_profiles(xcoef,ycoef,wavemin,wavemax, image
 
 
 
+    # traces of all fibers at once
+    all_ty = legval(rwave, ycoef[fibers].T)/image_rebin
+    all_tx = legval(rwave, xcoef[fibers].T)
+
     for f,fiber in enumerate(fibers) :
         # log.info("computing dx for fiber #%03d"%fiber)
 
-        # the following 5 lines take 0.25 sec for all 500 fibers
-        ty = legval(rwave, ycoef[fiber])/image_rebin
-        tx = legval(rwave, xcoef[fiber])
+        ty = all_ty[f]
+        tx = all_tx[f]
         wave_of_y  = np.interp(y,ty,twave)
         x_of_y     = np.interp(y,ty,tx)
 
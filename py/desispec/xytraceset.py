@@ -5,8 +5,16 @@ desispec.xytraceset
 Lightweight wrapper class for trace coordinates and wavelength solution, to be returned by :func:`~desispec.io.xytraceset.read_xytraceset`.
 """
 
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from numpy.polynomial.legendre import legvander
 from specter.util.traceset import TraceSet 
 
+# number of batched evaluations kept in the cache of each XYTraceSet
+_cache_size = 16
+
 class XYTraceSet(object):
     def __init__(self, xcoef, ycoef, wavemin, wavemax, npix_y, xsigcoef = None, ysigcoef = None, meta = None) :
         """
@@ -44,6 +52,7 @@ class XYTraceSet(object):
         
         self.wave_vs_y_traceset = None
         self.meta = meta
+        self._cache = OrderedDict()
 
     def x_vs_wave(self,fiber,wavelength) :
         return self.x_vs_wave_traceset.eval(fiber,wavelength)
@@ -71,6 +80,72 @@ class XYTraceSet(object):
     def x_vs_y(self,fiber,y) :
         return self.x_vs_wave(fiber,self.wave_vs_y(fiber,y))
 
+    def _eval_all(self,traceset,x) :
+        """
+        Evaluates a traceset for all the fibers at once
+
+        The Legendre polynomials of the grid are computed once and multiplied
+        by the (nspec,ncoef) coefficient array. The results are cached, keyed
+        by the grid and the coefficients, and returned as read-only arrays.
+
+        Args:
+            traceset : specter TraceSet
+            x : 1D array, grid common to all fibers, or 2D array (nspec,nx), one grid per fiber
+
+        Returns:
+            2D array (nspec,nx)
+        """
+        x = np.asarray(x,dtype=np.float64)
+        coef = traceset._coeff
+        key = (x.shape, traceset._xmin, traceset._xmax,
+               hashlib.sha1(x.tobytes()).hexdigest(),
+               hashlib.sha1(np.ascontiguousarray(coef).tobytes()).hexdigest())
+        if key in self._cache :
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        rx = 2.*(x-traceset._xmin)/(traceset._xmax-traceset._xmin)-1.
+        vander = legvander(rx,coef.shape[1]-1)
+        if x.ndim == 2 :
+            res = np.einsum("ijk,ik->ij",vander,coef)
+        else :
+            res = coef.dot(vander.T)
+        res.flags.writeable = False
+        self._cache[key] = res
+        while len(self._cache) > _cache_size :
+            self._cache.popitem(last=False)
+        return res
+
+    def x_vs_wave_all(self,wavelength) :
+        """x of all fibers (nspec,nwave) for a 1D wavelength grid, or a 2D (nspec,nwave) array of wavelength"""
+        return self._eval_all(self.x_vs_wave_traceset,wavelength)
+
+    def y_vs_wave_all(self,wavelength) :
+        """y of all fibers (nspec,nwave) for a 1D wavelength grid, or a 2D (nspec,nwave) array of wavelength"""
+        return self._eval_all(self.y_vs_wave_traceset,wavelength)
+
+    def xsig_vs_wave_all(self,wavelength) :
+        """xsig of all fibers (nspec,nwave) for a 1D wavelength grid, or a 2D (nspec,nwave) array of wavelength"""
+        if self.xsig_vs_wave_traceset is None :
+            raise RuntimeError("no xsig coefficents were read in the PSF")
+        return self._eval_all(self.xsig_vs_wave_traceset,wavelength)
+
+    def ysig_vs_wave_all(self,wavelength) :
+        """ysig of all fibers (nspec,nwave) for a 1D wavelength grid, or a 2D (nspec,nwave) array of wavelength"""
+        if self.ysig_vs_wave_traceset is None :
+            raise RuntimeError("no ysig coefficents were read in the PSF")
+        return self._eval_all(self.ysig_vs_wave_traceset,wavelength)
+
+    def wave_vs_y_all(self,y) :
+        """wavelength of all fibers (nspec,ny) for a 1D grid of y, or a 2D (nspec,ny) array of y"""
+        if self.wave_vs_y_traceset is None :
+            self.wave_vs_y_traceset = self.y_vs_wave_traceset.invert()
+        return self._eval_all(self.wave_vs_y_traceset,y)
+
+    def x_vs_y_all(self,y) :
+        """x of all fibers (nspec,ny) for a 1D grid of y, or a 2D (nspec,ny) array of y"""
+        return self.x_vs_wave_all(self.wave_vs_y_all(y))
+
     def xsig_vs_y(self,fiber,y) :
         return self.xsig_vs_wave(fiber,self.wave_vs_y(fiber,y))
     